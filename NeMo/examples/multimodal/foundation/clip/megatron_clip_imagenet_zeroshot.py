@@ -30,6 +30,7 @@ from nemo.collections.multimodal.data.clip.clip_dataset import (
 )
 from nemo.collections.multimodal.data.clip.imagenet_zeroshot_data import imagenet_classnames, openai_imagenet_template
 from nemo.collections.multimodal.models.clip.megatron_clip_models import MegatronCLIPModel
+from nemo.collections.multimodal.parts.clip.zero_shot import ZeroShotClassifier
 from nemo.collections.multimodal.parts.utils import setup_trainer_and_model_for_inference
 from nemo.collections.nlp.modules.common.megatron.utils import average_losses_across_data_parallel_group
 from nemo.collections.nlp.parts.nlp_overrides import NLPDDPStrategy, NLPSaveRestoreConnector
@@ -95,18 +96,15 @@ def main(cfg) -> None:
         cfg.model["text"] = model.cfg.text
 
     imagenet_val = build_imagenet_validation_dataloader(cfg.model, model.tokenizer)
+    # build imagenet classification classifier, with the class prompts sharded across data parallel ranks
+    text_dataset = imagenet_val["texts"].dataset
+    classifier = ZeroShotClassifier(
+        text_dataset, text_dataset.num_templates, process_group=parallel_state.get_data_parallel_group(),
+    )(text_encoder, device=torch.cuda.current_device(), autocast_dtype=autocast_dtype)
+
     with torch.no_grad(), torch.cuda.amp.autocast(
         enabled=autocast_dtype in (torch.half, torch.bfloat16), dtype=autocast_dtype,
     ):
-        # build imagenet classification classifier
-        classifier = []
-        for texts in imagenet_val["texts"]:
-            texts = texts.cuda(non_blocking=True)
-            class_embeddings = text_encoder(texts)
-            class_embedding = F.normalize(class_embeddings, dim=-1).mean(dim=0)
-            class_embedding /= class_embedding.norm()
-            classifier.append(class_embedding)
-        classifier = torch.stack(classifier, dim=1)
 
         top1, top5, n = 0.0, 0.0, 0.0
         for images, target in tqdm(imagenet_val["images"], desc="Imagenet Zero-shot Evaluation", leave=False):
@@ -20,6 +20,7 @@ from nemo.collections.multimodal.models.controlnet.controlnet import MegatronCon
 from nemo.collections.multimodal.models.controlnet.util import get_preprocessing_function
 from nemo.collections.multimodal.models.stable_diffusion.samplers.ddim import DDIMSampler
 from nemo.collections.multimodal.models.stable_diffusion.samplers.plms import PLMSSampler
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import configure_vae_tiling
 from nemo.collections.multimodal.parts.utils import setup_trainer_and_model_for_inference
 from nemo.core.config import hydra_runner
 
@@ -99,6 +100,9 @@ def pipeline(model, cfg, rng=None, verbose=True):
     guess_mode = cfg.model.get('guess_mode', False)
     hint_image_size = cfg.infer.get('hint_image_size', 512)
     control_image_preprocess = cfg.infer.get('control_image_preprocess', None)
+    vae_tiling = cfg.infer.get('vae_tiling', None)
+
+    configure_vae_tiling(model, vae_tiling)
 
     # get autocast_dtype
     if cfg.trainer.precision in ['bf16', 'bf16-mixed']:
@@ -35,6 +35,7 @@ from nemo.collections.multimodal.models.stable_diffusion.samplers.k_diffusion im
     DiscreteEpsDDPMDenoiser,
     sample_euler_ancestral,
 )
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import configure_vae_tiling
 from nemo.collections.multimodal.parts.utils import setup_trainer_and_model_for_inference
 from nemo.collections.nlp.parts.nlp_overrides import NLPDDPStrategy, NLPSaveRestoreConnector
 from nemo.core.config import hydra_runner
@@ -77,6 +78,7 @@ def main(cfg):
 
     # inference use the latent diffusion part of megatron wrapper
     model = megatron_diffusion_model.model
+    configure_vae_tiling(model, edit_cfg.get('vae_tiling', None))
     model_wrap = DiscreteEpsDDPMDenoiser(model)
     model_wrap_cfg = CFGDenoiser(model_wrap)
     null_token = model.get_learned_conditioning([""])
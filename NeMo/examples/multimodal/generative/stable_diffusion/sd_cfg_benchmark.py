@@ -0,0 +1,103 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the classifier-free guidance execution strategies of the Stable Diffusion samplers.
+Reports peak accelerator memory and sampling steps/sec of every strategy, e.g.
+
+    python sd_cfg_benchmark.py model.restore_from_path=<path/to/sd.nemo> \
+        infer.num_images_per_prompt=8 infer.cfg_truncation_steps=10
+"""
+import time
+
+import torch
+
+from nemo.collections.multimodal.models.stable_diffusion.ldm.ddpm import MegatronLatentDiffusion
+from nemo.collections.multimodal.models.stable_diffusion.samplers.base_sampler import CFG_STRATEGIES
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import encode_prompt, initialize_sampler
+from nemo.collections.multimodal.parts.utils import setup_trainer_and_model_for_inference
+from nemo.core.config import hydra_runner
+
+
+@hydra_runner(config_path='conf', config_name='sd_infer')
+def main(cfg):
+    def model_cfg_modifier(model_cfg):
+        model_cfg.precision = cfg.trainer.precision
+        model_cfg.ckpt_path = None
+        model_cfg.inductor = False
+        model_cfg.unet_config.use_flash_attention = False
+        model_cfg.unet_config.from_pretrained = None
+        model_cfg.first_stage_config.from_pretrained = None
+
+    trainer, megatron_diffusion_model = setup_trainer_and_model_for_inference(
+        model_provider=MegatronLatentDiffusion, cfg=cfg, model_cfg_modifier=model_cfg_modifier
+    )
+    model = megatron_diffusion_model.model
+    model.cuda().eval()
+
+    unconditional_guidance_scale = cfg.infer.get("unconditional_guidance_scale", 7.5)
+    batch_size = cfg.infer.get('num_images_per_prompt', 1)
+    height = cfg.infer.get('height', 512)
+    width = cfg.infer.get('width', 512)
+    downsampling_factor = cfg.infer.get('down_factor', 8)
+    sampler_type = cfg.infer.get('sampler_type', 'DDIM')
+    inference_steps = cfg.infer.get('inference_steps', 50)
+    cfg_truncation_steps = cfg.infer.get('cfg_truncation_steps', 0)
+    num_repeats = cfg.infer.get('benchmark_repeats', 3)
+    prompt = cfg.infer.prompts[0]
+
+    in_channels = model.model.diffusion_model.in_channels
+    latent_shape = [in_channels, height // downsampling_factor, width // downsampling_factor]
+    autocast_enabled = cfg.trainer.precision in [16, '16', '16-mixed', 'bf16', 'bf16-mixed']
+    autocast_dtype = torch.bfloat16 if str(cfg.trainer.precision).startswith('bf16') else torch.half
+
+    results = {}
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=autocast_enabled, dtype=autocast_dtype):
+        cond, u_cond = encode_prompt(model.cond_stage_model, prompt, unconditional_guidance_scale, batch_size)
+        for cfg_strategy in CFG_STRATEGIES:
+            sampler = initialize_sampler(
+                model, sampler_type.upper(), cfg_strategy=cfg_strategy, cfg_truncation_steps=cfg_truncation_steps
+            )
+            rng = torch.Generator().manual_seed(cfg.infer.seed)
+            timings = []
+            torch.cuda.reset_peak_memory_stats()
+            # the first run is a warmup
+            for _ in range(num_repeats + 1):
+                latents = torch.randn([batch_size, *latent_shape], generator=rng).cuda()
+                torch.cuda.synchronize()
+                tic = time.perf_counter()
+                sampler.sample(
+                    S=inference_steps,
+                    conditioning=cond,
+                    batch_size=batch_size,
+                    shape=latent_shape,
+                    verbose=False,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=u_cond,
+                    x_T=latents,
+                )
+                torch.cuda.synchronize()
+                timings.append(time.perf_counter() - tic)
+            sampling_time = sum(timings[1:]) / num_repeats
+            results[cfg_strategy] = {
+                'peak-memory-MB': torch.cuda.max_memory_allocated() / 1024 ** 2,
+                'steps-per-sec': inference_steps / sampling_time,
+                'images-per-sec': batch_size / sampling_time,
+            }
+
+    for cfg_strategy, metrics in results.items():
+        print(f'{cfg_strategy}: ' + ', '.join(f'{key}={value:.2f}' for key, value in metrics.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Precompute the AutoencoderKL latent moments and the text embeddings of a webdataset for Stable Diffusion and
+ControlNet training, and store them as memory-mappable shards (see `precached_dataset.py`). Launch one process
+per GPU, every rank encodes a disjoint subset of the raw shards, e.g.
+
+    torchrun --nproc_per_node=8 sd_precache.py precache.output_dir=/datasets/coyo_precached
+
+Train on the result with
+
+    model.first_stage_key=images_moments_encoded model.cond_stage_key=captions_encoded \
+    model.data.precached_format=memmap model.data.train.dataset_path=[/datasets/coyo_precached/index.json]
+"""
+import itertools
+import os
+
+import torch
+import torch.distributed as dist
+import webdataset as wds
+from omegaconf import OmegaConf
+from webdataset import warn_and_continue
+
+from nemo.collections.multimodal.data.common.webdataset import pil_loader
+from nemo.collections.multimodal.data.stable_diffusion.augmentation.augmentations import construct_image_augmentations
+from nemo.collections.multimodal.data.stable_diffusion.precached_dataset import (
+    PrecachedShardWriter,
+    merge_precached_indices,
+)
+from nemo.collections.multimodal.models.stable_diffusion.ldm.ddpm import LatentDiffusion
+from nemo.core.config import hydra_runner
+from nemo.utils import logging
+
+
+def build_dataloader(cfg, urls):
+    img_transform = construct_image_augmentations(cfg.data.augmentations)
+    keys = [cfg.data.image_key, cfg.data.text_key]
+    if cfg.data.get('hint_key'):
+        keys.append(cfg.data.hint_key)
+
+    def transform_fn(sample):
+        image, text = sample[0], sample[1]
+        out = [img_transform(image), text]
+        if len(sample) > 2:
+            out.append(img_transform(sample[2]))
+        return tuple(out)
+
+    dataset = (
+        wds.WebDataset(urls, handler=warn_and_continue, shardshuffle=False)
+        .decode(pil_loader, handler=warn_and_continue)
+        .to_tuple(*keys, handler=warn_and_continue)
+        .map(transform_fn, handler=warn_and_continue)
+        .batched(cfg.precache.batch_size, partial=True)
+    )
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, num_workers=min(cfg.precache.num_workers, len(urls)), pin_memory=True
+    )
+
+
+@hydra_runner(config_path='conf', config_name='sd_precache')
+def main(cfg):
+    logging.info(f'\n{OmegaConf.to_yaml(cfg)}')
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        dist.init_process_group(backend='gloo')
+    device = torch.device(cfg.precache.device)
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+
+    first_stage_model = LatentDiffusion.from_config_dict(cfg.model.first_stage_config).to(device).eval()
+    cond_stage_model = LatentDiffusion.from_config_dict(cfg.model.cond_stage_config).to(device).eval()
+
+    urls = list(itertools.chain.from_iterable(map(wds.shardlists.expand_urls, cfg.data.dataset_path)))
+    rank_urls = urls[rank::world_size]
+    logging.info(f'Rank {rank} encodes {len(rank_urls)} of {len(urls)} shards')
+
+    autocast_enabled = cfg.precache.precision in [16, '16', '16-mixed', 'bf16', 'bf16-mixed']
+    autocast_dtype = torch.bfloat16 if str(cfg.precache.precision).startswith('bf16') else torch.half
+    writer = PrecachedShardWriter(
+        cfg.precache.output_dir, prefix=f'r{rank:05d}', samples_per_shard=cfg.precache.samples_per_shard
+    )
+    if rank_urls:
+        dataloader = build_dataloader(cfg, rank_urls)
+        with torch.no_grad(), torch.autocast(device.type, enabled=autocast_enabled, dtype=autocast_dtype):
+            for step, batch in enumerate(dataloader):
+                images, texts = batch[0], batch[1]
+                moments = first_stage_model.encode(images.to(device, non_blocking=True)).parameters
+                embeddings = cond_stage_model.encode(list(texts))
+                arrays = {'latents': moments.half(), 'text': embeddings.half()}
+                if len(batch) > 2:
+                    # ControlNet consumes hints channels last
+                    arrays['hint'] = batch[2].permute(0, 2, 3, 1).half()
+                writer.write(arrays)
+                if step % 100 == 0:
+                    logging.info(f'Rank {rank}: {writer.num_samples} samples encoded')
+    index = writer.close()
+    logging.info(f'Rank {rank}: wrote {index["total_samples"]} samples in {len(index["shards"])} shards')
+
+    if world_size > 1:
+        dist.barrier()
+    if rank == 0:
+        index = merge_precached_indices(cfg.precache.output_dir)
+        logging.info(
+            f'Precached {index["total_samples"]} samples to {cfg.precache.output_dir} with fields {index["fields"]}'
+        )
+
+
+if __name__ == '__main__':
+    main()
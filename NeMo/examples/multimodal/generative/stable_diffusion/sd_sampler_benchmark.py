@@ -0,0 +1,168 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the Stable Diffusion samplers on a tiny randomly initialised UNet, runnable on CPU.
+
+For every sampler and number of steps it reports
+    - wall time of a sampling run,
+    - number of function evaluations (UNet calls),
+    - per-step overhead spent outside of the UNet,
+    - convergence error (RMSE) against a run of the same sampler with `reference_steps` steps,
+and writes the results to `benchmark.output_path` as JSON, e.g.
+
+    python sd_sampler_benchmark.py benchmark.steps=[10,20] benchmark.samplers=[DDIM,DPM]
+"""
+import json
+import time
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from nemo.collections.multimodal.models.stable_diffusion.samplers import k_diffusion
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.openaimodel import UNetModel
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import initialize_sampler
+from nemo.collections.multimodal.parts.stable_diffusion.tiny_diffusion import TinyLatentDiffusion
+from nemo.core.config import hydra_runner
+from nemo.utils import logging
+
+K_DIFFUSION_SAMPLERS = {
+    'K_EULER': k_diffusion.sample_euler,
+    'K_HEUN': k_diffusion.sample_heun,
+    'K_LMS': k_diffusion.sample_lms,
+    'K_DPMPP_2M': k_diffusion.sample_dpmpp_2m,
+}
+
+
+class CFGDenoiser(nn.Module):
+    """Classifier-free guidance on top of a k-diffusion denoiser."""
+
+    def __init__(self, denoiser):
+        super().__init__()
+        self.denoiser = denoiser
+
+    def forward(self, x, sigma, cond, uncond, guidance_scale):
+        x_in = torch.cat([x] * 2)
+        sigma_in = torch.cat([sigma] * 2)
+        c_in = torch.cat([uncond, cond])
+        denoised_uncond, denoised = self.denoiser(x_in, sigma_in, cond=c_in).chunk(2)
+        return denoised_uncond + guidance_scale * (denoised - denoised_uncond)
+
+
+def build_model(cfg):
+    unet = UNetModel(**OmegaConf.to_container(cfg.unet))
+    model = TinyLatentDiffusion(
+        unet, timesteps=cfg.timesteps, linear_start=cfg.linear_start, linear_end=cfg.linear_end
+    )
+    return model.to(cfg.benchmark.device).eval()
+
+
+def run_sampler(name, model, x_T, cond, uncond, steps, cfg):
+    guidance_scale = cfg.benchmark.unconditional_guidance_scale
+    if name in K_DIFFUSION_SAMPLERS:
+        denoiser = CFGDenoiser(k_diffusion.DiscreteEpsDDPMDenoiser(model))
+        sigmas = denoiser.denoiser.get_sigmas(steps)
+        return K_DIFFUSION_SAMPLERS[name](
+            denoiser,
+            x_T * sigmas[0],
+            sigmas,
+            extra_args={'cond': cond, 'uncond': uncond, 'guidance_scale': guidance_scale},
+            disable=True,
+        )
+    sampler = initialize_sampler(model, name)
+    samples, _ = sampler.sample(
+        S=steps,
+        conditioning=cond,
+        batch_size=x_T.shape[0],
+        shape=list(x_T.shape[1:]),
+        verbose=False,
+        unconditional_guidance_scale=guidance_scale,
+        unconditional_conditioning=uncond,
+        eta=0.0,
+        x_T=x_T,
+        parallelism=min(cfg.benchmark.parallelism, steps),
+        tolerance=cfg.benchmark.tolerance,
+    )
+    return samples
+
+
+def benchmark_sampler(name, model, x_T, cond, uncond, steps, cfg):
+    # warmup
+    run_sampler(name, model, x_T, cond, uncond, steps, cfg)
+
+    wall_times, model_times, function_evals = [], [], []
+    for _ in range(cfg.benchmark.repeats):
+        model.reset_counters()
+        tic = time.perf_counter()
+        samples = run_sampler(name, model, x_T, cond, uncond, steps, cfg)
+        if samples.is_cuda:
+            torch.cuda.synchronize()
+        wall_times.append(time.perf_counter() - tic)
+        model_times.append(model.model_time)
+        function_evals.append(model.num_function_evals)
+
+    wall_time = sum(wall_times) / len(wall_times)
+    model_time = sum(model_times) / len(model_times)
+    return (
+        samples,
+        {
+            'steps': steps,
+            'wall-time': wall_time,
+            'model-time': model_time,
+            'function-evals': function_evals[-1],
+            'per-step-overhead': (wall_time - model_time) / steps,
+            'steps-per-sec': steps / wall_time,
+        },
+    )
+
+
+@hydra_runner(config_path='conf', config_name='sd_sampler_benchmark')
+def main(cfg):
+    torch.manual_seed(cfg.benchmark.seed)
+    device = cfg.benchmark.device
+    model = build_model(cfg)
+
+    batch_size = cfg.benchmark.batch_size
+    latent_shape = [cfg.unet.in_channels, cfg.benchmark.latent_size, cfg.benchmark.latent_size]
+    context_shape = [batch_size, cfg.benchmark.context_length, cfg.unet.context_dim]
+    x_T = torch.randn([batch_size, *latent_shape], device=device)
+    cond = torch.randn(context_shape, device=device)
+    uncond = torch.randn(context_shape, device=device)
+
+    results = {}
+    with torch.no_grad():
+        for name in cfg.benchmark.samplers:
+            reference = run_sampler(name, model, x_T, cond, uncond, cfg.benchmark.reference_steps, cfg)
+            results[name] = []
+            for steps in cfg.benchmark.steps:
+                samples, metrics = benchmark_sampler(name, model, x_T, cond, uncond, steps, cfg)
+                metrics['rmse-vs-reference'] = (samples - reference).pow(2).mean().sqrt().item()
+                metrics['relative-error-vs-reference'] = ((samples - reference).norm() / reference.norm()).item()
+                results[name].append(metrics)
+                logging.info(f'{name}: {metrics}')
+
+    output = {
+        'device': device,
+        'batch_size': batch_size,
+        'latent_shape': latent_shape,
+        'reference_steps': cfg.benchmark.reference_steps,
+        'results': results,
+    }
+    with open(cfg.benchmark.output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    logging.info(f'Sampler benchmark results written to {cfg.benchmark.output_path}')
+
+
+if __name__ == "__main__":
+    main()
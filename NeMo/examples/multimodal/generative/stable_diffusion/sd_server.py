@@ -0,0 +1,87 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Long-running Stable Diffusion server. The model is loaded once, and compatible requests are batched together.
+
+    python sd_server.py model.restore_from_path=<path/to/sd.nemo> server.port=5000
+
+    curl -X POST localhost:5000/generate -d '{"prompt": "a corgi", "inference_steps": 25, "seed": 1}'
+    curl -X POST localhost:5000/generate -d '{"requests": [{"prompt": "a corgi"}, {"prompt": "a cat"}]}'
+
+Every request gets one JSON line with its base64 PNG images and latency metrics, streamed as soon as it is done.
+"""
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.multimodal.models.stable_diffusion.ldm.ddpm import MegatronLatentDiffusion
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import configure_vae_tiling
+from nemo.collections.multimodal.parts.stable_diffusion.server import (
+    GenerationRequest,
+    StableDiffusionServer,
+    run_http_server,
+)
+from nemo.collections.multimodal.parts.utils import setup_trainer_and_model_for_inference
+from nemo.core.config import hydra_runner
+
+
+@hydra_runner(config_path='conf', config_name='sd_server')
+def main(cfg):
+    def model_cfg_modifier(model_cfg):
+        model_cfg.precision = cfg.trainer.precision
+        model_cfg.ckpt_path = None
+        model_cfg.inductor = False
+        model_cfg.unet_config.use_flash_attention = False
+        model_cfg.unet_config.from_pretrained = None
+        model_cfg.first_stage_config.from_pretrained = None
+
+    torch.backends.cuda.matmul.allow_tf32 = True
+    trainer, megatron_diffusion_model = setup_trainer_and_model_for_inference(
+        model_provider=MegatronLatentDiffusion, cfg=cfg, model_cfg_modifier=model_cfg_modifier
+    )
+    model = megatron_diffusion_model.model
+    model.cuda().eval()
+
+    if cfg.trainer.precision in ['bf16', 'bf16-mixed']:
+        autocast_dtype = torch.bfloat16
+    elif cfg.trainer.precision in [16, '16', '16-mixed']:
+        autocast_dtype = torch.half
+    else:
+        autocast_dtype = torch.float
+
+    server_cfg = cfg.server
+    configure_vae_tiling(model, server_cfg.get('vae_tiling', None))
+    if server_cfg.get('token_merging_ratio', None) is not None:
+        model.model.diffusion_model.enable_token_merging(server_cfg.token_merging_ratio)
+
+    server = StableDiffusionServer(
+        model,
+        sampler_type=server_cfg.get('sampler_type', 'DDIM'),
+        eta=server_cfg.get('eta', 0.0),
+        down_factor=server_cfg.get('down_factor', 8),
+        max_batch_size=server_cfg.get('max_batch_size', 8),
+        batch_window_ms=server_cfg.get('batch_window_ms', 20),
+        autocast_dtype=autocast_dtype,
+        conditioning_cache_size=server_cfg.get('conditioning_cache_size', None),
+        max_queue_size=server_cfg.get('max_queue_size', 256),
+    )
+    warmup = [
+        GenerationRequest(prompt='warmup', **OmegaConf.to_container(request))
+        for request in server_cfg.get('warmup', [])
+    ]
+    server.start(warmup_requests=warmup)
+    run_http_server(server, host=server_cfg.get('host', '0.0.0.0'), port=server_cfg.get('port', 5000))
+
+
+if __name__ == "__main__":
+    main()
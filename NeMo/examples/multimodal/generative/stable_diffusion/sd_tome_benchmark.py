@@ -0,0 +1,98 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of UNet forward latency versus token merging ratio on a tiny randomly initialised UNet, runnable on CPU.
+
+For every latent size and merge ratio it reports
+    - mean latency of a UNet forward,
+    - speedup over the forward without token merging,
+    - relative error of the output against the forward without token merging,
+and writes the results to `benchmark.output_path` as JSON, e.g.
+
+    python sd_tome_benchmark.py benchmark.latent_sizes=[64,96] benchmark.merge_ratios=[0,0.5]
+"""
+import json
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.openaimodel import UNetModel
+from nemo.core.config import hydra_runner
+from nemo.utils import logging
+
+
+def build_unet(cfg):
+    unet = UNetModel(**OmegaConf.to_container(cfg.unet))
+    # zero-initialized output projections would make the UNet output identically zero
+    with torch.no_grad():
+        for param in unet.parameters():
+            if torch.all(param == 0):
+                param.normal_(std=0.02)
+    return unet.to(cfg.benchmark.device).eval()
+
+
+def time_forward(unet, x, t, context, repeats):
+    # warmup
+    out = unet(x, t, context=context)
+    latencies = []
+    for _ in range(repeats):
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        tic = time.perf_counter()
+        out = unet(x, t, context=context)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - tic)
+    return out, sum(latencies) / len(latencies)
+
+
+@hydra_runner(config_path='conf', config_name='sd_tome_benchmark')
+def main(cfg):
+    torch.manual_seed(cfg.benchmark.seed)
+    device = cfg.benchmark.device
+    unet = build_unet(cfg)
+    batch_size = cfg.benchmark.batch_size
+
+    results = {}
+    with torch.no_grad():
+        for latent_size in cfg.benchmark.latent_sizes:
+            x = torch.randn(batch_size, cfg.unet.in_channels, latent_size, latent_size, device=device)
+            t = torch.full((batch_size,), 500, device=device, dtype=torch.long)
+            context = torch.randn(batch_size, cfg.benchmark.context_length, cfg.unet.context_dim, device=device)
+
+            unet.disable_token_merging()
+            baseline, baseline_latency = time_forward(unet, x, t, context, cfg.benchmark.repeats)
+            results[latent_size] = []
+            for ratio in cfg.benchmark.merge_ratios:
+                unet.enable_token_merging(ratio, seed=cfg.benchmark.seed)
+                out, latency = time_forward(unet, x, t, context, cfg.benchmark.repeats)
+                metrics = {
+                    'merge-ratio': ratio,
+                    'latency': latency,
+                    'speedup': baseline_latency / latency,
+                    'relative-error': ((out - baseline).norm() / baseline.norm()).item(),
+                }
+                results[latent_size].append(metrics)
+                logging.info(f'latent size {latent_size}: {metrics}')
+            unet.disable_token_merging()
+
+    output = {'device': device, 'batch_size': batch_size, 'results': results}
+    with open(cfg.benchmark.output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    logging.info(f'Token merging benchmark results written to {cfg.benchmark.output_path}')
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ from torch.utils.data import DataLoader, Dataset
 from nemo.collections.multimodal.models.neva.neva_model import MegatronNevaModel
 from nemo.collections.nlp.modules.common.megatron.megatron_init import fake_initialize_model_parallel
 from nemo.collections.nlp.modules.common.megatron_web_server import get_demo
+from nemo.collections.nlp.modules.common.text_generation_prefix_cache import PrefixKVCache
 from nemo.collections.nlp.modules.common.text_generation_server import MegatronServer
 from nemo.collections.nlp.modules.common.text_generation_utils import generate
 from nemo.collections.nlp.modules.common.transformer.text_generation import LengthParam, SamplingParam
@@ -262,6 +263,10 @@ def main(cfg) -> None:
     except AttributeError:
         pass
 
+    if cfg.prefix_cache.enabled:
+        # the keys and values of the prompt prefixes are reused, those after an image only with the same image
+        model.prefix_kv_cache = PrefixKVCache(cfg.prefix_cache.max_memory_mb, cfg.prefix_cache.block_size)
+
     length_params: LengthParam = {
         "max_length": cfg.inference.tokens_to_generate,
         "min_length": cfg.inference.min_tokens_to_generate,
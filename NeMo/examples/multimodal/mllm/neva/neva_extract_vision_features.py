@@ -0,0 +1,177 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compute the features of the frozen vision encoder for all the images of the fine-tuning data once, and write them
+to the feature store read by the NeVA datasets when `model.data.vision_features` is set. Uses the same config as
+fine-tuning, so that the features match the vision encoder and image preprocessing of the model:
+
+```
+python examples/multimodal/mllm/neva/neva_extract_vision_features.py \
+    model.data.data_path=/data/llava_instruct_150k.json \
+    model.data.vision_features=/data/vision_features \
+    model.data.num_workers=16 \
+    +model.data.vision_features_batch_size=128
+```
+
+The features do not depend on the language model, whose weights are not loaded. With several data parallel
+ranks, every rank computes the features of a part of the images and writes them to a shard of its own, which the
+first rank merges into the store. Then fine-tune with the same `model.data.vision_features`.
+"""
+import json
+
+import torch
+import torch.multiprocessing as mp
+from omegaconf.omegaconf import open_dict
+from torch.utils.data import DataLoader, Dataset
+
+from nemo.collections.multimodal.data.neva.neva_dataset import (
+    get_multimodal_cfg,
+    make_image_loader,
+    parse_steerlm_record,
+    process_image,
+)
+from nemo.collections.multimodal.data.neva.neva_feature_store import (
+    VisionFeatureShardWriter,
+    feature_store_dir,
+    merge_vision_feature_shards,
+    remove_vision_feature_shards,
+    vision_config,
+)
+from nemo.collections.multimodal.models.neva.neva_model import MegatronNevaModel
+from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import MMapIndexedDataset
+from nemo.collections.nlp.parts.megatron_trainer_builder import MegatronTrainerBuilder
+from nemo.core.config import hydra_runner
+from nemo.utils import logging
+
+try:
+    from megatron.core import parallel_state
+
+    HAVE_MEGATRON_CORE = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_MEGATRON_CORE = False
+
+mp.set_start_method("spawn", force=True)
+
+
+def read_image_names(data_cfg):
+    """Names of all the images of the conversations, from the pre-tokenized data if set."""
+    names = set()
+    if data_cfg.get("data_prefix", None):
+        images = MMapIndexedDataset(f'{data_cfg.data_prefix}_images', skip_warmup=True)
+        names.update(images[i].tobytes().decode('utf-8') for i in range(len(images)))
+    elif data_cfg.data_path.endswith(".json"):
+        with open(data_cfg.data_path) as f:
+            for record in json.load(f):
+                images = record.get('image', [])
+                names.update(images if isinstance(images, list) else [images])
+    elif data_cfg.data_path.endswith(".jsonl"):
+        with open(data_cfg.data_path) as f:
+            for line in f:
+                names.update(parse_steerlm_record(json.loads(line), data_cfg.image_folder)['image'])
+    else:
+        raise ValueError(f"Formatting of {data_cfg.data_path} is not supported in Neva.")
+    return sorted(names)
+
+
+class ImageDataset(Dataset):
+    def __init__(self, image_names, multimodal_cfg):
+        super().__init__()
+        self.image_names = image_names
+        self.multimodal_cfg = multimodal_cfg
+        self.image_loader = make_image_loader(multimodal_cfg)
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def __getitem__(self, i):
+        image = self.image_loader.open_image(self.image_names[i])
+        if image is None:
+            raise FileNotFoundError(f"Image {self.image_names[i]} could not be found!")
+        pixel_values = process_image(
+            image, self.multimodal_cfg["image_processor"], self.multimodal_cfg['image_aspect_ratio']
+        )
+        return self.image_names[i], pixel_values
+
+
+@hydra_runner(config_path="conf", config_name="neva_finetune")
+def main(cfg) -> None:
+    data_cfg = cfg.model.data
+    assert data_cfg.get("vision_features", None), 'Set model.data.vision_features to the directory of the features'
+    if data_cfg.image_aspect_ratio == 'keep':
+        raise ValueError("image_aspect_ratio 'keep' gives every image its own number of features")
+
+    trainer = MegatronTrainerBuilder(cfg).create_trainer()
+    with open_dict(cfg):
+        cfg.model.precision = cfg.trainer.precision
+        cfg.model.mm_cfg.llm.from_pretrained = None
+    model = MegatronNevaModel(cfg.model, trainer)
+
+    # initialize the model parallel state as trainer.fit would
+    def dummy():
+        return
+
+    if trainer.strategy.launcher is not None:
+        trainer.strategy.launcher.launch(dummy, trainer=trainer)
+    trainer.strategy.setup_environment()
+
+    store_dir = feature_store_dir(cfg.model)
+    multimodal_cfg = get_multimodal_cfg(cfg.model)
+    multimodal_cfg['vision_features'] = None
+    image_names = read_image_names(data_cfg)
+    dp_rank, dp_size = parallel_state.get_data_parallel_rank(), parallel_state.get_data_parallel_world_size()
+    # the vision encoder is in the first pipeline stage, and the features are written once per tensor parallel group
+    is_first_stage = parallel_state.is_pipeline_first_stage()
+    is_writer = is_first_stage and parallel_state.get_tensor_model_parallel_rank() == 0
+    if is_first_stage:
+        module = model.model.module if hasattr(model.model, 'module') else model.model
+        embedding = module.language_model.embedding.word_embeddings
+        embedding.vision_encoder.cuda().eval()
+
+    dataset = ImageDataset(image_names[dp_rank::dp_size], multimodal_cfg)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=data_cfg.get("vision_features_batch_size", 64),
+        num_workers=data_cfg.get("num_workers", 0),
+        pin_memory=True,
+    )
+    if torch.distributed.get_rank() == 0:
+        # the shards of an interrupted extraction
+        remove_vision_feature_shards(store_dir)
+    torch.distributed.barrier()
+
+    # a rank writes to its own shard only, as memory maps of a shared file are not coherent across nodes, and a rank
+    # may have no images at all
+    writer = None
+    if is_writer:
+        writer = VisionFeatureShardWriter(store_dir, f'{dp_rank:05d}', dataset.image_names, dtype='bfloat16')
+    for step, (names, pixel_values) in enumerate(dataloader if is_first_stage else []):
+        features = embedding.encode_vision_features(pixel_values.cuda(non_blocking=True).to(torch.bfloat16))
+        if is_writer:
+            writer.add(names, features)
+        if step % 100 == 0:
+            logging.info(f'Rank {dp_rank}: computed the features of {(step + 1) * dataloader.batch_size} images')
+    if writer is not None:
+        writer.close()
+
+    torch.distributed.barrier()
+    if torch.distributed.get_rank() == 0:
+        # the layout of the features is taken from a shard that has images
+        merge_vision_feature_shards(store_dir, image_names, dtype='bfloat16', config=vision_config(cfg.model))
+        logging.info(f'Wrote the vision features of {len(image_names)} images to {store_dir}')
+
+
+if __name__ == '__main__':
+    main()
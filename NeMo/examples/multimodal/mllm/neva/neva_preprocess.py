@@ -0,0 +1,126 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tokenize the conversations of `model.data.data_path` once and write them to the memory-mapped files read by
+`NevaPackedDataset`, using the same config as fine-tuning so that the tokenization matches:
+
+```
+python examples/multimodal/mllm/neva/neva_preprocess.py \
+    model.data.data_path=/data/llava_instruct_150k.json \
+    model.data.data_prefix=/data/llava_instruct_150k \
+    model.data.num_workers=32
+```
+
+Then fine-tune with the same `model.data.data_prefix`, and `model.data.packing=True` to pack several conversations
+into every sample.
+"""
+import json
+from multiprocessing import Pool
+
+from omegaconf.omegaconf import OmegaConf
+
+from nemo.collections.multimodal.data.neva.neva_dataset import get_multimodal_cfg, parse_steerlm_record
+from nemo.collections.multimodal.data.neva.neva_memmap_dataset import NevaMemmapWriter, tokenize_conversation_record
+from nemo.collections.nlp.modules.common.tokenizer_utils import get_nmt_tokenizer
+from nemo.core.config import hydra_runner
+from nemo.utils import logging
+
+# patch size of the CLIP vision encoders
+PATCH_SIZE = 14
+
+_worker_state = {}
+
+
+def build_tokenizer(tokenizer_cfg):
+    legacy = tokenizer_cfg.get('sentencepiece_legacy', tokenizer_cfg.library == 'sentencepiece')
+    tokenizer = get_nmt_tokenizer(
+        library=tokenizer_cfg.library,
+        model_name=tokenizer_cfg.type,
+        tokenizer_model=tokenizer_cfg.get('model', None),
+        vocab_file=tokenizer_cfg.get('vocab_file', None),
+        merges_file=tokenizer_cfg.get('merge_file', None),
+        use_fast=tokenizer_cfg.get('use_fast', False),
+        delimiter=tokenizer_cfg.get('delimiter', None),
+        special_tokens=tokenizer_cfg.get('special_tokens', None),
+        legacy=legacy,
+    )
+    if tokenizer_cfg.get('additional_special_tokens', None) is not None:
+        tokenizer.add_special_tokens(OmegaConf.to_object(tokenizer_cfg.additional_special_tokens))
+    return tokenizer
+
+
+def init_worker(tokenizer_cfg, multimodal_cfg, image_token_len):
+    _worker_state['tokenizer'] = build_tokenizer(OmegaConf.create(tokenizer_cfg))
+    _worker_state['multimodal_cfg'] = multimodal_cfg
+    _worker_state['image_token_len'] = image_token_len
+
+
+def tokenize_record(record):
+    return tokenize_conversation_record(
+        record, _worker_state['tokenizer'], _worker_state['multimodal_cfg'], _worker_state['image_token_len']
+    )
+
+
+def read_records(data_path, image_folder):
+    if data_path.endswith(".json"):
+        with open(data_path) as f:
+            yield from json.load(f)
+    elif data_path.endswith(".jsonl"):
+        with open(data_path) as f:
+            for line in f:
+                yield parse_steerlm_record(json.loads(line), image_folder)
+    else:
+        raise ValueError(f"Formatting of {data_path} is not supported in Neva.")
+
+
+@hydra_runner(config_path="conf", config_name="neva_finetune")
+def main(cfg) -> None:
+    model_cfg = cfg.model
+    data_cfg = model_cfg.data
+    assert data_cfg.get("data_prefix", None), 'Set model.data.data_prefix to the prefix of the files to write'
+
+    multimodal_cfg = get_multimodal_cfg(model_cfg)
+    processor = multimodal_cfg.pop("image_processor")
+    if multimodal_cfg["image_aspect_ratio"] == 'keep':
+        raise ValueError("image_aspect_ratio 'keep' gives every image its own number of tokens, use 'square' or 'pad'")
+    # number of patch tokens of every image, as computed from the preprocessed images in LazySupervisedDataset
+    image_token_len = (processor.crop_size['height'] // PATCH_SIZE) * (processor.crop_size['width'] // PATCH_SIZE)
+
+    writer = NevaMemmapWriter(data_cfg.data_prefix)
+    records = read_records(data_cfg.data_path, data_cfg.image_folder)
+    tokenizer_cfg = OmegaConf.to_container(model_cfg.tokenizer)
+    with Pool(
+        processes=max(data_cfg.get("num_workers", 1), 1),
+        initializer=init_worker,
+        initargs=(tokenizer_cfg, multimodal_cfg, image_token_len),
+    ) as pool:
+        for n, (tokens, labels, images) in enumerate(pool.imap(tokenize_record, records, chunksize=64)):
+            writer.add(tokens, labels, images)
+            if (n + 1) % 100000 == 0:
+                logging.info(f'Tokenized {n + 1} conversations')
+
+    writer.finalize(
+        dict(
+            conv_template=multimodal_cfg["conv_template"],
+            use_im_start_end=multimodal_cfg["use_im_start_end"],
+            add_extra_token=multimodal_cfg["add_extra_token"],
+            context_length=multimodal_cfg["context_length"],
+            image_token_len=image_token_len,
+        )
+    )
+    logging.info(f'Wrote {writer.num_conversations} conversations to {data_cfg.data_prefix}')
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,12 @@ from torch.utils.data import DataLoader, Dataset
 
 from nemo.collections.nlp.models.language_modeling.megatron_gpt_model import MegatronGPTModel
 from nemo.collections.nlp.modules.common.megatron.megatron_init import fake_initialize_model_parallel
+from nemo.collections.nlp.modules.common.text_generation_prefix_cache import PrefixKVCache
+from nemo.collections.nlp.modules.common.text_generation_scheduler import (
+    ContinuousBatchingScheduler,
+    MegatronGPTSlotDecoder,
+    SlotKVCache,
+)
 from nemo.collections.nlp.modules.common.text_generation_server import MegatronServer
 from nemo.collections.nlp.modules.common.text_generation_utils import generate
 from nemo.collections.nlp.modules.common.transformer.text_generation import LengthParam, SamplingParam
@@ -136,6 +142,41 @@ Usage:
 
         sentences = request_data(data)
         ```
+
+    f. Launch the inference server with continuous batching, which adds the sequences of new requests to the
+       running batch as others finish, instead of serving the requests one at a time:
+         python megatron_gpt_eval.py \
+            gpt_model_file=PATH_TO_MODEL \
+            trainer.devices=1 \
+            trainer.num_nodes=1 \
+            tensor_model_parallel_size=-1 \
+            pipeline_model_parallel_size=-1 \
+            server=True \
+            continuous_batching.enabled=True
+
+        The queue depth and time to first token are served at http://localhost:5555/metrics
+
+        With "stream": True in the request, the generated tokens are sent as server-sent events as they come:
+        ```python
+        resp = requests.put('http://localhost:5555/generate', data=json.dumps(data), headers=headers, stream=True)
+        for line in resp.iter_lines():
+            if line and line != b'data: [DONE]':
+                event = json.loads(line[len(b'data: '):])
+                print(event['text'], end='', flush=True)
+        ```
+
+    g. Reuse the key-value memory of the prompt prefixes shared across requests, e.g. a long system prompt:
+         python megatron_gpt_eval.py \
+            gpt_model_file=PATH_TO_MODEL \
+            trainer.devices=1 \
+            trainer.num_nodes=1 \
+            tensor_model_parallel_size=-1 \
+            pipeline_model_parallel_size=-1 \
+            server=True \
+            prefix_cache.enabled=True
+
+        The hit rate of the cache is served at http://localhost:5555/metrics. The prefix cache can't be used with
+        continuous batching.
 """
 
 if not torch.cuda.is_available():
@@ -166,6 +207,9 @@ def remove_padded_prompts(response, nb_paddings):
 @hydra_runner(config_path="conf", config_name="megatron_gpt_inference")
 def main(cfg) -> None:
 
+    if cfg.prefix_cache.enabled and cfg.continuous_batching.enabled:
+        raise ValueError("The continuous batching scheduler does not use the prefix cache, enable only one of them")
+
     # trainer required for restoring model parallel models
     trainer = Trainer(strategy=NLPDDPStrategy(), **cfg.trainer, callbacks=[CustomProgressBar()])
 
@@ -266,6 +310,9 @@ def main(cfg) -> None:
     except AttributeError:
         pass
 
+    if cfg.prefix_cache.enabled:
+        model.prefix_kv_cache = PrefixKVCache(cfg.prefix_cache.max_memory_mb, cfg.prefix_cache.block_size)
+
     length_params: LengthParam = {
         "max_length": cfg.inference.tokens_to_generate,
         "min_length": cfg.inference.min_tokens_to_generate,
@@ -342,9 +389,26 @@ def main(cfg) -> None:
                     args=(cfg.share, cfg.username, cfg.password, cfg.port, cfg.web_port, loop),
                 )
                 thread.start()
-            server = MegatronServer(model.cuda())
+            scheduler = None
+            if cfg.continuous_batching.enabled:
+                scheduler = ContinuousBatchingScheduler(
+                    MegatronGPTSlotDecoder(model.cuda()),
+                    model.tokenizer,
+                    max_batch_size=cfg.continuous_batching.max_batch_size,
+                    max_seq_len=cfg.continuous_batching.get('max_seq_len') or model.cfg.encoder_seq_length,
+                    max_prefill_tokens=cfg.continuous_batching.max_prefill_tokens,
+                )
+                scheduler.start()
+            server = MegatronServer(model.cuda(), scheduler=scheduler)
             server.run("0.0.0.0", port=cfg.port)
 
+        if cfg.continuous_batching.enabled:
+            kv_cache = SlotKVCache(
+                cfg.continuous_batching.max_batch_size,
+                cfg.continuous_batching.get('max_seq_len') or model.cfg.encoder_seq_length,
+            )
+            MegatronGPTSlotDecoder(model.cuda()).serve(kv_cache)
+
         while True:
             choice = torch.cuda.LongTensor(1)
             torch.distributed.broadcast(choice, 0)
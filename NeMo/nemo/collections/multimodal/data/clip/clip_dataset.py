@@ -113,6 +113,7 @@ def build_train_valid_datasets(
         map_fn=partial(transform_fn, img_transform=train_img_transform, text_transform=text_transform),
         compose_fn=tuple_to_dict,
         is_train=True,
+        micro_batch_size=model_cfg.micro_batch_size,
     )
 
     val_data = None
@@ -124,6 +125,7 @@ def build_train_valid_datasets(
             map_fn=partial(transform_fn, img_transform=val_img_transform, text_transform=text_transform),
             compose_fn=tuple_to_dict,
             is_train=False,
+            micro_batch_size=model_cfg.micro_batch_size,
         )
 
     return train_data, val_data
@@ -0,0 +1,139 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Aspect ratio bucketing of images of varying shapes.
+
+Every image is assigned to the (height, width) bucket of the closest aspect ratio, resized to cover the bucket and
+cropped to it. Micro batches are made of samples of a single bucket, so that images of different shapes are trained
+on without padding or cropping them to a square, and every batch has a single shape.
+"""
+import math
+import random
+from bisect import bisect_left
+
+import torchvision.transforms.functional as TF
+from torchvision.transforms import InterpolationMode
+
+
+def generate_buckets(base_resolution=512, step=64, max_aspect_ratio=2.0):
+    r"""
+    Generate (height, width) buckets of at most `base_resolution ** 2` pixels with sides multiple of `step` and an
+    aspect ratio of at most `max_aspect_ratio`, sorted by aspect ratio (height / width).
+    """
+    max_area = base_resolution * base_resolution
+    buckets = set()
+    for width in range(step, max_area // step + 1, step):
+        # the largest height that fits the pixel budget
+        height = max_area // width // step * step
+        if height >= step and max(height / width, width / height) <= max_aspect_ratio:
+            buckets.add((height, width))
+    return sorted(buckets, key=lambda bucket: (bucket[0] / bucket[1], bucket[0]))
+
+
+class AspectRatioBuckets:
+    r"""
+    Set of (height, width) buckets that images are assigned to by aspect ratio.
+
+    Args:
+        buckets: list of (height, width) buckets.
+        image_key: key of the decoded image in the webdataset samples.
+        random_crop: crop images to their bucket at a random position instead of the center.
+    """
+
+    def __init__(self, buckets, image_key='jpg', random_crop=False):
+        buckets = sorted({(int(height), int(width)) for height, width in buckets}, key=lambda b: b[0] / b[1])
+        assert len(buckets) > 0, 'Need at least one aspect ratio bucket'
+        self.buckets = buckets
+        self.image_key = image_key
+        self.random_crop = random_crop
+        self._log_ratios = [math.log(height / width) for height, width in buckets]
+
+    @classmethod
+    def from_config(cls, cfg, image_key='jpg'):
+        r"""Build the buckets from `data.train.aspect_buckets`: either an explicit list of `buckets`, or generated."""
+        if cfg.get('buckets'):
+            buckets = [tuple(bucket) for bucket in cfg.buckets]
+        else:
+            buckets = generate_buckets(
+                base_resolution=cfg.get('base_resolution', 512),
+                step=cfg.get('step', 64),
+                max_aspect_ratio=cfg.get('max_aspect_ratio', 2.0),
+            )
+        return cls(buckets, image_key=image_key, random_crop=cfg.get('random_crop', False))
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def assign(self, height, width):
+        r"""Id of the bucket with the aspect ratio closest to `height / width` (in log space)."""
+        log_ratio = math.log(height / width)
+        i = bisect_left(self._log_ratios, log_ratio)
+        if i == 0:
+            return 0
+        if i == len(self._log_ratios):
+            return i - 1
+        return i if self._log_ratios[i] - log_ratio < log_ratio - self._log_ratios[i - 1] else i - 1
+
+    def sample_bucket(self, sample):
+        r"""Bucket id of a decoded webdataset sample."""
+        width, height = sample[self.image_key].size
+        return self.assign(height, width)
+
+    def resize_and_crop(self, image, bucket_id):
+        r"""Resize a PIL image to cover bucket `bucket_id`, keeping its aspect ratio, and crop it to the bucket."""
+        height, width = self.buckets[bucket_id]
+        image_width, image_height = image.size
+        scale = max(height / image_height, width / image_width)
+        resized = [max(height, round(image_height * scale)), max(width, round(image_width * scale))]
+        image = TF.resize(image, resized, interpolation=InterpolationMode.BICUBIC, antialias=True)
+        if self.random_crop:
+            top = random.randint(0, resized[0] - height)
+            left = random.randint(0, resized[1] - width)
+        else:
+            top = (resized[0] - height) // 2
+            left = (resized[1] - width) // 2
+        return TF.crop(image, top, left, height, width)
+
+
+def bucket_batches(src, aspect_buckets, micro_batch_size, map_fn=None, handler=None):
+    r"""
+    Webdataset pipeline stage grouping decoded samples into runs of `micro_batch_size` samples of the same bucket.
+
+    A run is yielded as soon as its bucket is full, and the bucket id is stored in the `__bucket__` field of every
+    sample. Samples left in partially filled buckets at the end of the stream are dropped. Because the runs only
+    depend on the order of the samples, a sampler knowing the bucket of every sample in advance can predict them.
+
+    The per-sample `map_fn` is applied to every sample once its bucket is assigned and before it joins the run of
+    its bucket, so that a sample failing to map never shifts the following samples into the run of another bucket.
+    A failure is passed to `handler` like in `webdataset`, which returns whether to skip the sample or stop, and is
+    raised without a handler.
+    """
+    pending = {}
+    for sample in src:
+        bucket_id = aspect_buckets.sample_bucket(sample)
+        sample['__bucket__'] = bucket_id
+        if map_fn is not None:
+            try:
+                sample = map_fn(sample)
+            except Exception as exn:
+                if handler is None:
+                    raise
+                if handler(exn):
+                    continue
+                break
+        samples = pending.setdefault(bucket_id, [])
+        samples.append(sample)
+        if len(samples) == micro_batch_size:
+            yield from samples
+            pending[bucket_id] = []
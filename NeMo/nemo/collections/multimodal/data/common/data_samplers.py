@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import heapq
 from multiprocessing import Value
 
 import torch
@@ -131,3 +132,259 @@ class WDSUrlsRandomSampler(IterableDataset):
                 yield dict(url=self.urls[idx])
             else:
                 yield dict(url=self.urls[additional_random_idx[idx - self.total_urls]])
+
+
+class WDSIndexedShardSampler(IterableDataset):
+    def __init__(
+        self,
+        urls,
+        shard_sizes,
+        consumed_samples: int,
+        micro_batch_size: int,
+        data_parallel_rank: int,
+        data_parallel_size: int,
+        num_workers: int,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        r"""Sampler for WebDataset shards of known sizes with data parallelism, driven by a shard index.
+
+        Every epoch the shards are permuted and assigned greedily to the `data_parallel_size * num_workers`
+        (rank, worker) slots, always to the least loaded slot, so that all slots get nearly the same number of
+        samples. Every slot then reads the same number of samples, a multiple of `micro_batch_size`, so the epoch
+        length is exact, and the few samples beyond it are dropped for this epoch only. The sampler yields shard
+        descriptors `dict(url, shard_id, epoch, start, stop)`, where `[start, stop)` is the slice of the shard to
+        read; on resume, whole consumed shards are skipped and the first shard is read from the exact sample.
+        Args:
+            urls : The urls of the tar files from which to sample.
+            shard_sizes (list): Number of (filtered) samples of every shard.
+            consumed_samples (int): Number of samples consumed so far by the training process.
+            micro_batch_size (int): Batch size of the dataloader.
+            data_parallel_rank (int): Rank of the current data parallel process.
+            data_parallel_size (int): Number of data parallel processes.
+            num_workers (int): Number of dataloader workers per data parallel process.
+            shuffle (bool): If True, permute the shards every epoch.
+            seed (int): Base seed of the permutation.
+        """
+        super().__init__()
+        assert len(urls) == len(shard_sizes)
+        self.urls = urls
+        self.shard_sizes = shard_sizes
+        self.consumed_samples = consumed_samples
+        self.micro_batch_size = micro_batch_size
+        self.data_parallel_rank = data_parallel_rank
+        self.data_parallel_size = data_parallel_size
+        self.num_workers = max(num_workers, 1)
+        self.num_slots = self.data_parallel_size * self.num_workers
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = SharedEpoch()
+        assert (
+            len(self.urls) >= self.num_slots
+        ), f'Need at least {self.num_slots} shards for {data_parallel_size} ranks with {self.num_workers} workers'
+
+    def assign_shards(self, epoch):
+        r"""Return the shard ids of every slot and the number of samples every slot reads in `epoch`."""
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + epoch)
+            order = torch.randperm(len(self.urls), generator=g).tolist()
+        else:
+            order = list(range(len(self.urls)))
+        heap = [(0, slot) for slot in range(self.num_slots)]
+        slots = [[] for _ in range(self.num_slots)]
+        for shard_id in order:
+            load, slot = heapq.heappop(heap)
+            slots[slot].append(shard_id)
+            heapq.heappush(heap, (load + self.shard_sizes[shard_id], slot))
+        slot_len = min(load for load, _ in heap)
+        slot_len -= slot_len % self.micro_batch_size
+        return slots, slot_len
+
+    def batches_per_epoch(self, epoch):
+        r"""Number of micro batches every data parallel rank reads in `epoch`."""
+        _, slot_len = self.assign_shards(epoch)
+        return slot_len * self.num_workers // self.micro_batch_size
+
+    def __len__(self):
+        # samples read by this data parallel rank in an epoch
+        return self.batches_per_epoch(self.epoch.get_value()) * self.micro_batch_size
+
+    def _get_worker_info(self):
+        worker_id = 0
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            worker_id = worker_info.id
+            assert worker_info.num_workers == self.num_workers, 'num_workers does not match the dataloader'
+        return worker_id
+
+    def _resume_position(self, worker_id):
+        r"""Return the epoch the consumed samples end in, the index of its first batch and the batches of the worker
+        already consumed in it."""
+        # find the epoch the consumed samples end in, epochs may differ in length by a few samples
+        rank_batches = self.consumed_samples // self.data_parallel_size // self.micro_batch_size
+        epoch, epoch_start = 0, 0
+        while True:
+            batches_per_epoch = self.batches_per_epoch(epoch)
+            if rank_batches < epoch_start + batches_per_epoch:
+                break
+            epoch_start += batches_per_epoch
+            epoch += 1
+        self.epoch.set_value(epoch)
+
+        # dataloader workers produce whole micro batches in turn
+        consumed_batches = rank_batches - epoch_start
+        worker_batches = consumed_batches // self.num_workers + int(worker_id < consumed_batches % self.num_workers)
+        return epoch, epoch_start, worker_batches
+
+    def _finish_epoch(self, epoch, epoch_start):
+        # every worker holds its own copy of the sampler and moves on to the next epoch
+        next_epoch_start = epoch_start + self.batches_per_epoch(epoch)
+        self.consumed_samples = next_epoch_start * self.micro_batch_size * self.data_parallel_size
+
+    def __iter__(self):
+        worker_id = self._get_worker_info()
+        epoch, epoch_start, worker_batches = self._resume_position(worker_id)
+        slots, slot_len = self.assign_shards(epoch)
+        skip = worker_batches * self.micro_batch_size
+
+        slot = self.data_parallel_rank * self.num_workers + worker_id
+        remaining = slot_len
+        for shard_id in slots[slot]:
+            size = min(self.shard_sizes[shard_id], remaining)
+            remaining -= size
+            if skip >= size:
+                skip -= size
+            elif size > 0:
+                yield dict(url=self.urls[shard_id], shard_id=shard_id, epoch=epoch, start=skip, stop=size)
+                skip = 0
+            if remaining == 0:
+                break
+
+        self._finish_epoch(epoch, epoch_start)
+
+
+class WDSBucketedShardSampler(WDSIndexedShardSampler):
+    def __init__(
+        self,
+        urls,
+        shard_sizes,
+        sample_buckets,
+        sample_order_fn,
+        consumed_samples: int,
+        micro_batch_size: int,
+        data_parallel_rank: int,
+        data_parallel_size: int,
+        num_workers: int,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        r"""Sampler for aspect ratio bucketed training on WebDataset shards, driven by a shard index.
+
+        Shards are assigned to the (rank, worker) slots like `WDSIndexedShardSampler`. Since the bucket of every
+        sample is known from the index, the micro batches formed by the `bucket_batches` pipeline stage of every
+        slot (runs of `micro_batch_size` samples of the same bucket, in reading order) are computed in advance.
+        Every slot reads the same number of micro batches, so all ranks run the same number of steps, and yields
+        descriptors `dict(url, shard_id, epoch, start, stop, positions)` listing exactly the samples of those
+        batches. On resume, the samples of the batches already consumed are not read at all, which leaves the
+        remaining batches unchanged.
+        Args:
+            urls : The urls of the tar files from which to sample.
+            shard_sizes (list): Number of (filtered) samples of every shard.
+            sample_buckets (list): For every shard, the bucket id of every sample in tar order, None for samples
+                that are filtered out or cannot be bucketed.
+            sample_order_fn (callable): `sample_order_fn(shard_id, epoch)` returns the positions of the samples of
+                a shard in the order the dataset reads them in `epoch`.
+            consumed_samples (int): Number of samples consumed so far by the training process.
+            micro_batch_size (int): Batch size of the dataloader.
+            data_parallel_rank (int): Rank of the current data parallel process.
+            data_parallel_size (int): Number of data parallel processes.
+            num_workers (int): Number of dataloader workers per data parallel process.
+            shuffle (bool): If True, permute the shards every epoch.
+            seed (int): Base seed of the permutation.
+        """
+        super().__init__(
+            urls=urls,
+            shard_sizes=shard_sizes,
+            consumed_samples=consumed_samples,
+            micro_batch_size=micro_batch_size,
+            data_parallel_rank=data_parallel_rank,
+            data_parallel_size=data_parallel_size,
+            num_workers=num_workers,
+            shuffle=shuffle,
+            seed=seed,
+        )
+        assert len(sample_buckets) == len(urls)
+        self.sample_buckets = sample_buckets
+        self.sample_order_fn = sample_order_fn
+        # the number of batches of a slot only depends on how many samples of every bucket its shards hold
+        self.bucket_counts = []
+        for buckets in sample_buckets:
+            counts = {}
+            for bucket_id in buckets:
+                if bucket_id is not None:
+                    counts[bucket_id] = counts.get(bucket_id, 0) + 1
+            self.bucket_counts.append(counts)
+        self._batches_per_epoch = {}
+
+    def batches_per_epoch(self, epoch):
+        if epoch not in self._batches_per_epoch:
+            slots, _ = self.assign_shards(epoch)
+            slot_batches = []
+            for slot in slots:
+                counts = {}
+                for shard_id in slot:
+                    for bucket_id, count in self.bucket_counts[shard_id].items():
+                        counts[bucket_id] = counts.get(bucket_id, 0) + count
+                slot_batches.append(sum(count // self.micro_batch_size for count in counts.values()))
+            self._batches_per_epoch[epoch] = min(slot_batches) * self.num_workers
+        return self._batches_per_epoch[epoch]
+
+    def slot_batches(self, slot, epoch):
+        r"""Return the micro batches of a slot in `epoch`, as lists of (shard id, position) in the order they are
+        yielded, and the reading order of their samples."""
+        slots, _ = self.assign_shards(epoch)
+        num_batches = self.batches_per_epoch(epoch) // self.num_workers
+        batches, read_order, pending = [], [], {}
+        for shard_id in slots[slot]:
+            buckets = self.sample_buckets[shard_id]
+            for position in self.sample_order_fn(shard_id, epoch):
+                bucket_id = buckets[position]
+                if bucket_id is None:
+                    continue
+                read_order.append((shard_id, position))
+                samples = pending.setdefault(bucket_id, [])
+                samples.append((shard_id, position))
+                if len(samples) == self.micro_batch_size:
+                    batches.append(samples)
+                    pending[bucket_id] = []
+                    if len(batches) == num_batches:
+                        return batches, read_order
+        return batches, read_order
+
+    def __iter__(self):
+        worker_id = self._get_worker_info()
+        epoch, epoch_start, worker_batches = self._resume_position(worker_id)
+
+        slot = self.data_parallel_rank * self.num_workers + worker_id
+        batches, read_order = self.slot_batches(slot, epoch)
+        # samples of consumed batches and samples that never complete a batch are not read
+        wanted = set(sample for batch in batches[worker_batches:] for sample in batch)
+        positions, current_shard = [], None
+        for shard_id, position in read_order:
+            if (shard_id, position) not in wanted:
+                continue
+            if shard_id != current_shard and positions:
+                yield self._descriptor(current_shard, epoch, positions)
+                positions = []
+            current_shard = shard_id
+            positions.append(position)
+        if positions:
+            yield self._descriptor(current_shard, epoch, positions)
+
+        self._finish_epoch(epoch, epoch_start)
+
+    def _descriptor(self, shard_id, epoch, positions):
+        return dict(
+            url=self.urls[shard_id], shard_id=shard_id, epoch=epoch, start=0, stop=len(positions), positions=positions
+        )
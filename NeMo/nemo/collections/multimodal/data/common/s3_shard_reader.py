@@ -0,0 +1,323 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import multiprocessing.util
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from nemo.utils import logging
+
+
+class S3ShardReader:
+    """
+    Reader of webdataset shards stored in S3 that downloads every shard with a pool of concurrent ranged GET
+    requests into a local spill cache, and prefetches the next shards in the background.
+
+    The spill caches of the dataloader workers are bounded to `cache_size_mb` together, every worker gets an even share
+    of it; the least recently used shards that are neither open nor being downloaded are evicted first. Failed or incomplete requests are retried with exponential backoff and jitter.
+    Fetch latency and throughput of every shard are recorded and logged every `log_interval` shards.
+
+    The thread pool and the client are created lazily in the process that first uses the reader, so that a reader
+    can be built in the main process and used in dataloader workers. The spill cache of a process is deleted by
+    `close`, or when the process exits.
+
+    Args:
+        client_factory: callable returning an S3 client (e.g. a boto3 client), called once per process.
+        bucket: name of the bucket.
+        cache_dir: directory of the spill cache, a temporary directory if None.
+        cache_size_mb: size budget of the spill caches of all the dataloader workers in MB.
+        max_concurrency: number of concurrent ranged GET requests.
+        prefetch_shards: number of upcoming shards to download ahead of the one being read.
+        part_size_mb: size of the ranged GET requests in MB.
+        max_attempts: number of attempts of every request.
+        backoff_base: delay before the first retry in seconds, doubled at every attempt.
+        backoff_max: maximum delay between retries in seconds.
+        log_interval: number of fetched shards between metrics logs, 0 to disable.
+    """
+
+    def __init__(
+        self,
+        client_factory,
+        bucket,
+        cache_dir=None,
+        cache_size_mb=4096,
+        max_concurrency=16,
+        prefetch_shards=2,
+        part_size_mb=8,
+        max_attempts=10,
+        backoff_base=0.1,
+        backoff_max=10.0,
+        log_interval=100,
+    ):
+        self.client_factory = client_factory
+        self.bucket = bucket
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = int(cache_size_mb * 1024 ** 2)
+        self.max_concurrency = max_concurrency
+        self.prefetch_shards = prefetch_shards
+        self.part_size = int(part_size_mb * 1024 ** 2)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.log_interval = log_interval
+        self._pid = None
+
+    def __getstate__(self):
+        # only the configuration is sent to dataloader workers
+        state = self.__dict__.copy()
+        for key in [
+            '_client',
+            '_executor',
+            '_shard_executor',
+            '_lock',
+            '_entries',
+            '_inflight',
+            '_open_counts',
+            '_fetch_stats',
+            '_finalizer',
+        ]:
+            state.pop(key, None)
+        state['_pid'] = None
+        return state
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._client = self.client_factory()
+        # parts are fetched by their own pool, so that shard downloads never wait for threads held by shards
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self._shard_executor = ThreadPoolExecutor(max_workers=self.prefetch_shards + 1)
+        # reentrant, done callbacks of already finished downloads run in the submitting thread
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (path, size) of the shards in the spill cache
+        self._inflight = {}  # key -> future of the shards being downloaded
+        self._open_counts = {}
+        self._fetch_stats = []
+        self._cache_bytes = 0
+        worker_info = torch.utils.data.get_worker_info()
+        self._max_process_cache_bytes = self.max_cache_bytes // (worker_info.num_workers if worker_info else 1)
+        self.hits = 0
+        self.misses = 0
+        root = self.cache_dir or tempfile.gettempdir()
+        # one spill directory per process, so that dataloader workers never share files
+        self._spill_dir = os.path.join(root, f's3_shard_cache_{os.getpid()}')
+        os.makedirs(self._spill_dir, exist_ok=True)
+        # dataloader workers exit without running the atexit handlers, the multiprocessing finalizers run in all
+        # the processes
+        self._finalizer = multiprocessing.util.Finalize(
+            self, _shutdown, args=(self._shard_executor, self._executor, self._spill_dir), exitpriority=0,
+        )
+
+    def _with_retries(self, fn, description):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:  # noqa
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise ConnectionError(f'Unable to {description} after {attempt} attempts') from e
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                delay *= 0.5 + random.random()
+                logging.warning(f'Failed to {description} ({e}), retrying in {delay:.2f}s')
+                time.sleep(delay)
+
+    def _get_size(self, key):
+        response = self._with_retries(
+            lambda: self._client.head_object(Bucket=self.bucket, Key=key), f'get the size of {key}'
+        )
+        return response['ContentLength']
+
+    def _get_range(self, key, start, end):
+        def get():
+            response = self._client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes={start}-{end - 1}')
+            data = response['Body'].read()
+            if len(data) != end - start:
+                raise IOError(f'Incomplete read of {key}: got {len(data)} of {end - start} bytes')
+            return data
+
+        return self._with_retries(get, f'read bytes {start}-{end - 1} of {key}')
+
+    def _fetch(self, key):
+        tic = time.perf_counter()
+        size = self._get_size(key)
+        path = os.path.join(self._spill_dir, key.replace('/', '_'))
+        tmp_path = f'{path}.part'
+        parts = [(start, min(start + self.part_size, size)) for start in range(0, size, self.part_size)]
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+        futures = [self._executor.submit(self._write_range, key, tmp_path, start, end) for start, end in parts]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        latency = time.perf_counter() - tic
+
+        with self._lock:
+            self._entries[key] = (path, size)
+            self._cache_bytes += size
+            self._fetch_stats.append((latency, size))
+            self._evict()
+            num_fetched = len(self._fetch_stats)
+        if self.log_interval and num_fetched % self.log_interval == 0:
+            logging.info(f'S3 shard reader: {self.format_metrics()}')
+        return path
+
+    def _write_range(self, key, path, start, end):
+        data = self._get_range(key, start, end)
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._cache_bytes <= self._max_process_cache_bytes:
+                break
+            if self._open_counts.get(key, 0) > 0:
+                continue
+            path, size = self._entries.pop(key)
+            self._cache_bytes -= size
+            os.remove(path)
+
+    def _submit(self, key):
+        # must be called with the lock held
+        if key not in self._entries and key not in self._inflight:
+            future = self._shard_executor.submit(self._fetch, key)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _, key=key: self._inflight_done(key))
+
+    def _inflight_done(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def prefetch(self, keys):
+        """Start downloading the shards `keys` in the background."""
+        self._ensure_started()
+        with self._lock:
+            for key in keys:
+                self._submit(key)
+
+    def open(self, key):
+        """Open a shard from the spill cache, downloading it first if needed. Close the returned file when done."""
+        self._ensure_started()
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                future = None
+            else:
+                self.misses += 1
+                self._submit(key)
+                future = self._inflight.get(key)
+            self._open_counts[key] = self._open_counts.get(key, 0) + 1
+        try:
+            if future is not None:
+                future.result()
+            with self._lock:
+                path, _ = self._entries[key]
+                self._entries.move_to_end(key)
+            return _CachedShardFile(path, lambda: self._release(key))
+        except Exception:
+            self._release(key)
+            raise
+
+    def _release(self, key):
+        with self._lock:
+            self._open_counts[key] -= 1
+            if self._open_counts[key] == 0:
+                del self._open_counts[key]
+            self._evict()
+
+    def metrics(self):
+        """Summary of the fetch latency and throughput of the shards downloaded so far by this process."""
+        self._ensure_started()
+        with self._lock:
+            stats = list(self._fetch_stats)
+            hits, misses = self.hits, self.misses
+        if not stats:
+            return {'shards': 0, 'cache_hits': hits, 'cache_misses': misses}
+        latencies = sorted(latency for latency, _ in stats)
+        total_bytes = sum(size for _, size in stats)
+        return {
+            'shards': len(stats),
+            'bytes': total_bytes,
+            'latency_mean_s': sum(latencies) / len(latencies),
+            'latency_p50_s': latencies[len(latencies) // 2],
+            'latency_p95_s': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+            'throughput_MBps': total_bytes / 1024 ** 2 / sum(latencies),
+            'cache_hits': hits,
+            'cache_misses': misses,
+        }
+
+    def format_metrics(self):
+        return ', '.join(
+            f'{key}={value:.3f}' if isinstance(value, float) else f'{key}={value}'
+            for key, value in self.metrics().items()
+        )
+
+    def close(self):
+        """Stop the thread pool and delete the spill cache of this process."""
+        if self._pid != os.getpid():
+            return
+        self._finalizer()
+        self._pid = None
+
+
+def _shutdown(shard_executor, executor, spill_dir):
+    shard_executor.shutdown(wait=True)
+    executor.shutdown(wait=True)
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+class _CachedShardFile:
+    """File object of a cached shard that releases the shard from the reader when it is closed."""
+
+    def __init__(self, path, release_fn):
+        self._release_fn = None
+        self._file = open(path, 'rb')
+        self._release_fn = release_fn
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._release_fn is not None:
+            self._file.close()
+            self._release_fn()
+            self._release_fn = None
+
+    def __del__(self):
+        self.close()
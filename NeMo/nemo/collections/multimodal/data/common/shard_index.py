@@ -0,0 +1,496 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Index of webdataset tar shards, replacing the pickled `wdinfo` files.
+
+For every shard the index records the exact number of samples, the key and the byte range `[start, end)` of every
+sample inside the tar file, when the index was built with a filter, which samples pass it and, when it was built
+with `record_sizes`, the `[height, width]` of the image of every sample. The index is a JSON file
+
+    {
+        "version": 1,
+        "filter": {"resolution": {"value": 512, "method": "larger"}},
+        "shards": [
+            {
+                "url": "00000.tar", "size": 123456789, "mtime": 1690000000.0, "num_samples": 1000,
+                "keys": ["000000000", ...], "offsets": [[0, 104448], ...], "keep": [true, ...],
+                "sizes": [[512, 768], ...]
+            },
+            ...
+        ]
+    }
+
+and is built with `scripts/dataset_processing/multimodal/build_webdataset_index.py`.
+"""
+import io
+import json
+import os
+import random
+import re
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image
+from webdataset.compat import FluidInterface
+from webdataset.filters import pipelinefilter
+from webdataset.handlers import reraise_exception
+from webdataset.pipeline import DataPipeline
+from webdataset.tariterators import group_by_keys, tar_file_expander
+
+from nemo.collections.multimodal.data.common.webdataset_s3 import prefetch_urls, read_byte_ranges, url_opener
+from nemo.utils import logging
+
+SHARD_INDEX_VERSION = 1
+_TAR_BLOCK_SIZE = 512
+# samples closer than this are fetched with a single read
+_MAX_RANGE_GAP = 1 << 20
+
+
+def split_member_name(name):
+    r"""Split a tar member name into the sample key and the extension, the same way webdataset groups members."""
+    match = re.match(r"^((?:.*/|)[^.]+)[.]([^/]*)$", name)
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+def build_shard_filter(filter_cfg, image_key='jpg'):
+    r"""
+    Build the filter function matching `data.train.filterings` from its (dict) config, evaluated on raw samples.
+    Returns None if there is nothing to filter.
+    """
+    if not filter_cfg or not filter_cfg.get('resolution'):
+        return None
+    value = filter_cfg['resolution']['value']
+    method = filter_cfg['resolution'].get('method', 'larger')
+    assert method in ['larger', 'smaller']
+
+    def filter_fn(sample):
+        if image_key not in sample:
+            return False
+        # only the image header is parsed, the pixels are not decoded
+        with Image.open(io.BytesIO(sample[image_key])) as img:
+            width, height = img.size
+        if method == 'larger':
+            return width >= value and height >= value
+        return width <= value and height <= value
+
+    return filter_fn
+
+
+def read_image_size(data):
+    r"""Return the `[height, width]` of an encoded image from its header, or None if it cannot be parsed."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+    except Exception:
+        return None
+    return [height, width]
+
+
+def scan_shard(url, root='', filter_cfg=None, image_key='jpg', open_fn=None, record_sizes=False):
+    r"""
+    Scan a single tar shard and return its index entry.
+
+    Args:
+        url: path of the shard relative to `root`.
+        root: root directory of the dataset.
+        filter_cfg: optional filter config (see `build_shard_filter`), evaluated on every sample.
+        image_key: extension of the image member the filter is evaluated on.
+        open_fn: optional function opening `url` as a binary stream, defaults to opening a local file.
+        record_sizes: record the size of the image of every sample, used by aspect ratio bucketing.
+    """
+    filter_fn = build_shard_filter(filter_cfg, image_key=image_key)
+    path = os.path.join(root, url)
+    if open_fn is None:
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime
+        stream = open(path, 'rb')
+    else:
+        size, mtime = None, None
+        stream = open_fn(url)
+
+    keys, offsets, keep, sizes = [], [], [], []
+    current_key, current_sample = None, {}
+    read_images = filter_fn is not None or record_sizes
+
+    def finish_sample():
+        if current_key is not None and filter_fn is not None:
+            keep.append(bool(filter_fn(current_sample)))
+        if current_key is not None and record_sizes:
+            image = current_sample.get(image_key)
+            sizes.append(read_image_size(image) if image is not None else None)
+
+    # offsets are only meaningful for uncompressed shards, which is what webdataset writes
+    with stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            if not member.isreg():
+                continue
+            name = member.name
+            # webdataset skips metadata members such as __index__
+            if '/' not in name and name.startswith('__') and name.endswith('__'):
+                continue
+            key, ext = split_member_name(name)
+            if key is None:
+                continue
+            member_end = member.offset_data + -(-member.size // _TAR_BLOCK_SIZE) * _TAR_BLOCK_SIZE
+            if key != current_key:
+                finish_sample()
+                current_key, current_sample = key, {}
+                keys.append(key)
+                offsets.append([member.offset, member_end])
+            else:
+                offsets[-1][1] = member_end
+            if read_images and ext.lower() == image_key:
+                current_sample[ext.lower()] = tar.extractfile(member).read()
+        finish_sample()
+
+    entry = {
+        'url': url,
+        'size': size,
+        'mtime': mtime,
+        'num_samples': len(keys),
+        'keys': keys,
+        'offsets': offsets,
+    }
+    if filter_fn is not None:
+        entry['keep'] = keep
+    if record_sizes:
+        entry['sizes'] = sizes
+    return entry
+
+
+class ShardIndex:
+    r"""
+    In-memory view of a shard index file.
+
+    Args:
+        shards: list of shard entries as returned by `scan_shard`.
+        filter_cfg: filter the `keep` masks of the shards were computed with, or None.
+    """
+
+    def __init__(self, shards, filter_cfg=None):
+        self.shards = shards
+        self.filter_cfg = filter_cfg or None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            index = json.load(f)
+        if index.get('version') != SHARD_INDEX_VERSION:
+            raise ValueError(f'Unsupported shard index version {index.get("version")} in {path}')
+        return cls(index['shards'], index.get('filter'))
+
+    @classmethod
+    def merge(cls, indices):
+        filter_cfgs = {json.dumps(index.filter_cfg, sort_keys=True) for index in indices}
+        if len(filter_cfgs) > 1:
+            raise ValueError(f'Cannot merge shard indices built with different filters: {filter_cfgs}')
+        shards = [shard for index in indices for shard in index.shards]
+        return cls(shards, indices[0].filter_cfg if indices else None)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'version': SHARD_INDEX_VERSION, 'filter': self.filter_cfg, 'shards': self.shards}, f)
+
+    def __len__(self):
+        return len(self.shards)
+
+    @property
+    def urls(self):
+        return [shard['url'] for shard in self.shards]
+
+    def kept_positions(self, shard_id):
+        r"""Positions (in tar order) of the samples of a shard that pass the filter."""
+        shard = self.shards[shard_id]
+        if 'keep' not in shard:
+            return list(range(shard['num_samples']))
+        return [i for i, keep in enumerate(shard['keep']) if keep]
+
+    @property
+    def shard_sizes(self):
+        r"""Number of samples of every shard after filtering."""
+        return [sum(shard['keep']) if 'keep' in shard else shard['num_samples'] for shard in self.shards]
+
+    @property
+    def has_sizes(self):
+        r"""Whether the image sizes of all samples were recorded."""
+        return all('sizes' in shard for shard in self.shards)
+
+    def sample_buckets(self, assign_fn):
+        r"""
+        Bucket of every sample of every shard, in tar order, as given by `assign_fn(height, width)`.
+        Samples that are filtered out or whose image size is unknown get the bucket None.
+        """
+        buckets = []
+        for shard_id, shard in enumerate(self.shards):
+            shard_buckets = [None] * shard['num_samples']
+            for position in self.kept_positions(shard_id):
+                size = shard['sizes'][position]
+                if size is not None:
+                    shard_buckets[position] = assign_fn(*size)
+            buckets.append(shard_buckets)
+        return buckets
+
+    @property
+    def num_raw_samples(self):
+        return sum(shard['num_samples'] for shard in self.shards)
+
+    @property
+    def num_samples(self):
+        return sum(self.shard_sizes)
+
+
+def build_shard_index(
+    urls, root='', num_workers=8, filter_cfg=None, image_key='jpg', cached_index=None, record_sizes=False
+):
+    r"""
+    Scan `urls` in parallel with a process pool and return a `ShardIndex`.
+
+    Entries of `cached_index` are reused for shards whose size and modification time did not change since they
+    were scanned with the same filter (and with the image sizes, if `record_sizes`), so that rebuilding the index
+    after adding shards only scans the new ones.
+    """
+    cached = {}
+    if cached_index is not None and cached_index.filter_cfg == (filter_cfg or None):
+        cached = {shard['url']: shard for shard in cached_index.shards}
+
+    def is_fresh(url):
+        shard = cached.get(url)
+        if shard is None or (record_sizes and 'sizes' not in shard):
+            return False
+        stat = os.stat(os.path.join(root, url))
+        return shard['size'] == stat.st_size and shard['mtime'] == stat.st_mtime
+
+    to_scan = [url for url in urls if not is_fresh(url)]
+    logging.info(f'Scanning {len(to_scan)} shards, reusing {len(urls) - len(to_scan)} cached entries')
+
+    scanned = {}
+    scan_fn = partial(scan_shard, root=root, filter_cfg=filter_cfg, image_key=image_key, record_sizes=record_sizes)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for n, entry in enumerate(pool.map(scan_fn, to_scan, chunksize=4)):
+            scanned[entry['url']] = entry
+            if (n + 1) % 1000 == 0:
+                logging.info(f'Scanned {n + 1}/{len(to_scan)} shards')
+
+    shards = [scanned[url] if url in scanned else cached[url] for url in urls]
+    return ShardIndex(shards, filter_cfg)
+
+
+def coalesce_ranges(ranges, max_gap=_MAX_RANGE_GAP):
+    r"""Merge sorted byte ranges that are at most `max_gap` bytes apart. Returns a list of `[start, end]`."""
+    merged = []
+    for start, end in ranges:
+        if merged and start - merged[-1][1] <= max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def iter_samples_by_range(url, shard, keys, max_gap=_MAX_RANGE_GAP, **kw):
+    r"""
+    Read the samples `keys` of an indexed shard with byte range reads instead of streaming the whole tar file.
+
+    Args:
+        url: the shard URL.
+        shard: the index entry of the shard.
+        keys: keys of the samples to read.
+        max_gap: samples closer than this many bytes are fetched with a single read.
+        kw: keyword arguments of `read_byte_ranges`.
+    Yields the samples in tar order, in the format produced by webdataset's `group_by_keys`. Only the bytes of one
+    read are held in memory at a time.
+    """
+    position = {key: i for i, key in enumerate(shard['keys'])}
+    sample_ranges = sorted(tuple(shard['offsets'][position[key]]) for key in keys)
+    reads = coalesce_ranges(sample_ranges, max_gap=max_gap)
+    range_id = 0
+    for read_start, read_end in reads:
+        (data,) = read_byte_ranges(url, [(read_start, read_end)], **kw)
+        while range_id < len(sample_ranges) and sample_ranges[range_id][0] < read_end:
+            start, end = sample_ranges[range_id]
+            range_id += 1
+            sample = None
+            with tarfile.open(fileobj=io.BytesIO(data[start - read_start : end - read_start]), mode='r:') as tar:
+                for member in tar:
+                    if not member.isreg():
+                        continue
+                    key, ext = split_member_name(member.name)
+                    if key is None:
+                        continue
+                    if sample is None:
+                        sample = {'__key__': key, '__url__': url}
+                    sample[ext.lower()] = tar.extractfile(member).read()
+            if sample is not None:
+                yield sample
+
+
+def samples_in_order(samples, keys):
+    r"""
+    Yield the samples of `keys`, in that order, out of an iterator of samples. A sample is yielded as soon as all
+    the samples before it are, so only the samples that arrive before their turn are buffered, and none when the
+    iterator is in the order of `keys`. The samples of `keys` missing from the iterator are skipped.
+    """
+    wanted = set(keys)
+    pending = {}
+    next_id = 0
+    for sample in samples:
+        if sample['__key__'] not in wanted:
+            continue
+        pending[sample['__key__']] = sample
+        while next_id < len(keys) and keys[next_id] in pending:
+            yield pending.pop(keys[next_id])
+            next_id += 1
+    for key in keys[next_id:]:
+        if key in pending:
+            yield pending.pop(key)
+
+
+def shard_sample_order(index, shard_id, epoch, seed=0, shuffle=True):
+    r"""
+    Positions (in tar order) of the samples of a shard that pass the index filter, in the order they are read in
+    `epoch`: permuted with a seed derived from (`seed`, epoch, shard id) if `shuffle`.
+    """
+    positions = index.kept_positions(shard_id)
+    if shuffle:
+        random.Random(f'{seed}-{epoch}-{shard_id}').shuffle(positions)
+    return positions
+
+
+def indexed_tarfile_samples(
+    src,
+    index,
+    seed=0,
+    shuffle=True,
+    use_byte_ranges=True,
+    handler=reraise_exception,
+    load_from_object_store=False,
+    s3_client=None,
+    s3_bucket_name=None,
+    local_root_path=None,
+    s3_reader=None,
+):
+    r"""
+    Expand shard descriptors `dict(url, shard_id, epoch, start, stop)` into samples.
+
+    The samples of a shard that pass the index filter are permuted with a seed derived from (`seed`, epoch,
+    shard id), and the slice `[start, stop)` of that permutation is yielded. Because the order only depends on the
+    descriptor, resuming in the middle of a shard yields exactly the samples that were not consumed yet.
+    Descriptors may instead list the exact `positions` (in tar order) of the samples to yield, in order.
+
+    With `use_byte_ranges`, shards of which only part of the samples are needed (the first shard after resuming,
+    or filtered shards) are read with file seeks or S3 ranged GET requests of the needed samples only, using the
+    byte offsets of the index. Otherwise the whole shard is streamed, through `s3_reader` if given.
+    """
+
+    def is_partial(descriptor):
+        num_wanted = descriptor['stop'] - descriptor['start']
+        return use_byte_ranges and num_wanted < index.shards[descriptor['shard_id']]['num_samples']
+
+    if load_from_object_store:
+        # shards read with byte ranges are not downloaded in full
+        src = prefetch_urls(src, s3_reader, should_prefetch=lambda descriptor: not is_partial(descriptor))
+    for descriptor in src:
+        shard_id, epoch = descriptor['shard_id'], descriptor['epoch']
+        shard = index.shards[shard_id]
+        if 'positions' in descriptor:
+            positions = descriptor['positions']
+        else:
+            positions = shard_sample_order(index, shard_id, epoch, seed=seed, shuffle=shuffle)
+            positions = positions[descriptor['start'] : descriptor['stop']]
+        wanted_keys = [shard['keys'][i] for i in positions]
+
+        if is_partial(descriptor):
+            try:
+                # byte ranges are read in tar order, so a shuffled shard holds the samples of the ranges read so far
+                # until their turn
+                yield from samples_in_order(
+                    iter_samples_by_range(
+                        descriptor['url'],
+                        shard,
+                        wanted_keys,
+                        object_store=load_from_object_store,
+                        s3_client=s3_client,
+                        s3_bucket_name=s3_bucket_name,
+                        local_root_path=local_root_path,
+                    ),
+                    wanted_keys,
+                )
+            except Exception as exn:
+                exn.args = exn.args + (descriptor['url'],)
+                if handler(exn):
+                    continue
+                else:
+                    break
+        else:
+            streams = url_opener(
+                [dict(url=descriptor['url'])],
+                handler=handler,
+                object_store=load_from_object_store,
+                s3_client=s3_client,
+                s3_bucket_name=s3_bucket_name,
+                local_root_path=local_root_path,
+                s3_reader=s3_reader,
+            )
+            samples = group_by_keys(tar_file_expander(streams, handler=handler), handler=handler)
+            yield from samples_in_order(samples, wanted_keys)
+
+
+indexed_tarfile_to_samples = pipelinefilter(indexed_tarfile_samples)
+
+
+class IndexedWebDataset(DataPipeline, FluidInterface):
+    r"""
+    Webdataset pipeline reading the shard descriptors produced by `WDSIndexedShardSampler`.
+
+    Args:
+        sampler: iterable of shard descriptors.
+        index: the `ShardIndex` the sampler was built from.
+        seed: seed of the within-shard permutation.
+        shuffle: permute the samples within every shard.
+        use_byte_ranges: read partially needed shards with byte range requests.
+        s3_reader: optional S3ShardReader fetching and prefetching the shards streamed from object store.
+    """
+
+    def __init__(
+        self,
+        sampler,
+        index,
+        seed=0,
+        shuffle=True,
+        use_byte_ranges=True,
+        handler=reraise_exception,
+        load_from_object_store=False,
+        s3_client=None,
+        s3_bucket_name=None,
+        local_root_path=None,
+        s3_reader=None,
+    ):
+        super().__init__()
+        self.append(sampler)
+        self.append(
+            indexed_tarfile_to_samples(
+                index=index,
+                seed=seed,
+                shuffle=shuffle,
+                use_byte_ranges=use_byte_ranges,
+                handler=handler,
+                load_from_object_store=load_from_object_store,
+                s3_client=s3_client,
+                s3_bucket_name=s3_bucket_name,
+                local_root_path=local_root_path,
+                s3_reader=s3_reader,
+            )
+        )
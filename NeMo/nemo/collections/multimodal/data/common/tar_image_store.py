@@ -0,0 +1,212 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Random access to the images of tar files through a persistent index and memory maps.
+
+The index is a directory built once by `scripts/dataset_processing/multimodal/build_tar_image_index.py`:
+
+    index.json    {"version": 1, "shards": ["/data/images_000.tar", ...], "num_images": 1000000}
+    names.npy     sorted member names, fixed width utf-8 bytes
+    entries.npy   (shard, offset, size) of the data of every member, in the order of the names
+
+Both arrays are opened as read-only memory maps, so all dataloader workers share the same pages, and a member
+name is found with a binary search. The tar files are memory mapped too, and the bytes of a member are a zero-copy
+view of the map. An optional `ThumbnailCache` keeps decoded images, resized to the fixed input size of the vision
+encoder, in a memory-mapped file shared by all workers.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from nemo.utils import logging
+
+TAR_IMAGE_INDEX_VERSION = 1
+ENTRY_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('size', '<i8')])
+
+
+def scan_tar_members(path):
+    r"""Return the name, data offset and size of every regular member of a tar file, reading the headers only."""
+    members = []
+    with tarfile.open(path, 'r:') as tar:
+        for member in tar:
+            if member.isreg():
+                members.append((member.name, member.offset_data, member.size))
+    return members
+
+
+def build_tar_image_index(tar_paths, output_dir, num_workers=8):
+    r"""
+    Scan `tar_paths` in parallel and write the index of their members to `output_dir`.
+    Members of the same name in several tar files are resolved to the first one.
+    """
+    tar_paths = [os.path.abspath(path) for path in tar_paths]
+    names, entries = [], []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for shard, members in enumerate(pool.map(scan_tar_members, tar_paths)):
+            for name, offset, size in members:
+                names.append(name.encode('utf-8'))
+                entries.append((shard, offset, size))
+            logging.info(f'Scanned {tar_paths[shard]}: {len(members)} members')
+
+    names = np.array(names, dtype=f'S{max((len(name) for name in names), default=1)}')
+    entries = np.array(entries, dtype=ENTRY_DTYPE)
+    order = np.argsort(names, kind='stable')
+    names, entries = names[order], entries[order]
+    # keep the first of duplicated names
+    unique = np.ones(len(names), dtype=bool)
+    unique[1:] = names[1:] != names[:-1]
+    names, entries = names[unique], entries[unique]
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, 'names.npy'), names)
+    np.save(os.path.join(output_dir, 'entries.npy'), entries)
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'version': TAR_IMAGE_INDEX_VERSION, 'shards': tar_paths, 'num_images': len(names)}, f)
+    return len(names)
+
+
+class TarImageStore:
+    r"""
+    Read-only store of the images of indexed tar files.
+
+    Memory maps are opened lazily in every process, so a store can be created in the main process and pickled to
+    the dataloader workers.
+
+    Args:
+        index_dir: directory of the index written by `build_tar_image_index`.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            index = json.load(f)
+        if index.get('version') != TAR_IMAGE_INDEX_VERSION:
+            raise ValueError(f'Unsupported tar image index version {index.get("version")} in {index_dir}')
+        self.shards = index['shards']
+        self.num_images = index['num_images']
+        self._names = None
+        self._entries = None
+        self._maps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_names=None, _entries=None, _maps={})
+        return state
+
+    def __len__(self):
+        return self.num_images
+
+    def _open_index(self):
+        if self._names is None:
+            self._names = np.load(os.path.join(self.index_dir, 'names.npy'), mmap_mode='r')
+            self._entries = np.load(os.path.join(self.index_dir, 'entries.npy'), mmap_mode='r')
+
+    def _shard_map(self, shard):
+        if shard not in self._maps:
+            with open(self.shards[shard], 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def find(self, name):
+        r"""Id of the image `name`, or -1 if it is not in the store."""
+        self._open_index()
+        key = name.encode('utf-8')
+        i = int(np.searchsorted(self._names, key))
+        if i < len(self._names) and self._names[i] == key:
+            return i
+        return -1
+
+    def read(self, image_id):
+        r"""Zero-copy view of the encoded bytes of an image."""
+        self._open_index()
+        shard, offset, size = self._entries[image_id].tolist()
+        return memoryview(self._shard_map(shard))[offset : offset + size]
+
+    def open_image(self, image_id):
+        with self.read(image_id) as data:
+            image = Image.open(io.BytesIO(data))
+            return image.convert('RGB')
+
+    def fingerprint(self):
+        r"""Hash of the paths, sizes and modification times of the tar files, which change with their images."""
+        shards = [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in self.shards]
+        return hashlib.sha1(json.dumps([self.num_images, shards]).encode('utf-8')).hexdigest()
+
+
+class ThumbnailCache:
+    r"""
+    Memory-mapped cache of decoded images of a fixed size, shared by all the processes on a node.
+
+    Slot `i` holds image `i` of a `TarImageStore` as a (height, width, 3) uint8 array. The cache files are sparse,
+    so only the slots that were filled take disk space. A slot is marked valid only after its pixels are written,
+    and concurrent writers of a slot write the same pixels. The file names include a hash of `key`, so that the
+    thumbnails of other images, or of other transforms, are kept in other files.
+
+    Args:
+        cache_dir: directory of the cache files, created if needed.
+        num_images: number of slots.
+        height: height of the thumbnails.
+        width: width of the thumbnails.
+        key: identity of the images and of their transform, e.g. the `TarImageStore.fingerprint` of the store and
+            the settings of the transform.
+    """
+
+    def __init__(self, cache_dir, num_images, height, width, key=''):
+        self.cache_dir = cache_dir
+        self.shape = (num_images, height, width, 3)
+        self._pixels = None
+        self._valid = None
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        name = f'thumbnails_{num_images}x{height}x{width}_{digest}'
+        self.pixels_path = os.path.join(cache_dir, f'{name}.u8')
+        self.valid_path = os.path.join(cache_dir, f'{name}.valid')
+        for path, size in [(self.pixels_path, int(np.prod(self.shape))), (self.valid_path, num_images)]:
+            if not os.path.exists(path):
+                # create the sparse file under a temporary name, so that other processes never see a partial one
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.truncate(size)
+                os.replace(tmp_path, path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pixels=None, _valid=None)
+        return state
+
+    def _open(self):
+        if self._pixels is None:
+            self._pixels = np.memmap(self.pixels_path, dtype=np.uint8, mode='r+', shape=self.shape)
+            self._valid = np.memmap(self.valid_path, dtype=np.uint8, mode='r+', shape=self.shape[:1])
+
+    def get(self, image_id):
+        r"""The cached thumbnail as a PIL image, or None."""
+        self._open()
+        if not self._valid[image_id]:
+            return None
+        return Image.fromarray(np.array(self._pixels[image_id]))
+
+    def put(self, image_id, image):
+        self._open()
+        pixels = np.asarray(image.convert('RGB'), dtype=np.uint8)
+        assert pixels.shape == self.shape[1:], f'Thumbnails must be of shape {self.shape[1:]}, got {pixels.shape}'
+        self._pixels[image_id] = pixels
+        self._valid[image_id] = 1
@@ -18,6 +18,7 @@ import os
 import pickle
 import random
 import re
+from functools import partial
 from typing import Callable, List, Union
 
 import boto3
@@ -29,7 +30,15 @@ from webdataset import WebDataset, warn_and_continue
 from webdataset.filters import _shuffle
 from webdataset.utils import pytorch_worker_info
 
-from nemo.collections.multimodal.data.common.data_samplers import SharedEpoch, WDSUrlsRandomSampler
+from nemo.collections.multimodal.data.common.aspect_buckets import bucket_batches
+from nemo.collections.multimodal.data.common.data_samplers import (
+    SharedEpoch,
+    WDSBucketedShardSampler,
+    WDSIndexedShardSampler,
+    WDSUrlsRandomSampler,
+)
+from nemo.collections.multimodal.data.common.s3_shard_reader import S3ShardReader
+from nemo.collections.multimodal.data.common.shard_index import IndexedWebDataset, ShardIndex, shard_sample_order
 from nemo.collections.multimodal.data.common.webdataset_s3 import WebDataset as WebDatasetS3
 from nemo.core.classes import IterableDataset as NeMoIterableDataset
 from nemo.utils import logging
@@ -115,6 +124,8 @@ class WebDatasetCommon(NeMoIterableDataset):
         gen_cfg=None,
         decode_fn: Callable = None,
         is_train=True,
+        micro_batch_size: int = 1,
+        aspect_buckets=None,
     ):
 
         super().__init__()
@@ -125,6 +136,8 @@ class WebDatasetCommon(NeMoIterableDataset):
         self.infinite_sampler = self.webdata_cfg.get("infinite_sampler", False)
         self.gen_cfg = gen_cfg
         self.consumed_samples = consumed_samples
+        self.micro_batch_size = micro_batch_size
+        self.aspect_buckets = aspect_buckets
 
         self.local_root_path = self.webdata_cfg.local_root_path
         if is_train:
@@ -142,19 +155,49 @@ class WebDatasetCommon(NeMoIterableDataset):
             assert dataset_cfg.boto3.credentials_file is not None
             with open(dataset_cfg.boto3.credentials_file) as fin:
                 self.credentials = json.load(fin)
-            config = Config(connect_timeout=30, signature_version="s3", retries={"max_attempts": 999999})
+            boto3_cfg = dataset_cfg.boto3
+            # botocore's standard retry mode backs off exponentially with jitter
+            config = Config(
+                connect_timeout=30,
+                signature_version="s3",
+                retries={"max_attempts": boto3_cfg.get("max_attempts", 10), "mode": "standard"},
+                max_pool_connections=boto3_cfg.get("max_concurrency", 16),
+            )
             self.s3 = boto3.client('s3', **self.credentials, config=config)
-            self.bucket = dataset_cfg.boto3.bucket
+            self.bucket = boto3_cfg.bucket
             self.local_root_path = ""
+            self.s3_reader = None
+            if boto3_cfg.get("prefetch_shards", 0) > 0:
+                self.s3_reader = S3ShardReader(
+                    client_factory=partial(boto3.client, 's3', config=config, **self.credentials),
+                    bucket=self.bucket,
+                    cache_dir=boto3_cfg.get("cache_dir", None),
+                    cache_size_mb=boto3_cfg.get("cache_size_mb", 4096),
+                    max_concurrency=boto3_cfg.get("max_concurrency", 16),
+                    prefetch_shards=boto3_cfg.prefetch_shards,
+                    part_size_mb=boto3_cfg.get("part_size_mb", 8),
+                    max_attempts=boto3_cfg.get("max_attempts", 10),
+                )
         else:
             logging.info(f'Read Webdataset locally. Data stores at {self.local_root_path}')
             self.use_boto3 = False
             self.s3 = None
             self.bucket = None
+            self.s3_reader = None
 
         # wdinfo in a dict containing webdata information
         self.wdinfo = dict()
-        if dataset_path[0].endswith(".pkl"):
+        self.shard_index = None
+        if dataset_path[0].endswith(".json"):
+            # shard index built by scripts/dataset_processing/multimodal/build_webdataset_index.py
+            self.shard_index = ShardIndex.merge([ShardIndex.load(path) for path in dataset_path])
+            self._check_shard_index_filter()
+            shard_sizes = self.shard_index.shard_sizes
+            self.wdinfo['tar_files'] = self.shard_index.urls
+            self.wdinfo['total_key_count'] = sum(shard_sizes)
+            self.wdinfo['chunk_size'] = max(shard_sizes)
+            train_info = self.wdinfo
+        elif dataset_path[0].endswith(".pkl"):
             for dset_info_path in dataset_path:
                 with open(dset_info_path, 'rb') as fp:
                     dset_info = pickle.load(fp)
@@ -185,6 +228,10 @@ class WebDatasetCommon(NeMoIterableDataset):
         )
         self.consumed_samples = self.consumed_urls * chunk_size
         self.skip_ahead = consumed_samples - self.consumed_samples
+        if self.use_shard_index:
+            # the indexed sampler resumes from the exact sample
+            self.consumed_samples = consumed_samples
+            self.skip_ahead = 0
 
         decode_fn = pil_loader if decode_fn is None else decode_fn
         shards_train_list = train_info["tar_files"]
@@ -194,30 +241,54 @@ class WebDatasetCommon(NeMoIterableDataset):
         # Shuffle buffer:
         shuffle_buffer_size = train_info["chunk_size"]
 
-        if self.filterings is not None:
+        if self.filterings is not None and not self.use_shard_index:
             # TODO : Not a good way of estimating filtering (We expect user to give estimated portion)
             # We should estimate in someway. This is anyway used only in progress bar
             logging.info(f'Estimated {self.filterings.estimated_portion} will be remaining after filtering')
             train_info["total_key_count"] = int(train_info["total_key_count"] * self.filterings.estimated_portion)
 
+        if self.aspect_buckets is not None and not (self.use_shard_index and self.shard_index.has_sizes):
+            logging.warning(
+                'Aspect ratio buckets are assigned on the fly, the number of batches per epoch is not exact and '
+                'resuming may repeat or skip samples. Build the shard index with --record_sizes to avoid it.'
+            )
+
         # WDS Dataset Pipeline
-        # DetShuffle -> Decode -> Filter -> Map -> Compose
+        # DetShuffle -> Decode -> Filter -> (Bucket and) Map -> Compose
         train_dataset, epoch = self._get_webdataset_and_epoch()
-        train_dataset = train_dataset.compose(detshuffle2(bufsize=shuffle_buffer_size, epoch=epoch))
+        if not self.use_shard_index:
+            # the indexed pipeline permutes the samples within every shard instead
+            train_dataset = train_dataset.compose(detshuffle2(bufsize=shuffle_buffer_size, epoch=epoch))
         train_dataset = train_dataset.decode(decode_fn, handler=warn_and_continue)
 
-        if self.filterings is not None:
+        # samples of an indexed dataset are filtered by the index before they are read
+        if self.filterings is not None and not self.use_shard_index:
             if self.filterings.resolution is not None:
                 train_dataset = train_dataset.select(filter_fn)
 
-        train_dataset = train_dataset.map(map_fn, handler=warn_and_continue)
+        if self.aspect_buckets is not None:
+            # micro batches hold samples of a single bucket, samples are mapped before they join the run of their
+            # bucket so that a sample failing to map does not shift the others into a run of another bucket
+            train_dataset = train_dataset.compose(
+                partial(
+                    bucket_batches,
+                    aspect_buckets=self.aspect_buckets,
+                    micro_batch_size=self.micro_batch_size,
+                    map_fn=map_fn,
+                    handler=warn_and_continue,
+                )
+            )
+        else:
+            train_dataset = train_dataset.map(map_fn, handler=warn_and_continue)
         if not isinstance(compose_fn, list):
             compose_fn = [compose_fn]
         for fn in compose_fn:
             train_dataset = train_dataset.compose(fn)
         train_dataset.total_images = train_info["total_key_count"]
-
-        if train_info["total_key_count"] != train_info["chunk_size"] * len(train_info["tar_files"]):
+        if self.use_shard_index:
+            # exact number of samples all data parallel ranks read in an epoch
+            train_dataset.total_images = len(self._sampler) * self.data_parallel_size
+        elif train_info["total_key_count"] != train_info["chunk_size"] * len(train_info["tar_files"]):
             logging.warning("Total image count is not equal to chunk_size * number of tar files.")
 
         if self.infinite_sampler:
@@ -231,7 +302,59 @@ class WebDatasetCommon(NeMoIterableDataset):
 
         self._dataset = train_dataset
 
+    @property
+    def use_shard_index(self):
+        return self.shard_index is not None and not self.infinite_sampler
+
+    def _check_shard_index_filter(self):
+        filter_cfg = None
+        if self.filterings is not None and self.filterings.get('resolution') is not None:
+            resolution = self.filterings.resolution
+            filter_cfg = {'resolution': {'value': resolution.value, 'method': resolution.get('method', 'larger')}}
+        if filter_cfg != self.shard_index.filter_cfg:
+            raise ValueError(
+                f'Shard index was built with filter {self.shard_index.filter_cfg}, but the dataset is configured with '
+                f'{filter_cfg}. Rebuild the index with the same filter to get exact sample counts.'
+            )
+
+    def _get_indexed_webdataset_and_epoch(self):
+        seed = self.webdata_cfg.get("seed", 0)
+        sampler_kwargs = dict(
+            urls=self.shard_index.urls,
+            shard_sizes=self.shard_index.shard_sizes,
+            consumed_samples=self.consumed_samples,
+            micro_batch_size=self.micro_batch_size,
+            data_parallel_rank=parallel_state.get_data_parallel_rank(),
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+            num_workers=self.num_workers,
+            seed=seed,
+        )
+        if self.aspect_buckets is not None and self.shard_index.has_sizes:
+            # the batches are planned from the image sizes of the index
+            self._sampler = WDSBucketedShardSampler(
+                sample_buckets=self.shard_index.sample_buckets(self.aspect_buckets.assign),
+                sample_order_fn=partial(shard_sample_order, self.shard_index, seed=seed),
+                **sampler_kwargs,
+            )
+        else:
+            self._sampler = WDSIndexedShardSampler(**sampler_kwargs)
+        train_dataset = IndexedWebDataset(
+            self._sampler,
+            self.shard_index,
+            seed=seed,
+            use_byte_ranges=self.webdata_cfg.get("use_byte_ranges", True),
+            handler=warn_and_continue,
+            load_from_object_store=self.use_boto3,
+            s3_client=self.s3,
+            s3_bucket_name=self.bucket,
+            local_root_path=self.local_root_path,
+            s3_reader=self.s3_reader,
+        )
+        return train_dataset, self._sampler.epoch
+
     def _get_webdataset_and_epoch(self):
+        if self.use_shard_index:
+            return self._get_indexed_webdataset_and_epoch()
         train_info = self.wdinfo
         chunk_size = train_info["chunk_size"]
         shards_train_list = train_info["tar_files"]
@@ -264,6 +387,7 @@ class WebDatasetCommon(NeMoIterableDataset):
                 load_from_object_store=self.use_boto3,
                 s3_client=self.s3,
                 s3_bucket_name=self.bucket,
+                s3_reader=self.s3_reader,
             )
         else:
             train_dataset = WebDataset(
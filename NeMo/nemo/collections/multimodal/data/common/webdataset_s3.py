@@ -1,6 +1,8 @@
 import io
+import itertools
 import os
 import sys
+from collections import deque
 from urllib.parse import urlparse
 
 import webdataset.gopen as gopen_webdata
@@ -54,6 +56,9 @@ def gopen(url, mode="rb", bufsize=8192, **kw):
     # in arguments.
     if 'object_store' in kw and kw['object_store']:
         # Load from object store
+        if kw.get('s3_reader') is not None:
+            # pooled, prefetching reader backed by a local spill cache
+            return kw['s3_reader'].open(url)
         attempt = 0
 
         while attempt < _NUM_OBJECT_STORE_READ_ATTEMPTS:
@@ -92,6 +97,71 @@ def gopen(url, mode="rb", bufsize=8192, **kw):
     return handler(url, mode, bufsize, **kw)
 
 
+def read_byte_ranges(url, ranges, **kw):
+    r"""Read the byte ranges `[start, end)` of the URL, with a file seek or S3 ranged GET requests.
+
+    Accepts the same keyword arguments as `gopen`. Returns the content of every range as bytes.
+
+    Args:
+        url (str): the source URL
+        ranges (list[tuple[int, int]]): the byte ranges to read
+    """
+    if 'object_store' in kw and kw['object_store']:
+        chunks = []
+        for start, end in ranges:
+            attempt = 0
+            while True:
+                try:
+                    s3_response_object = kw['s3_client'].get_object(
+                        Bucket=kw['s3_bucket_name'], Key=url, Range=f'bytes={start}-{end - 1}'
+                    )
+                    object_content = s3_response_object['Body'].read()
+                    if len(object_content) == end - start:
+                        break
+                    attempt += 1
+                except Exception as e:  # noqa
+                    attempt += 1
+                    print(e)
+                    print('Retrying ranged read of tar file, attempt {}'.format(attempt))
+                if attempt >= _NUM_OBJECT_STORE_READ_ATTEMPTS:
+                    raise ConnectionError('Unable to read {} from PBSS. {} attempts tried.'.format(url, attempt))
+            chunks.append(object_content)
+        return chunks
+
+    if 'local_root_path' in kw and kw['local_root_path'] is not None:
+        url = os.path.join(kw['local_root_path'], url)
+    pr = urlparse(url)
+    if pr.scheme not in ["", "file"]:
+        raise ValueError(f'Byte range reads are not supported for {url}')
+    chunks = []
+    with open(pr.path if pr.scheme == "file" else url, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            chunks.append(f.read(end - start))
+    return chunks
+
+
+def prefetch_urls(data, s3_reader=None, should_prefetch=None):
+    r"""Pass through a stream of `dict(url=url)` while asking `s3_reader` to prefetch the upcoming urls.
+
+    Args:
+        data: Iterator of dictionaires containing url paths.
+        s3_reader: S3ShardReader, if None the stream is passed through unchanged.
+        should_prefetch: Optional predicate selecting the dictionaries whose url is prefetched.
+    """
+    if s3_reader is None or s3_reader.prefetch_shards <= 0:
+        yield from data
+        return
+    data = iter(data)
+    upcoming = deque(itertools.islice(data, s3_reader.prefetch_shards + 1))
+    while upcoming:
+        s3_reader.prefetch(
+            [sample["url"] for sample in upcoming if should_prefetch is None or should_prefetch(sample)]
+        )
+        yield upcoming.popleft()
+        upcoming.extend(itertools.islice(data, 1))
+
+
 def url_opener(data, handler=reraise_exception, **kw):
     r"""Given a stream of url names (packaged in `dict(url=url)`), yield opened streams.
 
@@ -99,6 +169,8 @@ def url_opener(data, handler=reraise_exception, **kw):
         data: Iterator of dictionaires containing url paths.
         handler: Exception handler.
     """
+    if kw.get('object_store'):
+        data = prefetch_urls(data, kw.get('s3_reader'))
     for sample in data:
         assert isinstance(sample, dict), sample
         assert "url" in sample
@@ -123,6 +195,7 @@ def tarfile_samples(
     s3_client=None,
     s3_bucket_name=None,
     local_root_path=None,
+    s3_reader=None,
 ):
     r"""
     Given an iterator of filenames, this function opens the URL streams
@@ -137,6 +210,8 @@ def tarfile_samples(
         s3_bucket_name: If loading from object store, specify S3 bucket name.
         local_root_path: If loading from local (or mounted) disk system,
                 specify the root path of the dataset.
+        s3_reader: If loading from object store, optional S3ShardReader fetching
+                and prefetching the shards.
     """
     streams = url_opener(
         src,
@@ -145,6 +220,7 @@ def tarfile_samples(
         s3_client=s3_client,
         s3_bucket_name=s3_bucket_name,
         local_root_path=local_root_path,
+        s3_reader=s3_reader,
     )
     files = tar_file_expander(streams, handler=handler)
     samples = group_by_keys(files, handler=handler)
@@ -172,6 +248,7 @@ class WebDataset(DataPipeline, FluidInterface):
         s3_client=None,
         s3_bucket_name=None,
         local_root_path=None,
+        s3_reader=None,
     ):
         r"""
         Args:
@@ -190,6 +267,8 @@ class WebDataset(DataPipeline, FluidInterface):
             s3_bucket_name: If loading from object store, specify S3 bucket name.
             local_root_path: If loading from local (or mounted) disk system,
                 specify the root path of the dataset.
+            s3_reader: If loading from object store, optional S3ShardReader fetching
+                and prefetching the shards.
         """
         super().__init__()
         if isinstance(urls, IterableDataset):
@@ -224,6 +303,7 @@ class WebDataset(DataPipeline, FluidInterface):
                     s3_client=s3_client,
                     s3_bucket_name=s3_bucket_name,
                     local_root_path=local_root_path,
+                    s3_reader=s3_reader,
                 )
             )
         else:
@@ -18,6 +18,7 @@ from nemo.collections.multimodal.data.stable_diffusion.augmentation.augmentation
     construct_image_augmentations,
     identical_transform,
 )
+from nemo.collections.multimodal.data.stable_diffusion.precached_dataset import build_precached_memmap_datasets
 
 
 def build_train_valid_datasets(
@@ -48,6 +49,7 @@ def build_train_valid_datasets(
         map_fn=transform_fn,
         compose_fn=tuple_to_dict,
         is_train=True,
+        micro_batch_size=model_cfg.micro_batch_size,
     )
 
     val_data = None
@@ -58,6 +60,7 @@ def build_train_valid_datasets(
             map_fn=transform_fn,
             compose_fn=tuple_to_dict,
             is_train=False,
+            micro_batch_size=model_cfg.micro_batch_size,
         )
 
     return train_data, val_data
@@ -68,6 +71,18 @@ def build_train_valid_precached_datasets(
 ):
     data_cfg = model_cfg.data
 
+    # memory-mapped shards written by examples/multimodal/generative/stable_diffusion/sd_precache.py
+    if data_cfg.get('precached_format', 'webdataset') == 'memmap':
+        return build_precached_memmap_datasets(
+            model_cfg,
+            consumed_samples,
+            field_to_key={
+                'latents': model_cfg.first_stage_key,
+                'text': model_cfg.cond_stage_key,
+                'hint': model_cfg.control_key,
+            },
+        )
+
     # This function maps data that are tuples to dictionary.
     def tuple_to_dict(inp):
         for input in inp:
@@ -85,6 +100,7 @@ def build_train_valid_precached_datasets(
         map_fn=transform_fn,
         compose_fn=tuple_to_dict,
         is_train=True,
+        micro_batch_size=model_cfg.micro_batch_size,
     )
 
     val_data = None
@@ -95,6 +111,7 @@ def build_train_valid_precached_datasets(
             map_fn=transform_fn,
             compose_fn=tuple_to_dict,
             is_train=False,
+            micro_batch_size=model_cfg.micro_batch_size,
         )
 
     return train_data, val_data
@@ -152,5 +152,6 @@ def build_train_valid_datasets(
         compose_fn=compose_fn,
         filter_fn=build_resolution_filter(**filter_cfg.resolution, image_idx='jpg') if filter_cfg else None,
         is_train=True,
+        micro_batch_size=model_cfg.micro_batch_size,
     )
     return train_data, None
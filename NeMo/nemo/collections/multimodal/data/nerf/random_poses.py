@@ -371,7 +371,7 @@ class RandomPosesDataset(IterableDataset):
                     - azimuth (torch.Tensor): A A tensor containing the azimuth angle.
         """
         # Generate random poses and directions
-        poses, dirs, thetas, phis, radius = rand_poses(
+        poses, thetas, phis, radius, dirs = rand_poses(
             size=self.internal_batch_size,
             radius_range=self.current_radius_range,
             theta_range=self.current_theta_range,
@@ -6,6 +6,7 @@ import pathlib
 import re
 import tarfile
 from dataclasses import dataclass, field
+from functools import partial
 from typing import Any, Dict, List, Optional, Sequence, Union
 
 import torch
@@ -19,7 +20,9 @@ from torch.utils.data import Dataset, default_collate
 from transformers import CLIPImageProcessor
 
 import nemo.collections.multimodal.data.neva.conversation as conversation_lib
+from nemo.collections.multimodal.data.common.tar_image_store import TarImageStore, ThumbnailCache
 from nemo.collections.multimodal.data.kosmos.kosmos_dataset import tokenize_and_insert_media_tokens
+from nemo.collections.multimodal.data.neva.neva_feature_store import VisionFeatureStore, feature_store_dir
 from nemo.collections.nlp.modules.common.megatron.utils import get_ltor_masks_and_position_ids
 
 MAX_NUM_IMAGES = 4
@@ -38,10 +41,42 @@ DEFAULT_IM_END_TOKEN = "<extra_id_5>"
 
 
 class TarOrFolderImageLoader:
-    def __init__(self, image_folder):
+    """
+    Opens images by file name from a folder or a tar file.
+
+    With `image_index`, the directory written by `scripts/dataset_processing/multimodal/build_tar_image_index.py`,
+    images are read from memory-mapped tar files through the persistent index instead, and with `thumbnail_cache`
+    the images are decoded once, transformed with `thumbnail_fn` and kept in a memory-mapped cache of
+    `thumbnail_size` (height, width) images shared by all the workers. `thumbnail_key` describes the settings of
+    `thumbnail_fn`, the thumbnails of other settings are cached in other files.
+    """
+
+    def __init__(
+        self,
+        image_folder,
+        image_index=None,
+        thumbnail_cache=None,
+        thumbnail_size=None,
+        thumbnail_fn=None,
+        thumbnail_key='',
+    ):
         self.image_folder = image_folder
         self.tar_index = {}
-        if self.image_folder.endswith('.tar'):
+        self.image_store = None
+        self.thumbnails = None
+        self.thumbnail_fn = thumbnail_fn
+        if image_index is not None:
+            self.image_store = TarImageStore(image_index)
+            if thumbnail_cache is not None:
+                self.thumbnails = ThumbnailCache(
+                    thumbnail_cache,
+                    len(self.image_store),
+                    *thumbnail_size,
+                    key=f'{self.image_store.fingerprint()} {thumbnail_key}',
+                )
+        elif thumbnail_cache is not None:
+            raise ValueError('The thumbnail cache requires an image index')
+        elif self.image_folder.endswith('.tar'):
             self.build_index()
 
     def build_index(self):
@@ -50,6 +85,17 @@ class TarOrFolderImageLoader:
                 self.tar_index[member.name] = member
 
     def open_image(self, file_name):
+        if self.image_store is not None:
+            image_id = self.image_store.find(file_name)
+            if image_id < 0:
+                return None
+            if self.thumbnails is None:
+                return self.image_store.open_image(image_id)
+            image = self.thumbnails.get(image_id)
+            if image is None:
+                image = self.thumbnail_fn(self.image_store.open_image(image_id))
+                self.thumbnails.put(image_id, image)
+            return image
         if self.image_folder.endswith('.tar'):
             with tarfile.open(self.image_folder, 'r') as tar:
                 member = self.tar_index.get(file_name)
@@ -357,6 +403,103 @@ def preprocess_nvgpt(sources: dict, tokenizer: transformers.PreTrainedTokenizer,
     return dict(tokens=tokens, labels=labels,)
 
 
+def preprocess_conversations(sources: dict, tokenizer: transformers.PreTrainedTokenizer, cfg,) -> Dict:
+    """Tokenize conversations and mask their labels with the preprocessing of the `conv_template` of `cfg`."""
+    conv_template = cfg["conv_template"]
+    if conv_template == "nvgpt":
+        return preprocess_nvgpt(sources, tokenizer, cfg,)
+    elif conv_template == "v1":
+        return preprocess_v1(sources, tokenizer, cfg,)
+    elif conv_template == "llama_2":
+        return preprocess_llama_2(sources, tokenizer, cfg,)
+    raise ValueError(f"Conversation template `{conv_template}` is not supported in Neva now.")
+
+
+def expand2square(pil_img, background_color):
+    width, height = pil_img.size
+    if width == height:
+        return pil_img
+    elif width > height:
+        result = Image.new(pil_img.mode, (width, width), background_color)
+        result.paste(pil_img, (0, (width - height) // 2))
+        return result
+    else:
+        result = Image.new(pil_img.mode, (height, height), background_color)
+        result.paste(pil_img, ((height - width) // 2, 0))
+        return result
+
+
+def process_image(image, processor, image_aspect_ratio):
+    """Preprocess a PIL image into the pixel values of the vision encoder, according to `image_aspect_ratio`."""
+    if image_aspect_ratio == 'keep':
+        max_hw, min_hw = max(image.size), min(image.size)
+        aspect_ratio = max_hw / min_hw
+        max_len, min_len = 448, 224
+        shortest_edge = int(min(max_len / aspect_ratio, min_len))
+        return processor.preprocess(
+            image, return_tensors='pt', do_center_crop=False, size={"shortest_edge": shortest_edge}
+        )['pixel_values'][0]
+    elif image_aspect_ratio == 'pad':
+        image = expand2square(image, tuple(int(x * 255) for x in processor.image_mean))
+    return processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+
+
+def resize_to_input_size(image, processor, image_aspect_ratio):
+    """
+    Resize and crop a PIL image to the input size of the vision encoder, as `process_image` does before rescaling
+    and normalizing, so that `process_image` leaves the result unchanged.
+    """
+    if image_aspect_ratio == 'pad':
+        image = expand2square(image, tuple(int(x * 255) for x in processor.image_mean))
+    width, height = image.size
+    shortest_edge = processor.size['shortest_edge']
+    if width <= height:
+        size = (shortest_edge, int(shortest_edge * height / width))
+    else:
+        size = (int(shortest_edge * width / height), shortest_edge)
+    image = image.resize(size, resample=processor.resample)
+    crop_height, crop_width = processor.crop_size['height'], processor.crop_size['width']
+    left, top = (size[0] - crop_width) // 2, (size[1] - crop_height) // 2
+    return image.crop((left, top, left + crop_width, top + crop_height))
+
+
+def make_image_loader(multimodal_cfg: dict) -> TarOrFolderImageLoader:
+    """Make the image loader of the NeVA datasets, reading from the tar image index and thumbnail cache if set."""
+    thumbnail_cache = multimodal_cfg.get('thumbnail_cache')
+    processor = multimodal_cfg['image_processor']
+    image_aspect_ratio = multimodal_cfg['image_aspect_ratio']
+    if thumbnail_cache is not None and image_aspect_ratio == 'keep':
+        raise ValueError("image_aspect_ratio 'keep' resizes every image differently, it can't use a thumbnail cache")
+    return TarOrFolderImageLoader(
+        multimodal_cfg['image_folder'],
+        image_index=multimodal_cfg.get('image_index'),
+        thumbnail_cache=thumbnail_cache,
+        thumbnail_size=(processor.crop_size['height'], processor.crop_size['width']) if thumbnail_cache else None,
+        thumbnail_fn=partial(resize_to_input_size, processor=processor, image_aspect_ratio=image_aspect_ratio),
+        thumbnail_key=f'{resize_to_input_size.__name__} {image_aspect_ratio} {processor.size} {processor.crop_size} '
+        f'{processor.resample} {processor.image_mean}',
+    )
+
+
+def parse_steerlm_record(record: dict, image_folder: str) -> dict:
+    """
+    Move the images of a SteerLM record, given as `<img src="/absolute/path/to/image">` tags in the conversation,
+    to `record['image']` and replace the tags with the image token.
+    """
+    record['image'] = []
+    for turn in record['conversations']:
+        matches = re.finditer('<img src="([^"]+)"', turn['value'])
+        for match in matches:
+            image_name = match.group(1).split("/")[-1]
+            image_path = os.path.join(image_folder, image_name)
+            if not os.path.isfile(image_path):
+                logging.warning(f"Image not found: {image_path}")
+                continue
+            record['image'].append(image_name)  # url
+        turn['value'] = re.sub('<img src="([^"]+)">', DEFAULT_IMAGE_TOKEN, turn['value'])
+    return record
+
+
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -377,7 +520,11 @@ class LazySupervisedDataset(Dataset):
         self.image_folder = multimodal_cfg['image_folder']
         self.processor = multimodal_cfg["image_processor"]
 
-        self.image_loader = TarOrFolderImageLoader(self.image_folder)
+        self.image_loader = make_image_loader(multimodal_cfg)
+        # precomputed features of the frozen vision encoder, read instead of the images
+        self.feature_store = None
+        if multimodal_cfg.get('vision_features') is not None:
+            self.feature_store = VisionFeatureStore(multimodal_cfg['vision_features'])
 
     def __len__(self):
         return len(self.list_data_dict)
@@ -394,62 +541,37 @@ class LazySupervisedDataset(Dataset):
 
             images = []
             for image_file in self.list_data_dict[i]['image']:
+                if self.feature_store is not None:
+                    images.append(self.feature_store.get(image_file))
+                    continue
                 image = self.image_loader.open_image(image_file)
                 if image is None:
                     logging.warning(f"Image {image_file} could not be found!")
-                if self.multimodal_cfg['image_aspect_ratio'] == 'keep':
-                    max_hw, min_hw = max(image.size), min(image.size)
-                    aspect_ratio = max_hw / min_hw
-                    max_len, min_len = 448, 224
-                    shortest_edge = int(min(max_len / aspect_ratio, min_len))
-                    image = processor.preprocess(
-                        image, return_tensors='pt', do_center_crop=False, size={"shortest_edge": shortest_edge}
-                    )['pixel_values'][0]
-                elif self.multimodal_cfg['image_aspect_ratio'] == 'pad':
-
-                    def expand2square(pil_img, background_color):
-                        width, height = pil_img.size
-                        if width == height:
-                            return pil_img
-                        elif width > height:
-                            result = Image.new(pil_img.mode, (width, width), background_color)
-                            result.paste(pil_img, (0, (width - height) // 2))
-                            return result
-                        else:
-                            result = Image.new(pil_img.mode, (height, height), background_color)
-                            result.paste(pil_img, ((height - width) // 2, 0))
-                            return result
-
-                    image = expand2square(image, tuple(int(x * 255) for x in processor.image_mean))
-                    image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-                else:
-                    image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+                image = process_image(image, processor, self.multimodal_cfg['image_aspect_ratio'])
                 images.append(image)
             images_tensors = torch.tensor([])
             if images:
                 images_tensors = torch.stack(images)
-                cur_token_len = (images_tensors[0].shape[1] // 14) * (
-                    images_tensors[0].shape[2] // 14
-                )  # FIXME: 14 is hardcoded patch size
+                if self.feature_store is not None:
+                    cur_token_len = images_tensors.shape[1]
+                else:
+                    cur_token_len = (images_tensors[0].shape[1] // 14) * (
+                        images_tensors[0].shape[2] // 14
+                    )  # FIXME: 14 is hardcoded patch size
                 sources = preprocess_multimodal(copy.deepcopy(sources), self.multimodal_cfg, cur_token_len)
         else:
             images_tensors = torch.tensor([])
             sources = copy.deepcopy(sources)
 
-        if self.conv_template == "nvgpt":
-            data_dict = preprocess_nvgpt(sources, self.tokenizer, self.multimodal_cfg,)
-        elif self.conv_template == "v1":
-            data_dict = preprocess_v1(sources, self.tokenizer, self.multimodal_cfg,)
-        elif self.conv_template == "llama_2":
-            data_dict = preprocess_llama_2(sources, self.tokenizer, self.multimodal_cfg,)
-        else:
-            raise ValueError(f"Conversation template `{self.conv_template}` is not supported in Neva now.")
+        data_dict = preprocess_conversations(sources, self.tokenizer, self.multimodal_cfg)
 
         if isinstance(i, int):
             data_dict = dict(tokens=data_dict["tokens"][0], labels=data_dict["labels"][0])
 
         # image exist in the data
-        if self.multimodal_cfg['is_multimodal']:
+        if self.multimodal_cfg['is_multimodal'] and self.feature_store is not None:
+            data_dict['image'] = self.feature_store.pad(images_tensors, MAX_NUM_IMAGES)
+        elif self.multimodal_cfg['is_multimodal']:
             crop_size = self.processor.crop_size
             # image does not exist in the data, but the model is multimodal
             zero_padding = torch.zeros(
@@ -475,28 +597,40 @@ class NevaDataset(LazySupervisedDataset):
             for line in open(data_path, "r"):
                 record = json.loads(line)
 
-                # This currently supports only a single image
                 # search for <img src="/absolute/path/to/image" in the conversation
                 #   add it as record['image'], remove src tag from the <img> tag
-
-                record['image'] = []
-                for turn in record['conversations']:
-                    matches = re.finditer('<img src="([^"]+)"', turn['value'])
-                    for match in matches:
-                        image_name = match.group(1).split("/")[-1]
-                        image_path = os.path.join(image_folder, image_name)
-                        if not os.path.isfile(image_path):
-                            logging.warning(f"Image not found: {image_path}")
-                            continue
-                        record['image'].append(image_name)  # url
-                    turn['value'] = re.sub('<img src="([^"]+)">', DEFAULT_IMAGE_TOKEN, turn['value'])
-
-                self.list_data_dict.append(record)
+                self.list_data_dict.append(parse_steerlm_record(record, image_folder))
 
         else:
             raise ValueError(f"Formatting of {data_path} is not supported in Neva.")
 
 
+def get_packed_masks_and_position_ids(seq_lengths, seq_len: int):
+    """
+    Block diagonal causal attention mask and position ids of packed samples.
+
+    Args:
+        seq_lengths: for every sample, the lengths of the sequences packed in it. The tokens after the last
+            sequence (padding) form a sequence of their own.
+        seq_len: padded length of the samples.
+    Returns:
+        attention_mask of shape (b, 1, seq_len, seq_len), True where attention is masked, and position_ids of shape
+        (b, seq_len) restarting from 0 at every sequence.
+    """
+    segment_ids = torch.zeros(len(seq_lengths), seq_len, dtype=torch.long)
+    position_ids = torch.zeros(len(seq_lengths), seq_len, dtype=torch.long)
+    for i, lengths in enumerate(seq_lengths):
+        offset = 0
+        for segment, length in enumerate(lengths.tolist()):
+            segment_ids[i, offset : offset + length] = segment + 1
+            position_ids[i, offset : offset + length] = torch.arange(length)
+            offset += length
+        position_ids[i, offset:] = torch.arange(seq_len - offset)
+    causal = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool))
+    attention_mask = ~(causal & (segment_ids[:, :, None] == segment_ids[:, None, :]))
+    return attention_mask.unsqueeze(1), position_ids
+
+
 @dataclass
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
@@ -505,6 +639,10 @@ class DataCollatorForSupervisedDataset(object):
     tokenizer: transformers.PreTrainedTokenizer
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        # packed samples hold several conversations, which must not attend to each other
+        seq_lengths = None
+        if 'seq_lengths' in instances[0]:
+            seq_lengths = [instance.pop('seq_lengths') for instance in instances]
         max_len = max(instance['tokens'].shape[0] for instance in instances)
         max_len = (max_len - 1) // 4 * 4 + 4
         for instance in instances:
@@ -527,6 +665,8 @@ class DataCollatorForSupervisedDataset(object):
             reset_attention_mask=False,
             reset_position_ids=False,
         )
+        if seq_lengths is not None:
+            attention_mask, position_ids = get_packed_masks_and_position_ids(seq_lengths, tokens.shape[1])
 
         loss_mask[labels == -1] = 0.0
         tokens[tokens == -1] = 0
@@ -534,6 +674,9 @@ class DataCollatorForSupervisedDataset(object):
 
         if media is None:
             raise NotImplementedError
+        elif media.ndim == 4:
+            # precomputed vision features
+            media = rearrange(media, "b T v d -> b T 1 v d")
         else:
             media = rearrange(media, "b T c h w -> b T 1 c h w")
 
@@ -548,8 +691,8 @@ class DataCollatorForSupervisedDataset(object):
         return batch
 
 
-def make_supervised_data_module(tokenizer, model_cfg) -> Dict:
-    """Make dataset and collator for supervised fine-tuning."""
+def get_multimodal_cfg(model_cfg) -> Dict:
+    """Build the multimodal config of the NeVA datasets, including the image processor."""
     data_cfg = model_cfg.data
     mm_cfg = model_cfg.mm_cfg
     add_extra_token = 1
@@ -564,21 +707,33 @@ def make_supervised_data_module(tokenizer, model_cfg) -> Dict:
         image_processor = CLIPImageProcessor.from_pretrained(
             "openai/clip-vit-large-patch14", torch_dtype=torch.bfloat16
         )
+    vision_features = None
+    if data_cfg.get("vision_features", None) is not None:
+        if not mm_cfg.vision_encoder.freeze:
+            raise ValueError("model.data.vision_features requires a frozen vision encoder")
+        vision_features = feature_store_dir(model_cfg)
+    return dict(
+        is_multimodal=data_cfg.is_multimodal,
+        sep_image_conv_front=data_cfg.sep_image_conv_front,
+        conv_template=data_cfg.get("conv_template", "nvgpt"),
+        image_token_len=data_cfg.image_token_len,
+        image_folder=data_cfg.image_folder,
+        image_index=data_cfg.get("image_index", None),
+        thumbnail_cache=data_cfg.get("thumbnail_cache", None),
+        vision_features=vision_features,
+        image_aspect_ratio=data_cfg.image_aspect_ratio,
+        use_im_start_end=getattr(model_cfg.mm_cfg, 'use_im_start_end', False),
+        image_processor=image_processor,
+        add_extra_token=add_extra_token,
+        context_length=model_cfg.encoder_seq_length,
+    )
+
+
+def make_supervised_data_module(tokenizer, model_cfg) -> Dict:
+    """Make dataset and collator for supervised fine-tuning."""
+    data_cfg = model_cfg.data
     train_dataset = NevaDataset(
-        tokenizer=tokenizer,
-        data_path=data_cfg.data_path,
-        multimodal_cfg=dict(
-            is_multimodal=data_cfg.is_multimodal,
-            sep_image_conv_front=data_cfg.sep_image_conv_front,
-            conv_template=data_cfg.get("conv_template", "nvgpt"),
-            image_token_len=data_cfg.image_token_len,
-            image_folder=data_cfg.image_folder,
-            image_aspect_ratio=data_cfg.image_aspect_ratio,
-            use_im_start_end=getattr(model_cfg.mm_cfg, 'use_im_start_end', False),
-            image_processor=image_processor,
-            add_extra_token=add_extra_token,
-            context_length=model_cfg.encoder_seq_length,
-        ),
+        tokenizer=tokenizer, data_path=data_cfg.data_path, multimodal_cfg=get_multimodal_cfg(model_cfg),
     )
     # data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset, eval_dataset=train_dataset)
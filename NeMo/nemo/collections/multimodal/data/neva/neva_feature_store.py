@@ -0,0 +1,271 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Precomputed features of a frozen NeVA vision encoder, stored in memory-mapped files.
+
+With a frozen vision encoder the features of an image are the same at every epoch, so
+`examples/multimodal/mllm/neva/neva_extract_vision_features.py` computes them once and the datasets read them
+instead of decoding and preprocessing the images. The features are the hidden states of the selected layer without
+the class tokens, before the trainable vision projection. A store lives in a directory named after the hash of the
+vision config the features depend on, so that a config change never reads stale features:
+
+    <vision_features>/<vision_config_hash>/index.json    layout and config, "complete" once all features are written
+    <vision_features>/<vision_config_hash>/names.npy     sorted image names, fixed width utf-8 bytes
+    <vision_features>/<vision_config_hash>/features.npy  (num_images, num_patches, hidden_size) features
+    <vision_features>/<vision_config_hash>/written.npy   whether the features of every image are written
+
+Every extraction process writes the features of its images to a shard of its own, `shard-<name>.*.npy` in the
+store directory, as memory maps of a file shared by processes on different nodes are not coherent. The shards are
+then merged into the store by `merge_vision_feature_shards`.
+"""
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+VISION_FEATURE_STORE_VERSION = 1
+# numpy has no bfloat16, bfloat16 features are stored as their int16 bits
+STORAGE_DTYPES = {'bfloat16': np.int16, 'float16': np.float16, 'float32': np.float32}
+TORCH_DTYPES = {'bfloat16': torch.bfloat16, 'float16': torch.float16, 'float32': torch.float32}
+MERGE_CHUNK_SIZE = 1024
+
+
+def vision_config(model_cfg) -> dict:
+    """The settings of a NeVA model config that the vision features depend on."""
+    vision_cfg = model_cfg.mm_cfg.vision_encoder
+    return dict(
+        from_pretrained=vision_cfg.from_pretrained,
+        from_hf=vision_cfg.from_hf,
+        vision_select_layer=vision_cfg.get("vision_select_layer", -2),
+        class_token_length=vision_cfg.get("class_token_length", 1),
+        image_aspect_ratio=model_cfg.data.image_aspect_ratio,
+    )
+
+
+def vision_config_hash(model_cfg) -> str:
+    return hashlib.sha1(json.dumps(vision_config(model_cfg), sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def feature_store_dir(model_cfg) -> str:
+    """Directory of the feature store of `model.data.vision_features` for the vision config of the model."""
+    return os.path.join(model_cfg.data.vision_features, vision_config_hash(model_cfg))
+
+
+def _encode_names(image_names):
+    return np.unique(np.array([name.encode('utf-8') for name in image_names], dtype=np.bytes_))
+
+
+def _to_storage(features: torch.Tensor, dtype) -> np.ndarray:
+    features = features.detach().to(TORCH_DTYPES[dtype]).cpu().contiguous()
+    if dtype == 'bfloat16':
+        features = features.view(torch.int16)
+    return features.numpy()
+
+
+class VisionFeatureStoreWriter:
+    """
+    Creates a store and writes vision features to it.
+
+    Args:
+        store_dir: directory of the store.
+        image_names: names of all the images of the store.
+        num_patches: number of feature vectors per image.
+        hidden_size: size of the feature vectors.
+        dtype: 'bfloat16', 'float16' or 'float32'.
+        config: vision config recorded in the store.
+    """
+
+    def __init__(self, store_dir, image_names, num_patches, hidden_size, dtype='bfloat16', config=None):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.names = _encode_names(image_names)
+        np.save(os.path.join(store_dir, 'names.npy'), self.names)
+        shape = (len(self.names), num_patches, hidden_size)
+        self.features = np.lib.format.open_memmap(
+            os.path.join(store_dir, 'features.npy'), mode='w+', dtype=STORAGE_DTYPES[dtype], shape=shape
+        )
+        self.written = np.lib.format.open_memmap(
+            os.path.join(store_dir, 'written.npy'), mode='w+', dtype=np.uint8, shape=(len(self.names),)
+        )
+        self.index = dict(shape=list(shape), dtype=dtype, config=config or {}, complete=False)
+        self._write_index(self.index)
+
+    def _write_index(self, index):
+        with open(os.path.join(self.store_dir, 'index.json'), 'w') as f:
+            json.dump({'version': VISION_FEATURE_STORE_VERSION, **index}, f, indent=2)
+
+    def add(self, image_names, features: torch.Tensor):
+        """Write the (len(image_names), num_patches, hidden_size) features of `image_names`."""
+        self._write([name.encode('utf-8') for name in image_names], _to_storage(features, self.index['dtype']))
+
+    def _write(self, names, features: np.ndarray):
+        ids = np.searchsorted(self.names, names)
+        if len(names) > 0 and (ids.max() >= len(self.names) or np.any(self.names[ids] != names)):
+            raise KeyError(f'Some of the images are not in the store {self.store_dir}')
+        self.features[ids] = features
+        self.written[ids] = 1
+
+    def finalize(self):
+        """Mark the store as complete once the features of all the images are written."""
+        self.features.flush()
+        self.written.flush()
+        num_missing = int(len(self.written) - np.count_nonzero(self.written))
+        if num_missing > 0:
+            raise ValueError(f'The features of {num_missing} images were not written to {self.store_dir}')
+        self._write_index(dict(self.index, complete=True))
+
+
+class VisionFeatureShardWriter:
+    """
+    Writes the vision features of a subset of the images of a store to a shard, merged into the store by
+    `merge_vision_feature_shards`. The layout of the features is taken from the first added features, and a shard
+    without images has no features file.
+
+    Args:
+        store_dir: directory of the store.
+        shard_name: name of the shard, unique among the processes writing the store.
+        image_names: names of the images of the shard.
+        dtype: 'bfloat16', 'float16' or 'float32'.
+    """
+
+    def __init__(self, store_dir, shard_name, image_names, dtype='bfloat16'):
+        self.prefix = os.path.join(store_dir, f'shard-{shard_name}')
+        self.dtype = dtype
+        os.makedirs(store_dir, exist_ok=True)
+        self.names = _encode_names(image_names)
+        self.written = np.zeros(len(self.names), dtype=np.uint8)
+        self.features = None
+
+    def add(self, image_names, features: torch.Tensor):
+        """Write the (len(image_names), num_patches, hidden_size) features of `image_names`."""
+        features = _to_storage(features, self.dtype)
+        if self.features is None:
+            self.features = np.lib.format.open_memmap(
+                f'{self.prefix}.features.npy',
+                mode='w+',
+                dtype=features.dtype,
+                shape=(len(self.names), *features.shape[1:]),
+            )
+        ids = np.searchsorted(self.names, [name.encode('utf-8') for name in image_names])
+        self.features[ids] = features
+        self.written[ids] = 1
+
+    def close(self):
+        """Flush the features, then write the names and whether the features of every image are written."""
+        if self.features is not None:
+            self.features.flush()
+            self.features = None
+        np.save(f'{self.prefix}.written.npy', self.written)
+        # written last, a shard is only merged once complete
+        np.save(f'{self.prefix}.names.npy', self.names)
+
+
+def remove_vision_feature_shards(store_dir):
+    """Remove the shards of the store, e.g. of an interrupted extraction."""
+    for path in glob.glob(os.path.join(store_dir, 'shard-*.npy')):
+        os.remove(path)
+
+
+def merge_vision_feature_shards(store_dir, image_names, dtype='bfloat16', config=None) -> VisionFeatureStoreWriter:
+    """
+    Create the store of `image_names` from the shards written by `VisionFeatureShardWriter`, with the layout of the
+    features of the first shard that has images, then mark the store complete and remove the shards.
+    """
+    shards = []
+    for names_path in sorted(glob.glob(os.path.join(store_dir, 'shard-*.names.npy'))):
+        prefix = names_path[: -len('.names.npy')]
+        features_path = f'{prefix}.features.npy'
+        if os.path.exists(features_path):
+            written = np.flatnonzero(np.load(f'{prefix}.written.npy'))
+            shards.append((np.load(names_path), np.load(features_path, mmap_mode='r'), written))
+    if not shards:
+        raise ValueError(f'No vision features were written to the shards of {store_dir}')
+
+    _, num_patches, hidden_size = shards[0][1].shape
+    writer = VisionFeatureStoreWriter(store_dir, image_names, num_patches, hidden_size, dtype=dtype, config=config)
+    for names, features, written in shards:
+        # copied in chunks, a shard may not fit in memory
+        for start in range(0, len(written), MERGE_CHUNK_SIZE):
+            ids = written[start : start + MERGE_CHUNK_SIZE]
+            writer._write(names[ids], features[ids])
+    writer.finalize()
+    remove_vision_feature_shards(store_dir)
+    return writer
+
+
+def _read_index(store_dir):
+    with open(os.path.join(store_dir, 'index.json')) as f:
+        index = json.load(f)
+    if index.get('version') != VISION_FEATURE_STORE_VERSION:
+        raise ValueError(f'Unsupported vision feature store version {index.get("version")} in {store_dir}')
+    return index
+
+
+class VisionFeatureStore:
+    """
+    Read-only access to the vision features of a complete store. Memory maps are opened lazily in every process,
+    so the store can be pickled to dataloader workers.
+
+    Args:
+        store_dir: directory of the store, see `feature_store_dir`.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(os.path.join(store_dir, 'index.json')):
+            raise FileNotFoundError(
+                f'No vision features in {store_dir} for this vision config, '
+                f'run examples/multimodal/mllm/neva/neva_extract_vision_features.py first'
+            )
+        index = _read_index(store_dir)
+        if not index['complete']:
+            raise ValueError(f'The vision features in {store_dir} are incomplete, the extraction did not finish')
+        self.feature_shape = tuple(index['shape'][1:])
+        self.dtype = TORCH_DTYPES[index['dtype']]
+        self._names = None
+        self._features = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_names=None, _features=None)
+        return state
+
+    def _open(self):
+        if self._names is None:
+            self._names = np.load(os.path.join(self.store_dir, 'names.npy'), mmap_mode='r')
+            self._features = np.load(os.path.join(self.store_dir, 'features.npy'), mmap_mode='r')
+
+    def __len__(self):
+        self._open()
+        return len(self._names)
+
+    def get(self, image_name) -> torch.Tensor:
+        """The (num_patches, hidden_size) features of an image."""
+        self._open()
+        key = image_name.encode('utf-8')
+        i = int(np.searchsorted(self._names, key))
+        if i >= len(self._names) or self._names[i] != key:
+            raise KeyError(f'No vision features for image {image_name} in {self.store_dir}')
+        features = torch.from_numpy(np.array(self._features[i]))
+        return features.view(self.dtype) if self.dtype == torch.bfloat16 else features
+
+    def pad(self, features: torch.Tensor, max_num_images: int) -> torch.Tensor:
+        """Pad the stacked features of the images of a sample, possibly none, with zeros to `max_num_images`."""
+        padding = torch.zeros((max_num_images - len(features), *self.feature_shape), dtype=self.dtype)
+        if len(features) == 0:
+            return padding
+        return torch.cat((features, padding), dim=0)
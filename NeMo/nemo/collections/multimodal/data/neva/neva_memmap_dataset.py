@@ -0,0 +1,267 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pre-tokenized NeVA conversations stored in memory-mapped indexed files, with packing of several conversations per
+sample.
+
+`examples/multimodal/mllm/neva/neva_preprocess.py` tokenizes every conversation once and writes three
+`MMapIndexedDataset`s (the `.bin` / `.idx` format of the Megatron language modeling datasets) and a metadata file:
+
+    <prefix>_tokens.{bin,idx}  tokens of every conversation, one item per conversation
+    <prefix>_labels.{bin,idx}  labels of every conversation (already shifted, IGNORE_INDEX where there is no loss)
+    <prefix>_images.{bin,idx}  utf-8 file names of the images, one item per image, one document per conversation
+    <prefix>_meta.json         preprocessing settings
+
+Training then reads tokens and labels straight from the page cache, without loading the conversation file into
+memory or tokenizing again, and only opens and preprocesses the images.
+"""
+import copy
+import json
+import logging
+from typing import Dict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from nemo.collections.multimodal.data.neva.neva_dataset import (
+    MAX_NUM_IMAGES,
+    get_multimodal_cfg,
+    make_image_loader,
+    preprocess_conversations,
+    preprocess_multimodal,
+    process_image,
+)
+from nemo.collections.multimodal.data.neva.neva_feature_store import VisionFeatureStore
+from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import (
+    MMapIndexedDataset,
+    MMapIndexedDatasetBuilder,
+    data_file_path,
+    index_file_path,
+)
+
+NEVA_MEMMAP_VERSION = 1
+
+
+def tokenize_conversation_record(record: dict, tokenizer, multimodal_cfg: dict, image_token_len: int):
+    """
+    Tokenize a conversation record the same way `LazySupervisedDataset` does.
+
+    Args:
+        record: conversation record, with the names of its images in `record['image']` if any.
+        tokenizer: the NeMo tokenizer of the model.
+        multimodal_cfg: the multimodal config of `make_supervised_data_module`.
+        image_token_len: number of patch tokens per image.
+    Returns:
+        (tokens, labels, image names), tokens and labels as int32 arrays.
+    """
+    images = record.get('image', [])
+    if not isinstance(images, list):
+        images = [images]
+    sources = [record]
+    if images:
+        sources = preprocess_multimodal(copy.deepcopy(sources), multimodal_cfg, image_token_len)
+    data_dict = preprocess_conversations(sources, tokenizer, multimodal_cfg)
+    tokens = data_dict['tokens'][0].numpy().astype(np.int32)
+    labels = data_dict['labels'][0].numpy().astype(np.int32)
+    return tokens, labels, images
+
+
+class NevaMemmapWriter:
+    """
+    Writes tokenized conversations to the memory-mapped files of `NevaPackedDataset`.
+
+    Args:
+        output_prefix: prefix of the files to write.
+    """
+
+    def __init__(self, output_prefix: str):
+        self.output_prefix = output_prefix
+        self._tokens = MMapIndexedDatasetBuilder(data_file_path(f'{output_prefix}_tokens'), dtype=np.int32)
+        self._labels = MMapIndexedDatasetBuilder(data_file_path(f'{output_prefix}_labels'), dtype=np.int32)
+        self._images = MMapIndexedDatasetBuilder(data_file_path(f'{output_prefix}_images'), dtype=np.uint8)
+        self.num_conversations = 0
+
+    def add(self, tokens, labels, images):
+        assert len(tokens) == len(labels), 'Tokens and labels must have the same length'
+        self._tokens.add_item(torch.from_numpy(np.asarray(tokens, dtype=np.int32)))
+        self._tokens.end_document()
+        self._labels.add_item(torch.from_numpy(np.asarray(labels, dtype=np.int32)))
+        self._labels.end_document()
+        for image in images:
+            self._images.add_item(torch.from_numpy(np.frombuffer(image.encode('utf-8'), dtype=np.uint8).copy()))
+        self._images.end_document()
+        self.num_conversations += 1
+
+    def finalize(self, metadata: dict):
+        for name, builder in [('tokens', self._tokens), ('labels', self._labels), ('images', self._images)]:
+            builder.finalize(index_file_path(f'{self.output_prefix}_{name}'))
+        with open(f'{self.output_prefix}_meta.json', 'w') as f:
+            json.dump(
+                {'version': NEVA_MEMMAP_VERSION, 'num_conversations': self.num_conversations, **metadata}, f, indent=2
+            )
+
+
+def pack_conversations(lengths, num_images, pack_length: int, max_num_images: int = MAX_NUM_IMAGES):
+    """
+    Pack conversations into samples of at most `pack_length` tokens and `max_num_images` images, best fit
+    decreasing: conversations are placed from the longest to the shortest into the sample with the least room left
+    that can hold them.
+
+    Returns:
+        (offsets, members): the conversations of pack `i` are `members[offsets[i] : offsets[i + 1]]`, in increasing
+        order. Packs are sorted by their first conversation.
+    """
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), pack_length)
+    num_images = np.asarray(num_images, dtype=np.int64)
+    # bins by remaining room, and how many there are of every room
+    free = [[] for _ in range(pack_length + 1)]
+    num_free = np.zeros(pack_length + 1, dtype=np.int64)
+    bins, bin_images = [], []
+    for i in np.argsort(-lengths, kind='stable'):
+        length, images = int(lengths[i]), int(num_images[i])
+        bin_id = None
+        fitting = np.flatnonzero(num_free[length:])
+        if len(fitting) > 0:
+            room = length + int(fitting[0])
+            if bin_images[free[room][-1]] + images <= max_num_images:
+                bin_id = free[room].pop()
+                num_free[room] -= 1
+        if bin_id is None:
+            bin_id, room = len(bins), pack_length
+            bins.append([])
+            bin_images.append(0)
+        bins[bin_id].append(int(i))
+        bin_images[bin_id] += images
+        free[room - length].append(bin_id)
+        num_free[room - length] += 1
+
+    bins = sorted(sorted(members) for members in bins)
+    offsets = np.zeros(len(bins) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(members) for members in bins])
+    members = np.fromiter((i for members in bins for i in members), dtype=np.int64, count=int(offsets[-1]))
+    return offsets, members
+
+
+class NevaPackedDataset(Dataset):
+    """
+    Dataset of pre-tokenized NeVA conversations written by `NevaMemmapWriter`.
+
+    With `pack_length`, several conversations are packed into every sample (see `pack_conversations`) and the
+    `seq_lengths` of the packed conversations are returned, from which `DataCollatorForSupervisedDataset` builds a
+    block diagonal attention mask and position ids restarting at every conversation. Labels already mask the
+    prompts, so the loss of a sample only covers the responses of its conversations.
+
+    Args:
+        data_prefix: prefix of the files written by the preprocessing.
+        multimodal_cfg: the multimodal config of `make_supervised_data_module`.
+        pack_length: maximum number of tokens of a packed sample, None to read one conversation per sample.
+        max_num_images: number of images every sample is padded to.
+    """
+
+    def __init__(self, data_prefix: str, multimodal_cfg: dict, pack_length=None, max_num_images=MAX_NUM_IMAGES):
+        super().__init__()
+        with open(f'{data_prefix}_meta.json') as f:
+            self.metadata = json.load(f)
+        if self.metadata.get('version') != NEVA_MEMMAP_VERSION:
+            raise ValueError(f'Unsupported NeVA memmap version {self.metadata.get("version")} for {data_prefix}')
+        for key in ['conv_template', 'use_im_start_end', 'add_extra_token']:
+            if key in self.metadata and self.metadata[key] != multimodal_cfg.get(key):
+                raise ValueError(
+                    f'{data_prefix} was preprocessed with {key}={self.metadata[key]}, but the model is configured '
+                    f'with {key}={multimodal_cfg.get(key)}. Preprocess the data again.'
+                )
+
+        self.multimodal_cfg = multimodal_cfg
+        self.processor = multimodal_cfg["image_processor"]
+        self.image_loader = make_image_loader(multimodal_cfg)
+        self.feature_store = None
+        if multimodal_cfg.get('vision_features') is not None:
+            self.feature_store = VisionFeatureStore(multimodal_cfg['vision_features'])
+            image_token_len = self.metadata.get('image_token_len')
+            if image_token_len is not None and image_token_len != self.feature_store.feature_shape[0]:
+                raise ValueError(
+                    f'{data_prefix} was preprocessed with {image_token_len} tokens per image, but the vision '
+                    f'features have {self.feature_store.feature_shape[0]}'
+                )
+        self.max_num_images = max_num_images
+        self.tokens = MMapIndexedDataset(f'{data_prefix}_tokens', skip_warmup=True)
+        self.labels = MMapIndexedDataset(f'{data_prefix}_labels', skip_warmup=True)
+        self.images = MMapIndexedDataset(f'{data_prefix}_images', skip_warmup=True)
+        self.image_doc_idx = np.asarray(self.images.doc_idx, dtype=np.int64)
+
+        num_conversations = len(self.tokens)
+        if pack_length is None:
+            self.pack_offsets = np.arange(num_conversations + 1, dtype=np.int64)
+            self.pack_members = np.arange(num_conversations, dtype=np.int64)
+        else:
+            self.pack_offsets, self.pack_members = pack_conversations(
+                self.tokens.sizes, np.diff(self.image_doc_idx), pack_length, max_num_images
+            )
+            logging.info(
+                f'Packed {num_conversations} conversations into {len(self)} samples of at most {pack_length} tokens'
+            )
+
+    def __len__(self):
+        return len(self.pack_offsets) - 1
+
+    def image_names(self, conversation_id):
+        start, end = self.image_doc_idx[conversation_id], self.image_doc_idx[conversation_id + 1]
+        return [self.images[int(j)].tobytes().decode('utf-8') for j in range(start, end)]
+
+    def __getitem__(self, i):
+        tokens, labels, images, seq_lengths = [], [], [], []
+        for conversation_id in self.pack_members[self.pack_offsets[i] : self.pack_offsets[i + 1]]:
+            conversation_id = int(conversation_id)
+            tokens.append(torch.from_numpy(self.tokens[conversation_id].astype(np.int64)))
+            labels.append(torch.from_numpy(self.labels[conversation_id].astype(np.int64)))
+            seq_lengths.append(len(tokens[-1]))
+            if not self.multimodal_cfg['is_multimodal']:
+                continue
+            for image_file in self.image_names(conversation_id):
+                if self.feature_store is not None:
+                    images.append(self.feature_store.get(image_file))
+                    continue
+                image = self.image_loader.open_image(image_file)
+                if image is None:
+                    logging.warning(f"Image {image_file} could not be found!")
+                images.append(process_image(image, self.processor, self.multimodal_cfg['image_aspect_ratio']))
+
+        data_dict = dict(
+            tokens=torch.cat(tokens), labels=torch.cat(labels), seq_lengths=torch.tensor(seq_lengths, dtype=torch.long)
+        )
+        if self.multimodal_cfg['is_multimodal'] and self.feature_store is not None:
+            features = torch.stack(images) if images else torch.tensor([])
+            data_dict['image'] = self.feature_store.pad(features, self.max_num_images)
+        elif self.multimodal_cfg['is_multimodal']:
+            crop_size = self.processor.crop_size
+            images_tensors = torch.stack(images) if images else torch.tensor([])
+            zero_padding = torch.zeros(
+                (self.max_num_images - len(images), 3, crop_size['height'], crop_size['width']), dtype=torch.float
+            )
+            data_dict['image'] = torch.cat((images_tensors, zero_padding), dim=0)
+        return data_dict
+
+
+def make_packed_data_module(model_cfg) -> Dict:
+    """Make the datasets of pre-tokenized conversations, packed if `model.data.packing`."""
+    data_cfg = model_cfg.data
+    pack_length = model_cfg.encoder_seq_length if data_cfg.get("packing", False) else None
+    train_dataset = NevaPackedDataset(
+        data_cfg.data_prefix,
+        get_multimodal_cfg(model_cfg),
+        pack_length=pack_length,
+        max_num_images=data_cfg.get("max_num_images", MAX_NUM_IMAGES),
+    )
+    return dict(train_dataset=train_dataset, eval_dataset=train_dataset)
@@ -0,0 +1,366 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Memory-mappable storage of precomputed Stable Diffusion inputs (latent moments, text embeddings, ControlNet hints).
+
+A precached dataset is a directory holding an `index.json` and, for every shard and every field, one `.npy` file
+`<shard name>.<field>.npy` of shape `[num_samples, *field shape]`. The index looks like
+
+    {
+        "version": 1,
+        "fields": {"latents": {"shape": [8, 64, 64], "dtype": "float16"}, "text": {...}},
+        "shards": [{"name": "r00000-000000", "num_samples": 1000}, ...],
+        "total_samples": 1000000
+    }
+
+Samples are read straight from the page cache through copy-on-write memory maps, without unpickling or copying.
+"""
+import bisect
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+from nemo.core.classes import IterableDataset as NeMoIterableDataset
+from nemo.utils import logging
+
+try:
+    from megatron.core import parallel_state
+
+    HAVE_MEGATRON_CORE = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_MEGATRON_CORE = False
+
+PRECACHED_INDEX_VERSION = 1
+PRECACHED_INDEX_NAME = 'index.json'
+
+
+def _shard_field_path(root, shard_name, field):
+    return os.path.join(root, f'{shard_name}.{field}.npy')
+
+
+class PrecachedShardWriter:
+    """
+    Writes batches of fixed-shape arrays into memory-mappable shards of `samples_per_shard` samples.
+
+    The shape and dtype of every field are taken from the first batch. Shards are preallocated with
+    `numpy.lib.format.open_memmap`, so the writer never holds more than one batch in memory; the last
+    shard is truncated to the number of samples written when the writer is closed.
+
+    Args:
+        output_dir: directory the shards and the index are written to.
+        prefix: prefix of the shard names, must be unique per writer (e.g. per rank).
+        samples_per_shard: number of samples per shard.
+    """
+
+    def __init__(self, output_dir, prefix, samples_per_shard=1000):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.samples_per_shard = samples_per_shard
+        self.fields = None
+        self.shards = []
+        self._arrays = None
+        self._offset = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def num_samples(self):
+        return sum(shard['num_samples'] for shard in self.shards) + self._offset
+
+    def _open_shard(self):
+        name = f'{self.prefix}-{len(self.shards):06d}'
+        self._arrays = {
+            field: np.lib.format.open_memmap(
+                _shard_field_path(self.output_dir, name, field),
+                mode='w+',
+                dtype=np.dtype(spec['dtype']),
+                shape=(self.samples_per_shard, *spec['shape']),
+            )
+            for field, spec in self.fields.items()
+        }
+        self._name = name
+        self._offset = 0
+
+    def _close_shard(self):
+        if self._arrays is None:
+            return
+        num_samples = self._offset
+        for field in list(self._arrays):
+            array = self._arrays.pop(field)
+            array.flush()
+            if num_samples < self.samples_per_shard:
+                truncated = np.array(array[:num_samples])
+                # release the memory map before the file is rewritten
+                del array
+                np.save(_shard_field_path(self.output_dir, self._name, field), truncated)
+        self._arrays = None
+        if num_samples > 0:
+            self.shards.append({'name': self._name, 'num_samples': num_samples})
+        else:
+            for field in self.fields:
+                os.remove(_shard_field_path(self.output_dir, self._name, field))
+        self._offset = 0
+
+    def write(self, batch):
+        """
+        Append a batch given as a dict of field name to array (or tensor) with a leading batch dimension.
+        """
+        batch = {
+            field: value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else np.asarray(value)
+            for field, value in batch.items()
+        }
+        batch_size = {len(value) for value in batch.values()}
+        assert len(batch_size) == 1, 'All fields of a batch must have the same number of samples'
+        batch_size = batch_size.pop()
+
+        if self.fields is None:
+            self.fields = {
+                field: {'shape': list(value.shape[1:]), 'dtype': value.dtype.name} for field, value in batch.items()
+            }
+        elif set(batch) != set(self.fields):
+            raise ValueError(f'Expected fields {sorted(self.fields)}, got {sorted(batch)}')
+
+        start = 0
+        while start < batch_size:
+            if self._arrays is None:
+                self._open_shard()
+            count = min(batch_size - start, self.samples_per_shard - self._offset)
+            for field, value in batch.items():
+                if list(value.shape[1:]) != self.fields[field]['shape']:
+                    raise ValueError(
+                        f'Field {field} has shape {list(value.shape[1:])}, expected {self.fields[field]["shape"]}'
+                    )
+                self._arrays[field][self._offset : self._offset + count] = value[start : start + count]
+            self._offset += count
+            start += count
+            if self._offset == self.samples_per_shard:
+                self._close_shard()
+
+    def close(self, index_name=None):
+        """
+        Finish the last shard and write the index of the shards of this writer. Returns the index.
+        """
+        self._close_shard()
+        index = {
+            'version': PRECACHED_INDEX_VERSION,
+            'fields': self.fields or {},
+            'shards': self.shards,
+            'total_samples': self.num_samples,
+        }
+        with open(os.path.join(self.output_dir, index_name or f'{self.prefix}.index.json'), 'w') as f:
+            json.dump(index, f)
+        return index
+
+
+def merge_precached_indices(output_dir, pattern='*.index.json', index_name=PRECACHED_INDEX_NAME):
+    """
+    Merge the partial indices written by several `PrecachedShardWriter` (e.g. one per rank) into a single index.
+    """
+    paths = sorted(glob.glob(os.path.join(output_dir, pattern)))
+    assert len(paths) > 0, f'No index matching {pattern} found in {output_dir}'
+    fields, shards = None, []
+    for path in paths:
+        with open(path) as f:
+            index = json.load(f)
+        if not index['shards']:
+            continue
+        if fields is None:
+            fields = index['fields']
+        elif index['fields'] != fields:
+            raise ValueError(f'Fields of {path} do not match: {index["fields"]} vs {fields}')
+        shards.extend(index['shards'])
+    index = {
+        'version': PRECACHED_INDEX_VERSION,
+        'fields': fields or {},
+        'shards': shards,
+        'total_samples': sum(shard['num_samples'] for shard in shards),
+    }
+    with open(os.path.join(output_dir, index_name), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def load_precached_index(path):
+    """
+    Load an index given either its path or the directory containing `index.json`. Returns (root, index).
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PRECACHED_INDEX_NAME)
+    with open(path) as f:
+        index = json.load(f)
+    if index.get('version') != PRECACHED_INDEX_VERSION:
+        raise ValueError(f'Unsupported precached index version {index.get("version")} in {path}')
+    return os.path.dirname(path), index
+
+
+class PrecachedMemmapDataset(NeMoIterableDataset):
+    """
+    Zero-copy reader of the shards written by `PrecachedShardWriter`.
+
+    Every epoch visits a permutation of all samples (seeded by `seed + epoch`) that is interleaved across data
+    parallel ranks. Within a rank, consecutive micro batches are handed to the dataloader workers round robin,
+    which is the order the dataloader collects them in, so the sample order does not depend on the number of
+    workers and resuming from `consumed_samples` is exact.
+
+    Args:
+        paths: index files or directories containing an `index.json`.
+        field_to_key: mapping of the stored fields to the keys of the returned samples.
+        consumed_samples: number of samples consumed by all data parallel ranks so far.
+        micro_batch_size: batch size of the dataloader.
+        shuffle: shuffle the samples every epoch.
+        seed: base seed of the shuffling.
+        drop_last: drop the samples that do not fill a micro batch on every rank.
+    """
+
+    def __init__(
+        self,
+        paths,
+        field_to_key,
+        consumed_samples=0,
+        micro_batch_size=1,
+        shuffle=True,
+        seed=0,
+        drop_last=True,
+        data_parallel_rank=None,
+        data_parallel_size=None,
+    ):
+        super().__init__()
+        if isinstance(paths, str):
+            paths = [paths]
+        self.field_to_key = dict(field_to_key)
+        self.consumed_samples = consumed_samples
+        self.micro_batch_size = micro_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+
+        if data_parallel_rank is None:
+            if HAVE_MEGATRON_CORE and not parallel_state.is_unitialized():
+                data_parallel_rank = parallel_state.get_data_parallel_rank()
+                data_parallel_size = parallel_state.get_data_parallel_world_size()
+            else:
+                data_parallel_rank, data_parallel_size = 0, 1
+        self.data_parallel_rank = data_parallel_rank
+        self.data_parallel_size = data_parallel_size
+
+        self.shards = []
+        for path in paths:
+            root, index = load_precached_index(path)
+            missing = set(self.field_to_key) - set(index['fields'])
+            if missing:
+                raise ValueError(f'Precached dataset {path} has no fields {sorted(missing)}')
+            for shard in index['shards']:
+                self.shards.append((root, shard['name'], shard['num_samples']))
+        self.cumulative_sizes = np.cumsum([num_samples for _, _, num_samples in self.shards]).tolist()
+        self.total_samples = self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+        assert self.total_samples > 0, 'Did not find any precached samples.'
+
+        if self.drop_last:
+            self.samples_per_rank = self.total_samples // self.data_parallel_size
+            self.samples_per_rank -= self.samples_per_rank % self.micro_batch_size
+        else:
+            self.samples_per_rank = -(-self.total_samples // self.data_parallel_size)
+        if self.samples_per_rank == 0:
+            raise ValueError(
+                f'The precached dataset has {self.total_samples} samples, fewer than a micro batch of '
+                f'{self.micro_batch_size} samples on each of the {self.data_parallel_size} data parallel ranks'
+            )
+        self._memmaps = {}
+
+        logging.info(
+            f'Precached dataset with {len(self.shards)} shards, {self.total_samples} samples, '
+            f'{self.samples_per_rank} samples per data parallel rank'
+        )
+
+    def __len__(self):
+        return self.samples_per_rank
+
+    def _get_array(self, shard_id, field):
+        # opened lazily so that every dataloader worker maps the files after forking
+        key = (shard_id, field)
+        if key not in self._memmaps:
+            root, name, _ = self.shards[shard_id]
+            self._memmaps[key] = np.load(_shard_field_path(root, name, field), mmap_mode='c')
+        return self._memmaps[key]
+
+    def __getitem__(self, idx):
+        shard_id = bisect.bisect_right(self.cumulative_sizes, idx)
+        offset = idx - (self.cumulative_sizes[shard_id - 1] if shard_id > 0 else 0)
+        # the rows of 1-D fields are numpy scalars
+        return {
+            key: torch.from_numpy(np.asarray(self._get_array(shard_id, field)[offset]))
+            for field, key in self.field_to_key.items()
+        }
+
+    def _epoch_indices(self, epoch):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + epoch).permutation(self.total_samples)
+        else:
+            order = np.arange(self.total_samples)
+        if self.drop_last:
+            order = order[: self.samples_per_rank * self.data_parallel_size]
+        return order[self.data_parallel_rank :: self.data_parallel_size]
+
+    def __iter__(self):
+        worker_id, num_workers = 0, 1
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        rank_consumed = self.consumed_samples // self.data_parallel_size
+        epoch, offset = divmod(rank_consumed, self.samples_per_rank)
+        indices = self._epoch_indices(epoch)[offset:]
+
+        num_batches = -(-len(indices) // self.micro_batch_size)
+        for batch_id in range(worker_id, num_batches, num_workers):
+            start = batch_id * self.micro_batch_size
+            for idx in indices[start : start + self.micro_batch_size]:
+                yield self[int(idx)]
+
+        # every worker holds its own copy of the dataset and moves on to the next epoch
+        self.consumed_samples = (epoch + 1) * self.samples_per_rank * self.data_parallel_size
+
+
+def build_precached_memmap_datasets(model_cfg, consumed_samples, field_to_key):
+    """
+    Build train and validation `PrecachedMemmapDataset` from `model_cfg.data`, where `train.dataset_path` and
+    `validation.dataset_path` list precached index files or directories.
+    """
+    data_cfg = model_cfg.data
+    train_data = PrecachedMemmapDataset(
+        paths=list(data_cfg.train.dataset_path),
+        field_to_key=field_to_key,
+        consumed_samples=consumed_samples,
+        micro_batch_size=model_cfg.micro_batch_size,
+        shuffle=data_cfg.train.get('shuffle', True),
+        seed=data_cfg.get('seed', 0),
+        drop_last=True,
+    )
+
+    val_data = None
+    if data_cfg.get("validation") is not None and data_cfg.validation.get("dataset_path"):
+        val_data = PrecachedMemmapDataset(
+            paths=list(data_cfg.validation.dataset_path),
+            field_to_key=field_to_key,
+            consumed_samples=0,
+            micro_batch_size=model_cfg.micro_batch_size,
+            shuffle=False,
+            drop_last=False,
+        )
+
+    return train_data, val_data
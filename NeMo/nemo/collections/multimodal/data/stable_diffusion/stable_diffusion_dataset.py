@@ -13,11 +13,13 @@
 # limitations under the License.
 import torch
 
+from nemo.collections.multimodal.data.common.aspect_buckets import AspectRatioBuckets
 from nemo.collections.multimodal.data.common.webdataset import WebDatasetCommon
 from nemo.collections.multimodal.data.stable_diffusion.augmentation.augmentations import (
     construct_image_augmentations,
     identical_transform,
 )
+from nemo.collections.multimodal.data.stable_diffusion.precached_dataset import build_precached_memmap_datasets
 from nemo.core.classes import Dataset as NeMoDataset
 from nemo.utils import logging
 
@@ -82,6 +84,20 @@ def build_train_valid_datasets(
         text_transform = identical_transform
         return img_transform(image), text_transform(text)
 
+    aspect_buckets = None
+    if data_cfg.train.get('aspect_buckets', None) is not None:
+        aspect_buckets = AspectRatioBuckets.from_config(data_cfg.train.aspect_buckets, image_key='jpg')
+        logging.info(f'Training with {len(aspect_buckets)} aspect ratio buckets: {aspect_buckets.buckets}')
+        # images are resized and cropped to their bucket instead of the resize and crop augmentations
+        augmentations = data_cfg.train.get("augmentations", None) or {}
+        bucket_augmentations = {'horizontal_flip': augmentations.get('horizontal_flip', False)}
+
+        def transform_fn(sample):
+            image, text = sample["jpg"], sample["txt"]
+            image = aspect_buckets.resize_and_crop(image, sample['__bucket__'])
+            img_transform = construct_image_augmentations(bucket_augmentations)
+            return img_transform(image), identical_transform(text)
+
     if data_cfg.get('synthetic_data', False):
         H, W = data_cfg.train.augmentations.center_crop_h_w.split(',')
         train_data = SDSyntheticDataset(
@@ -102,6 +118,8 @@ def build_train_valid_datasets(
             compose_fn=tuple_to_dict,
             filter_fn=filter_fn,
             is_train=True,
+            micro_batch_size=model_cfg.micro_batch_size,
+            aspect_buckets=aspect_buckets,
         )
 
     val_data = None
@@ -122,6 +140,7 @@ def build_train_valid_datasets(
                 compose_fn=tuple_to_dict,
                 filter_fn=filter_fn,
                 is_train=False,
+                micro_batch_size=model_cfg.micro_batch_size,
             )
 
     return train_data, val_data
@@ -132,6 +151,14 @@ def build_train_valid_precached_datasets(
 ):
     data_cfg = model_cfg.data
 
+    # memory-mapped shards written by examples/multimodal/generative/stable_diffusion/sd_precache.py
+    if data_cfg.get('precached_format', 'webdataset') == 'memmap' and not data_cfg.get('synthetic_data', False):
+        return build_precached_memmap_datasets(
+            model_cfg,
+            consumed_samples,
+            field_to_key={'latents': model_cfg.first_stage_key, 'text': model_cfg.cond_stage_key},
+        )
+
     # This function maps data that are tuples to dictionary.
     def tuple_to_dict(inp):
         for input in inp:
@@ -159,6 +186,7 @@ def build_train_valid_precached_datasets(
             map_fn=transform_fn,
             compose_fn=tuple_to_dict,
             is_train=True,
+            micro_batch_size=model_cfg.micro_batch_size,
         )
 
     val_data = None
@@ -179,6 +207,7 @@ def build_train_valid_precached_datasets(
                 map_fn=transform_fn,
                 compose_fn=tuple_to_dict,
                 is_train=False,
+                micro_batch_size=model_cfg.micro_batch_size,
             )
 
     return train_data, val_data
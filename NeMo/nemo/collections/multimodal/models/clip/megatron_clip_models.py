@@ -30,6 +30,7 @@ from nemo.collections.multimodal.data.clip.clip_dataset import (
     tokenize,
 )
 from nemo.collections.multimodal.losses.clip_loss import ClipLoss
+from nemo.collections.multimodal.parts.clip.zero_shot import ZeroShotClassifier
 from nemo.collections.nlp.models.language_modeling.megatron_base_model import MegatronBaseModel
 from nemo.collections.nlp.modules.common.megatron.build_model import build_model
 from nemo.collections.nlp.modules.common.megatron.language_model import get_language_model
@@ -302,6 +303,7 @@ class MegatronCLIPModel(MegatronBaseModel):
         # this prevents base constructor from initializing tokenizer
         self.tokenizer = None
         self.imagenet_val = None
+        self._zero_shot_classifier = None
         super().__init__(cfg, trainer=trainer)
 
         self._validate_trainer()
@@ -720,20 +722,16 @@ class MegatronCLIPModel(MegatronBaseModel):
         else:
             text_encoder = self.model.text_encoder
 
-        with torch.no_grad():
-            zeroshot_weights = []
-            for texts in self.imagenet_val["texts"]:
-                texts = texts.cuda(non_blocking=True)
-                # TODO (yuya): distributed not working
-                with torch.cuda.amp.autocast(
-                    enabled=self.autocast_dtype in (torch.half, torch.bfloat16), dtype=self.autocast_dtype,
-                ):
-                    class_embeddings = text_encoder(texts)
-                    class_embedding = F.normalize(class_embeddings, dim=-1).mean(dim=0)
-                    class_embedding /= class_embedding.norm()
-                zeroshot_weights.append(class_embedding)
-            zeroshot_weights = torch.stack(zeroshot_weights, dim=1)
-        return zeroshot_weights
+        if self._zero_shot_classifier is None:
+            # class prompts are sharded across data parallel ranks, the weights are cached while the text encoder
+            # does not change
+            text_dataset = self.imagenet_val["texts"].dataset
+            self._zero_shot_classifier = ZeroShotClassifier(
+                text_dataset, text_dataset.num_templates, process_group=parallel_state.get_data_parallel_group(),
+            )
+        return self._zero_shot_classifier(
+            text_encoder, device=torch.cuda.current_device(), autocast_dtype=self.autocast_dtype
+        )
 
     def zero_shot_eval(self):
         def accuracy(output, target, topk=(1,)):
@@ -11,7 +11,10 @@ from torch._dynamo import optimize
 from torch._inductor import config as inductor_config
 from torchvision.utils import make_grid
 
-from nemo.collections.multimodal.data.controlnet.controlnet_dataset import build_train_valid_datasets
+from nemo.collections.multimodal.data.controlnet.controlnet_dataset import (
+    build_train_valid_datasets,
+    build_train_valid_precached_datasets,
+)
 from nemo.collections.multimodal.models.stable_diffusion.ldm.ddpm import LatentDiffusion
 from nemo.collections.multimodal.models.stable_diffusion.samplers.ddim import DDIMSampler
 from nemo.collections.multimodal.modules.stable_diffusion.attention import SpatialTransformer
@@ -284,6 +287,7 @@ class ControlNet(nn.Module):
         use_flash_attention=False,
         from_pretrained_unet=None,
         from_NeMo=True,
+        attention_backend='auto',
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -428,6 +432,7 @@ class ControlNet(nn.Module):
                                 use_linear=use_linear_in_transformer,
                                 use_checkpoint=use_checkpoint,
                                 use_flash_attention=use_flash_attention,
+                                attention_backend=attention_backend,
                             )
                         )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -493,6 +498,7 @@ class ControlNet(nn.Module):
                 use_linear=use_linear_in_transformer,
                 use_checkpoint=use_checkpoint,
                 use_flash_attention=use_flash_attention,
+                attention_backend=attention_backend,
             ),
             ResBlock(
                 ch,
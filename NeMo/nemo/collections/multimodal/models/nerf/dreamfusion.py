@@ -180,6 +180,10 @@ class DreamFusion(Txt2NerfBase):
 
         self.log('global_step', self.global_step + 1, prog_bar=True, rank_zero_only=True)
 
+        render_stats = getattr(self.renderer, 'render_stats', None)
+        if render_stats:
+            self.log('rays_per_sec', render_stats['rays_per_sec'], prog_bar=False, rank_zero_only=True)
+
         return loss
 
     def validation_step(self, batch, batch_idx):
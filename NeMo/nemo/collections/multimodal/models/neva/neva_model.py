@@ -39,6 +39,7 @@ from nemo.collections.multimodal.data.neva.neva_dataset import (
     DataCollatorForSupervisedDataset,
     make_supervised_data_module,
 )
+from nemo.collections.multimodal.data.neva.neva_memmap_dataset import make_packed_data_module
 from nemo.collections.multimodal.models.clip.megatron_clip_models import CLIPVisionTransformer, MegatronCLIPModel
 from nemo.collections.multimodal.models.kosmos.perceiver_resampler import PerceiverResampler
 from nemo.collections.multimodal.parts.utils import extend_instance
@@ -185,6 +186,20 @@ class NevaWordEmbeddingMixin(torch.nn.Module, adapter_mixins.AdapterModuleMixin)
 
         return self.replace_media_embeddings(input_ids, words_embeddings, media)
 
+    def encode_vision_features(self, pixel_values: torch.Tensor):
+        """
+        Compute the features of the frozen vision encoder: the hidden states of the selected layer without the class
+        tokens, of shape (N, V, D) for pixel values of shape (N, C, H, W).
+        """
+        with torch.no_grad():
+            if self.from_hf:
+                vision_x = self.vision_encoder(pixel_values, output_hidden_states=True)
+                vision_x = vision_x.hidden_states[self.vision_select_layer]
+            else:
+                self.vision_encoder.backbone.transformer.return_select_layer = self.vision_select_layer
+                vision_x = self.vision_encoder(pixel_values)
+        return vision_x[:, self.class_token_length :]
+
     def encode_vision_x(self, vision_x: torch.Tensor):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
@@ -193,24 +208,19 @@ class NevaWordEmbeddingMixin(torch.nn.Module, adapter_mixins.AdapterModuleMixin)
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+                or precomputed vision features of shape (B, T_img, F, V, D), see `encode_vision_features`
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
+        assert vision_x.ndim in [5, 6], "vision_x should be of shape (b, T_img, F, C, H, W) or (b, T_img, F, v, d)"
         b, T, F = vision_x.shape[:3]
         assert F == 1, "Only single frame supported"
 
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        with torch.no_grad():
-            if self.from_hf:
-                vision_x = self.vision_encoder(vision_x, output_hidden_states=True)
-                vision_x = vision_x.hidden_states[self.vision_select_layer]
-            else:
-                self.vision_encoder.backbone.transformer.return_select_layer = self.vision_select_layer
-                vision_x = self.vision_encoder(vision_x)
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
-        vision_x = vision_x[:, :, :, self.class_token_length :]
+        if vision_x.ndim == 6:
+            vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+            vision_x = self.encode_vision_features(vision_x)
+            vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
         assert self.is_adapter_available(), "Cannot find multimodal vision adapter!"
         vision_connector = self.get_adapter_module(AdapterName.MM_LINEAR_ADAPTER)
         vision_x = vision_connector(vision_x)
@@ -410,6 +420,7 @@ class MegatronNevaModel(MegatronGPTPEFTModel):
             {AdapterName.MM_LINEAR_ADAPTER: adapter_cfg,}
         )
         MegatronGPTModel.__init__(self, cfg, trainer)
+        self._check_packing_attention_mask()
 
         self.setup_complete = False
         self.base_keys = self.get_all_keys()
@@ -418,6 +429,23 @@ class MegatronNevaModel(MegatronGPTPEFTModel):
         if self.megatron_amp_O2:
             self.adapter_keys = set(key.replace("model.module.", "model.", 1) for key in self.adapter_keys)
 
+    def _check_packing_attention_mask(self):
+        """
+        Packed samples hold several conversations that must not attend to each other, through the block diagonal
+        attention mask built by the collator. The fused causal softmax would ignore it.
+        """
+        data_cfg = self.cfg.data
+        if (
+            data_cfg.get("data_prefix", None)
+            and data_cfg.get("packing", False)
+            and self.get_attention_mask_from_fusion
+        ):
+            logging.warning(
+                "model.data.packing uses the block diagonal attention mask of the packed samples, "
+                "setting get_attention_mask_from_fusion to False"
+            )
+            self.get_attention_mask_from_fusion = False
+
     def get_all_keys(self,):
         # TODO (yuya): p-tuning need additional handle, check peft models.
         """
@@ -551,6 +579,51 @@ class MegatronNevaModel(MegatronGPTPEFTModel):
         """
         return MegatronGPTModel.training_step(self, dataloader_iter, batch_idx)
 
+    def _get_step_batch(self, batch, device=None):
+        """
+        Move the inputs used by this pipeline stage to the device, the others are set to None. The attention mask is
+        dropped when the fused softmax computes the causal mask, see `_check_packing_attention_mask`.
+        """
+        if device is None:
+            device = torch.cuda.current_device()
+        if parallel_state.get_pipeline_model_parallel_world_size() == 1:
+            for k in batch.keys():
+                if self.get_attention_mask_from_fusion:
+                    batch[k] = batch[k].to(device, non_blocking=True) if k not in ['attention_mask'] else None
+                else:
+                    batch[k] = batch[k].to(device, non_blocking=True)
+        else:
+            if parallel_state.is_pipeline_first_stage():
+                # First pipeline stage needs tokens, position_ids, and attention_mask
+                for k in batch.keys():
+                    if self.get_attention_mask_from_fusion:
+                        batch[k] = (
+                            batch[k].to(device, non_blocking=True)
+                            if k in ['tokens', 'position_ids', 'media']
+                            else None
+                        )
+                    else:
+                        batch[k] = (
+                            batch[k].to(device, non_blocking=True)
+                            if k in ['tokens', 'position_ids', 'attention_mask', 'media']
+                            else None
+                        )
+            elif parallel_state.is_pipeline_last_stage():
+                # Last pipeline stage needs the labels, loss_mask, and attention_mask
+                for k in batch.keys():
+                    if self.get_attention_mask_from_fusion:
+                        batch[k] = batch[k].to(device, non_blocking=True) if k in ['labels', 'loss_mask'] else None
+                    else:
+                        batch[k] = (
+                            batch[k].to(device, non_blocking=True)
+                            if k in ['labels', 'loss_mask', 'attention_mask']
+                            else None
+                        )
+            else:
+                # Intermediate pipeline stage doesn't need any inputs
+                batch = {k: None for k in ['tokens', 'position_ids', 'attention_mask', 'labels', 'media']}
+        return batch
+
     def get_forward_output_and_loss_func(self, validation_step=False):
         def loss_func(output_tensor, loss_mask):
             loss_for_ub = self.loss_func(loss_mask, output_tensor)
@@ -561,41 +634,7 @@ class MegatronNevaModel(MegatronGPTPEFTModel):
                 return loss_for_ub, dict(avg=reduced_loss[0].unsqueeze(0))
 
         def fwd_output_and_loss_func(dataloader_iter, model, checkpoint_activations_all_layers=None):
-            batch = next(dataloader_iter)
-            if parallel_state.get_pipeline_model_parallel_world_size() == 1:
-                for k in batch.keys():
-                    if self.get_attention_mask_from_fusion:
-                        batch[k] = batch[k].cuda(non_blocking=True) if k not in ['attention_mask'] else None
-                    else:
-                        batch[k] = batch[k].cuda(non_blocking=True)
-            else:
-                if parallel_state.is_pipeline_first_stage():
-                    # First pipeline stage needs tokens, position_ids, and attention_mask
-                    for k in batch.keys():
-                        if self.get_attention_mask_from_fusion:
-                            batch[k] = (
-                                batch[k].cuda(non_blocking=True) if k in ['tokens', 'position_ids', 'media'] else None
-                            )
-                        else:
-                            batch[k] = (
-                                batch[k].cuda(non_blocking=True)
-                                if k in ['tokens', 'position_ids', 'attention_mask', 'media']
-                                else None
-                            )
-                elif parallel_state.is_pipeline_last_stage():
-                    # Last pipeline stage needs the labels, loss_mask, and attention_mask
-                    for k in batch.keys():
-                        if self.get_attention_mask_from_fusion:
-                            batch[k] = batch[k].cuda(non_blocking=True) if k in ['labels', 'loss_mask'] else None
-                        else:
-                            batch[k] = (
-                                batch[k].cuda(non_blocking=True)
-                                if k in ['labels', 'loss_mask', 'attention_mask']
-                                else None
-                            )
-                else:
-                    # Intermediate pipeline stage doesn't need any inputs
-                    batch = {k: None for k in ['tokens', 'position_ids', 'attention_mask', 'labels', 'media']}
+            batch = self._get_step_batch(next(dataloader_iter))
 
             output_tensor = model(
                 batch['tokens'],
@@ -762,7 +801,11 @@ class MegatronNevaModel(MegatronGPTPEFTModel):
 
     def build_train_valid_test_datasets(self):
         logging.info('Building Neva datasets.')
-        ds_dict = make_supervised_data_module(tokenizer=self.tokenizer, model_cfg=self.cfg,)
+        if self.cfg.data.get("data_prefix", None):
+            # conversations pre-tokenized by examples/multimodal/mllm/neva/neva_preprocess.py
+            ds_dict = make_packed_data_module(model_cfg=self.cfg)
+        else:
+            ds_dict = make_supervised_data_module(tokenizer=self.tokenizer, model_cfg=self.cfg,)
         self._train_ds = ds_dict["train_dataset"]
         self._validation_ds = ds_dict["eval_dataset"]
 
@@ -19,6 +19,7 @@ import torch.nn.functional as F
 from taming.modules.vqvae.quantize import VectorQuantizer2 as VectorQuantizer
 
 from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.model import Decoder, Encoder
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.tiling import tiled_forward
 from nemo.collections.multimodal.modules.stable_diffusion.distributions.distributions import (
     DiagonalGaussianDistribution,
 )
@@ -315,6 +316,7 @@ class AutoencoderKL(pl.LightningModule):
         monitor=None,
         from_pretrained: str = None,
         capture_cudagraph_iters=-1,
+        tiling=None,
     ):
         super().__init__()
         self.image_key = image_key
@@ -325,6 +327,11 @@ class AutoencoderKL(pl.LightningModule):
         self.quant_conv = torch.nn.Conv2d(2 * ddconfig["z_channels"], 2 * embed_dim, 1)
         self.post_quant_conv = torch.nn.Conv2d(embed_dim, ddconfig["z_channels"], 1)
         self.embed_dim = embed_dim
+        self.ch_mult = tuple(ddconfig.get("ch_mult", (1, 2, 4, 8)))
+        self.downsampling_factor = 2 ** (len(self.ch_mult) - 1)
+        self.use_tiling = False
+        if tiling is not None:
+            self.enable_tiling(**tiling)
         if colorize_nlabels is not None:
             assert type(colorize_nlabels) == int
             self.register_buffer("colorize", torch.randn(3, colorize_nlabels, 1, 1))
@@ -468,13 +475,82 @@ class AutoencoderKL(pl.LightningModule):
         self.load_state_dict(sd, strict=False)
         print(f"Restored from {path}")
 
+    def enable_tiling(self, tile_size=512, tile_overlap=64, memory_budget_mb=None, max_tile_batch=None):
+        """
+        Encode and decode images larger than `tile_size` pixels in overlapping tiles, blended over the overlap.
+
+        Peak memory is bounded by the size of a tile batch instead of the image size. The number of tiles run at
+        once is `max_tile_batch` if set, otherwise the number of tiles whose estimated activation memory fits in
+        `memory_budget_mb`, which defaults to 80% of the free CUDA memory. Group norm statistics are computed per
+        tile, so tiled outputs slightly differ from full resolution ones.
+
+        Args:
+            tile_size: size of the tiles in pixels, a multiple of the downsampling factor.
+            tile_overlap: minimum overlap between neighbouring tiles in pixels, a multiple of the downsampling factor.
+            memory_budget_mb: activation memory budget of a tile batch in MB.
+            max_tile_batch: number of tiles run at once, counting every image of the batch.
+        """
+        assert (
+            tile_size % self.downsampling_factor == 0 and tile_overlap % self.downsampling_factor == 0
+        ), f'Tile size and overlap must be multiples of {self.downsampling_factor}'
+        self.use_tiling = True
+        self.tile_size = tile_size // self.downsampling_factor
+        self.tile_overlap = tile_overlap // self.downsampling_factor
+        self.tile_memory_budget_mb = memory_budget_mb
+        self.max_tile_batch = max_tile_batch
+
+    def disable_tiling(self):
+        self.use_tiling = False
+
+    def _should_tile(self, latent_h, latent_w):
+        return self.use_tiling and max(latent_h, latent_w) > self.tile_size
+
+    def _get_max_tile_batch(self, x):
+        if self.max_tile_batch is not None:
+            return self.max_tile_batch
+        if self.tile_memory_budget_mb is not None:
+            budget = self.tile_memory_budget_mb * 1024 ** 2
+        elif x.is_cuda:
+            free, _ = torch.cuda.mem_get_info(x.device)
+            budget = 0.8 * free
+        else:
+            return None
+        dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else x.dtype
+        element_size = torch.finfo(dtype).bits // 8
+        # largest feature map, with a few of them alive at once in the resnet blocks, plus the attention matrix
+        # of the mid block which runs at the lowest resolution
+        pixels = (self.tile_size * self.downsampling_factor) ** 2
+        feature_map = max(self.encoder.ch * mult * pixels // 4 ** i for i, mult in enumerate(self.ch_mult))
+        attention = (pixels // 4 ** (len(self.ch_mult) - 1)) ** 2
+        tile_bytes = element_size * (4 * feature_map + attention)
+        return max(1, int(budget // tile_bytes))
+
     def encode(self, x):
+        if self._should_tile(x.shape[-2] // self.downsampling_factor, x.shape[-1] // self.downsampling_factor):
+            moments = tiled_forward(
+                lambda tiles: self.quant_conv(self.encoder(tiles)),
+                x,
+                self.tile_size,
+                self.tile_overlap,
+                in_factor=self.downsampling_factor,
+                max_tile_batch=self._get_max_tile_batch(x),
+            )
+            return DiagonalGaussianDistribution(moments)
         h = self.encoder(x)
         moments = self.quant_conv(h)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
     def decode(self, z):
+        if self._should_tile(z.shape[-2], z.shape[-1]):
+            return tiled_forward(
+                lambda tiles: self.decoder(self.post_quant_conv(tiles)),
+                z,
+                self.tile_size,
+                self.tile_overlap,
+                out_factor=self.downsampling_factor,
+                max_tile_batch=self._get_max_tile_batch(z),
+            )
         z = self.post_quant_conv(z)
         dec = self.decoder(z)
         return dec
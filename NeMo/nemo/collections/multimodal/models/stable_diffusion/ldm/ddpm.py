@@ -55,6 +55,7 @@ from nemo.collections.multimodal.modules.stable_diffusion.distributions.distribu
     DiagonalGaussianDistribution,
     normal_kl,
 )
+from nemo.collections.multimodal.parts.stable_diffusion.conditioning_cache import ConditioningCache
 from nemo.collections.multimodal.parts.stable_diffusion.utils import (
     count_params,
     default,
@@ -516,6 +517,11 @@ class LatentDiffusion(DDPM, Serialization):
         self.bbox_tokenizer = None
         self.text_embedding_dropout_rate = cfg.text_embedding_dropout_rate
         self.fused_opt = cfg.fused_opt
+        # Embeddings of a frozen text encoder can be reused across steps for repeated captions
+        self.conditioning_cache = None
+        conditioning_cache_size = cfg.get('conditioning_cache_size', None)
+        if conditioning_cache_size and not self.cond_stage_trainable:
+            self.conditioning_cache = ConditioningCache(conditioning_cache_size)
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -608,7 +614,13 @@ class LatentDiffusion(DDPM, Serialization):
 
     def get_learned_conditioning(self, c):
         if self.cond_stage_forward is None:
-            if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
+            if (
+                self.conditioning_cache is not None
+                and isinstance(c, (list, tuple))
+                and all(isinstance(text, str) for text in c)
+            ):
+                c = self.conditioning_cache.encode(self.cond_stage_model, c)
+            elif hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
                 if isinstance(c, DiagonalGaussianDistribution):
                     c = c.mode()
@@ -729,7 +741,8 @@ class LatentDiffusion(DDPM, Serialization):
         bs=None,
     ):
         if self.first_stage_key.endswith('encoded'):
-            gaussian_parameters = batch[self.first_stage_key]
+            # precached moments may be stored in half precision
+            gaussian_parameters = batch[self.first_stage_key].float()
             encoder_posterior = DiagonalGaussianDistribution(gaussian_parameters)
         else:
             x = super().get_input(batch, k)
@@ -757,6 +770,9 @@ class LatentDiffusion(DDPM, Serialization):
                     c = self.get_learned_conditioning(xc)
                 else:
                     c = self.get_learned_conditioning(xc)
+            elif cond_key.endswith('encoded'):
+                # precached text embeddings may be stored in half precision
+                c = xc.float()
             else:
                 c = xc
             if bs is not None:
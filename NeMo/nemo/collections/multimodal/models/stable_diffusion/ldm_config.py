@@ -34,6 +34,8 @@ class LDMUnetConfig:
     use_checkpoint: Optional[bool] = True
     legacy: Optional[bool] = False
     use_flash_attention: Optional[bool] = False
+    attention_backend: Optional[str] = 'auto'
+    token_merging_ratio: Optional[float] = 0.0
 
 
 @dataclass
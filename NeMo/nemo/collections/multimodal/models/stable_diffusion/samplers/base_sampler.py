@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import numpy as np
 import torch
@@ -25,19 +26,46 @@ from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.util
 )
 
 
+# Execution strategies of classifier-free guidance:
+#   fused: conditional and unconditional inputs are concatenated into one doubled batch.
+#   sequential: two half-size passes, which halves peak activation memory.
+#   truncated: fused, but the unconditional pass is skipped for the last `cfg_truncation_steps` steps.
+CFG_STRATEGIES = ("fused", "sequential", "truncated")
+
+
 class AbstractBaseSampler(ABC):
-    def __init__(self, model, sampler, schedule="linear", **kwargs):
+    def __init__(
+        self,
+        model,
+        sampler,
+        schedule="linear",
+        cfg_strategy="fused",
+        cfg_truncation_steps=0,
+        feature_cache_interval=1,
+        feature_cache_block_id=0,
+        feature_cache_warmup_steps=0,
+        **kwargs,
+    ):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         assert isinstance(sampler, Sampler), "Sampler should be of ENUM type Sampler"
         self.sampler = sampler
+        if cfg_strategy not in CFG_STRATEGIES:
+            raise ValueError(f"CFG strategy {cfg_strategy} is not supported, choose one of {CFG_STRATEGIES}.")
+        self.cfg_strategy = cfg_strategy
+        self.cfg_truncation_steps = cfg_truncation_steps
+        # UNet deep feature reuse across steps, disabled when the interval is 1
+        self.feature_cache_interval = feature_cache_interval
+        self.feature_cache_block_id = feature_cache_block_id
+        self.feature_cache_warmup_steps = feature_cache_warmup_steps
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            device = self.model.betas.device
+            if attr.device != device:
+                attr = attr.to(device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True):
@@ -49,7 +77,7 @@ class AbstractBaseSampler(ABC):
         )
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, "alphas have to be defined for each timestep"
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(torch.cuda.current_device())
+        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.betas.device)
         self.register_buffer("betas", to_torch(self.model.betas))
         self.register_buffer("alphas_cumprod", to_torch(alphas_cumprod))
         self.register_buffer("alphas_cumprod_prev", to_torch(self.model.alphas_cumprod_prev))
@@ -79,6 +107,31 @@ class AbstractBaseSampler(ABC):
         )
         self.register_buffer("ddim_sigmas_for_original_num_steps", sigmas_for_original_sampling_steps)
 
+    def _get_unet(self):
+        return getattr(getattr(self.model, "model", None), "diffusion_model", None)
+
+    @contextmanager
+    def _unet_feature_cache(self):
+        unet = self._get_unet()
+        if self.feature_cache_interval <= 1 or not hasattr(unet, "enable_feature_cache"):
+            yield
+            return
+        unet.enable_feature_cache(
+            interval=self.feature_cache_interval,
+            block_id=self.feature_cache_block_id,
+            warmup_steps=self.feature_cache_warmup_steps,
+        )
+        try:
+            yield
+        finally:
+            unet.disable_feature_cache()
+
+    def _set_feature_cache_step(self, step):
+        if self.feature_cache_interval > 1:
+            unet = self._get_unet()
+            if hasattr(unet, "set_feature_cache_step"):
+                unet.set_feature_cache_step(step)
+
     @abstractmethod
     def p_sampling_fn(self):
         pass
@@ -134,53 +187,54 @@ class AbstractBaseSampler(ABC):
         size = (batch_size, C, H, W)
         print(f"Data shape for sampling is {size}, eta {eta}")
 
-        if self.sampler is Sampler.DPM:
-            return self.dpm_sampling_fn(
-                shape=shape,
-                steps=S,
-                conditioning=conditioning,
-                unconditional_conditioning=unconditional_conditioning,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                x_T=x_T,
-            )
+        with self._unet_feature_cache():
+            if self.sampler is Sampler.DPM:
+                return self.dpm_sampling_fn(
+                    shape=shape,
+                    steps=S,
+                    conditioning=conditioning,
+                    unconditional_conditioning=unconditional_conditioning,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    x_T=x_T,
+                )
 
-        if self.sampler is Sampler.PARA_DDIM:
-            return self.para_ddim_sampling_fn(
-                cond=conditioning,
-                batch_size=batch_size,
-                per_latent_shape=shape,
-                x_T=x_T,
-                steps=S,
-                parallelism=parallelism,
-                tolerance=tolerance,
-                temperature=temperature,
-                noise_dropout=noise_dropout,
+            if self.sampler is Sampler.PARA_DDIM:
+                return self.para_ddim_sampling_fn(
+                    cond=conditioning,
+                    batch_size=batch_size,
+                    per_latent_shape=shape,
+                    x_T=x_T,
+                    steps=S,
+                    parallelism=parallelism,
+                    tolerance=tolerance,
+                    temperature=temperature,
+                    noise_dropout=noise_dropout,
+                    quantize_denoised=quantize_x0,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=unconditional_conditioning,
+                    score_corrector=score_corrector,
+                    corrector_kwargs=corrector_kwargs,
+                )
+
+            samples, intermediates = self.sampling_fn(
+                conditioning,
+                size,
+                callback=callback,
+                img_callback=img_callback,
                 quantize_denoised=quantize_x0,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning,
+                mask=mask,
+                x0=x0,
+                ddim_use_original_steps=False,
+                noise_dropout=noise_dropout,
+                temperature=temperature,
                 score_corrector=score_corrector,
                 corrector_kwargs=corrector_kwargs,
+                x_T=x_T,
+                log_every_t=log_every_t,
+                unconditional_guidance_scale=unconditional_guidance_scale,
+                unconditional_conditioning=unconditional_conditioning,
             )
-
-        samples, intermediates = self.sampling_fn(
-            conditioning,
-            size,
-            callback=callback,
-            img_callback=img_callback,
-            quantize_denoised=quantize_x0,
-            mask=mask,
-            x0=x0,
-            ddim_use_original_steps=False,
-            noise_dropout=noise_dropout,
-            temperature=temperature,
-            score_corrector=score_corrector,
-            corrector_kwargs=corrector_kwargs,
-            x_T=x_T,
-            log_every_t=log_every_t,
-            unconditional_guidance_scale=unconditional_guidance_scale,
-            unconditional_conditioning=unconditional_conditioning,
-        )
-        return samples, intermediates
+            return samples, intermediates
 
     @torch.no_grad()
     def sampling_fn(
@@ -240,6 +294,7 @@ class AbstractBaseSampler(ABC):
                 assert x0 is not None
                 img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
                 img = img_orig * mask + (1.0 - mask) * img
+            self._set_feature_cache_step(i)
             outs = self.p_sampling_fn(
                 img,
                 cond,
@@ -271,12 +326,18 @@ class AbstractBaseSampler(ABC):
                 intermediates["pred_x0"].append(pred_x0)
         return img, intermediates
 
-    def _get_model_output(
-        self, x, t, unconditional_conditioning, unconditional_guidance_scale, score_corrector, c, corrector_kwargs,
+    def _apply_model_with_guidance(
+        self, x, t, c, unconditional_conditioning, unconditional_guidance_scale, index=None,
     ):
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0:
+        """
+        Model output with classifier-free guidance executed according to `self.cfg_strategy`.
+        `index` is the number of sampling steps left after the current one; when it is None
+        the 'truncated' strategy never skips the unconditional pass.
+        """
+        truncated = self.cfg_strategy == "truncated" and index is not None and index < self.cfg_truncation_steps
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0 or truncated:
             model_output = self.model.apply_model(x, t, c)
-        elif isinstance(c, dict):
+        elif isinstance(c, dict) or self.cfg_strategy == "sequential":
             ### Contolnet conditioning is dict format
             model_t = self.model.apply_model(x, t, c)
             model_uncond = self.model.apply_model(x, t, unconditional_conditioning)
@@ -287,6 +348,22 @@ class AbstractBaseSampler(ABC):
             c_in = torch.cat([unconditional_conditioning, c])
             e_t_uncond, model_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
             model_output = e_t_uncond + unconditional_guidance_scale * (model_t - e_t_uncond)
+        return model_output
+
+    def _get_model_output(
+        self,
+        x,
+        t,
+        unconditional_conditioning,
+        unconditional_guidance_scale,
+        score_corrector,
+        c,
+        corrector_kwargs,
+        index=None,
+    ):
+        model_output = self._apply_model_with_guidance(
+            x, t, c, unconditional_conditioning, unconditional_guidance_scale, index=index
+        )
         if self.model.parameterization == "v":
             e_t = self.model.predict_eps_from_z_and_v(x, t, model_output)
         else:
@@ -48,7 +48,14 @@ class DDIMSampler(AbstractBaseSampler):
     ):
         b, *_, device = *x.shape, x.device
         e_t, model_output = self._get_model_output(
-            x, t, unconditional_conditioning, unconditional_guidance_scale, score_corrector, c, corrector_kwargs
+            x,
+            t,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            score_corrector,
+            c,
+            corrector_kwargs,
+            index=index,
         )
         x_prev, pred_x0 = self._get_x_prev_and_pred_x0(
             use_original_steps,
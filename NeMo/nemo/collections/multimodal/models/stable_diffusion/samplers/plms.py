@@ -49,7 +49,14 @@ class PLMSSampler(AbstractBaseSampler):
     ):
         b, *_, device = *x.shape, x.device
         e_t, model_output = self._get_model_output(
-            x, t, unconditional_conditioning, unconditional_guidance_scale, score_corrector, c, corrector_kwargs
+            x,
+            t,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            score_corrector,
+            c,
+            corrector_kwargs,
+            index=index,
         )
         if len(old_eps) == 0:
             # Pseudo Improved Euler (2nd order)
@@ -75,6 +82,7 @@ class PLMSSampler(AbstractBaseSampler):
                 score_corrector,
                 c,
                 corrector_kwargs,
+                index=index,
             )
             e_t_prime = (e_t + e_t_next) / 2
         elif len(old_eps) == 1:
@@ -60,15 +60,40 @@ class DPMSolverSampler(AbstractBaseSampler):
 
         ns = NoiseScheduleVP("discrete", alphas_cumprod=self.alphas_cumprod)
 
-        model_fn = model_wrapper(
-            lambda x, t, c: self.model.apply_model(x, t, c),
-            ns,
-            model_type=MODEL_TYPES[self.model.parameterization],
-            guidance_type="classifier-free",
-            condition=conditioning,
-            unconditional_condition=unconditional_conditioning,
-            guidance_scale=unconditional_guidance_scale,
-        )
+        # Multistep DPM-Solver evaluates the model once per step, so the number of evaluations
+        # gives the current step for the UNet feature cache and the truncated CFG strategy
+        num_evals = [0]
+
+        def next_step():
+            step = num_evals[0]
+            num_evals[0] += 1
+            self._set_feature_cache_step(step)
+            return steps - 1 - step
+
+        if self.cfg_strategy == "fused":
+
+            def fused_model(x, t, c):
+                next_step()
+                return self.model.apply_model(x, t, c)
+
+            model_fn = model_wrapper(
+                fused_model,
+                ns,
+                model_type=MODEL_TYPES[self.model.parameterization],
+                guidance_type="classifier-free",
+                condition=conditioning,
+                unconditional_condition=unconditional_conditioning,
+                guidance_scale=unconditional_guidance_scale,
+            )
+        else:
+
+            def guided_model(x, t):
+                index = next_step()
+                return self._apply_model_with_guidance(
+                    x, t, conditioning, unconditional_conditioning, unconditional_guidance_scale, index=index
+                )
+
+            model_fn = model_wrapper(guided_model, ns, model_type=MODEL_TYPES[self.model.parameterization])
         dpm_solver = DPMSolver(model_fn, ns, predict_x0=True, thresholding=False)
         x = dpm_solver.sample(
             img, steps=steps, skip_type="time_uniform", method="multistep", order=2, lower_order_final=True,
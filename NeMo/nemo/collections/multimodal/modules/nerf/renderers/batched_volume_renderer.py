@@ -0,0 +1,259 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nemo.collections.multimodal.modules.nerf.materials.materials_base import ShadingEnum
+from nemo.collections.multimodal.modules.nerf.renderers.base_renderer import BaseRenderer
+
+
+def ray_aabb_intersect(rays_o: torch.Tensor, rays_d: torch.Tensor, bound: float):
+    """
+    Distances along the rays to the [-bound, bound]^3 box.
+
+    Returns:
+        nears, fars of shape [N], nears clamped to 0. Rays that miss the box have fars <= nears.
+    """
+    rays_d = torch.where(rays_d.abs() < 1e-9, torch.full_like(rays_d, 1e-9), rays_d)
+    t0 = (-bound - rays_o) / rays_d
+    t1 = (bound - rays_o) / rays_d
+    nears = torch.minimum(t0, t1).amax(dim=-1).clamp(min=0)
+    fars = torch.maximum(t0, t1).amin(dim=-1)
+    return nears, fars
+
+
+class OccupancyGrid(nn.Module):
+    """
+    Occupancy grid of the [-bound, bound]^3 box, used to skip the samples in empty space.
+
+    Every update evaluates the density at a random point of `update_fraction` of the cells (all the cells at the
+    first update) and keeps the decayed maximum per cell, so the cost of a refresh is spread over several updates.
+    A cell is occupied while its density is above min(mean density, density_thresh), and before it is evaluated.
+
+    Args:
+        bound: half size of the box.
+        resolution: number of cells per axis.
+        density_thresh: upper bound of the occupancy threshold.
+        update_fraction: fraction of the cells evaluated per update.
+        batch_size: number of points evaluated together.
+    """
+
+    def __init__(
+        self,
+        bound: float,
+        resolution: int = 64,
+        density_thresh: float = 10.0,
+        update_fraction: float = 1.0,
+        batch_size: int = 65536,
+    ):
+        super().__init__()
+        self.bound = bound
+        self.resolution = resolution
+        self.density_thresh = density_thresh
+        self.update_fraction = update_fraction
+        self.batch_size = batch_size
+        self.register_buffer('density', torch.full((resolution ** 3,), -1.0))
+        self.register_buffer('occupied', torch.ones(resolution ** 3, dtype=torch.bool))
+        self.num_updates = 0
+
+    def cell_indices(self, positions: torch.Tensor) -> torch.Tensor:
+        coords = ((positions + self.bound) / (2 * self.bound) * self.resolution).long()
+        coords = coords.clamp(0, self.resolution - 1)
+        return (coords[..., 0] * self.resolution + coords[..., 1]) * self.resolution + coords[..., 2]
+
+    def query(self, positions: torch.Tensor) -> torch.Tensor:
+        """Whether the cells of `positions` [..., 3] are occupied, of shape [...]."""
+        return self.occupied[self.cell_indices(positions)]
+
+    @torch.no_grad()
+    def update(self, density_fn, decay: float = 0.95):
+        num_cells = self.density.numel()
+        device = self.density.device
+        if self.num_updates > 0 and self.update_fraction < 1.0:
+            cells = torch.randperm(num_cells, device=device)[: max(1, int(num_cells * self.update_fraction))]
+        else:
+            cells = torch.arange(num_cells, device=device)
+
+        res = self.resolution
+        coords = torch.stack([cells // (res * res), (cells // res) % res, cells % res], dim=-1).float()
+        positions = (coords + torch.rand_like(coords)) / res * 2 * self.bound - self.bound
+        density = torch.cat([density_fn(chunk).reshape(-1).float() for chunk in positions.split(self.batch_size)])
+
+        previous = self.density[cells]
+        self.density[cells] = torch.where(previous < 0, density, torch.maximum(previous * decay, density))
+        evaluated = self.density >= 0
+        density_thresh = min(self.density[evaluated].mean().item(), self.density_thresh)
+        self.occupied = ~evaluated | (self.density > density_thresh)
+        self.num_updates += 1
+
+
+class BatchedVolumeRenderer(BaseRenderer):
+    """
+    Volume renderer in plain PyTorch, that runs on CPU as well as on GPU.
+
+    The rays of all the views of a batch, e.g. several random poses of `RandomPosesDataset`, are rendered in one
+    call: every ray gets `num_samples` samples between its intersections with the scene box, and the samples in
+    empty cells of a shared `OccupancyGrid` are dropped before the NeRF is evaluated. The grid is refreshed every
+    `update_interval` steps, `update_fraction` of its cells at a time.
+
+    The statistics of the last call (rays, samples, evaluated samples, seconds and rays per second) are kept in
+    `render_stats`. On GPU, timing synchronizes the device once per call.
+    """
+
+    def __init__(
+        self,
+        bound,
+        update_interval,
+        grid_resolution=64,
+        density_thresh=10.0,
+        update_fraction=1.0,
+        num_samples=128,
+        max_ray_batch=16384,
+    ):
+        super().__init__(bound, update_interval)
+        self.num_samples = num_samples
+        self.max_ray_batch = max_ray_batch
+        self.occupancy_grid = OccupancyGrid(
+            bound, resolution=grid_resolution, density_thresh=density_thresh, update_fraction=update_fraction
+        )
+        self.render_stats = {}
+
+        # TODO(ahmadki): needs rework
+        self.nerf = None
+        self.material = None
+        self.background = None
+
+    @torch.no_grad()
+    def update_step(self, epoch: int, global_step: int, decay: float = 0.95, **kwargs):
+        if global_step % self.update_interval != 0:
+            return
+        self.occupancy_grid.update(self.nerf.forward_density, decay=decay)
+
+    def forward(
+        self,
+        rays_o,
+        rays_d,
+        light_d=None,
+        ambient_ratio=1.0,
+        shading_type=None,
+        return_normal_image=False,
+        return_normal_perturb=False,
+        perturb=False,
+        **kwargs
+    ):
+        start = time.perf_counter()
+        # rays_o, rays_d: [B, H, W, 3]
+        B, H, W, _ = rays_o.shape
+
+        # group the rays of all the views into a single batch
+        rays_o = rays_o.contiguous().view(-1, 3)
+        rays_d = rays_d.contiguous().view(-1, 3)
+        num_rays = rays_o.shape[0]
+
+        # random light direction around the ray origin, so the light always faces the view dir
+        if light_d is None:
+            light_d = F.normalize(rays_o + torch.randn(3, device=rays_o.device))
+        light_d = light_d.expand(num_rays, -1)
+
+        return_normal = shading_type not in [None, ShadingEnum.TEXTURELESS] or return_normal_image
+        chunks = [
+            self._render_rays(
+                rays_o[i : i + self.max_ray_batch],
+                rays_d[i : i + self.max_ray_batch],
+                light_d[i : i + self.max_ray_batch],
+                ambient_ratio=ambient_ratio,
+                shading_type=shading_type,
+                return_normal=return_normal,
+                return_normal_image=return_normal_image,
+                perturb=perturb,
+            )
+            for i in range(0, num_rays, self.max_ray_batch)
+        ]
+        outputs = {key: torch.cat([chunk[key] for chunk in chunks]) for key in chunks[0] if chunks[0][key] is not None}
+
+        # mix background color
+        bg_color = self.background(rays_d)  # [N, 3]
+        image = outputs['image'] + (1 - outputs['opacity']).unsqueeze(-1) * bg_color
+
+        results = {
+            "image": image.view(B, H, W, 3),
+            "depth": outputs['depth'].view(B, H, W, 1),
+            "opacity": outputs['opacity'].view(B, H, W, 1),
+            "weights": outputs['weights'],
+            "dirs": outputs['dirs'],
+        }
+        if 'normals' in outputs:
+            results["normals"] = outputs['normals']
+            if return_normal_perturb:
+                positions = outputs['positions'].detach()
+                _, _, results["normal_perturb"] = self.nerf(
+                    positions=positions + torch.randn_like(positions) * 1e-2, return_normal=True
+                )
+        if 'normal_image' in outputs:
+            results["normal_image"] = outputs['normal_image'].view(B, H, W, 3)
+
+        if rays_o.is_cuda:
+            torch.cuda.synchronize(rays_o.device)
+        seconds = time.perf_counter() - start
+        self.render_stats = {
+            'rays': num_rays,
+            'samples': num_rays * self.num_samples,
+            'evaluated_samples': len(outputs['weights']),
+            'seconds': seconds,
+            'rays_per_sec': num_rays / max(seconds, 1e-9),
+        }
+        return results
+
+    def _render_rays(
+        self, rays_o, rays_d, light_d, ambient_ratio, shading_type, return_normal, return_normal_image, perturb
+    ):
+        num_rays, num_samples = rays_o.shape[0], self.num_samples
+        nears, fars = ray_aabb_intersect(rays_o, rays_d, self.bound)
+
+        # samples at the middle of equal intervals, or at a random point of every interval
+        deltas = ((fars - nears).clamp(min=0) / num_samples).unsqueeze(-1)  # [N, 1]
+        if perturb:
+            offsets = torch.rand(num_rays, num_samples, device=rays_o.device)
+        else:
+            offsets = torch.full((num_rays, num_samples), 0.5, device=rays_o.device)
+        ts = nears.unsqueeze(-1) + (torch.arange(num_samples, device=rays_o.device) + offsets) * deltas  # [N, S]
+        positions = rays_o.unsqueeze(1) + rays_d.unsqueeze(1) * ts.unsqueeze(-1)  # [N, S, 3]
+
+        # only evaluate the samples in occupied cells
+        mask = self.occupancy_grid.query(positions) & (fars > nears).unsqueeze(-1)  # [N, S]
+        ray_indices = mask.nonzero()[:, 0]
+        positions = positions[mask]
+        sigmas, albedo, normals = self.nerf(positions=positions, return_normal=return_normal)
+        colors = self.material(
+            albedo=albedo,
+            normals=normals,
+            light_d=light_d[ray_indices],
+            ambient_ratio=ambient_ratio,
+            shading_type=shading_type,
+        )
+
+        sigma_samples = ts.new_zeros(num_rays, num_samples)
+        sigma_samples[mask] = sigmas.float()
+        color_samples = ts.new_zeros(num_rays, num_samples, 3)
+        color_samples[mask] = colors.float()
+
+        alphas = 1 - torch.exp(-sigma_samples * deltas)
+        transmittance = torch.cumprod(torch.cat([alphas.new_ones(num_rays, 1), 1 - alphas + 1e-10], dim=-1), dim=-1)
+        weights = alphas * transmittance[:, :-1]  # [N, S]
+
+        outputs = {
+            'image': (weights.unsqueeze(-1) * color_samples).sum(dim=1),
+            'opacity': weights.sum(dim=1),
+            'depth': (weights * ts).sum(dim=1),
+            'weights': weights[mask],
+            'dirs': F.normalize(rays_d)[ray_indices],
+            'positions': positions,
+            'normals': normals,
+            'normal_image': None,
+        }
+        if return_normal_image and normals is not None:
+            normal_samples = ts.new_zeros(num_rays, num_samples, 3)
+            normal_samples[mask] = (normals.float() + 1) / 2
+            outputs['normal_image'] = (weights.detach().unsqueeze(-1) * normal_samples).sum(dim=1)
+        return outputs
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
+from functools import partial
 from inspect import isfunction
 
 import torch
@@ -22,6 +23,10 @@ from torch import einsum, nn
 from torch._dynamo import disable
 
 from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.util import checkpoint
+from nemo.collections.multimodal.modules.stable_diffusion.token_merging import (
+    bipartite_soft_matching_random2d,
+    random_destination_indices,
+)
 
 
 def check_cuda():
@@ -50,6 +55,11 @@ try:
 except ImportError:
     flash_attn_installed = False
 
+# fused attention kernels of PyTorch 2.0+, dispatching to flash / memory efficient / math implementations
+HAVE_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+ATTENTION_BACKENDS = ('auto', 'flash', 'sdpa', 'chunked', 'math')
+
 
 def exists(val):
     return val is not None
@@ -184,8 +194,75 @@ def rearrange_heads_inner(t: torch.Tensor, h: int) -> torch.Tensor:
     return t.view(b, h, n, -1).transpose(1, 2).reshape(b, n, -1)
 
 
+def chunked_attention(q, k, v, scale, mask=None, query_chunk_size=1024, key_chunk_size=4096):
+    """
+    Memory efficient attention that never materializes the full attention matrix.
+
+    Queries are processed in chunks of `query_chunk_size`, and for every query chunk the keys and values are
+    consumed in chunks of `key_chunk_size` with an online softmax: a running maximum, normalizer and output are
+    kept per query and rescaled whenever a larger score is seen. Peak memory of the scores is
+    (b, query_chunk_size, key_chunk_size) instead of (b, n, m). Scores are accumulated in fp32, or in the dtype of the
+    queries if it is wider.
+
+    Args:
+        q: queries of shape (b, n, d).
+        k: keys of shape (b, m, d).
+        v: values of shape (b, m, dv).
+        scale: scale of the scores.
+        mask: optional boolean mask of shape (b, m), False for the keys that must not be attended to.
+    Returns:
+        Attention output of shape (b, n, dv).
+    """
+    b, n, _ = q.shape
+    m = k.shape[1]
+    out = q.new_empty(b, n, v.shape[-1])
+    acc_dtype = torch.promote_types(q.dtype, torch.float32)
+    masked_value = torch.finfo(acc_dtype).min
+    for i in range(0, n, query_chunk_size):
+        q_chunk = q[:, i : i + query_chunk_size]
+        row_max = q.new_full((b, q_chunk.shape[1], 1), -math.inf, dtype=acc_dtype)
+        row_sum = q.new_zeros((b, q_chunk.shape[1], 1), dtype=acc_dtype)
+        acc = q.new_zeros((b, q_chunk.shape[1], v.shape[-1]), dtype=acc_dtype)
+        for j in range(0, m, key_chunk_size):
+            sim = einsum('b i d, b j d -> b i j', q_chunk, k[:, j : j + key_chunk_size]).to(acc_dtype) * scale
+            if mask is not None:
+                sim.masked_fill_(~mask[:, None, j : j + key_chunk_size], masked_value)
+            new_max = torch.maximum(row_max, sim.amax(dim=-1, keepdim=True))
+            probs = torch.exp(sim - new_max)
+            correction = torch.exp(row_max - new_max)
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            acc = acc * correction + einsum('b i j, b j d -> b i d', probs.to(v.dtype), v[:, j : j + key_chunk_size])
+            row_max = new_max
+        out[:, i : i + query_chunk_size] = (acc / row_sum).to(out.dtype)
+    return out
+
+
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0, use_flash_attention=False):
+    """
+    Multi-head attention with selectable backends:
+
+    - `flash`: flash-attn kernels, fp16/bf16 only, no mask, dim_head <= 160 and a multiple of 8.
+    - `sdpa`: `torch.nn.functional.scaled_dot_product_attention`, PyTorch 2.0+.
+    - `chunked`: query/key chunked attention with an online softmax, see `chunked_attention`.
+    - `math`: the reference implementation materializing the full attention matrix.
+    - `auto`: picks the fastest valid backend for every call, in the order above.
+      flash is only considered with `use_flash_attention`, and chunked only for sequences longer than a chunk.
+
+    An explicitly requested backend that is not valid for a call falls back to `auto`.
+    """
+
+    def __init__(
+        self,
+        query_dim,
+        context_dim=None,
+        heads=8,
+        dim_head=64,
+        dropout=0.0,
+        use_flash_attention=False,
+        attention_backend='auto',
+        query_chunk_size=1024,
+        key_chunk_size=4096,
+    ):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
@@ -203,6 +280,10 @@ class CrossAttention(nn.Module):
 
         self.to_out = nn.Sequential(nn.Linear(inner_dim, query_dim), nn.Dropout(dropout))
         self.use_flash_attention = use_flash_attention
+        assert attention_backend in ATTENTION_BACKENDS, f'Unknown attention backend {attention_backend}'
+        self.attention_backend = attention_backend
+        self.query_chunk_size = query_chunk_size
+        self.key_chunk_size = key_chunk_size
 
         if dim_head <= 160 and (dim_head % 8) == 0 and flash_attn_installed:
             if context_dim == query_dim:
@@ -222,35 +303,77 @@ class CrossAttention(nn.Module):
 
         return self.to_out(out)
 
+    def _is_valid_backend(self, backend, q, k, mask):
+        if backend == 'flash':
+            if not hasattr(self, 'flash_attn') or mask is not None:
+                return False
+            if not q.is_cuda or q.dtype not in (torch.float16, torch.bfloat16):
+                return False
+            # self-attention kernels take stacked q, k, v
+            return self.context_dim != self.query_dim or q.shape[1] == k.shape[1]
+        if backend == 'sdpa':
+            return HAVE_SDPA
+        return backend in ('chunked', 'math')
+
+    def select_backend(self, q, k, mask=None):
+        """Backend used to compute the attention of queries `q` and keys `k`, see the class docstring."""
+        if self.attention_backend != 'auto' and self._is_valid_backend(self.attention_backend, q, k, mask):
+            return self.attention_backend
+        if self.use_flash_attention and self._is_valid_backend('flash', q, k, mask):
+            return 'flash'
+        if HAVE_SDPA:
+            return 'sdpa'
+        if q.shape[1] > self.query_chunk_size or k.shape[1] > self.key_chunk_size:
+            return 'chunked'
+        return 'math'
+
     def _attention(self, q, k, v, mask=None):
         h = self.heads
-
-        if (
-            not flash_attn_installed
-            or not self.use_flash_attention
-            or q.dtype == torch.float32
-            or (self.dim_head > 160 or (self.dim_head % 8) != 0)
-            or mask is not None
-        ):
-            # original implementation
+        backend = self.select_backend(q, k, mask)
+
+        if mask is not None:
+            # b ... -> b j, True for the keys to attend to
+            mask = mask.view(mask.shape[0], -1).bool()
+
+        if backend == 'sdpa':
+            b, s_q, hd = q.shape
+            # b n (h d) -> b h n d
+            q, k, v = (t.view(b, t.shape[1], h, -1).transpose(1, 2) for t in (q, k, v))
+            attn_mask = mask[:, None, None, :] if mask is not None else None
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+            # b h n d -> b n (h d)
+            out = out.transpose(1, 2).reshape(b, s_q, -1)
+        elif backend in ('chunked', 'math'):
             # b n (h d) -> (b h) n d
             q = rearrange_heads_outer(q, h)
             k = rearrange_heads_outer(k, h)
             v = rearrange_heads_outer(v, h)
 
-            sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
             if exists(mask):
                 # standard stable diffusion does not run into here
-                mask = mask.view(mask.shape[0], -1)
-                b, j = mask.shape
-                mask = mask.unsqueeze(1).expand(b, h, j).reshape(b * h, 1, j)  # b j -> (b h) () j
-                sim.masked_fill_(~mask, self.max_neg[sim.dtype])
+                mask = mask.repeat_interleave(h, dim=0)  # b j -> (b h) j
+
+            if backend == 'chunked':
+                out = chunked_attention(
+                    q,
+                    k,
+                    v,
+                    self.scale,
+                    mask=mask,
+                    query_chunk_size=self.query_chunk_size,
+                    key_chunk_size=self.key_chunk_size,
+                )
+            else:
+                # original implementation
+                sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+
+                if exists(mask):
+                    sim.masked_fill_(~mask[:, None, :], torch.finfo(sim.dtype).min)
 
-            # attention, what we cannot get enough of
-            attn = sim.softmax(dim=-1)
+                # attention, what we cannot get enough of
+                attn = sim.softmax(dim=-1)
 
-            out = einsum('b i j, b j d -> b i d', attn, v)
+                out = einsum('b i j, b j d -> b i d', attn, v)
 
             # (b h) n d -> b n (h d)
             out = rearrange_heads_inner(out, h)
@@ -292,6 +415,7 @@ class BasicTransformerBlock(nn.Module):
         use_checkpoint=False,
         use_flash_attention=False,
         disable_self_attn=False,
+        attention_backend='auto',
     ):
         super().__init__()
         self.disable_self_attn = disable_self_attn
@@ -302,6 +426,7 @@ class BasicTransformerBlock(nn.Module):
             dropout=dropout,
             use_flash_attention=use_flash_attention,
             context_dim=context_dim if self.disable_self_attn else None,
+            attention_backend=attention_backend,
         )  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = CrossAttention(
@@ -311,20 +436,53 @@ class BasicTransformerBlock(nn.Module):
             dim_head=d_head,
             dropout=dropout,
             use_flash_attention=use_flash_attention,
+            attention_backend=attention_backend,
         )  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.use_checkpoint = use_checkpoint
+        # Token merging before self-attention, see `UNetModel.enable_token_merging`
+        self.token_merging_ratio = 0.0
+        self.token_merging_stride = 2
+        self.token_merging_seed = 0
+        self.token_merging_hw = None  # height and width of the token grid, set by SpatialTransformer
+        self._token_merging_generator = None
+
+    def _get_token_merging_indices(self, x):
+        """Pick the destination tokens of token merging, None without token merging."""
+        if self.token_merging_ratio <= 0.0 or self.token_merging_hw is None:
+            return None
+        generator = self._token_merging_generator
+        if generator is None or generator.device != x.device:
+            generator = torch.Generator(device=x.device).manual_seed(self.token_merging_seed)
+            self._token_merging_generator = generator
+        h, w = self.token_merging_hw
+        return random_destination_indices(h, w, self.token_merging_stride, generator=generator, device=x.device)
+
+    def _get_token_merging(self, x, merge_indices):
+        if merge_indices is None:
+            return None, None
+        h, w = self.token_merging_hw
+        r = int(x.shape[1] * self.token_merging_ratio)
+        return bipartite_soft_matching_random2d(x, h, w, r, stride=self.token_merging_stride, rand_idx=merge_indices)
 
     def forward(self, x, context=None):
+        # the destination tokens are picked outside of the checkpointed function, so that its recomputation in the
+        # backward pass merges the same tokens
+        forward = partial(self._forward, merge_indices=self._get_token_merging_indices(x))
         if self.use_checkpoint:
-            return checkpoint(self._forward, (x, context), self.parameters(), self.use_checkpoint)
+            return checkpoint(forward, (x, context), self.parameters(), self.use_checkpoint)
         else:
-            return self._forward(x, context)
+            return forward(x, context)
 
-    def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x), context=context if self.disable_self_attn else None) + x
+    def _forward(self, x, context=None, merge_indices=None):
+        merge, unmerge = self._get_token_merging(x, merge_indices)
+        if merge is not None:
+            h = unmerge(self.attn1(merge(self.norm1(x)), context=context if self.disable_self_attn else None))
+            x = h + x
+        else:
+            x = self.attn1(self.norm1(x), context=context if self.disable_self_attn else None) + x
         x = self.attn2(self.norm2(x), context=context) + x
         x = self.ff(self.norm3(x)) + x
         return x
@@ -351,6 +509,7 @@ class SpatialTransformer(nn.Module):
         use_linear=False,
         use_checkpoint=False,
         use_flash_attention=False,
+        attention_backend='auto',
     ):
         super().__init__()
         if exists(context_dim) and not isinstance(context_dim, list):
@@ -375,6 +534,7 @@ class SpatialTransformer(nn.Module):
                     use_checkpoint=use_checkpoint,
                     use_flash_attention=use_flash_attention,
                     disable_self_attn=disable_self_attn,
+                    attention_backend=attention_backend,
                 )
                 for d in range(depth)
             ]
@@ -399,6 +559,7 @@ class SpatialTransformer(nn.Module):
         if self.use_linear:
             x = self.proj_in(x)
         for i, block in enumerate(self.transformer_blocks):
+            block.token_merging_hw = (h, w)
             x = block(x, context=context[i])
         if self.use_linear:
             x = self.proj_out(x)
@@ -32,6 +32,7 @@ from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.util
     timestep_embedding,
     zero_module,
 )
+from nemo.collections.multimodal.modules.stable_diffusion.token_merging import get_token_merging_ratios
 
 
 def convert_module_to_dtype(module, dtype):
@@ -477,6 +478,8 @@ class UNetModel(nn.Module):
         # It must be specified when from pretrained is not None. It indicates loading unet from NeMo trained ckpt or HF
         use_flash_attention: bool = False,
         enable_amp_o2_fp16: bool = False,
+        attention_backend: str = 'auto',
+        token_merging_ratio=0.0,
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -573,6 +576,7 @@ class UNetModel(nn.Module):
                             use_linear=use_linear_in_transformer,
                             use_checkpoint=use_checkpoint,
                             use_flash_attention=use_flash_attention,
+                            attention_backend=attention_backend,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -635,6 +639,7 @@ class UNetModel(nn.Module):
                 use_linear=use_linear_in_transformer,
                 use_checkpoint=use_checkpoint,
                 use_flash_attention=use_flash_attention,
+                attention_backend=attention_backend,
             ),
             ResBlock(
                 ch,
@@ -690,6 +695,7 @@ class UNetModel(nn.Module):
                             use_linear=use_linear_in_transformer,
                             use_checkpoint=use_checkpoint,
                             use_flash_attention=use_flash_attention,
+                            attention_backend=attention_backend,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -722,6 +728,17 @@ class UNetModel(nn.Module):
                 # nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
             )
 
+        # Reuse of deep features across sampling steps, see `enable_feature_cache`
+        self.feature_cache_interval = 1
+        self.feature_cache_block_id = 0
+        self.feature_cache_warmup_steps = 0
+        self._feature_cache = {}
+        self._feature_cache_step = None
+        self._feature_cache_call = 0
+
+        if token_merging_ratio:
+            self.enable_token_merging(token_merging_ratio)
+
         if from_pretrained is not None:
             if from_NeMo:
                 state_dict = torch.load(from_pretrained, map_location='cpu')
@@ -959,6 +976,81 @@ class UNetModel(nn.Module):
         """
         self.apply(convert_module_to_fp16)
 
+    def enable_feature_cache(self, interval=3, block_id=0, warmup_steps=0):
+        """
+        Enable reuse of deep features across sampling steps (DeepCache, https://arxiv.org/abs/2312.00858).
+        At refresh steps the full UNet is computed and the input of the output block matching input block
+        `block_id` is cached. At the other steps only the shallow branch made of input blocks [0, block_id]
+        and the matching output blocks is computed, on top of the cached deep features.
+        The samplers drive the cache through `set_feature_cache_step`.
+        :param interval: the full UNet is computed every `interval` sampling steps.
+        :param block_id: last input block of the shallow branch. Larger values trade speed for quality.
+        :param warmup_steps: number of initial sampling steps always computed with the full UNet.
+        """
+        if not 0 <= block_id < len(self.input_blocks) - 1:
+            raise ValueError(f'block_id must be in [0, {len(self.input_blocks) - 1}), got {block_id}')
+        self.feature_cache_interval = interval
+        self.feature_cache_block_id = block_id
+        self.feature_cache_warmup_steps = warmup_steps
+        self._feature_cache.clear()
+        self._feature_cache_step = None
+
+    def disable_feature_cache(self):
+        self.feature_cache_interval = 1
+        self._feature_cache.clear()
+        self._feature_cache_step = None
+
+    def _spatial_transformers_by_level(self):
+        """Yield (level, module) for every SpatialTransformer, level 0 being the highest resolution."""
+        level = 0
+        for block in self.input_blocks:
+            for layer in block:
+                if isinstance(layer, SpatialTransformer):
+                    yield level, layer
+                elif isinstance(layer, Downsample) or (isinstance(layer, ResBlock) and layer.updown):
+                    level += 1
+        for layer in self.middle_block:
+            if isinstance(layer, SpatialTransformer):
+                yield level, layer
+        for block in self.output_blocks:
+            for layer in block:
+                if isinstance(layer, SpatialTransformer):
+                    yield level, layer
+                elif isinstance(layer, (Upsample, TransposedUpsample)) or (
+                    isinstance(layer, ResBlock) and layer.updown
+                ):
+                    level -= 1
+
+    def enable_token_merging(self, ratio=0.5, stride=2, seed=0):
+        """
+        Enable token merging before the self-attention of the SpatialTransformer blocks (ToMe for SD,
+        https://arxiv.org/abs/2303.17604). Self-attention runs on `1 - ratio` of the latent pixel tokens.
+        :param ratio: fraction of the tokens merged away. A float applies to the highest resolution level
+            only, where most of the tokens are; a list gives the ratio of every level.
+        :param stride: destination tokens are picked at random in every `stride` x `stride` window.
+        :param seed: seed of the random choice of the destination tokens.
+        """
+        ratios = get_token_merging_ratios(ratio, len(self.input_blocks))
+        for level, transformer in self._spatial_transformers_by_level():
+            for block in transformer.transformer_blocks:
+                block.token_merging_ratio = ratios[level]
+                block.token_merging_stride = stride
+                block.token_merging_seed = seed
+                block._token_merging_generator = None
+
+    def disable_token_merging(self):
+        for _, transformer in self._spatial_transformers_by_level():
+            for block in transformer.transformer_blocks:
+                block.token_merging_ratio = 0.0
+
+    def set_feature_cache_step(self, step):
+        """
+        Set the index of the current sampling step. Model calls within a step are told apart by their order,
+        so that e.g. the two passes of sequential classifier-free guidance use their own cache entries.
+        """
+        self._feature_cache_step = step
+        self._feature_cache_call = 0
+
     def forward(self, x, timesteps=None, context=None, y=None, **kwargs):
         """
         Apply the model to an input batch.
@@ -979,12 +1071,35 @@ class UNetModel(nn.Module):
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
+        use_cache = self.feature_cache_interval > 1 and self._feature_cache_step is not None
+        reuse_cache = False
+        if use_cache:
+            cache_key = self._feature_cache_call
+            self._feature_cache_call += 1
+            step = self._feature_cache_step - self.feature_cache_warmup_steps
+            cached = self._feature_cache.get(cache_key)
+            reuse_cache = (
+                step > 0 and step % self.feature_cache_interval != 0 and cached is not None and len(cached) == len(x)
+            )
+        cache_output_id = len(self.output_blocks) - self.feature_cache_block_id - 1
+
         h = x.type(emb.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        if reuse_cache:
+            # shallow branch on top of the cached deep features
+            for module in self.input_blocks[: self.feature_cache_block_id + 1]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = cached
+            output_blocks = self.output_blocks[cache_output_id:]
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+        for i, module in enumerate(output_blocks):
+            if use_cache and not reuse_cache and i == cache_output_id:
+                self._feature_cache[cache_key] = h
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         if self.predict_codebook_ids:
@@ -0,0 +1,96 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import torch
+
+
+def get_tile_starts(size, tile_size, overlap):
+    """
+    Start offsets of tiles of `tile_size` covering `size`, with at least `overlap` between neighbouring tiles.
+    The last tile is aligned to the end, so that every tile has the same size.
+    """
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def get_blend_ramp(length, ramp, ramp_start, ramp_end):
+    """1D blending weights of a tile: linear ramps of `ramp` elements on the sides shared with a neighbour."""
+    weight = torch.ones(length)
+    if ramp > 0:
+        ramp_values = torch.arange(1, ramp + 1, dtype=torch.float) / (ramp + 1)
+        if ramp_start:
+            weight[:ramp] = torch.minimum(weight[:ramp], ramp_values)
+        if ramp_end:
+            weight[-ramp:] = torch.minimum(weight[-ramp:], ramp_values.flip(0))
+    return weight
+
+
+def tiled_forward(fn, x, tile_size, overlap, in_factor=1, out_factor=1, max_tile_batch=None):
+    """
+    Apply a fully convolutional `fn` to overlapping tiles of `x` and blend the outputs.
+
+    Tiles are laid out on a grid whose unit is `in_factor` pixels of `x` and `out_factor` pixels of the output,
+    e.g. latent pixels for a VAE with `in_factor=8, out_factor=1` when encoding and `in_factor=1, out_factor=8`
+    when decoding. Overlapping outputs are blended with linear ramps over the overlap, which hides the seams
+    between tiles. Tiles of all images are batched together, at most `max_tile_batch` of them per call of `fn`.
+
+    Args:
+        fn: function mapping a batch of tiles (n, c, t * in_factor, t * in_factor) to (n, c', t * out_factor, ...).
+        x: input of shape (b, c, h, w), h and w multiples of `in_factor`.
+        tile_size: size of the tiles in grid units.
+        overlap: minimum overlap between neighbouring tiles in grid units, smaller than `tile_size`.
+        in_factor: input pixels per grid unit.
+        out_factor: output pixels per grid unit.
+        max_tile_batch: maximum number of tiles, counting every image of the batch, passed to `fn` at once.
+            All tiles are passed at once if None.
+    Returns:
+        Blended output of shape (b, c', h // in_factor * out_factor, w // in_factor * out_factor).
+    """
+    assert 0 <= overlap < tile_size, f'Tile overlap {overlap} must be smaller than the tile size {tile_size}'
+    b, _, h, w = x.shape
+    grid_h, grid_w = h // in_factor, w // in_factor
+    tile_h, tile_w = min(tile_size, grid_h), min(tile_size, grid_w)
+    starts_h = get_tile_starts(grid_h, tile_h, overlap)
+    starts_w = get_tile_starts(grid_w, tile_w, overlap)
+    tiles = [(i, j) for i in starts_h for j in starts_w]
+    tiles_per_call = len(tiles) if max_tile_batch is None else max(1, max_tile_batch // b)
+
+    ramp = overlap * out_factor
+    out = weight_sum = None
+    for k in range(0, len(tiles), tiles_per_call):
+        chunk = tiles[k : k + tiles_per_call]
+        inputs = torch.cat(
+            [
+                x[:, :, i * in_factor : (i + tile_h) * in_factor, j * in_factor : (j + tile_w) * in_factor]
+                for i, j in chunk
+            ]
+        )
+        outputs = fn(inputs)
+        if out is None:
+            out = torch.zeros(
+                b, outputs.shape[1], grid_h * out_factor, grid_w * out_factor, device=x.device, dtype=torch.float
+            )
+            weight_sum = torch.zeros(1, 1, grid_h * out_factor, grid_w * out_factor, device=x.device)
+        for (i, j), output in zip(chunk, outputs.split(b)):
+            weight_h = get_blend_ramp(tile_h * out_factor, ramp, i > 0, i + tile_h < grid_h)
+            weight_w = get_blend_ramp(tile_w * out_factor, ramp, j > 0, j + tile_w < grid_w)
+            weight = (weight_h[:, None] * weight_w[None, :]).to(x.device)
+            rows = slice(i * out_factor, (i + tile_h) * out_factor)
+            cols = slice(j * out_factor, (j + tile_w) * out_factor)
+            out[:, :, rows, cols] += output.float() * weight
+            weight_sum[:, :, rows, cols] += weight
+    return (out / weight_sum).to(outputs.dtype)
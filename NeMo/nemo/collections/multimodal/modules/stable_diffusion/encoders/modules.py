@@ -215,7 +215,7 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
-    def forward(self, text):
+    def tokenize(self, text):
         batch_encoding = self.tokenizer(
             text,
             truncation=True,
@@ -225,15 +225,21 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             padding="max_length",
             return_tensors="pt",
         )
+        return batch_encoding["input_ids"]
+
+    def forward(self, text):
+        return self.encode_tokens(self.tokenize(text))
+
+    def encode_tokens(self, tokens):
         if self.capture_cudagraph_iters < 0:
-            tokens = batch_encoding["input_ids"].to(self.device, non_blocking=True)
+            tokens = tokens.to(self.device, non_blocking=True)
             outputs = self.transformer(input_ids=tokens)
             z = outputs.last_hidden_state
 
         else:
             if self.static_tokens is None:
-                self.static_tokens = batch_encoding["input_ids"].to(device=self.device, non_blocking=True)
-            self.static_tokens.copy_(batch_encoding["input_ids"], non_blocking=True)
+                self.static_tokens = tokens.to(device=self.device, non_blocking=True)
+            self.static_tokens.copy_(tokens, non_blocking=True)
 
             if self.iterations == self.capture_cudagraph_iters:
                 # cuda graph capture
@@ -306,8 +312,13 @@ class FrozenOpenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
+    def tokenize(self, text):
+        return open_clip.tokenize(text)
+
     def forward(self, text):
-        tokens = open_clip.tokenize(text)
+        return self.encode_tokens(self.tokenize(text))
+
+    def encode_tokens(self, tokens):
         z = self.encode_with_transformer(tokens.to(self.device))
         return z
 
@@ -436,9 +447,14 @@ class FrozenMegatronCLIPEmbedder(AbstractEncoder):
             after += 1
         return after
 
+    def tokenize(self, text):
+        return self.text_transform(text)
+
     def forward(self, text):
-        texts = self.text_transform(text)
-        z = self.encode_with_transformer(texts.to(self.device))
+        return self.encode_tokens(self.tokenize(text))
+
+    def encode_tokens(self, tokens):
+        z = self.encode_with_transformer(tokens.to(self.device))
         # # Pad the seq length to multiple of 8
         seq_len = (z.shape[1] + 8 - 1) // 8 * 8
         z = torch.nn.functional.pad(z, (0, 0, 0, seq_len - z.shape[1]), value=0.0)
@@ -0,0 +1,134 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Token merging for Stable Diffusion (ToMe for SD, https://arxiv.org/abs/2303.17604).
+
+Before self-attention, the latent pixel tokens are split into destination tokens, one picked at random in every
+`stride` x `stride` window, and source tokens. The `r` source tokens most similar to a destination token are
+averaged into it, and after self-attention every merged token is copied back to the positions it was made of.
+"""
+import torch
+
+
+def _identity(x):
+    return x
+
+
+def random_destination_indices(h, w, stride=2, generator=None, device=None):
+    """
+    Pick the destination token of every `stride` x `stride` window of a h x w token grid, at random.
+
+    Returns:
+        the index of the destination token in every window, of shape (h // stride, w // stride, 1).
+    """
+    return torch.randint(stride * stride, size=(h // stride, w // stride, 1), generator=generator, device=device)
+
+
+def bipartite_soft_matching_random2d(metric, h, w, r, stride=2, generator=None, rand_idx=None):
+    """
+    Build the merge and unmerge functions of tokens laid out on a h x w grid.
+
+    Args:
+        metric: tokens of shape (b, h * w, c) the similarity is computed on.
+        h: height of the token grid.
+        w: width of the token grid.
+        r: number of tokens to remove by merging.
+        stride: size of the windows every destination token is picked from.
+        generator: random generator used to pick the destination tokens, on the device of `metric`.
+        rand_idx: destination tokens from `random_destination_indices`, picked with `generator` if None.
+    Returns:
+        (merge, unmerge) functions. `merge` maps (b, h * w, c) tokens to (b, h * w - r, c),
+        `unmerge` maps them back.
+    """
+    b, n, _ = metric.shape
+    grid_h, grid_w = h // stride, w // stride
+    if r <= 0 or grid_h * grid_w == 0:
+        return _identity, _identity
+
+    with torch.no_grad():
+        # mark one random destination token per window with -1, sorting then puts destination tokens first
+        if rand_idx is None:
+            rand_idx = random_destination_indices(h, w, stride, generator=generator, device=metric.device)
+        window_buffer = torch.zeros(grid_h, grid_w, stride * stride, device=metric.device, dtype=torch.int64)
+        window_buffer.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        window_buffer = window_buffer.view(grid_h, grid_w, stride, stride).transpose(1, 2)
+        window_buffer = window_buffer.reshape(grid_h * stride, grid_w * stride)
+        if grid_h * stride < h or grid_w * stride < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[: grid_h * stride, : grid_w * stride] = window_buffer
+        else:
+            idx_buffer = window_buffer
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+
+        num_dst = grid_h * grid_w
+        src_positions = rand_idx[:, num_dst:, :]
+        dst_positions = rand_idx[:, :num_dst, :]
+
+        def split(x):
+            c = x.shape[-1]
+            src = torch.gather(x, dim=1, index=src_positions.expand(x.shape[0], n - num_dst, c))
+            dst = torch.gather(x, dim=1, index=dst_positions.expand(x.shape[0], num_dst, c))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        src_metric, dst_metric = split(metric)
+        scores = src_metric @ dst_metric.transpose(-1, -2)
+
+        r = min(src_metric.shape[1], r)
+        # every source token is matched to its most similar destination token, the r best matches are merged
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unmerged_idx = edge_idx[..., r:, :]
+        merged_idx = edge_idx[..., :r, :]
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=merged_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        bs, num_src, c = src.shape
+        unmerged = torch.gather(src, dim=-2, index=unmerged_idx.expand(bs, num_src - r, c))
+        src = torch.gather(src, dim=-2, index=merged_idx.expand(bs, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(bs, r, c), src, reduce='mean')
+        return torch.cat([unmerged, dst], dim=1)
+
+    def unmerge(x):
+        num_unmerged = unmerged_idx.shape[1]
+        unmerged, dst = x[..., :num_unmerged, :], x[..., num_unmerged:, :]
+        bs, _, c = unmerged.shape
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(bs, r, c))
+        out = torch.zeros(bs, n, c, device=x.device, dtype=x.dtype)
+        all_src_positions = src_positions.expand(bs, n - num_dst, 1)
+        out.scatter_(dim=-2, index=dst_positions.expand(bs, num_dst, c), src=dst)
+        out.scatter_(
+            dim=-2,
+            index=torch.gather(all_src_positions, dim=1, index=unmerged_idx).expand(bs, num_unmerged, c),
+            src=unmerged,
+        )
+        out.scatter_(dim=-2, index=torch.gather(all_src_positions, dim=1, index=merged_idx).expand(bs, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def get_token_merging_ratios(ratio, num_levels):
+    """
+    Merge ratio of every UNet level, level 0 being the highest resolution.
+    A float applies to level 0 only, where most of the tokens are; a list gives the ratio of every level.
+    """
+    if isinstance(ratio, (int, float)):
+        ratios = [float(ratio)]
+    else:
+        ratios = [float(value) for value in ratio]
+    if any(not 0.0 <= value < 1.0 for value in ratios):
+        raise ValueError(f'Token merging ratios must be in [0, 1), got {ratios}')
+    return (ratios + [0.0] * num_levels)[:num_levels]
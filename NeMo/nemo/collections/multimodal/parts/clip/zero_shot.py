@@ -0,0 +1,114 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+def text_encoder_version(text_encoder):
+    """
+    Version of the weights of a text encoder. It changes whenever a parameter is replaced or modified in place,
+    e.g. by an optimizer step or by loading a checkpoint, and stays the same while the encoder is frozen.
+    """
+    return tuple((param.data_ptr(), param._version) for param in text_encoder.parameters())
+
+
+class ZeroShotClassifier:
+    """
+    Zero-shot classifier of a CLIP model: for every class, the normalized mean of the normalized text embeddings
+    of its prompts (the class name in every template).
+
+    The classes are split into contiguous shards, one per data parallel rank, every rank encodes the prompts of its
+    shard and the class embeddings are all-gathered. The classifier is cached and only recomputed when the weights
+    of the text encoder change (see `text_encoder_version`), so that validation with a frozen text tower encodes
+    the prompts once.
+
+    Args:
+        texts: tokenized prompts of shape (num_classes * num_templates, seq_len), or a dataset of tokenized prompts
+            such as `ImagenetClassnameDataset`, grouped by class.
+        num_templates: number of prompts per class.
+        process_group: data parallel group the classes are sharded across, None for the default group.
+        batch_size: number of prompts encoded at once.
+    """
+
+    def __init__(self, texts, num_templates, process_group=None, batch_size=1024):
+        if not torch.is_tensor(texts):
+            texts = torch.stack([texts[i] for i in range(len(texts))])
+        assert len(texts) % num_templates == 0, 'Every class needs the same number of prompts'
+        self.texts = texts
+        self.num_templates = num_templates
+        self.num_classes = len(texts) // num_templates
+        self.process_group = process_group
+        self.batch_size = max(batch_size // num_templates, 1) * num_templates
+        self._weights = None
+        self._version = None
+
+    def _world(self):
+        if not dist.is_available() or not dist.is_initialized():
+            return 0, 1
+        return dist.get_rank(group=self.process_group), dist.get_world_size(group=self.process_group)
+
+    def is_stale(self, text_encoder, device):
+        r"""Whether the cached classifier is out of date on any rank, so that all ranks recompute it together."""
+        stale = self._weights is None or self._version != text_encoder_version(text_encoder)
+        _, world_size = self._world()
+        if world_size > 1:
+            flag = torch.tensor([float(stale)], device=device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX, group=self.process_group)
+            stale = bool(flag.item())
+        return stale
+
+    def encode_classes(self, text_encoder, start, end, device, autocast_dtype=torch.float):
+        r"""Class embeddings of classes `[start, end)`, of shape (end - start, embed_dim), in float32."""
+        texts = self.texts[start * self.num_templates : end * self.num_templates]
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i : i + self.batch_size].to(device, non_blocking=True)
+            with torch.cuda.amp.autocast(
+                enabled=autocast_dtype in (torch.half, torch.bfloat16), dtype=autocast_dtype,
+            ):
+                embeddings.append(F.normalize(text_encoder(batch).float(), dim=-1))
+        embeddings = torch.cat(embeddings).view(end - start, self.num_templates, -1).mean(dim=1)
+        return F.normalize(embeddings, dim=-1)
+
+    @torch.no_grad()
+    def __call__(self, text_encoder, device=None, autocast_dtype=torch.float):
+        r"""Return the classifier weights of shape (embed_dim, num_classes)."""
+        if device is None:
+            device = next(text_encoder.parameters()).device
+        if not self.is_stale(text_encoder, device):
+            return self._weights
+
+        rank, world_size = self._world()
+        shard_size = math.ceil(self.num_classes / world_size)
+        start = min(rank * shard_size, self.num_classes)
+        end = min(start + shard_size, self.num_classes)
+        if end > start:
+            local = self.encode_classes(text_encoder, start, end, device, autocast_dtype)
+        else:
+            # the prompts of the first class give the embedding size of ranks left without classes
+            local = self.encode_classes(text_encoder, 0, 1, device, autocast_dtype)[:0]
+        if world_size > 1:
+            # shards are padded to the same size for the all-gather
+            padded = local.new_zeros(shard_size, local.shape[-1])
+            padded[: len(local)] = local
+            gathered = [torch.empty_like(padded) for _ in range(world_size)]
+            dist.all_gather(gathered, padded, group=self.process_group)
+            local = torch.cat(gathered)[: self.num_classes]
+
+        self._weights = local.t().contiguous()
+        self._version = text_encoder_version(text_encoder)
+        return self._weights
@@ -0,0 +1,136 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+class ConditioningCache:
+    """
+    LRU cache of text-conditioning embeddings produced by a frozen cond stage model.
+
+    Entries are keyed by the encoder and the tokenized prompt, for the encoders that expose
+    `tokenize` / `encode_tokens` (FrozenCLIPEmbedder, FrozenOpenCLIPEmbedder,
+    FrozenMegatronCLIPEmbedder). Only the rows that miss the cache are sent through the encoder, and
+    duplicated prompts within a batch are encoded once. The other encoders, and the encoders replayed
+    with CUDA graphs that need full batches, bypass the cache.
+    Embeddings of `pinned_prompts` (by default the empty unconditional prompt) are never evicted
+    and do not count towards the size budget.
+
+    Args:
+        max_size_mb: size budget of the evictable entries in MB.
+        pinned_prompts: prompts whose embeddings are kept permanently.
+    """
+
+    def __init__(self, max_size_mb=256, pinned_prompts=("",)):
+        self.max_bytes = int(max_size_mb * 1024 ** 2)
+        self.pinned_prompts = set(pinned_prompts)
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._bytes = 0
+        # ids of the encoders are never reused, unlike id(encoder) after the encoder is freed
+        self._encoder_ids = weakref.WeakKeyDictionary()
+        self._next_encoder_id = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def clear(self):
+        self._entries.clear()
+        self._pinned.clear()
+        self._bytes = 0
+
+    @staticmethod
+    def supports_token_keys(encoder):
+        # CUDA graph replay requires a static batch, so partial batches of misses cannot be encoded
+        if getattr(encoder, 'capture_cudagraph_iters', -1) >= 0:
+            return False
+        return callable(getattr(encoder, 'tokenize', None)) and callable(getattr(encoder, 'encode_tokens', None))
+
+    def _lookup(self, key):
+        if key in self._pinned:
+            return self._pinned[key]
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        return None
+
+    def _insert(self, key, embedding, pinned=False):
+        embedding = embedding.detach()
+        if pinned:
+            self._pinned[key] = embedding
+            return
+        nbytes = embedding.numel() * embedding.element_size()
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = embedding
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+
+    def encode(self, encoder, text):
+        """
+        Drop-in replacement of `encoder.encode(text)` for a list of prompts.
+        """
+        if isinstance(text, str):
+            text = [text]
+        if not self.supports_token_keys(encoder):
+            return encoder.encode(text)
+        if encoder not in self._encoder_ids:
+            self._encoder_ids[encoder] = next(self._next_encoder_id)
+        encoder_id = self._encoder_ids[encoder]
+        tokens = encoder.tokenize(text)
+        keys = [(encoder_id, tuple(row.tolist())) for row in tokens]
+
+        embeddings = [None] * len(keys)
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            cached = self._lookup(key)
+            if cached is not None:
+                embeddings[i] = cached
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+                self.misses += 1
+
+        if missing:
+            first = [indices[0] for indices in missing.values()]
+            z = encoder.encode_tokens(tokens[first])
+            for (key, indices), embedding in zip(missing.items(), z):
+                for i in indices:
+                    embeddings[i] = embedding
+                self._insert(key, embedding, pinned=text[indices[0]] in self.pinned_prompts)
+
+        return torch.stack(embeddings)
+
+
+def get_conditioning_cache(model, max_size_mb=None):
+    """
+    Return the conditioning cache attached to a LatentDiffusion model, creating one of
+    `max_size_mb` MB if the model has none. Returns None when caching is disabled.
+    """
+    cache = getattr(model, 'conditioning_cache', None)
+    if cache is None and max_size_mb:
+        cache = ConditioningCache(max_size_mb)
+        model.conditioning_cache = cache
+    return cache
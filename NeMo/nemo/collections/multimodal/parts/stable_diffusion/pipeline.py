@@ -14,6 +14,10 @@
 import os
 import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from queue import Queue
+from threading import BoundedSemaphore, Thread
 
 import torch
 from PIL import Image
@@ -22,32 +26,91 @@ from nemo.collections.multimodal.models.stable_diffusion.samplers.ddim import DD
 from nemo.collections.multimodal.models.stable_diffusion.samplers.para_ddim import ParaDDIMSampler
 from nemo.collections.multimodal.models.stable_diffusion.samplers.plms import PLMSSampler
 from nemo.collections.multimodal.models.stable_diffusion.samplers.sampler_dpm import DPMSolverSampler
+from nemo.collections.multimodal.parts.stable_diffusion.conditioning_cache import get_conditioning_cache
 from nemo.collections.multimodal.parts.stable_diffusion.utils import DataParallelWrapper
 
 
-def encode_prompt(cond_stage_model, prompt, unconditional_guidance_scale, batch_size):
-    c = cond_stage_model.encode(batch_size * [prompt])
+def _encode_text(cond_stage_model, text, conditioning_cache=None):
+    if conditioning_cache is not None:
+        return conditioning_cache.encode(cond_stage_model, text)
+    return cond_stage_model.encode(text)
+
+
+def encode_prompt(cond_stage_model, prompt, unconditional_guidance_scale, batch_size, conditioning_cache=None):
+    c = _encode_text(cond_stage_model, batch_size * [prompt], conditioning_cache)
     if unconditional_guidance_scale != 1.0:
-        uc = cond_stage_model.encode(batch_size * [""])
+        uc = _encode_text(cond_stage_model, batch_size * [""], conditioning_cache)
     else:
         uc = None
     return c, uc
 
 
-def initialize_sampler(model, sampler_type):
+def encode_prompts(cond_stage_model, prompts, unconditional_guidance_scale, batch_size, conditioning_cache=None):
+    """
+    Encode several prompts in a single call of the text encoder. Conditionings are laid out
+    prompt-major, i.e. the first `batch_size` rows belong to `prompts[0]` and so on.
+    """
+    if len(prompts) == 1:
+        return encode_prompt(
+            cond_stage_model, prompts[0], unconditional_guidance_scale, batch_size, conditioning_cache
+        )
+    c = _encode_text(cond_stage_model, [prompt for prompt in prompts for _ in range(batch_size)], conditioning_cache)
+    if unconditional_guidance_scale != 1.0:
+        uc = _encode_text(cond_stage_model, len(prompts) * batch_size * [""], conditioning_cache)
+    else:
+        uc = None
+    return c, uc
+
+
+def get_prompt_batches(prompts, num_images_per_prompt, max_batch_size=None, max_latent_memory=None, latent_bytes=0):
+    """
+    Group prompts into micro-batches for cross-prompt batching.
+
+    Args:
+        prompts: list of text prompts.
+        num_images_per_prompt: number of images generated for every prompt.
+        max_batch_size: maximum number of images (sampler batch size) in a micro-batch.
+        max_latent_memory: maximum latent memory of a micro-batch in MB.
+        latent_bytes: memory in bytes taken by the latents of a single image, including the
+            unconditional branch of classifier-free guidance.
+    Returns:
+        list of lists of prompts. Every micro-batch holds at least one prompt.
+    """
+    max_prompts = len(prompts)
+    if max_batch_size is not None:
+        max_prompts = min(max_prompts, max_batch_size // num_images_per_prompt)
+    if max_latent_memory is not None and latent_bytes > 0:
+        max_prompts = min(max_prompts, int(max_latent_memory * 1024 ** 2) // (latent_bytes * num_images_per_prompt))
+    max_prompts = max(max_prompts, 1)
+    return [prompts[i : i + max_prompts] for i in range(0, len(prompts), max_prompts)]
+
+
+def initialize_sampler(model, sampler_type, **kwargs):
     if sampler_type == 'DDIM':
-        sampler = DDIMSampler(model)
+        sampler = DDIMSampler(model, **kwargs)
     elif sampler_type == 'PLMS':
-        sampler = PLMSSampler(model)
+        sampler = PLMSSampler(model, **kwargs)
     elif sampler_type == 'DPM':
-        sampler = DPMSolverSampler(model)
+        sampler = DPMSolverSampler(model, **kwargs)
     elif sampler_type == 'PARA_DDIM':
-        sampler = ParaDDIMSampler(model)
+        sampler = ParaDDIMSampler(model, **kwargs)
     else:
         raise ValueError(f'Sampler {sampler_type} is not supported.')
     return sampler
 
 
+def configure_vae_tiling(model, tiling_cfg):
+    """
+    Enable tiled encoding and decoding of the first stage model, e.g. for outputs of 2048px and more.
+    `tiling_cfg` holds the arguments of `AutoencoderKL.enable_tiling`, tiling is left unchanged if None.
+    """
+    if tiling_cfg is None:
+        return
+    if not hasattr(model.first_stage_model, 'enable_tiling'):
+        raise ValueError(f'{type(model.first_stage_model).__name__} does not support tiling')
+    model.first_stage_model.enable_tiling(**tiling_cfg)
+
+
 def decode_images(model, samples):
     images = model.decode_first_stage(samples)
 
@@ -73,6 +136,152 @@ def torch_to_numpy(images):
     return numpy_images
 
 
+class AsyncOutputStage:
+    """
+    Streaming output stage of the inference pipeline.
+
+    Sampled latents are handed over through a bounded queue to a decode thread, which runs the VAE
+    decoder on a side CUDA stream so that decoding of a micro-batch overlaps with sampling of the
+    next one. Decoded images are converted to the requested output type and written to disk by a
+    pool of worker threads. Both the latent queue and the number of decoded prompts waiting for the
+    workers are bounded, so memory does not grow with the number of prompts.
+
+    `close` waits for all the micro-batches and returns the outputs, `abort` stops the stage without
+    waiting for them, e.g. when sampling fails. Either of them has to be called to stop the threads.
+
+    Args:
+        model: LatentDiffusion model used to decode latents.
+        num_images_per_prompt: number of images generated for every prompt.
+        output_type: one of 'pil', 'numpy' or 'torch'.
+        out_path: directory PIL images are saved to, None to skip saving.
+        autocast_dtype: dtype of the autocast context the decoder runs in.
+        num_workers: number of image conversion/saving threads.
+        max_queue_size: maximum number of micro-batches waiting to be decoded, and of decoded prompts
+            waiting for a conversion worker.
+        keep_outputs: whether converted outputs are kept and returned by `close`.
+    """
+
+    def __init__(
+        self,
+        model,
+        num_images_per_prompt,
+        output_type='pil',
+        out_path=None,
+        autocast_dtype=torch.float,
+        num_workers=4,
+        max_queue_size=2,
+        keep_outputs=True,
+    ):
+        self.model = model
+        self.num_images_per_prompt = num_images_per_prompt
+        self.output_type = output_type
+        self.out_path = out_path
+        self.autocast_dtype = autocast_dtype
+        self.keep_outputs = keep_outputs
+
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.queue = Queue(maxsize=max_queue_size)
+        # one slot per prompt being converted or waiting for a worker
+        self.pending = BoundedSemaphore(num_workers + max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.futures = []
+        self.decode_times = []
+        self.error = None
+        self.aborted = False
+        self._closed = False
+        self.thread = Thread(target=self._decode_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, prompts, samples):
+        """
+        Enqueue the sampled latents of a micro-batch. Blocks while the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        event = None
+        if self.stream is not None and samples.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((prompts, samples, event))
+
+    def close(self):
+        """
+        Wait for all enqueued micro-batches and return the per-prompt outputs and per-micro-batch decode times.
+        """
+        try:
+            self._stop_decode_thread()
+            if self.error is not None:
+                raise self.error
+            output = [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown()
+        return output, self.decode_times
+
+    def abort(self):
+        """
+        Stop the decode thread and the workers, skipping the micro-batches that are not decoded yet.
+        Does nothing once the stage is closed.
+        """
+        self.aborted = True
+        self._stop_decode_thread()
+        self.executor.shutdown()
+
+    def _stop_decode_thread(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _decode_loop(self):
+        # autocast and grad mode are thread local, so they have to be entered again in this thread
+        with torch.no_grad(), torch.cuda.amp.autocast(
+            enabled=self.autocast_dtype in (torch.half, torch.bfloat16), dtype=self.autocast_dtype,
+        ):
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if self.error is not None or self.aborted:
+                    continue
+                prompts, samples, event = item
+                try:
+                    self._decode(prompts, samples, event)
+                except BaseException as e:
+                    self.error = e
+
+    def _decode(self, prompts, samples, event):
+        tic = time.perf_counter()
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            if event is not None:
+                self.stream.wait_event(event)
+                samples.record_stream(self.stream)
+            images = decode_images(self.model, samples)
+            if self.output_type != 'torch':
+                images = images.float().cpu()
+            if self.stream is not None:
+                self.stream.synchronize()
+        self.decode_times.append(time.perf_counter() - tic)
+
+        for prompt, prompt_images in zip(prompts, images.split(self.num_images_per_prompt)):
+            # the slot of a prompt is released as soon as its own images are converted
+            self.pending.acquire()
+            future = self.executor.submit(self._convert_and_save, prompt, prompt_images)
+            future.add_done_callback(lambda _: self.pending.release())
+            self.futures.append(future)
+
+    def _convert_and_save(self, prompt, images):
+        if self.output_type == 'torch':
+            return images
+        output = images.permute(0, 2, 3, 1).numpy()
+        if self.output_type == 'pil':
+            output = numpy_to_pil(output)
+            if self.out_path is not None:
+                for idx, image in enumerate(output):
+                    image.save(os.path.join(self.out_path, f'{prompt[:50]}_{idx}.png'))
+        return output if self.keep_outputs else None
+
+
 def pipeline(model, cfg, verbose=True, rng=None):
     # setup default values for inference configs
     unconditional_guidance_scale = cfg.infer.get("unconditional_guidance_scale", 7.5)
@@ -90,6 +299,29 @@ def pipeline(model, cfg, verbose=True, rng=None):
     out_path = cfg.infer.get('out_path', '')
     eta = cfg.infer.get('eta', 0)
     num_devices = cfg.infer.get('devices', 1)
+    # Classifier-free guidance execution: 'fused', 'sequential' or 'truncated'
+    cfg_strategy = cfg.infer.get('cfg_strategy', 'fused')
+    cfg_truncation_steps = cfg.infer.get('cfg_truncation_steps', 0)
+    # UNet deep feature reuse: the full UNet runs every `feature_cache_interval` steps, 1 to disable
+    feature_cache_interval = cfg.infer.get('feature_cache_interval', 1)
+    feature_cache_block_id = cfg.infer.get('feature_cache_block_id', 0)
+    feature_cache_warmup_steps = cfg.infer.get('feature_cache_warmup_steps', 0)
+    # Cross-prompt batching: pack several prompts into one sampler call. A micro-batch never exceeds
+    # `max_batch_size` images nor `max_latent_memory` MB of latents, whichever is tighter.
+    prompt_batching = cfg.infer.get('prompt_batching', False)
+    max_batch_size = cfg.infer.get('max_batch_size', None)
+    max_latent_memory = cfg.infer.get('max_latent_memory', None)
+    # Size in MB of the LRU cache of prompt embeddings, which is kept on the model across calls
+    conditioning_cache_size = cfg.infer.get('conditioning_cache_size', None)
+    # Streaming output: decode, image conversion and saving overlap with sampling of the next prompts
+    async_output = cfg.infer.get('async_output', False)
+    output_workers = cfg.infer.get('output_workers', 4)
+    output_queue_size = cfg.infer.get('output_queue_size', 2)
+    # Tiled VAE decoding with bounded memory, see `AutoencoderKL.enable_tiling`
+    vae_tiling = cfg.infer.get('vae_tiling', None)
+    # Token merging before UNet self-attention, a float for the highest resolution level or a ratio per level;
+    # None keeps the setting of the model config
+    token_merging_ratio = cfg.infer.get('token_merging_ratio', None)
 
     if sampler_parallelism > 1:
         if not sampler_type.startswith('PARA'):
@@ -97,6 +329,10 @@ def pipeline(model, cfg, verbose=True, rng=None):
         if not num_devices > 1:
             print("It is recommended to run parallel sampler with multiple GPUs")
 
+    configure_vae_tiling(model, vae_tiling)
+    if token_merging_ratio is not None:
+        model.model.diffusion_model.enable_token_merging(token_merging_ratio)
+
     if num_devices > 1:
         print(f"Running DataParallel model with {num_devices} GPUs.")
         model.model.diffusion_model = DataParallelWrapper(
@@ -119,79 +355,137 @@ def pipeline(model, cfg, verbose=True, rng=None):
 
         in_channels = model.model.diffusion_model.in_channels
 
-        sampler = initialize_sampler(model, sampler_type.upper())
+        sampler = initialize_sampler(
+            model,
+            sampler_type.upper(),
+            cfg_strategy=cfg_strategy,
+            cfg_truncation_steps=cfg_truncation_steps,
+            feature_cache_interval=feature_cache_interval,
+            feature_cache_block_id=feature_cache_block_id,
+            feature_cache_warmup_steps=feature_cache_warmup_steps,
+        )
+        conditioning_cache = get_conditioning_cache(model, conditioning_cache_size)
 
         output = []
         throughput = []
+        batch_throughput = []
+
+        output_stage = None
+        if async_output:
+            save_images = save_to_file and output_type == 'pil'
+            if save_images:
+                os.makedirs(out_path, exist_ok=True)
+            output_stage = AsyncOutputStage(
+                model,
+                batch_size,
+                output_type=output_type,
+                out_path=out_path if save_images else None,
+                autocast_dtype=autocast_dtype,
+                num_workers=output_workers,
+                max_queue_size=output_queue_size,
+                keep_outputs=not save_images,
+            )
 
         if isinstance(prompts, str):
             prompts = [prompts]
 
-        for prompt in prompts:
-            tic = time.perf_counter()
-            tic_total = tic
-            cond, u_cond = encode_prompt(model.cond_stage_model, prompt, unconditional_guidance_scale, batch_size)
-            toc = time.perf_counter()
-            conditioning_time = toc - tic
-
-            latent_shape = [in_channels, height // downsampling_factor, width // downsampling_factor]
-            latents = torch.randn(
-                [batch_size, in_channels, height // downsampling_factor, width // downsampling_factor], generator=rng
-            ).to(torch.cuda.current_device())
-
-            tic = time.perf_counter()
-            samples, intermediates = sampler.sample(
-                S=inference_steps,
-                conditioning=cond,
-                batch_size=batch_size,
-                shape=latent_shape,
-                verbose=False,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=u_cond,
-                eta=eta,
-                x_T=latents,
-                parallelism=sampler_parallelism,
-                tolerance=sampler_tolerance,
+        latent_shape = [in_channels, height // downsampling_factor, width // downsampling_factor]
+        if prompt_batching:
+            cfg_factor = 2 if unconditional_guidance_scale != 1.0 else 1
+            latent_bytes = cfg_factor * in_channels * latent_shape[1] * latent_shape[2] * 4  # fp32 latents
+            prompt_batches = get_prompt_batches(
+                prompts, batch_size, max_batch_size, max_latent_memory, latent_bytes=latent_bytes
             )
-            toc = time.perf_counter()
-            sampling_time = toc - tic
-
-            tic = time.perf_counter()
-            images = decode_images(model, samples)
-            toc = time.perf_counter()
-            decode_time = toc - tic
-
-            toc_total = time.perf_counter()
-            total_time = toc_total - tic_total
-            output.append(images)
-
-            throughput.append(
-                {
-                    'text-conditioning-time': conditioning_time,
-                    'sampling-time': sampling_time,
-                    'decode-time': decode_time,
-                    'total-time': total_time,
+        else:
+            prompt_batches = [[prompt] for prompt in prompts]
+
+        try:
+            for prompt_batch in prompt_batches:
+                num_prompts = len(prompt_batch)
+                tic = time.perf_counter()
+                tic_total = tic
+                cond, u_cond = encode_prompts(
+                    model.cond_stage_model, prompt_batch, unconditional_guidance_scale, batch_size, conditioning_cache
+                )
+                toc = time.perf_counter()
+                conditioning_time = toc - tic
+
+                # Draw the noise prompt by prompt so that results do not depend on the micro-batch size
+                latents = torch.cat(
+                    [torch.randn([batch_size, *latent_shape], generator=rng) for _ in range(num_prompts)]
+                ).to(torch.cuda.current_device())
+
+                tic = time.perf_counter()
+                samples, intermediates = sampler.sample(
+                    S=inference_steps,
+                    conditioning=cond,
+                    batch_size=num_prompts * batch_size,
+                    shape=latent_shape,
+                    verbose=False,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=u_cond,
+                    eta=eta,
+                    x_T=latents,
+                    parallelism=sampler_parallelism,
+                    tolerance=sampler_tolerance,
+                )
+                toc = time.perf_counter()
+                sampling_time = toc - tic
+
+                if output_stage is not None:
+                    # decode time is filled in once the output stage is drained
+                    output_stage.put(prompt_batch, samples)
+                    decode_time = 0.0
+                else:
+                    tic = time.perf_counter()
+                    images = decode_images(model, samples)
+                    toc = time.perf_counter()
+                    decode_time = toc - tic
+                    output.extend(images.split(batch_size))
+
+                toc_total = time.perf_counter()
+                total_time = toc_total - tic_total
+
+                # Timings of a micro-batch are amortized over its prompts to keep per-prompt metrics comparable
+                prompt_throughput = {
+                    'text-conditioning-time': conditioning_time / num_prompts,
+                    'sampling-time': sampling_time / num_prompts,
+                    'decode-time': decode_time / num_prompts,
+                    'total-time': total_time / num_prompts,
                     'sampling-steps': inference_steps,
                 }
-            )
+                throughput.extend([prompt_throughput] * num_prompts)
+                batch_throughput.append(prompt_throughput)
+
+            if output_stage is not None:
+                output, decode_times = output_stage.close()
+        finally:
+            # stops the output threads when sampling fails, after `close` it does nothing
+            if output_stage is not None:
+                output_stage.abort()
+
+        if output_stage is not None:
+            for prompt_batch, prompt_throughput, decode_time in zip(prompt_batches, batch_throughput, decode_times):
+                prompt_throughput['decode-time'] = decode_time / len(prompt_batch)
+                prompt_throughput['total-time'] += decode_time / len(prompt_batch)
 
         # Convert output type and save to disk
         if output_type == 'torch':
             output = torch.cat(output, dim=0)
-        else:
+        elif output_stage is None:
             output = torch_to_numpy(output)
             if output_type == 'pil':
                 output = [numpy_to_pil(x) for x in output]
 
         if save_to_file:
             os.makedirs(out_path, exist_ok=True)
-            if output_type == 'pil':
+            if output_type != 'pil':
+                with open(os.path.join(out_path, 'output.pkl'), 'wb') as f:
+                    pickle.dump(output, f)
+            elif output_stage is None:
                 for text_prompt, pils in zip(prompts, output):
                     for idx, image in enumerate(pils):
                         image.save(os.path.join(out_path, f'{text_prompt[:50]}_{idx}.png'))
-            else:
-                with open(os.path.join(out_path, 'output.pkl'), 'wb') as f:
-                    pickle.dump(output, f)
         else:
             return output
 
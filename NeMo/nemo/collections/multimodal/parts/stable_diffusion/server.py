@@ -0,0 +1,369 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Long-running Stable Diffusion generation service.
+
+The model is loaded once and kept warm. Requests are queued, and requests that can share a sampler call
+(same resolution, number of steps and guidance scale) are batched together within a short time window.
+Every request gets its result back as soon as its batch is decoded, along with its latency metrics.
+The service is exposed in process through `StableDiffusionServer.submit` and over HTTP through
+`run_http_server`.
+"""
+import base64
+import dataclasses
+import io
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, as_completed
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+
+import torch
+
+from nemo.collections.multimodal.parts.stable_diffusion.conditioning_cache import get_conditioning_cache
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import (
+    _encode_text,
+    decode_images,
+    initialize_sampler,
+    numpy_to_pil,
+)
+from nemo.utils import logging
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    inference_steps: int = 50
+    unconditional_guidance_scale: float = 7.5
+    height: int = 512
+    width: int = 512
+    seed: int = 0
+    num_images: int = 1
+
+    def batch_key(self):
+        """Requests with the same key are sampled in the same sampler call."""
+        return self.height, self.width, self.inference_steps, self.unconditional_guidance_scale
+
+
+@dataclass
+class GenerationResult:
+    request: GenerationRequest
+    images: torch.Tensor  # (num_images, 3, height, width) in [0, 1], on CPU
+    metrics: dict = field(default_factory=dict)
+
+
+@dataclass
+class _QueuedRequest:
+    request: GenerationRequest
+    future: Future
+    enqueue_time: float
+
+
+class StableDiffusionServer:
+    """
+    Generation service around a warm LatentDiffusion model.
+
+    A single worker thread owns the model. It takes the oldest queued request, waits at most `batch_window_ms`
+    for compatible requests, and samples them in one call of at most `max_batch_size` images. Incompatible
+    requests stay queued in arrival order. Every request draws its initial noise from its own seed, so its
+    images do not depend on the requests it is batched with.
+
+    Args:
+        model: LatentDiffusion model in eval mode.
+        sampler_type: sampler used for all requests, see `initialize_sampler`.
+        eta: DDIM eta of the sampler.
+        down_factor: downsampling factor of the first stage model.
+        max_batch_size: maximum number of images of a sampler call. A request with more images runs alone.
+        batch_window_ms: time the oldest request waits for compatible requests.
+        autocast_dtype: dtype of the autocast context the model runs in.
+        conditioning_cache_size: size in MB of the LRU cache of prompt embeddings, None to disable.
+        max_queue_size: maximum number of queued requests, `submit` blocks beyond it.
+    """
+
+    def __init__(
+        self,
+        model,
+        sampler_type='DDIM',
+        eta=0.0,
+        down_factor=8,
+        max_batch_size=8,
+        batch_window_ms=20,
+        autocast_dtype=torch.float,
+        conditioning_cache_size=None,
+        max_queue_size=256,
+    ):
+        self.model = model
+        self.sampler = initialize_sampler(model, sampler_type.upper())
+        self.eta = eta
+        self.down_factor = down_factor
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.autocast_dtype = autocast_dtype
+        self.conditioning_cache = get_conditioning_cache(model, conditioning_cache_size)
+        self.in_channels = model.model.diffusion_model.in_channels
+        self.device = next(model.model.diffusion_model.parameters()).device
+
+        self._queue = Queue(maxsize=max_queue_size)
+        self._pending = deque()
+        self._thread = None
+        self._stopping = False
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def start(self, warmup_requests=()):
+        """Run the warmup requests, e.g. one per served resolution, then start serving."""
+        for request in warmup_requests:
+            tic = time.perf_counter()
+            self._generate([_QueuedRequest(request, Future(), tic)])
+            logging.info(f'Warmup of {request.height}x{request.width} took {time.perf_counter() - tic:.2f}s')
+        self.num_requests = self.num_batches = 0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Serve the queued requests, then stop the worker."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, request):
+        """Queue a request and return a future of its `GenerationResult`."""
+        if self._thread is None:
+            raise RuntimeError('The server is not running, call start() first')
+        future = Future()
+        self._queue.put(_QueuedRequest(request, future, time.perf_counter()))
+        return future
+
+    def generate(self, request, timeout=None):
+        return self.submit(request).result(timeout=timeout)
+
+    def _serve(self):
+        while not (self._stopping and not self._pending):
+            batch = self._next_batch()
+            if batch:
+                self._generate(batch)
+
+    def _next_batch(self):
+        if not self._pending:
+            if self._stopping:
+                return []
+            item = self._queue.get()
+            if item is None:
+                self._stopping = True
+                return []
+            self._pending.append(item)
+
+        key = self._pending[0].request.batch_key()
+        deadline = self._pending[0].enqueue_time + self.batch_window
+        while not self._stopping:
+            num_images = sum(item.request.num_images for item in self._pending if item.request.batch_key() == key)
+            timeout = deadline - time.perf_counter()
+            if num_images >= self.max_batch_size or timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+            if item is None:
+                self._stopping = True
+            else:
+                self._pending.append(item)
+
+        batch, num_images = [], 0
+        for item in list(self._pending):
+            if item.request.batch_key() != key:
+                continue
+            if batch and num_images + item.request.num_images > self.max_batch_size:
+                break
+            batch.append(item)
+            num_images += item.request.num_images
+            self._pending.remove(item)
+        return batch
+
+    def _generate(self, batch):
+        start_time = time.perf_counter()
+        try:
+            results = self._run_batch(batch, start_time)
+        except Exception as e:
+            logging.error(f'Generation of a batch of {len(batch)} requests failed: {e}')
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        for item, result in zip(batch, results):
+            item.future.set_result(result)
+        self.num_requests += len(batch)
+        self.num_batches += 1
+
+    def _run_batch(self, batch, start_time):
+        requests = [item.request for item in batch]
+        first = requests[0]
+        num_images = sum(request.num_images for request in requests)
+        latent_shape = [self.in_channels, first.height // self.down_factor, first.width // self.down_factor]
+        guidance_scale = first.unconditional_guidance_scale
+
+        with torch.no_grad(), torch.cuda.amp.autocast(
+            enabled=self.autocast_dtype in (torch.half, torch.bfloat16), dtype=self.autocast_dtype,
+        ):
+            tic = time.perf_counter()
+            prompts = [request.prompt for request in requests for _ in range(request.num_images)]
+            cond = _encode_text(self.model.cond_stage_model, prompts, self.conditioning_cache)
+            u_cond = None
+            if guidance_scale != 1.0:
+                u_cond = _encode_text(self.model.cond_stage_model, num_images * [""], self.conditioning_cache)
+            conditioning_time = time.perf_counter() - tic
+
+            latents = torch.cat(
+                [
+                    torch.randn(
+                        [request.num_images, *latent_shape], generator=torch.Generator().manual_seed(request.seed)
+                    )
+                    for request in requests
+                ]
+            ).to(self.device)
+            tic = time.perf_counter()
+            samples, _ = self.sampler.sample(
+                S=first.inference_steps,
+                conditioning=cond,
+                batch_size=num_images,
+                shape=latent_shape,
+                verbose=False,
+                unconditional_guidance_scale=guidance_scale,
+                unconditional_conditioning=u_cond,
+                eta=self.eta,
+                x_T=latents,
+            )
+            sampling_time = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            images = decode_images(self.model, samples).float().cpu()
+            decode_time = time.perf_counter() - tic
+
+        end_time = time.perf_counter()
+        results = []
+        for item, request_images in zip(batch, images.split([request.num_images for request in requests])):
+            metrics = {
+                'queue-time': start_time - item.enqueue_time,
+                'text-conditioning-time': conditioning_time,
+                'sampling-time': sampling_time,
+                'decode-time': decode_time,
+                'latency': end_time - item.enqueue_time,
+                'batch-size': num_images,
+                'batch-requests': len(batch),
+            }
+            results.append(GenerationResult(item.request, request_images, metrics))
+        return results
+
+    def status(self):
+        return {
+            'running': self._thread is not None,
+            'queued': self._queue.qsize() + len(self._pending),
+            'served-requests': self.num_requests,
+            'served-batches': self.num_batches,
+        }
+
+
+def encode_png(image):
+    """Base64 PNG of a (3, height, width) image in [0, 1]."""
+    buffer = io.BytesIO()
+    numpy_to_pil(image.permute(1, 2, 0).numpy())[0].save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def parse_request(data):
+    allowed = {f.name for f in dataclasses.fields(GenerationRequest)}
+    unknown = set(data) - allowed
+    if unknown:
+        raise ValueError(f'Unknown request keys {sorted(unknown)}, allowed keys are {sorted(allowed)}')
+    if 'prompt' not in data:
+        raise ValueError('The request has no prompt')
+    return GenerationRequest(**data)
+
+
+class _GenerationHandler(BaseHTTPRequestHandler):
+    server_version = 'NeMoStableDiffusion'
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, self.server.generation_server.status())
+        else:
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            requests = [parse_request(item) for item in data.get('requests', [data])]
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        # one JSON line per request, streamed in completion order
+        futures = {self.server.generation_server.submit(request): index for index, request in enumerate(requests)}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                payload = {
+                    'index': futures[future],
+                    'images': [encode_png(image) for image in result.images],
+                    'metrics': result.metrics,
+                }
+            except Exception as e:  # noqa
+                payload = {'index': futures[future], 'error': str(e)}
+            line = (json.dumps(payload) + '\n').encode()
+            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} - {format % args}')
+
+
+def run_http_server(generation_server, host='0.0.0.0', port=5000, block=True):
+    """
+    Serve `generation_server` over HTTP:
+        - POST /generate with a request, or {"requests": [...]}, streams back one JSON line per request
+          as soon as it is generated, with base64 PNG images and latency metrics.
+        - GET /health returns the status of the server.
+    Returns the HTTP server, which serves in a background thread if `block` is False.
+    """
+    httpd = ThreadingHTTPServer((host, port), _GenerationHandler)
+    httpd.daemon_threads = True
+    httpd.generation_server = generation_server
+    logging.info(f'Stable Diffusion server listening on {host}:{httpd.server_address[1]}')
+    if block:
+        httpd.serve_forever()
+    else:
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
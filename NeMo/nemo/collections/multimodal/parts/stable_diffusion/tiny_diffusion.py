@@ -0,0 +1,79 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Stand-in of LatentDiffusion around a bare, randomly initialised UNet, for the sampler benchmark and the tests of the
+samplers and of the server, which run on CPU without a checkpoint.
+"""
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.util import make_beta_schedule
+
+
+class TinyLatentDiffusion(nn.Module):
+    """
+    Stand-in of LatentDiffusion with the interface used by the samplers and the server. Counts the UNet calls and the
+    time spent in them.
+
+    Args:
+        unet: the UNet, its zero-initialised parameters are randomly initialised, as they would make its output zero.
+        cond_stage_model: text encoder with an `encode(texts)` method, for the server.
+        timesteps: number of diffusion timesteps.
+        linear_start: first beta of the linear schedule.
+        linear_end: last beta of the linear schedule.
+    """
+
+    def __init__(self, unet, cond_stage_model=None, timesteps=1000, linear_start=0.00085, linear_end=0.012):
+        super().__init__()
+        with torch.no_grad():
+            for param in unet.parameters():
+                if torch.all(param == 0):
+                    param.normal_(std=0.02)
+        self.model = nn.Module()
+        self.model.diffusion_model = unet
+        self.cond_stage_model = cond_stage_model
+        self.num_timesteps = timesteps
+        self.parameterization = 'eps'
+        self.rng = None
+
+        # make_beta_schedule returns a float64 numpy array
+        betas = torch.from_numpy(
+            make_beta_schedule('linear', timesteps, linear_start=linear_start, linear_end=linear_end)
+        )
+        alphas_cumprod = torch.cumprod(1.0 - betas, dim=0)
+        alphas_cumprod_prev = torch.cat([torch.ones(1, dtype=alphas_cumprod.dtype), alphas_cumprod[:-1]])
+        self.register_buffer('betas', betas.float())
+        self.register_buffer('alphas_cumprod', alphas_cumprod.float())
+        self.register_buffer('alphas_cumprod_prev', alphas_cumprod_prev.float())
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.num_function_evals = 0
+        self.model_time = 0.0
+
+    def apply_model(self, x, t, cond):
+        tic = time.perf_counter()
+        out = self.model.diffusion_model(x, t, context=cond)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        self.model_time += time.perf_counter() - tic
+        self.num_function_evals += 1
+        return out
+
+    def decode_first_stage(self, z):
+        # no autoencoder, the first latent channels upsampled to the image size
+        return F.interpolate(torch.tanh(z[:, :3]), scale_factor=8)
@@ -0,0 +1,187 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reuse of the inference key-value memory of prompt prefixes across generation requests.
+
+Without it every request computes its whole context, although in most traffic a long system prompt or few-shot
+preamble is shared by many requests. Set a `PrefixKVCache` as the `prefix_kv_cache` attribute of a GPT or NeVA model,
+and the text generation strategies of the model restore the keys and values of the longest cached prefix of the
+prompts into the inference memory of the attention layers, then only compute the rest of the context.
+"""
+
+import collections
+import hashlib
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from nemo.collections.nlp.modules.common.megatron.attention import AttnType, ParallelAttention
+from nemo.collections.nlp.modules.common.megatron.language_model import TransformerLanguageModel
+
+__all__ = ["PrefixKVCache", "inference_attention_layers"]
+
+
+def inference_attention_layers(model) -> List[ParallelAttention]:
+    """
+    The self attention layers of the transformer of a Megatron GPT model on this rank, which hold the inference
+    key-value memory. The layers of other transformers, like the vision encoder of NeVA, are left out.
+    """
+    modules = model.model if isinstance(model.model, list) else [model.model]
+    encoders = [
+        language_model.encoder
+        for module in modules
+        for language_model in module.modules()
+        if isinstance(language_model, TransformerLanguageModel)
+    ]
+    return [
+        layer
+        for encoder in encoders
+        for layer in encoder.modules()
+        if isinstance(layer, ParallelAttention) and layer.attention_type == AttnType.self_attn
+    ]
+
+
+class PrefixKVCache:
+    """
+    LRU cache of the inference keys and values of token prefixes, under a memory budget.
+
+    Prompts are split in blocks of `block_size` tokens. The keys and values of a block are stored under the hash of
+    the whole prefix up to the end of the block, so that a request reuses the blocks of the longest prefix it shares
+    with earlier requests. When the cache exceeds `max_memory_mb`, the least recently used blocks are evicted. A
+    request touches its blocks from the last to the first, so that the prefixes shared by more requests are evicted
+    after the blocks that extend them.
+
+    Args:
+        max_memory_mb: memory budget of the cached keys and values on every rank, in MiB.
+        block_size: number of tokens of a block, the granularity of the reused prefixes.
+    """
+
+    def __init__(self, max_memory_mb: float = 1024, block_size: int = 64):
+        self.max_memory_bytes = int(max_memory_mb * 2 ** 20)
+        self.block_size = block_size
+        # block hash -> [(key, value)] of every attention layer, of shape [block_size, np, hn]
+        self._blocks = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.requests = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.evicted_blocks = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def block_hashes(self, tokens: List[int], salt: Optional[bytes] = None, salt_from: int = 0) -> List[bytes]:
+        """
+        Hashes of the prefixes of `tokens` ending at every full block.
+
+        Args:
+            tokens: token ids.
+            salt: extra content the keys and values depend on from position `salt_from` on, e.g. the image of a
+                NeVA prompt, hashed with the blocks that end after `salt_from`.
+            salt_from: first position that depends on the salt.
+        """
+        prefix_hash = hashlib.sha1()
+        hashes = []
+        for end in range(self.block_size, len(tokens) + 1, self.block_size):
+            if salt is not None and end - self.block_size <= salt_from < end:
+                prefix_hash.update(salt)
+            prefix_hash.update(np.asarray(tokens[end - self.block_size : end], dtype=np.int64).tobytes())
+            hashes.append(prefix_hash.digest())
+        return hashes
+
+    def lookup(self, hashes: List[bytes]) -> int:
+        """Number of leading blocks of `hashes` in the cache."""
+        num_blocks = 0
+        while num_blocks < len(hashes) and hashes[num_blocks] in self._blocks:
+            num_blocks += 1
+        return num_blocks
+
+    def record(self, prompt_lengths: List[int], prefix_length: int):
+        """Count the prompts of a batch and the prefix reused by all of them."""
+        self.requests += len(prompt_lengths)
+        self.hits += len(prompt_lengths) if prefix_length > 0 else 0
+        self.prompt_tokens += sum(prompt_lengths)
+        self.reused_tokens += prefix_length * len(prompt_lengths)
+
+    def restore(self, layers: List[ParallelAttention], hashes: List[List[bytes]], maxlen: int):
+        """
+        Allocate the inference memory of `layers` for a batch and copy the cached keys and values of the prefix of
+        every sequence, given by the hashes of its blocks, all of the same length.
+        """
+        prefix_length = len(hashes[0]) * self.block_size
+        for index, layer in enumerate(layers):
+            rows = [[self._blocks[block_hash][index] for block_hash in row_hashes] for row_hashes in hashes]
+            key = torch.stack([torch.cat([block[0] for block in row]) for row in rows], dim=1)
+            value = torch.stack([torch.cat([block[1] for block in row]) for row in rows], dim=1)
+            layer.inference_key_memory = layer._allocate_memory(maxlen, len(hashes), key.dtype, key.device)
+            layer.inference_value_memory = layer._allocate_memory(maxlen, len(hashes), value.dtype, value.device)
+            layer.inference_key_memory[:prefix_length] = key
+            layer.inference_value_memory[:prefix_length] = value
+            layer.inference_current_sequence_len = prefix_length
+        for row_hashes in hashes:
+            self._touch(row_hashes)
+
+    def store(self, layers: List[ParallelAttention], hashes: List[List[bytes]], length: int):
+        """
+        Cache the blocks of the first `length` positions of the inference memory of `layers`, for every sequence of
+        the batch given by the hashes of its blocks.
+        """
+        num_blocks = length // self.block_size
+        for row, row_hashes in enumerate(hashes):
+            for block, block_hash in enumerate(row_hashes[:num_blocks]):
+                if block_hash in self._blocks:
+                    continue
+                positions = slice(block * self.block_size, (block + 1) * self.block_size)
+                self._blocks[block_hash] = [
+                    (
+                        layer.inference_key_memory[positions, row].clone(),
+                        layer.inference_value_memory[positions, row].clone(),
+                    )
+                    for layer in layers
+                ]
+                self.memory_bytes += self._block_bytes(self._blocks[block_hash])
+            self._touch(row_hashes[:num_blocks])
+        while self.memory_bytes > self.max_memory_bytes and self._blocks:
+            _, evicted = self._blocks.popitem(last=False)
+            self.memory_bytes -= self._block_bytes(evicted)
+            self.evicted_blocks += 1
+
+    def clear(self):
+        self._blocks.clear()
+        self.memory_bytes = 0
+
+    def stats(self) -> dict:
+        """Hit-rate counters of the cache."""
+        return {
+            'requests': self.requests,
+            'hits': self.hits,
+            'hit_rate': self.hits / max(self.requests, 1),
+            'prompt_tokens': self.prompt_tokens,
+            'reused_tokens': self.reused_tokens,
+            'token_hit_rate': self.reused_tokens / max(self.prompt_tokens, 1),
+            'blocks': len(self._blocks),
+            'evicted_blocks': self.evicted_blocks,
+            'memory_mb': self.memory_bytes / 2 ** 20,
+        }
+
+    def _touch(self, hashes: List[bytes]):
+        for block_hash in reversed(hashes):
+            self._blocks.move_to_end(block_hash)
+
+    @staticmethod
+    def _block_bytes(block) -> int:
+        return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in block)
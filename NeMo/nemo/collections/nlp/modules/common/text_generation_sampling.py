@@ -0,0 +1,216 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sampling of the next tokens of a batch of sequences with per-sequence parameters.
+
+`top_k_logits`, `repetition_penalty` and `sample_token_topk` in `text_generation_utils` apply the same parameters to
+the whole batch, and the repetition penalty gathers the generated tokens at every step. The `BatchedSampler` keeps
+the parameters of every sequence in tensors, applies all of them in a single vectorized pass, and keeps the counts
+of the generated tokens of every sequence, updated with the sampled tokens.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ["BatchedSampler", "end_strings_to_token_ids"]
+
+
+def end_strings_to_token_ids(tokenizer, end_strings: List[str]) -> Tuple[List[List[int]], List[str]]:
+    """
+    Split end strings into the ones that are a single (special) token of the tokenizer, as in
+    `TextGenerationStrategy._get_end_of_generation_tokens_and_strings`, and the others.
+
+    Returns:
+        the token ids of the single token end strings, as sequences of one token, and the other end strings, which
+        are checked on the text of the generated tokens.
+    """
+    ids_ref = tokenizer.text_to_ids("<extra_id_1>")
+    end_token_ids, end_strings_to_check = [], []
+    for end_string in end_strings:
+        ids_with_end_string = tokenizer.text_to_ids(f"<extra_id_1>{end_string}")
+        if len(ids_with_end_string) == len(ids_ref) + 1 and ids_with_end_string[:-1] == ids_ref:
+            end_token_ids.append(ids_with_end_string[-1:])
+        else:
+            end_strings_to_check.append(end_string)
+    return end_token_ids, end_strings_to_check
+
+
+class BatchedSampler:
+    """
+    Samples the next tokens of a batch of sequences, every row of the sampler with its own sampling parameters.
+
+    The parameters of rows are set with `reset`, as scalars or [n] tensors, and the sequences of the rows are then
+    sampled together with `sample`, whatever their parameters, and `append` records their new tokens. The
+    semantics of the parameters are the ones of `text_generation_utils.generate`:
+
+    - the end of document token is not sampled before `min_tokens_to_generate` tokens,
+    - greedy rows take the most likely token, without temperature nor penalties,
+    - the other rows divide the logits of their generated tokens by `repetition_penalty`, subtract
+      `presence_penalty` from them, divide all the logits by `temperature` and sample among the `top_k` most likely
+      tokens (all of them if 0) and the smallest set of most likely tokens with a probability of at least `top_p`
+      (all of them if 0).
+
+    A sequence ends with the end of document token or when its generated tokens end with one of its end token
+    sequences, given with `end_token_ids`.
+
+    Args:
+        num_rows: number of rows, e.g. the batch size or the number of key-value memory slots of a continuous batch.
+        vocab_size: number of tokens of the tokenizer, the logits of the padded vocabulary are dropped.
+        eod_id: end of document token.
+        device: device of the logits.
+    """
+
+    def __init__(self, num_rows: int, vocab_size: int, eod_id: int, device=None):
+        self.num_rows = num_rows
+        self.vocab_size = vocab_size
+        self.eod_id = eod_id
+        self.device = device
+        self.temperature = torch.ones(num_rows, device=device)
+        self.top_k = torch.zeros(num_rows, dtype=torch.long, device=device)
+        self.top_p = torch.zeros(num_rows, device=device)
+        self.greedy = torch.zeros(num_rows, dtype=torch.bool, device=device)
+        self.repetition_penalty = torch.ones(num_rows, device=device)
+        self.presence_penalty = torch.zeros(num_rows, device=device)
+        self.min_tokens_to_generate = torch.zeros(num_rows, dtype=torch.long, device=device)
+        self.num_generated = torch.zeros(num_rows, dtype=torch.long, device=device)
+        # number of times every token was generated by every row
+        self.token_counts = torch.zeros(num_rows, vocab_size, dtype=torch.int32, device=device)
+        # [num_rows, num_end_sequences, length] end token sequences, left padded with -1, which matches any token,
+        # and the last generated tokens of every row, -1 before the first one
+        self.end_token_ids = torch.full((num_rows, 0, 1), -1, dtype=torch.long, device=device)
+        self.end_token_ids_mask = torch.zeros(num_rows, 0, dtype=torch.bool, device=device)
+        self.last_tokens = torch.full((num_rows, 1), -1, dtype=torch.long, device=device)
+
+    def reset(
+        self,
+        rows,
+        greedy=False,
+        temperature=1.0,
+        top_k=0,
+        top_p=0.0,
+        repetition_penalty=1.0,
+        presence_penalty=0.0,
+        min_tokens_to_generate=0,
+        end_token_ids: Optional[Sequence[Sequence[int]]] = None,
+    ):
+        """
+        Start new sequences in `rows`, with the given parameters, scalars or tensors with a value per row. The end
+        token sequences are shared by the rows.
+        """
+        rows = torch.as_tensor(rows, dtype=torch.long, device=self.device).view(-1)
+        self.greedy[rows] = torch.as_tensor(greedy, dtype=torch.bool, device=self.device)
+        self.temperature[rows] = torch.as_tensor(temperature, dtype=torch.float, device=self.device)
+        self.top_k[rows] = torch.as_tensor(top_k, dtype=torch.long, device=self.device)
+        self.top_p[rows] = torch.as_tensor(top_p, dtype=torch.float, device=self.device)
+        self.repetition_penalty[rows] = torch.as_tensor(repetition_penalty, dtype=torch.float, device=self.device)
+        self.presence_penalty[rows] = torch.as_tensor(presence_penalty, dtype=torch.float, device=self.device)
+        self.min_tokens_to_generate[rows] = torch.as_tensor(
+            min_tokens_to_generate, dtype=torch.long, device=self.device
+        )
+        self.num_generated[rows] = 0
+        self.token_counts[rows] = 0
+
+        end_token_ids = [list(ids) for ids in end_token_ids or [] if ids]
+        length = max([len(ids) for ids in end_token_ids], default=1)
+        self._grow_end_token_ids(len(end_token_ids), length)
+        self.end_token_ids[rows] = -1
+        self.end_token_ids_mask[rows] = False
+        for i, ids in enumerate(end_token_ids):
+            self.end_token_ids[rows, i, -len(ids) :] = torch.tensor(ids, device=self.device)
+            self.end_token_ids_mask[rows, i] = True
+        self.last_tokens[rows] = -1
+
+    def sample(self, logits: torch.Tensor, rows=None) -> torch.Tensor:
+        """
+        Sample the next tokens of sequences.
+
+        Args:
+            logits: [n, vocab] logits of the next tokens, the vocabulary may be padded.
+            rows: [n] rows of the sequences, all the rows by default.
+        Returns:
+            the [n] sampled tokens.
+        """
+        rows = self._rows(rows, logits.size(0))
+        logits = logits[:, : self.vocab_size].to(torch.float32, copy=True)
+        # make sure it will generate at least min_tokens_to_generate
+        within_min_length = self.num_generated[rows] < self.min_tokens_to_generate[rows]
+        logits[:, self.eod_id].masked_fill_(within_min_length, -float('Inf'))
+        greedy = self.greedy[rows]
+        greedy_tokens = logits.argmax(dim=-1)
+        if greedy.all():
+            return greedy_tokens
+
+        counts = self.token_counts[rows]
+        generated = counts > 0
+        logits = torch.where(generated, logits / self.repetition_penalty[rows, None], logits)
+        logits = logits - generated * self.presence_penalty[rows, None]
+        logits = logits / torch.where(greedy, torch.ones_like(self.temperature[rows]), self.temperature[rows])[:, None]
+
+        # top-k and top-p filtering of the sorted logits, top-p among the top-k tokens
+        sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+        ranks = torch.arange(sorted_logits.size(-1), device=logits.device)
+        top_k = self.top_k[rows, None]
+        sorted_logits = sorted_logits.masked_fill((top_k > 0) & (ranks >= top_k), -float('Inf'))
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        # keep the tokens until the probability of the more likely ones reaches top_p, the first token is always kept
+        top_p = self.top_p[rows, None]
+        above_top_p = (top_p > 0) & (sorted_probs.cumsum(dim=-1) - sorted_probs > top_p)
+        sorted_logits = sorted_logits.masked_fill(above_top_p, -float('Inf'))
+        samples = torch.multinomial(F.softmax(sorted_logits, dim=-1), num_samples=1)
+        sampled_tokens = sorted_indices.gather(1, samples).view(-1)
+        return torch.where(greedy, greedy_tokens, sampled_tokens)
+
+    def append(self, tokens: torch.Tensor, rows=None) -> torch.Tensor:
+        """
+        Record the new tokens of sequences.
+
+        Args:
+            tokens: [n] new tokens.
+            rows: [n] rows of the sequences, all the rows by default.
+        Returns:
+            a [n] boolean tensor, whether the sequences end with their new token.
+        """
+        rows = self._rows(rows, tokens.size(0))
+        tokens = tokens.to(device=self.token_counts.device, dtype=torch.long)
+        self.token_counts[rows, tokens] += 1
+        self.num_generated[rows] += 1
+        last_tokens = torch.cat([self.last_tokens[rows, 1:], tokens[:, None]], dim=1)
+        self.last_tokens[rows] = last_tokens
+
+        end_token_ids = self.end_token_ids[rows]
+        matches = (end_token_ids == last_tokens[:, None, :]) | (end_token_ids == -1)
+        ends = (matches.all(dim=-1) & self.end_token_ids_mask[rows]).any(dim=-1)
+        return ends | (tokens == self.eod_id)
+
+    def _rows(self, rows, n: int) -> torch.Tensor:
+        if rows is None:
+            return torch.arange(n, device=self.token_counts.device)
+        return torch.as_tensor(rows, dtype=torch.long, device=self.token_counts.device)
+
+    def _grow_end_token_ids(self, num_sequences: int, length: int):
+        """Make room for `num_sequences` end token sequences of `length` tokens in every row."""
+        current_num, current_length = self.end_token_ids.shape[1:]
+        if num_sequences <= current_num and length <= current_length:
+            return
+        num_sequences, length = max(num_sequences, current_num), max(length, current_length)
+        end_token_ids = torch.full((self.num_rows, num_sequences, length), -1, dtype=torch.long, device=self.device)
+        end_token_ids[:, :current_num, length - current_length :] = self.end_token_ids
+        mask = torch.zeros(self.num_rows, num_sequences, dtype=torch.bool, device=self.device)
+        mask[:, :current_num] = self.end_token_ids_mask
+        last_tokens = torch.full((self.num_rows, length), -1, dtype=torch.long, device=self.device)
+        last_tokens[:, length - current_length :] = self.last_tokens
+        self.end_token_ids, self.end_token_ids_mask, self.last_tokens = end_token_ids, mask, last_tokens
@@ -0,0 +1,652 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Continuous (in-flight) batching for text generation.
+
+`generate` decodes a batch of prompts until its longest sequence is done, and the next batch waits for it. The
+`ContinuousBatchingScheduler` instead keeps a running batch of sequences, each with its own length, stop conditions
+and sampling parameters: a sequence leaves the batch as soon as it is done, and a waiting sequence takes its place
+at the next step. The keys and values of every sequence live in a slot of a `SlotKVCache`, which is reused by the
+next sequence once freed.
+
+The model is called through a decoder, `decoder(input_ids, position_ids, slots, kv_cache)`, that returns the
+[n, s, vocab_size] logits of the [n, s] `input_ids` of the sequences in `slots`. The tokens of a sequence are at
+`position_ids`, and attend to the keys and values in the first `position_ids[:, 0]` positions of their slot, see
+`slot_attention_mask`. The decoder stores the keys and values of the new tokens with `kv_cache.write`.
+`MegatronGPTSlotDecoder` is the decoder of `MegatronGPTModel`.
+"""
+
+import collections
+import heapq
+import queue
+import threading
+import time
+from typing import Iterator, List
+
+import numpy as np
+import torch
+
+from nemo.collections.nlp.models.language_modeling.megatron.gpt_model import post_language_model_processing
+from nemo.collections.nlp.modules.common.megatron.module import Float16Module
+from nemo.collections.nlp.modules.common.text_generation_sampling import BatchedSampler, end_strings_to_token_ids
+from nemo.collections.nlp.modules.common.text_generation_strategy import END_OF_SEQ
+from nemo.collections.nlp.modules.common.text_generation_streaming import EndStringMatcher, IncrementalDetokenizer
+from nemo.collections.nlp.modules.common.text_generation_utils import get_model_parallel_src_rank
+from nemo.utils import logging
+
+try:
+    from megatron.core import parallel_state, tensor_parallel
+
+    HAVE_MEGATRON_CORE = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_MEGATRON_CORE = False
+
+__all__ = [
+    "SlotKVCache",
+    "slot_attention_mask",
+    "GenerationRequest",
+    "ContinuousBatchingScheduler",
+    "MegatronGPTSlotDecoder",
+]
+
+
+class SlotKVCache:
+    """
+    Key-value memory of the sequences of a continuous batch, one slot per sequence.
+
+    Every layer keeps [max_seq_len, num_slots, ...] keys and values, in the [s, b, np, hn] layout of the Megatron
+    attention, allocated at the first write. The keys and values of a sequence are stored from the first position of
+    its slot, so that sequences of different lengths share the memory. A slot is owned by a sequence from its
+    admission to its end, then reused by the next sequence.
+
+    Args:
+        num_slots: maximum number of sequences decoded together.
+        max_seq_len: maximum number of tokens of a sequence, prompt included.
+    """
+
+    def __init__(self, num_slots: int, max_seq_len: int):
+        self.num_slots = num_slots
+        self.max_seq_len = max_seq_len
+        self.keys = {}
+        self.values = {}
+        self._free_slots = list(range(num_slots))
+
+    @property
+    def num_free(self) -> int:
+        return len(self._free_slots)
+
+    def allocate(self) -> int:
+        if not self._free_slots:
+            raise RuntimeError('All the key-value memory slots are in use')
+        return heapq.heappop(self._free_slots)
+
+    def free(self, slot: int):
+        heapq.heappush(self._free_slots, slot)
+
+    def write(self, layer, slots: torch.Tensor, positions: torch.Tensor, key: torch.Tensor, value: torch.Tensor):
+        """Store the [s, n, ...] keys and values of `layer` at positions[i] .. positions[i] + s - 1 of slots[i]."""
+        if layer not in self.keys:
+            shape = (self.max_seq_len, self.num_slots, *key.shape[2:])
+            self.keys[layer] = torch.zeros(shape, dtype=key.dtype, device=key.device)
+            self.values[layer] = torch.zeros(shape, dtype=value.dtype, device=value.device)
+        if key.shape[0] == 1:
+            self.keys[layer][positions, slots] = key[0]
+            self.values[layer][positions, slots] = value[0]
+        else:
+            for i, (slot, position) in enumerate(zip(slots.tolist(), positions.tolist())):
+                self.keys[layer][position : position + key.shape[0], slot] = key[:, i]
+                self.values[layer][position : position + key.shape[0], slot] = value[:, i]
+
+    @staticmethod
+    def slot_index(slots: torch.Tensor):
+        """
+        Index of `slots` in the memory for `read`: a slice when they are a contiguous range of slots, else the tensor.
+        """
+        slot_list = slots.tolist()
+        if slot_list == list(range(slot_list[0], slot_list[0] + len(slot_list))):
+            return slice(slot_list[0], slot_list[0] + len(slot_list))
+        return slots
+
+    def read(self, layer, slots, length: int):
+        """
+        The [length, n, ...] keys and values of the first `length` positions of `slots`.
+
+        With a slice of `slot_index`, they are views of the memory. With a tensor of slots, they are gathered in new
+        tensors, which copies length * n keys and values per layer and per step.
+        """
+        return self.keys[layer][:length, slots], self.values[layer][:length, slots]
+
+
+def slot_attention_mask(position_ids: torch.Tensor, past_length: int) -> torch.Tensor:
+    """
+    Attention mask of new tokens attending to `past_length` cached positions, as read from a `SlotKVCache`, then to
+    each other. The cached keys past the length of a sequence belong to a longer sequence of the batch, or to the
+    previous owner of the slot, and are masked.
+
+    Args:
+        position_ids: [n, s] positions of the new tokens, position_ids[:, 0] is the length of every sequence.
+        past_length: number of cached positions read for all the sequences.
+    Returns:
+        [n, 1, s, past_length + s] boolean mask, True where attention is not allowed.
+    """
+    n, s = position_ids.shape
+    past = torch.arange(past_length, device=position_ids.device) >= position_ids[:, :1]
+    causal = torch.ones(s, s, dtype=torch.bool, device=position_ids.device).triu(diagonal=1)
+    return torch.cat([past[:, None, None, :].expand(n, 1, s, past_length), causal.expand(n, 1, s, s)], dim=-1)
+
+
+class GenerationRequest:
+    """
+    A sequence to generate, with its own length, stop conditions and sampling parameters, as in
+    `text_generation_utils.generate`.
+
+    Args:
+        context_tokens: token ids of the prompt.
+        tokens_to_generate: maximum number of generated tokens.
+        min_tokens_to_generate: the end of document token is not sampled before this number of tokens.
+        end_strings: generation stops when the text ends with one of these strings, or on the end of document token.
+        greedy: use greedy decoding instead of sampling.
+        temperature, top_k, top_p, repetition_penalty, presence_penalty: sampling parameters, see `BatchedSampler`.
+    """
+
+    def __init__(
+        self,
+        context_tokens: List[int],
+        tokens_to_generate: int = 64,
+        min_tokens_to_generate: int = 0,
+        end_strings: List[str] = (END_OF_SEQ,),
+        greedy: bool = False,
+        temperature: float = 1.0,
+        top_k: int = 0,
+        top_p: float = 0.9,
+        repetition_penalty: float = 1.0,
+        presence_penalty: float = 0.0,
+    ):
+        self.context_tokens = list(context_tokens)
+        self.tokens_to_generate = tokens_to_generate
+        self.min_tokens_to_generate = min_tokens_to_generate
+        self.end_strings = [end_string for end_string in end_strings if end_string != END_OF_SEQ]
+        # the end strings that are not a single token, checked on the generated text as it is decoded
+        self._end_strings_to_check = self.end_strings
+        self._end_string_matcher = None
+        self._detokenizer = None
+        self.greedy = greedy
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.presence_penalty = presence_penalty
+
+        self.generated_tokens = []
+        self.slot = None
+        # number of tokens whose keys and values are in the slot
+        self.length = 0
+        self.error = None
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_time = None
+        self._done = threading.Event()
+        # queue of the (request, token) of every generated token, then (request, None) when done, see `stream`
+        self._stream = None
+
+    @property
+    def tokens(self) -> List[int]:
+        return self.context_tokens + self.generated_tokens
+
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token_time is None else self.first_token_time - self.submit_time
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout=None) -> List[int]:
+        """Block until the sequence is done and return its generated tokens."""
+        if not self._done.wait(timeout):
+            raise TimeoutError('The generation did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return self.generated_tokens
+
+    def _finish(self, error=None):
+        self.error = error
+        self.finish_time = time.perf_counter()
+        self._done.set()
+        if self._stream is not None:
+            self._stream.put((self, None))
+
+
+class ContinuousBatchingScheduler:
+    """
+    Generates the submitted sequences in a continuous batch.
+
+    Every step admits waiting sequences into the free slots of the key-value memory and computes their prompts
+    together, which gives their first tokens, then generates one token for all the other running sequences. A
+    sequence leaves the batch and frees its slot as soon as it meets its stop conditions, so short requests do not
+    wait for long ones, and new requests wait at most one step to start. The steps run in a background thread after
+    `start`, or are called directly with `step`. `generate` returns the sequences once they are done, and `stream`
+    yields their tokens as they are generated.
+
+    Args:
+        decoder: callable computing the logits of new tokens, see the module docstring.
+        tokenizer: tokenizer of the model.
+        max_batch_size: maximum number of running sequences, and number of key-value memory slots.
+        max_seq_len: maximum number of tokens of a sequence, prompt included.
+        max_prefill_tokens: maximum number of (padded) prompt tokens computed in a step, at least one prompt is.
+        device: device of the model inputs.
+    """
+
+    def __init__(self, decoder, tokenizer, max_batch_size=32, max_seq_len=2048, max_prefill_tokens=8192, device=None):
+        self.decoder = decoder
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.max_prefill_tokens = max_prefill_tokens
+        if device is None:
+            device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.kv_cache = SlotKVCache(max_batch_size, max_seq_len)
+        # the sampling parameters and generated token counts of every slot
+        self.sampler = BatchedSampler(max_batch_size, tokenizer.vocab_size, tokenizer.eos_id, device=device)
+
+        self.waiting = collections.deque()
+        self.running = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self.num_finished = 0
+        self.num_generated_tokens = 0
+        self._time_to_first_token = collections.deque(maxlen=1000)
+        self._start_time = time.perf_counter()
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queue a sequence for generation, `request.wait()` returns its tokens."""
+        self._check_request(request)
+        with self._condition:
+            self.waiting.append(request)
+            self._condition.notify()
+        return request
+
+    def generate(
+        self,
+        sentences: List[str],
+        tokens_to_generate: int = 64,
+        add_BOS: bool = False,
+        wait_timeout=None,
+        **request_args,
+    ) -> dict:
+        """
+        Submit every sentence as its own sequence and wait for all of them.
+
+        Returns:
+            a dictionary with the `sentences`, `tokens` and `token_ids` of the prompts followed by the generated
+            tokens, as returned by `text_generation_utils.generate`, and the `time_to_first_token` of every
+            sentence in seconds.
+        """
+        requests = self._submit_sentences(sentences, tokens_to_generate, add_BOS, request_args)
+        for request in requests:
+            request.wait(wait_timeout)
+
+        token_ids = [request.tokens for request in requests]
+        return {
+            'sentences': [self.tokenizer.ids_to_text(ids) for ids in token_ids],
+            'tokens': [self.tokenizer.ids_to_tokens(ids) for ids in token_ids],
+            'logprob': None,
+            'full_logprob': None,
+            'token_ids': token_ids,
+            'time_to_first_token': [request.time_to_first_token for request in requests],
+        }
+
+    def stream(
+        self,
+        sentences: List[str],
+        tokens_to_generate: int = 64,
+        add_BOS: bool = False,
+        wait_timeout=None,
+        **request_args,
+    ) -> Iterator[dict]:
+        """
+        Submit every sentence as its own sequence and yield the tokens of all of them as they are generated.
+
+        The text of the tokens is decoded incrementally, and held back while it ends with an incomplete character,
+        so that the texts of the tokens of a sentence add up to the text of its generated tokens.
+
+        The sentences are submitted when `stream` is called, so that invalid prompts raise a `ValueError` before any
+        event is read.
+
+        Returns:
+            an iterator over a dictionary with the `index` of the sentence, the generated `token_id` and the `text` it
+            adds, for every generated token, then a dictionary with the `index`, the remaining `text`, `finished` set
+            to True and the `time_to_first_token` of the sentence in seconds, once the sentence is done.
+        """
+        events = queue.Queue()
+        requests = self._submit_sentences(sentences, tokens_to_generate, add_BOS, request_args, stream=events)
+        return self._stream_events(requests, events, wait_timeout)
+
+    def _stream_events(self, requests: List[GenerationRequest], events: queue.Queue, wait_timeout) -> Iterator[dict]:
+        indices = {id(request): index for index, request in enumerate(requests)}
+        detokenizers = [IncrementalDetokenizer(self.tokenizer, request.context_tokens) for request in requests]
+        num_running = len(requests)
+        while num_running > 0:
+            try:
+                request, token = events.get(timeout=wait_timeout)
+            except queue.Empty:
+                raise TimeoutError('The generation did not finish in time')
+            index = indices[id(request)]
+            if token is not None:
+                yield {'index': index, 'token_id': token, 'text': detokenizers[index].push([token])}
+                continue
+            if request.error is not None:
+                raise request.error
+            num_running -= 1
+            yield {
+                'index': index,
+                'text': detokenizers[index].flush(),
+                'finished': True,
+                'time_to_first_token': request.time_to_first_token,
+            }
+
+    def metrics(self) -> dict:
+        """Queue depth, batch occupancy, throughput and time to first token of the recent sequences in seconds."""
+        with self._condition:
+            queue_depth = len(self.waiting)
+            time_to_first_token = np.array(self._time_to_first_token)
+        metrics = {
+            'queue_depth': queue_depth,
+            'running_sequences': len(self.running),
+            'free_slots': self.kv_cache.num_free,
+            'finished_sequences': self.num_finished,
+            'generated_tokens': self.num_generated_tokens,
+            'tokens_per_sec': self.num_generated_tokens / (time.perf_counter() - self._start_time),
+            'time_to_first_token': None,
+        }
+        if len(time_to_first_token) > 0:
+            metrics['time_to_first_token'] = {
+                'mean': float(time_to_first_token.mean()),
+                'p50': float(np.percentile(time_to_first_token, 50)),
+                'p90': float(np.percentile(time_to_first_token, 90)),
+                'p99': float(np.percentile(time_to_first_token, 99)),
+                'max': float(time_to_first_token.max()),
+            }
+        return metrics
+
+    def start(self):
+        """Run the steps in a background thread while there are sequences to generate."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.waiting and not self.running and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            try:
+                self.step()
+            except Exception as error:
+                logging.error(f'Continuous batching step failed: {error}')
+                with self._condition:
+                    failed = self.running + list(self.waiting)
+                    self.waiting.clear()
+                for request in failed:
+                    self._release(request, error)
+                self.running = []
+
+    @torch.no_grad()
+    def step(self) -> bool:
+        """
+        Admit waiting sequences and generate a token for every running sequence.
+
+        Returns:
+            whether there was any sequence to generate.
+        """
+        decoding = list(self.running)
+        admitted = self._admit()
+        self.running.extend(admitted)
+        if admitted:
+            self._prefill(admitted)
+        if decoding:
+            self._decode(decoding)
+        self.running = [request for request in self.running if not request.done]
+        return bool(admitted or decoding)
+
+    def _submit_sentences(
+        self, sentences: List[str], tokens_to_generate: int, add_BOS: bool, request_args: dict, stream=None
+    ) -> List[GenerationRequest]:
+        requests = []
+        for sentence in sentences:
+            context_tokens = self.tokenizer.text_to_ids(sentence)
+            if add_BOS:
+                context_tokens = [self.tokenizer.bos_id] + context_tokens
+            request = GenerationRequest(context_tokens, tokens_to_generate, **request_args)
+            request._stream = stream
+            requests.append(request)
+        # none of the sentences is generated if one of them is invalid
+        for request in requests:
+            self._check_request(request)
+        return [self.submit(request) for request in requests]
+
+    def _check_request(self, request: GenerationRequest):
+        if not request.context_tokens:
+            raise ValueError('The prompt of a generation request must have at least one token')
+        if len(request.context_tokens) >= self.max_seq_len:
+            raise ValueError(f'The prompt has {len(request.context_tokens)} tokens, max_seq_len is {self.max_seq_len}')
+
+    def _admit(self) -> List[GenerationRequest]:
+        admitted = []
+        with self._condition:
+            while self.waiting and self.kv_cache.num_free > 0:
+                padded_length = max([len(r.context_tokens) for r in admitted + [self.waiting[0]]])
+                if admitted and padded_length * (len(admitted) + 1) > self.max_prefill_tokens:
+                    break
+                request = self.waiting.popleft()
+                request.slot = self.kv_cache.allocate()
+                admitted.append(request)
+        return admitted
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        """Compute the prompts from the first position of their slots, padded to the same length."""
+        for request in requests:
+            self._reset_sampler(request)
+        lengths = [len(request.context_tokens) for request in requests]
+        input_ids = torch.full((len(requests), max(lengths)), self.tokenizer.eos_id, dtype=torch.long)
+        for i, request in enumerate(requests):
+            input_ids[i, : lengths[i]] = torch.tensor(request.context_tokens)
+        input_ids = input_ids.to(self.device)
+        position_ids = torch.arange(input_ids.shape[1], device=self.device).expand_as(input_ids)
+        slots = torch.tensor([request.slot for request in requests], device=self.device)
+        logits = self.decoder(input_ids, position_ids, slots, self.kv_cache)
+        last_index = torch.tensor(lengths, device=logits.device) - 1
+        logits = logits[torch.arange(len(requests), device=logits.device), last_index]
+        for request, length in zip(requests, lengths):
+            request.length = length
+        self._append_tokens(requests, logits)
+
+    def _decode(self, requests: List[GenerationRequest]):
+        """Compute the last generated token of every sequence, at the end of its slot."""
+        # in the order of the slots, which are read without a copy when they are contiguous
+        requests = sorted(requests, key=lambda request: request.slot)
+        input_ids = torch.tensor([[request.generated_tokens[-1]] for request in requests], device=self.device)
+        position_ids = torch.tensor([[request.length] for request in requests], device=self.device)
+        slots = torch.tensor([request.slot for request in requests], device=self.device)
+        logits = self.decoder(input_ids, position_ids, slots, self.kv_cache)[:, -1]
+        for request in requests:
+            request.length += 1
+        self._append_tokens(requests, logits)
+
+    def _append_tokens(self, requests: List[GenerationRequest], logits: torch.Tensor):
+        now = time.perf_counter()
+        slots = torch.tensor([request.slot for request in requests], device=logits.device)
+        tokens = self.sampler.sample(logits, slots)
+        ends = self.sampler.append(tokens, slots)
+        for request, token, end in zip(requests, tokens.tolist(), ends.tolist()):
+            request.generated_tokens.append(token)
+            self.num_generated_tokens += 1
+            if request._stream is not None:
+                request._stream.put((request, token))
+            if request.first_token_time is None:
+                request.first_token_time = now
+                self._time_to_first_token.append(request.time_to_first_token)
+            if end or self._is_finished(request):
+                self._release(request)
+                self.num_finished += 1
+
+    def _reset_sampler(self, request: GenerationRequest):
+        """Set the sampling parameters of the slot of a sequence, and its end strings that are single tokens."""
+        end_token_ids, request._end_strings_to_check = end_strings_to_token_ids(self.tokenizer, request.end_strings)
+        if request._end_strings_to_check:
+            request._end_string_matcher = EndStringMatcher(request._end_strings_to_check)
+            request._detokenizer = IncrementalDetokenizer(self.tokenizer)
+        self.sampler.reset(
+            request.slot,
+            greedy=request.greedy,
+            temperature=request.temperature,
+            top_k=request.top_k,
+            top_p=request.top_p,
+            repetition_penalty=request.repetition_penalty,
+            presence_penalty=request.presence_penalty,
+            min_tokens_to_generate=request.min_tokens_to_generate,
+            end_token_ids=end_token_ids,
+        )
+
+    def _is_finished(self, request: GenerationRequest) -> bool:
+        if len(request.generated_tokens) >= request.tokens_to_generate:
+            return True
+        # the next step stores the last token at position request.length
+        if request.length + 1 >= self.max_seq_len:
+            return True
+        if request._end_string_matcher is not None:
+            # the generated tokens are decoded as they come, the previous ones are not decoded again
+            text = request._detokenizer.push(request.generated_tokens[-1:])
+            return request._end_string_matcher.push(text)
+        return False
+
+    def _release(self, request: GenerationRequest, error=None):
+        if request.slot is not None:
+            self.kv_cache.free(request.slot)
+            request.slot = None
+        request._finish(error)
+
+
+class MegatronGPTSlotDecoder:
+    """
+    Decoder of a `MegatronGPTModel` for the `ContinuousBatchingScheduler`, through the `layer_past` and
+    `get_key_value` arguments of the Megatron transformer. The model must use learned absolute position embeddings,
+    which are given the position of every token, the NeMo transformer (not Transformer Engine or Megatron Core) and
+    a single pipeline stage.
+
+    With tensor parallelism, the scheduler runs on the source rank of the model parallel group, which sends the
+    inputs of every step to the other ranks, and the other ranks call `serve`.
+
+    Args:
+        model: the MegatronGPTModel, in eval mode.
+    """
+
+    def __init__(self, model):
+        cfg = model.cfg
+        if cfg.get('position_embedding_type', 'learned_absolute') != 'learned_absolute':
+            raise ValueError('Continuous batching needs learned absolute position embeddings')
+        if cfg.get('mcore_gpt', False) or cfg.get('transformer_engine', False):
+            raise ValueError('Continuous batching needs the NeMo transformer, without mcore_gpt or transformer_engine')
+        assert (
+            parallel_state.get_pipeline_model_parallel_world_size() == 1
+        ), 'Continuous batching does not support pipeline parallelism'
+        self.model = model
+        self.module = model.model.module if isinstance(model.model, Float16Module) else model.model
+        self.num_layers = len(self.module.language_model.encoder.layers)
+
+    def __call__(self, input_ids, position_ids, slots, kv_cache):
+        if parallel_state.get_model_parallel_world_size() > 1:
+            self._send_step(input_ids, position_ids, slots)
+        return self._forward(input_ids, position_ids, slots, kv_cache)
+
+    def serve(self, kv_cache: SlotKVCache):
+        """Run the steps sent by the source rank of the model parallel group, forever."""
+        while True:
+            self._forward(*self._receive_step(), kv_cache)
+
+    def _send_step(self, input_ids, position_ids, slots):
+        group = parallel_state.get_model_parallel_group()
+        src = get_model_parallel_src_rank()
+        torch.distributed.broadcast(torch.cuda.LongTensor(list(input_ids.shape)), src, group)
+        torch.distributed.broadcast(input_ids.contiguous(), src, group)
+        torch.distributed.broadcast(position_ids.contiguous(), src, group)
+        torch.distributed.broadcast(slots, src, group)
+
+    def _receive_step(self):
+        group = parallel_state.get_model_parallel_group()
+        src = get_model_parallel_src_rank()
+        shape = torch.cuda.LongTensor(2)
+        torch.distributed.broadcast(shape, src, group)
+        n, s = shape.tolist()
+        input_ids = torch.cuda.LongTensor(n, s)
+        position_ids = torch.cuda.LongTensor(n, s)
+        slots = torch.cuda.LongTensor(n)
+        for tensor in (input_ids, position_ids, slots):
+            torch.distributed.broadcast(tensor, src, group)
+        return input_ids, position_ids, slots
+
+    @torch.no_grad()
+    def _forward(self, input_ids, position_ids, slots, kv_cache):
+        past_length = int(position_ids[:, 0].max())
+        layer_past = None
+        if past_length > 0:
+            # the Megatron attention computes one new token at a time with layer_past
+            assert input_ids.shape[1] == 1
+            # views of the memory when the slots are contiguous, the attention still concatenates them with the
+            # keys and values of the new tokens
+            slot_index = kv_cache.slot_index(slots)
+            layer_past = [kv_cache.read(layer, slot_index, past_length) for layer in range(self.num_layers)]
+        attention_mask = slot_attention_mask(position_ids, past_length)
+
+        hidden_states, presents = self.module.language_model(
+            input_ids, position_ids, attention_mask, layer_past=layer_past, get_key_value=True
+        )
+        # the keys and values of the new tokens are the last ones of presents
+        for layer, (key, value) in enumerate(presents):
+            kv_cache.write(layer, slots, position_ids[:, 0], key[past_length:], value[past_length:])
+        return self._logits(hidden_states)
+
+    def _logits(self, hidden_states):
+        module = self.module
+        logits = post_language_model_processing(
+            hidden_states,
+            None,
+            module.language_model.output_layer.weight
+            if not module.share_embeddings_and_output_weights
+            else module.word_embeddings_weight(),
+            False,
+            module.parallel_output,
+            False,
+            module.fp16_lm_cross_entropy,
+            sequence_parallel=module.sequence_parallel,
+            gradient_accumulation_fusion=module.config.gradient_accumulation_fusion,
+        )
+        # the logits of a tensor parallel rank are a shard of the vocabulary
+        return tensor_parallel.gather_from_tensor_model_parallel_region(logits)
@@ -17,7 +17,7 @@ import json
 import threading
 
 import torch
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_restful import Api, Resource
 
 from nemo.collections.nlp.modules.common.retro_inference_strategies import (
@@ -43,16 +43,19 @@ API_ALLOWED_KEYS = set(
         "top_p",
         "neighbors",
         "repetition_penalty",
+        "presence_penalty",
         "min_tokens_to_generate",
         "end_strings",
+        "stream",
     ]
 )
 
 
 class MegatronGenerate(Resource):
-    def __init__(self, model, inference_strategy=None):
+    def __init__(self, model, inference_strategy=None, scheduler=None):
         self.model = model
         self.inference_strategy = inference_strategy
+        self.scheduler = scheduler
 
     @staticmethod
     def send_do_generate():
@@ -141,6 +144,12 @@ class MegatronGenerate(Resource):
             if not (1.0 <= repetition_penalty):
                 return "repetition_penalty must be a positive number no less than 1.0"
 
+        presence_penalty = 0.0
+        if "presence_penalty" in request.get_json():
+            presence_penalty = request.get_json()["presence_penalty"]
+            if not (type(presence_penalty) == int or type(presence_penalty) == float):
+                return "presence_penalty must be a number"
+
         end_strings = ['<|endoftext|>']
         if 'end_strings' in request.get_json():
             end_strings = request.get_json()['end_strings']
@@ -165,6 +174,42 @@ class MegatronGenerate(Resource):
             if neighbors < 0:
                 return "num of neighbors must be an integer no less than 0"
 
+        stream = False
+        if "stream" in request.get_json():
+            stream = request.get_json()["stream"]
+            if not isinstance(stream, bool):
+                return "stream must be a boolean value"
+
+        if self.scheduler is not None:
+            # the sentences join the running batch of the scheduler, without waiting for the other requests
+            if isinstance(sentences, tuple) or task_ids is not None or neighbors is not None or all_probs:
+                return "Token tensors, task_ids, neighbors and all_probs are not supported with continuous batching"
+            request_args = dict(
+                tokens_to_generate=tokens_to_generate,
+                add_BOS=add_BOS,
+                min_tokens_to_generate=min_tokens_to_generate,
+                end_strings=end_strings,
+                greedy=greedy,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                presence_penalty=presence_penalty,
+            )
+            try:
+                if stream:
+                    events = self.scheduler.stream(sentences, **request_args)
+                    return Response(self.stream_events(events), mimetype='text/event-stream')
+                output = self.scheduler.generate(sentences, **request_args)
+            except ValueError as error:
+                # e.g. a prompt longer than the max sequence length of the scheduler
+                return str(error)
+            del output['full_logprob']
+            return jsonify(output)
+
+        if presence_penalty != 0.0 or stream:
+            return "presence_penalty and stream are only supported with continuous batching"
+
         with lock:  # Need to get lock to keep multiple threads from hitting code
             MegatronGenerate.send_do_generate()  # Tell other ranks we're doing generate
             extra = {}
@@ -208,12 +253,43 @@ class MegatronGenerate(Resource):
                 output['retrieved'] = retrieved_doc
         return jsonify(output)
 
+    def stream_events(self, events):
+        """
+        The tokens of the sentences as server-sent events, a `data: {json}` event per token and per finished
+        sentence (see `ContinuousBatchingScheduler.stream`), then `data: [DONE]`, or an event with the `error`.
+        """
+        try:
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as error:
+            logging.error(f"Streaming generation failed: {error}")
+            yield f"data: {json.dumps({'error': str(error)})}\n\n"
+            return
+        yield "data: [DONE]\n\n"
+
+
+class MegatronMetrics(Resource):
+    def __init__(self, model, scheduler):
+        self.model = model
+        self.scheduler = scheduler
+
+    def get(self):
+        metrics = {}
+        if self.scheduler is not None:
+            metrics.update(self.scheduler.metrics())
+        prefix_cache = getattr(self.model, 'prefix_kv_cache', None)
+        if prefix_cache is not None:
+            metrics['prefix_cache'] = prefix_cache.stats()
+        return jsonify(metrics)
+
 
 class MegatronServer(object):
-    def __init__(self, model, inference_strategy=None):
+    def __init__(self, model, inference_strategy=None, scheduler=None):
         self.app = Flask(__name__, static_url_path='')
         api = Api(self.app)
-        api.add_resource(MegatronGenerate, '/generate', resource_class_args=[model, inference_strategy])
+        api.add_resource(MegatronGenerate, '/generate', resource_class_args=[model, inference_strategy, scheduler])
+        if scheduler is not None or getattr(model, 'prefix_kv_cache', None) is not None:
+            api.add_resource(MegatronMetrics, '/metrics', resource_class_args=[model, scheduler])
 
     def run(self, url, port=5000):
         self.app.run(url, threaded=True, port=port, debug=False)
@@ -0,0 +1,366 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Speculative decoding for text generation.
+
+`sample_sequence_batch` runs the target model once for every generated token. With speculative decoding, a small
+draft model proposes the next `num_speculative_tokens` tokens one at a time, and the target model computes the
+distributions of all of them in a single forward step. The drafted tokens are accepted with rejection sampling, which
+keeps the distribution of the target model: a token is accepted with probability min(1, p / q) of its target and
+draft probabilities, and the first rejected one is replaced by a sample of the normalized max(p - q, 0). Every step
+generates from one to `num_speculative_tokens + 1` tokens. With greedy decoding, the output is the one of the target
+model alone.
+
+The models are called through runners, `runner.forward(tokens, start, end, maxlen)`, that compute the tokens at
+positions [start, end) after the ones in their key-value memory and return their [b, end - start, vocab] logits,
+and `runner.truncate(length)`, that discards the memory from position `length` on. `MegatronGPTSpeculativeRunner`
+is the runner of `MegatronGPTModel`.
+"""
+
+import time
+from functools import partial
+
+import torch
+import torch.nn.functional as F
+
+from nemo.collections.nlp.modules.common.text_generation_prefix_cache import inference_attention_layers
+from nemo.collections.nlp.modules.common.text_generation_strategy import GPTModelTextGenerationStrategy
+from nemo.collections.nlp.modules.common.text_generation_utils import top_k_logits
+from nemo.utils import AppState, logging
+
+try:
+    from apex.transformer.pipeline_parallel.utils import _reconfigure_microbatch_calculator
+
+    HAVE_APEX = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_APEX = False
+
+try:
+    from megatron.core import parallel_state, tensor_parallel
+
+    HAVE_MEGATRON_CORE = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_MEGATRON_CORE = False
+
+__all__ = [
+    "speculative_accept",
+    "SpeculativeDecoder",
+    "MegatronGPTSpeculativeRunner",
+    "speculative_synced_generate",
+]
+
+
+def speculative_accept(draft_tokens, draft_probs, target_probs):
+    """
+    Rejection sampling of drafted tokens.
+
+    Args:
+        draft_tokens: [b, k] tokens proposed by the draft model.
+        draft_probs: [b, k, vocab] draft distributions the tokens were sampled from.
+        target_probs: [b, k + 1, vocab] target distributions at the positions of the drafted tokens and the next one.
+    Returns:
+        the [b] numbers of leading drafted tokens that are accepted, and the [b] tokens that follow them, sampled
+        from the residual distribution of the first rejected position, or from the target distribution after the
+        last drafted token when all of them are accepted.
+    """
+    batch = torch.arange(draft_tokens.size(0), device=draft_tokens.device)
+    k = draft_tokens.size(1)
+    p = torch.gather(target_probs[:, :k], 2, draft_tokens.unsqueeze(2)).squeeze(2)
+    q = torch.gather(draft_probs, 2, draft_tokens.unsqueeze(2)).squeeze(2)
+    # accept with probability min(1, p / q), q > 0 for a sampled token
+    accepted = torch.rand_like(p) * q < p
+    num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+
+    next_probs = target_probs[batch, num_accepted]
+    draft_probs = torch.cat([draft_probs, torch.zeros_like(draft_probs[:, :1])], dim=1)
+    residual = (next_probs - draft_probs[batch, num_accepted]).clamp(min=0)
+    # the residual is only zero when p == q, where the drafted token is always accepted
+    residual_sum = residual.sum(dim=-1, keepdim=True)
+    residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-20), next_probs)
+    next_tokens = torch.multinomial(residual, num_samples=1).view(-1)
+    return num_accepted, next_tokens
+
+
+class SpeculativeDecoder:
+    """
+    Generates a batch of sequences with a target and a draft model, see the module docstring.
+
+    The sequences of the batch keep the same length: at every step, all of them take as many drafted tokens as the
+    sequence that accepted the fewest, then one more token. The sequences that accepted more take their drafted
+    token, which is a sample of the target distribution, and the others their token from `speculative_accept`.
+
+    Args:
+        target: runner of the target model.
+        draft: runner of the draft model.
+        num_speculative_tokens: number of tokens proposed by the draft model at every step.
+    """
+
+    def __init__(self, target, draft, num_speculative_tokens: int = 4):
+        if num_speculative_tokens < 1:
+            raise ValueError(f'num_speculative_tokens must be at least 1, got {num_speculative_tokens}')
+        self.target = target
+        self.draft = draft
+        self.num_speculative_tokens = num_speculative_tokens
+        self.target_steps = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.elapsed = 0.0
+
+    def metrics(self) -> dict:
+        """Acceptance rate and throughput of the sequences generated so far."""
+        return {
+            'target_steps': self.target_steps,
+            'drafted_tokens': self.drafted_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'acceptance_rate': self.accepted_tokens / max(self.drafted_tokens, 1),
+            'generated_tokens': self.generated_tokens,
+            'tokens_per_target_step': self.generated_tokens / max(self.target_steps, 1),
+            'tokens_per_sec': self.generated_tokens / self.elapsed if self.elapsed > 0 else 0.0,
+        }
+
+    @torch.no_grad()
+    def generate(
+        self,
+        tokens,
+        context_lengths,
+        maxlen,
+        eod_id,
+        vocab_size,
+        greedy=False,
+        temperature=1.0,
+        top_k=0,
+        top_p=0.0,
+        min_tokens_to_generate=0,
+        end_of_generation=None,
+    ):
+        """
+        Generate the tokens of a batch up to `maxlen`, or until all the sequences are done.
+
+        Args:
+            tokens: [b, >= maxlen] context tokens, padded, updated in place with the generated tokens.
+            context_lengths: [b] lengths of the contexts, the shorter contexts start generating first.
+            maxlen: maximum length of the sequences.
+            eod_id: end of document token, which also replaces the tokens after the end of a sequence.
+            vocab_size: number of tokens of the tokenizer, the logits of the padded vocabulary are dropped.
+            greedy, temperature, top_k, top_p, min_tokens_to_generate: sampling parameters of `generate`.
+            end_of_generation: `end_of_generation(tokens, prev)`, whether the sequences end with their previous
+                token `prev`, by default when it is `eod_id`.
+        Returns:
+            the tokens of the batch, up to the length of the longest sequence.
+        """
+        start_time = time.time()
+        sampling = {
+            'eod_id': eod_id,
+            'vocab_size': vocab_size,
+            'greedy': greedy,
+            'temperature': temperature,
+            'top_k': top_k,
+            'top_p': top_p,
+            'min_tokens_to_generate': min_tokens_to_generate,
+        }
+        is_done = torch.zeros(tokens.size(0), dtype=torch.bool, device=tokens.device)
+        length = context_lengths.min().item()
+        # number of positions in the key-value memory of the models
+        target_length = draft_length = 0
+        while length < maxlen and not is_done.all():
+            k = min(self.num_speculative_tokens, maxlen - length - 1)
+            positions = torch.arange(length, length + k + 1, device=tokens.device)
+
+            draft_probs = []
+            for j in range(k):
+                logits = self.draft.forward(tokens, draft_length, length + j, maxlen)
+                draft_length = length + j
+                probs = self._probs(logits[:, -1:], tokens, positions[j : j + 1], context_lengths, sampling)
+                tokens[:, length + j] = torch.multinomial(probs[:, 0], num_samples=1).view(-1)
+                draft_probs.append(probs)
+
+            logits = self.target.forward(tokens, target_length, length + k, maxlen)
+            target_length = length + k
+            target_probs = self._probs(logits[:, -(k + 1) :], tokens, positions, context_lengths, sampling)
+            draft_probs = torch.cat(draft_probs, dim=1) if draft_probs else target_probs[:, :0]
+            num_accepted, next_tokens = speculative_accept(tokens[:, length : length + k], draft_probs, target_probs)
+
+            active = ~is_done
+            num_emitted = num_accepted[active].min().item()
+            last = length + num_emitted
+            if num_emitted < k:
+                next_tokens = torch.where(num_accepted > num_emitted, tokens[:, last], next_tokens)
+            tokens[:, last] = next_tokens
+
+            # the positions of the contexts are not drafted nor generated
+            generating = (positions[None, :k] >= context_lengths[:, None]) & active[:, None]
+            self.drafted_tokens += generating.sum().item()
+            leading = torch.arange(k, device=tokens.device)[None] < num_accepted[:, None]
+            self.accepted_tokens += (generating & leading).sum().item()
+
+            for position in range(length, last + 1):
+                started = context_lengths <= position
+                # replace the tokens after the end of a sequence with the end of document token
+                new_tokens = torch.where(is_done, torch.full_like(tokens[:, position], eod_id), tokens[:, position])
+                tokens[:, position] = new_tokens
+                self.generated_tokens += (started & ~is_done).sum().item()
+                if end_of_generation is not None:
+                    done_token = end_of_generation(tokens[:, : position + 1], new_tokens)
+                else:
+                    done_token = new_tokens == eod_id
+                is_done = is_done | (done_token.bool() & started)
+
+            length = last + 1
+            # discard the memory of the rejected tokens, the last token is computed at the next step
+            target_length = min(target_length, length - 1)
+            draft_length = min(draft_length, length - 1)
+            self.target.truncate(target_length)
+            self.draft.truncate(draft_length)
+            self.target_steps += 1
+
+        self.elapsed += time.time() - start_time
+        return tokens[:, :length]
+
+    def _probs(self, logits, tokens, positions, context_lengths, sampling):
+        """
+        [b, s, vocab] distributions of the tokens at `positions` from the logits of the previous positions, the
+        context tokens have probability one
+        """
+        # a copy, the logits of the caller are not modified
+        logits = logits[..., : sampling['vocab_size']].to(torch.float32, copy=True)
+        # make sure it will generate at least min_tokens_to_generate
+        within_min_length = positions[None] - context_lengths[:, None] < sampling['min_tokens_to_generate']
+        logits[..., sampling['eod_id']].masked_fill_(within_min_length, -float('Inf'))
+        if sampling['greedy']:
+            probs = F.one_hot(logits.argmax(dim=-1), logits.size(-1)).float()
+        else:
+            # the logits of the last positions are not contiguous
+            flat_logits = logits.reshape(-1, logits.size(-1)) / sampling['temperature']
+            flat_logits = top_k_logits(flat_logits, top_k=sampling['top_k'], top_p=sampling['top_p'])
+            probs = F.softmax(flat_logits, dim=-1).reshape(logits.shape)
+        in_context = (positions[None] < context_lengths[:, None]).unsqueeze(-1)
+        context_probs = F.one_hot(tokens[:, positions], probs.size(-1)).float()
+        return torch.where(in_context, context_probs, probs)
+
+
+class MegatronGPTSpeculativeRunner:
+    """
+    Runner of a `MegatronGPTModel` for the `SpeculativeDecoder`, on the inference key-value memory of its attention
+    layers, which is truncated by resetting their sequence length. The model must use the NeMo transformer (not
+    Transformer Engine or Megatron Core) and a single pipeline stage.
+
+    Args:
+        model: the MegatronGPTModel, in eval mode.
+        strategy: the text generation strategy of the model, a new GPTModelTextGenerationStrategy by default.
+    """
+
+    def __init__(self, model, strategy=None):
+        if model.cfg.get('mcore_gpt', False) or model.cfg.get('transformer_engine', False):
+            raise ValueError('Speculative decoding needs the NeMo transformer, not mcore_gpt or transformer_engine')
+        assert (
+            parallel_state.get_pipeline_model_parallel_world_size() == 1
+        ), 'Speculative decoding does not support pipeline parallelism'
+        self.model = model
+        self.strategy = strategy if strategy is not None else GPTModelTextGenerationStrategy(model)
+        if not isinstance(self.strategy, GPTModelTextGenerationStrategy):
+            raise ValueError(f'Speculative decoding is not supported with {type(self.strategy).__name__}')
+        self.layers = inference_attention_layers(model)
+
+    def forward(self, tokens, start, end, maxlen):
+        micro_batch_size = tokens.size(0)
+        if start == 0:
+            self.strategy.init_batch(tokens, end, compute_attention_mask=True)
+        batch = [
+            tokens[:, start:end],
+            self.strategy.attention_mask,
+            self.strategy.position_ids[:, start:end],
+            # allocate the memory for maxlen tokens at the first step
+            torch.tensor([start == 0] * micro_batch_size, device=tokens.device),
+            torch.tensor([maxlen] * micro_batch_size, device=tokens.device),
+        ]
+        output = self.strategy.forward_step(batch, [end - start, micro_batch_size, self.model.cfg.hidden_size])
+        return tensor_parallel.gather_from_tensor_model_parallel_region(output[0]['logits'])
+
+    def truncate(self, length):
+        for layer in self.layers:
+            layer.inference_current_sequence_len = length
+
+
+def speculative_synced_generate(
+    model,
+    draft_model,
+    inference_strategy,
+    context_tokens_tensor,
+    context_length_tensor,
+    tokens_to_generate,
+    all_probs,
+    temperature,
+    top_k=0,
+    top_p=0.0,
+    greedy=False,
+    compute_attention_mask=True,
+    compute_logprob=False,
+    repetition_penalty=1.0,
+    end_strings=[],
+    min_tokens_to_generate=0,
+    num_speculative_tokens=4,
+):
+    """
+    `synced_generate` with speculative decoding, the draft model must share the tokenizer of the model. Returns the
+    output of `synced_generate` and the metrics of the `SpeculativeDecoder`.
+    """
+    if compute_logprob or all_probs:
+        raise ValueError('Speculative decoding does not compute log probabilities')
+    if not compute_attention_mask:
+        raise ValueError('Speculative decoding needs the attention mask')
+    if repetition_penalty != 1.0:
+        logging.warning('The repetition penalty is not applied with speculative decoding')
+
+    micro_batch_size = context_tokens_tensor.size(0)
+    _reconfigure_microbatch_calculator(
+        rank=AppState().global_rank,
+        rampup_batch_size=None,
+        global_batch_size=micro_batch_size,
+        micro_batch_size=micro_batch_size,
+        data_parallel_size=1,
+    )
+    target = MegatronGPTSpeculativeRunner(model, inference_strategy)
+    draft = MegatronGPTSpeculativeRunner(draft_model)
+    maxlen = tokens_to_generate + context_length_tensor.max().item()
+    maxlen = draft.strategy.clip_max_len(target.strategy.clip_max_len(maxlen))
+
+    eod_id = model.tokenizer.eos_id
+    inference_strategy.reset_end_of_generation_condition()
+    end_of_generation = partial(inference_strategy.end_of_generation_condition, eod_id=eod_id, end_strings=end_strings)
+    decoder = SpeculativeDecoder(target, draft, num_speculative_tokens)
+    tokens = decoder.generate(
+        context_tokens_tensor,
+        context_length_tensor,
+        maxlen,
+        eod_id,
+        model.tokenizer.vocab_size,
+        greedy=greedy,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        min_tokens_to_generate=min_tokens_to_generate,
+        end_of_generation=end_of_generation,
+    )
+    metrics = decoder.metrics()
+    logging.info(
+        f"Speculative decoding: acceptance rate {metrics['acceptance_rate']:.3f}, "
+        f"{metrics['tokens_per_target_step']:.2f} tokens per target step, {metrics['tokens_per_sec']:.1f} tokens/sec"
+    )
+    return (tokens, None, None), metrics
@@ -24,6 +24,8 @@ from transformers import CLIPImageProcessor
 
 from nemo.collections.nlp.modules.common.lm_utils import pad_batch
 from nemo.collections.nlp.modules.common.megatron.utils import get_ltor_masks_and_position_ids
+from nemo.collections.nlp.modules.common.text_generation_prefix_cache import inference_attention_layers
+from nemo.collections.nlp.modules.common.text_generation_streaming import EndStringMatcher, IncrementalDetokenizer
 
 try:
     from apex.transformer.pipeline_parallel.utils import get_num_microbatches
@@ -34,6 +36,7 @@ except (ImportError, ModuleNotFoundError):
     HAVE_APEX = False
 
 try:
+    from megatron.core import parallel_state
     from megatron.core.pipeline_parallel.schedules import get_forward_backward_func
 
     HAVE_MEGATRON_CORE = True
@@ -62,6 +65,17 @@ class TextGenerationStrategy:
             )
             self.model.eval()
         self._end_of_generation_cache = None
+        self.reset_end_of_generation_condition()
+
+        # reuse of the inference key-value memory of prompt prefixes, see `PrefixKVCache`
+        self.prefix_cache = getattr(model, 'prefix_kv_cache', None)
+        if self.prefix_cache is not None and (
+            model.cfg.get('transformer_engine', False) or model.cfg.get('mcore_gpt', False)
+        ):
+            warnings.warn("The prefix cache does not support Transformer Engine and Megatron Core, it is not used")
+            self.prefix_cache = None
+        self._prefix_hashes = None
+        self._prefill_length = 0
 
     def forward_step(self, batch, tensor_shape):
         fwd_bwd_function = get_forward_backward_func()
@@ -162,23 +176,6 @@ class TextGenerationStrategy:
         if (len(end_strings) == 1 and end_strings[0] == END_OF_SEQ) or not end_strings:
             # Simple scenario: only finish on end of document token.
             return prev == eod_id
-        else:
-            tokenizer = self.model.tokenizer
-            conditions = []
-            end_tokens = set()
-            end_tokens.add(eod_id)
-            for end_string in end_strings:
-                ids_1 = tokenizer.text_to_ids(f'<extra_id_1>{end_string}')
-                ids_2 = tokenizer.text_to_ids('<extra_id_1>')
-                if len(ids_1) <= len(ids_2):
-                    continue
-                token_id = ids_1[len(ids_2) :][0]
-                end_tokens.add(token_id)
-            for p, token_item in zip(prev, tokens):
-                text = tokenizer.ids_to_text(token_item.tolist())
-                conditions.append(
-                    any([text.endswith(end_string) for end_string in end_strings] + [p.item() in end_tokens])
-                )
 
         end_tokens, end_strings_to_check = self._get_end_of_generation_tokens_and_strings(eod_id, end_strings)
         assert end_tokens
@@ -186,19 +183,57 @@ class TextGenerationStrategy:
         is_end = torch.isin(prev, torch.tensor(list(end_tokens), dtype=prev.dtype, device=prev.device))
 
         if end_strings_to_check:
-            # The loop below is inefficient (see warning in `_get_end_of_generation_tokens_and_strings()`)
-            # TODO In addition, we will not stop if the model generates an end string followed by extra characters,
+            # Only the new tokens are decoded at every step (see `_end_strings_matched()`)
+            # TODO We will not stop if the model generates an end string followed by extra characters,
             # e.g., if `end_string` is "Done" and there exists a "Done!" token it could generate tokens
             #       [..., ".", "Done!"]
             # which would fail the `endswith("Done")` check. However, stopping when "Done!" is generated would not
             # work either, since we would need to post-process the generated string to truncate the extra "!".
             # ==> this is left for future work if there is a compelling use case requiring this feature.
-            for idx, token_seq in enumerate(tokens):
-                text = self.model.tokenizer.ids_to_text(token_seq.tolist())
-                is_end[idx] |= any(text.endswith(end_string) for end_string in end_strings_to_check)
+            is_end |= torch.tensor(self._end_strings_matched(tokens, end_strings_to_check), device=is_end.device)
 
         return is_end
 
+    def reset_end_of_generation_condition(self):
+        """
+        forget the text of the sequences decoded by `end_of_generation_condition`, called before a new batch
+        """
+        self._end_string_detokenizers = None
+        self._end_string_matchers = None
+        self._end_strings = None
+        self._end_string_length = 0
+
+    def _end_strings_matched(self, tokens: torch.Tensor, end_strings: List[str]) -> List[bool]:
+        """
+        return whether the text of every sequence ends with one of `end_strings`, decoding only the tokens added
+        since the previous call of the batch
+        """
+        length = tokens.size(1)
+        if (
+            self._end_string_matchers is None
+            or len(self._end_string_matchers) != tokens.size(0)
+            or self._end_strings != end_strings
+            or length <= self._end_string_length
+        ):
+            # the whole sequences but their last token are decoded once, at the first step of the batch
+            tokenizer = self.model.tokenizer
+            contexts = tokens[:, :-1].tolist()
+            self._end_string_detokenizers = [IncrementalDetokenizer(tokenizer, context) for context in contexts]
+            self._end_string_matchers = [EndStringMatcher(end_strings) for _ in contexts]
+            self._end_strings = end_strings
+            for matcher, context in zip(self._end_string_matchers, contexts):
+                matcher.push(tokenizer.ids_to_text(context))
+            self._end_string_length = length - 1
+
+        new_tokens = tokens[:, self._end_string_length :].tolist()
+        self._end_string_length = length
+        return [
+            matcher.push(detokenizer.push(row_tokens))
+            for detokenizer, matcher, row_tokens in zip(
+                self._end_string_detokenizers, self._end_string_matchers, new_tokens
+            )
+        ]
+
     def post_generation_process(self, output):
         """
         At the end of the text generation, post process the results
@@ -207,6 +242,62 @@ class TextGenerationStrategy:
         """
         return output
 
+    def clip_prefix_length(self, tokens: List[int], prefix_length: int) -> int:
+        """
+        return the longest reusable prefix of a prompt that is not longer than `prefix_length`
+        """
+        return prefix_length
+
+    def restore_prefix(self, tokens: torch.Tensor, context_length: int, maxlen: int) -> int:
+        """
+        restore the inference key-value memory of the longest cached prefix shared by the context of all the
+        sequences, and allocate the memory for `maxlen` tokens
+        Args:
+            tokens (torch.Tensor): the context tokens
+            context_length (int): the length of the context computed at the first step
+            maxlen (int): the maximum length in the context tokens
+        returns:
+            the length of the restored prefix, 0 if the memory is not allocated and the whole context is computed
+        """
+        if self.prefix_cache is None:
+            return 0
+        cache = self.prefix_cache
+        contexts = tokens[:, :context_length].tolist()
+        # only the blocks of the reusable prefix are looked up, then stored after the first step
+        self._prefix_hashes = [
+            cache.block_hashes(context)[: self.clip_prefix_length(context, len(context)) // cache.block_size]
+            for context in contexts
+        ]
+        self._prefill_length = context_length
+
+        # the last context token is always computed, for the logits of the first generated token
+        max_prefix_length = (context_length - 1) // cache.block_size * cache.block_size
+        prefix_length = max_prefix_length
+        for hashes in self._prefix_hashes:
+            prefix_length = min(prefix_length, cache.lookup(hashes) * cache.block_size)
+        if parallel_state.get_model_parallel_world_size() > 1:
+            # the ranks of a model may have evicted different blocks, all of them restore the common prefix
+            prefix_length_tensor = torch.cuda.LongTensor([prefix_length])
+            group = parallel_state.get_model_parallel_group()
+            torch.distributed.all_reduce(prefix_length_tensor, op=torch.distributed.ReduceOp.MIN, group=group)
+            prefix_length = prefix_length_tensor.item()
+
+        cache.record([len(context) for context in contexts], prefix_length)
+        if prefix_length > 0:
+            num_blocks = prefix_length // cache.block_size
+            layers = inference_attention_layers(self.model)
+            cache.restore(layers, [hashes[:num_blocks] for hashes in self._prefix_hashes], maxlen)
+        return prefix_length
+
+    def store_prefix(self):
+        """
+        cache the inference key-value memory of the reusable prefix of the context computed at the first step, called
+        after that step
+        """
+        if self.prefix_cache is not None and self._prefix_hashes is not None:
+            self.prefix_cache.store(inference_attention_layers(self.model), self._prefix_hashes, self._prefill_length)
+            self._prefix_hashes = None
+
     def _get_end_of_generation_tokens_and_strings(
         self, eod_id: int, end_strings: List[str]
     ) -> Tuple[Set[int], List[str]]:
@@ -311,14 +402,19 @@ class GPTModelTextGenerationStrategy(TextGenerationStrategy):
         """
         # types2use = None
         if step == 0:
-            # Allocate memory for the entire context.
-            set_inference_key_value_memory = True
-            tokens2use = tokens[:, :context_length]
-            positions2use = self.position_ids[:, :context_length]
+            # Restore the memory of a cached prefix of the context, if any.
+            prefix_length = self.restore_prefix(tokens, context_length, maxlen) if compute_attention_mask else 0
+            # Otherwise allocate memory for the entire context.
+            set_inference_key_value_memory = prefix_length == 0
+            tokens2use = tokens[:, prefix_length:context_length]
+            positions2use = self.position_ids[:, prefix_length:context_length]
             # not using type2use. uncomment it if it is used
             # if type_ids is not None:
             #     types2use = type_ids[:, :context_length]
         else:
+            if step == 1:
+                # The memory now holds the context computed at the first step.
+                self.store_prefix()
             # Set this to false so the memory is not reallocated.
             set_inference_key_value_memory = False
             tokens2use = tokens[:, context_length - 1].view(micro_batch_size, -1)
@@ -446,6 +542,27 @@ class NevaModelTextGenerationStrategy(TextGenerationStrategy):
             raise ValueError(f"Conversation template `{self.conv_template}` is not supported in Neva now.")
         return data_dict['tokens'].tolist()
 
+    def _media_spans(self, tokens: List[int]) -> List[Tuple[int, int]]:
+        """the first and last positions of the tokens of every image of a prompt, start and end tokens included"""
+        from nemo.collections.multimodal.data.neva.neva_dataset import DEFAULT_IM_END_TOKEN
+
+        media_end_id = self.tokenizer.token_to_id(DEFAULT_IM_END_TOKEN)
+        return [
+            (position - self.num_media_latents - 1, position)
+            for position, token in enumerate(tokens)
+            if token == media_end_id
+        ]
+
+    def clip_prefix_length(self, tokens: List[int], prefix_length: int) -> int:
+        """
+        a restored prefix ends before the first image: the computed suffix replaces the embeddings of its images with
+        the media of the prompt from the first one on, which would be shifted if the prefix held some of them
+        """
+        spans = self._media_spans(tokens)
+        if spans:
+            return min(prefix_length, spans[0][0])
+        return prefix_length
+
     def tokenize_batch(self, prompt, max_len, add_BOS):
         context_tokens = self.process_prompts(prompt)
         context_tokens, context_lengths = pad_batch(context_tokens, self.tokenizer.eos_id, max_len)
@@ -512,14 +629,19 @@ class NevaModelTextGenerationStrategy(TextGenerationStrategy):
         """
         # types2use = None
         if step == 0:
-            # Allocate memory for the entire context.
-            set_inference_key_value_memory = True
-            tokens2use = tokens[:, :context_length]
-            positions2use = self.position_ids[:, :context_length]
+            # Restore the memory of a cached prefix of the context, if any.
+            prefix_length = self.restore_prefix(tokens, context_length, maxlen) if compute_attention_mask else 0
+            # Otherwise allocate memory for the entire context.
+            set_inference_key_value_memory = prefix_length == 0
+            tokens2use = tokens[:, prefix_length:context_length]
+            positions2use = self.position_ids[:, prefix_length:context_length]
             # not using type2use. uncomment it if it is used
             # if type_ids is not None:
             #     types2use = type_ids[:, :context_length]
         else:
+            if step == 1:
+                # The memory now holds the context computed at the first step.
+                self.store_prefix()
             # Set this to false so the memory is not reallocated.
             set_inference_key_value_memory = False
             tokens2use = tokens[:, context_length - 1].view(micro_batch_size, -1)
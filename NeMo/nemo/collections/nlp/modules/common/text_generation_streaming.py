@@ -0,0 +1,90 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental decoding of the text of generated tokens.
+
+Checking the end strings of a sequence by decoding all its tokens at every step costs O(n^2) over the generation,
+and streaming the text of new tokens needs the text they add to the sequence. The `IncrementalDetokenizer` decodes
+only the last tokens of a sequence to get the text of its new tokens, and the `EndStringMatcher` checks the end
+strings on the last characters of the text.
+"""
+
+from typing import List, Sequence
+
+__all__ = ["IncrementalDetokenizer", "EndStringMatcher"]
+
+
+class IncrementalDetokenizer:
+    """
+    Decodes the text of a sequence as its tokens are generated.
+
+    The text of a token depends on the previous tokens, e.g. SentencePiece drops the leading space of the first
+    token of a text, and a character may be split over several byte tokens. The text of new tokens is therefore the
+    difference between the texts of a few previous tokens with and without them. The text is held back while it ends
+    with an incomplete character, decoded as the replacement character.
+
+    Args:
+        tokenizer: tokenizer of the model.
+        prompt_tokens: tokens before the first generated token, only the last of them are decoded.
+        num_prefix_tokens: number of previous tokens decoded with the new tokens.
+    """
+
+    def __init__(self, tokenizer, prompt_tokens: Sequence[int] = (), num_prefix_tokens: int = 5):
+        self.tokenizer = tokenizer
+        self.tokens = list(prompt_tokens)
+        self._read_offset = len(self.tokens)
+        self._prefix_offset = max(len(self.tokens) - num_prefix_tokens, 0)
+
+    def push(self, tokens: Sequence[int]) -> str:
+        """Add new tokens to the sequence and return the text they add, empty while it is incomplete."""
+        self.tokens.extend(tokens)
+        prefix_text = self._decode(self.tokens[self._prefix_offset : self._read_offset])
+        text = self._decode(self.tokens[self._prefix_offset :])
+        if len(text) <= len(prefix_text) or text.endswith('\ufffd'):
+            return ''
+        self._prefix_offset, self._read_offset = self._read_offset, len(self.tokens)
+        return text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """Return the text held back at the end of the sequence."""
+        prefix_text = self._decode(self.tokens[self._prefix_offset : self._read_offset])
+        text = self._decode(self.tokens[self._prefix_offset :])
+        self._prefix_offset = self._read_offset = len(self.tokens)
+        return text[len(prefix_text) :]
+
+    def _decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.ids_to_text(tokens) if tokens else ''
+
+
+class EndStringMatcher:
+    """
+    Whether a text ends with one of the end strings, given the text in pieces. Only the last characters of the text,
+    as many as in the longest end string, are kept.
+
+    Args:
+        end_strings: the strings that end the text.
+    """
+
+    def __init__(self, end_strings: List[str]):
+        self.end_strings = [end_string for end_string in end_strings if end_string]
+        self._max_length = max([len(end_string) for end_string in self.end_strings], default=0)
+        self._tail = ''
+
+    def push(self, text: str) -> bool:
+        """Add a piece of text and return whether the text ends with one of the end strings."""
+        if not self._max_length:
+            return False
+        self._tail = (self._tail + text)[-self._max_length :]
+        return any(self._tail.endswith(end_string) for end_string in self.end_strings)
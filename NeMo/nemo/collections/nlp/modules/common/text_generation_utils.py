@@ -556,7 +556,9 @@ def generate(
         greedy (bool):  Whether or not to use sampling ; use greedy decoding otherwise
         repetition_penalty (float): The parameter for repetition penalty. 1.0 means no penalty
         min_tokens_to_generate (int): The minimum length of the tokens to be generated
-        strategy_args, the extra arguments are treated as inference strategy arguments
+        strategy_args, the extra arguments are treated as inference strategy arguments, except:
+            draft_model (MegatronGPTModel): a small model sharing the tokenizer, to generate with speculative decoding
+            num_speculative_tokens (int): number of tokens proposed by the draft model at every step, 4 by default
         end_strings, a list of strings to stop generation when they are encountered in the output.
     Returns:
         OutputType: It generates the output in a dictionary type. It has the following keys:
@@ -566,7 +568,10 @@ def generate(
             full_logprob: List[Tensor], log prob of all the tokens in the vocab
             token_ids: List[Tensor], output sentence token ids
             offsets: List[List[int]]  # list of tokens start positions in text
+            speculative_decoding: dict, acceptance rate and tokens/sec, only with a draft model
     """
+    draft_model = strategy_args.pop('draft_model', None)
+    num_speculative_tokens = strategy_args.pop('num_speculative_tokens', 4)
     if 'strategy' in strategy_args:
         inference_strategy = strategy_args['strategy']
     else:
@@ -610,24 +615,49 @@ def generate(
             end_strings,
         ) = receive_generate_info()
 
-    output = synced_generate(
-        model,
-        inference_strategy,
-        context_tokens_tensor,
-        context_length_tensor,
-        tokens_to_generate,
-        all_probs,
-        temperature,
-        compute_attention_mask=compute_attention_mask,
-        compute_logprob=compute_logprob,
-        top_k=top_k,
-        top_p=top_p,
-        greedy=greedy,
-        repetition_penalty=repetition_penalty,
-        end_strings=end_strings,
-        min_tokens_to_generate=min_tokens_to_generate,
-        image_list=image_list,
-    )
+    speculative_metrics = None
+    if draft_model is not None:
+        # Importing here to avoid circular import errors
+        from nemo.collections.nlp.modules.common.text_generation_speculative import speculative_synced_generate
+
+        output, speculative_metrics = speculative_synced_generate(
+            model,
+            draft_model,
+            inference_strategy,
+            context_tokens_tensor,
+            context_length_tensor,
+            tokens_to_generate,
+            all_probs,
+            temperature,
+            compute_attention_mask=compute_attention_mask,
+            compute_logprob=compute_logprob,
+            top_k=top_k,
+            top_p=top_p,
+            greedy=greedy,
+            repetition_penalty=repetition_penalty,
+            end_strings=end_strings,
+            min_tokens_to_generate=min_tokens_to_generate,
+            num_speculative_tokens=num_speculative_tokens,
+        )
+    else:
+        output = synced_generate(
+            model,
+            inference_strategy,
+            context_tokens_tensor,
+            context_length_tensor,
+            tokens_to_generate,
+            all_probs,
+            temperature,
+            compute_attention_mask=compute_attention_mask,
+            compute_logprob=compute_logprob,
+            top_k=top_k,
+            top_p=top_p,
+            greedy=greedy,
+            repetition_penalty=repetition_penalty,
+            end_strings=end_strings,
+            min_tokens_to_generate=min_tokens_to_generate,
+            image_list=image_list,
+        )
     special_tokens = set()
     if hasattr(tokenizer, 'pad_token') and tokenizer.pad_token is not None:
         special_tokens.add(tokenizer.pad_token)
@@ -689,6 +719,8 @@ def generate(
         output['full_logprob'] = full_logits
         output['token_ids'] = decode_tokens
         output['offsets'] = all_offsets
+        if speculative_metrics is not None:
+            output['speculative_decoding'] = speculative_metrics
         output = inference_strategy.post_generation_process(output)
         return output
 
@@ -739,6 +771,7 @@ def sample_sequence_batch(
     with torch.no_grad():
         context_length = context_lengths.min().item()
         inference_strategy.init_batch(context_tokens, context_length, compute_attention_mask)
+        inference_strategy.reset_end_of_generation_condition()
         # added eos_id to support the function generate_samples_eval that passes
         # eos_id as an argument and needs termination when that id id found.
         eod_id = tokenizer.eos_id
@@ -0,0 +1,52 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Build the image index of tar files, read by the NeVA datasets in place of walking the tar members at startup.
+
+The tar files are scanned in parallel and the offset and size of every member are recorded, so that the
+dataloader workers read images straight from memory-mapped tars.
+
+```
+python scripts/dataset_processing/multimodal/build_tar_image_index.py \
+    --tars /data/images_000.tar /data/images_001.tar \
+    --workers 64 \
+    --output /data/images_index
+```
+
+Then set `model.data.image_index=/data/images_index`, and optionally `model.data.thumbnail_cache` to a local
+directory to cache the decoded and resized images.
+"""
+import argparse
+import os
+
+from nemo.collections.multimodal.data.common.tar_image_store import build_tar_image_index
+from nemo.utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Build the image index of tar files')
+    parser.add_argument('--tars', type=str, nargs='+', required=True, help='Paths of the tar files')
+    parser.add_argument('--output', type=str, required=True, help='Directory of the index to write')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of scanning processes')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    num_images = build_tar_image_index(args.tars, args.output, num_workers=args.workers)
+    logging.info(f'Wrote index of {num_images} images in {len(args.tars)} tar files to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
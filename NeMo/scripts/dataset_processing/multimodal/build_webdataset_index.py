@@ -0,0 +1,92 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Build the shard index of a webdataset, used by the multimodal datasets in place of a pickled `wdinfo`.
+
+The tar shards are scanned in parallel and the exact number of samples, the sample keys and the byte offsets of
+every sample are recorded. With `--filter_resolution`, the resolution filter of `data.train.filterings` is
+evaluated once here, so that training knows the exact number of samples after filtering and never reads the
+samples that are filtered out. With `--record_sizes`, the image size of every sample is recorded too, which
+aspect ratio bucketing (`data.train.aspect_buckets`) needs to plan same-shape batches and resume exactly.
+Rerunning the script on an existing index only scans new or modified shards.
+
+```
+python scripts/dataset_processing/multimodal/build_webdataset_index.py \
+    --root /datasets/coyo \
+    --shards "{00000..09999}.tar" \
+    --filter_resolution 512 --filter_method larger \
+    --workers 64 \
+    --output /datasets/coyo/index.json
+```
+
+Then set `model.data.train.dataset_path=[/datasets/coyo/index.json]` and `model.data.webdataset.local_root_path`
+to the same root. The filter must match `model.data.train.filterings`.
+"""
+import argparse
+import itertools
+import os
+
+import webdataset as wds
+
+from nemo.collections.multimodal.data.common.shard_index import ShardIndex, build_shard_index
+from nemo.utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Build the shard index of a webdataset')
+    parser.add_argument('--root', type=str, default='', help='Root directory of the tar shards')
+    parser.add_argument(
+        '--shards', type=str, nargs='+', required=True, help='Shard paths relative to root, brace expansion allowed'
+    )
+    parser.add_argument('--output', type=str, required=True, help='Path of the index file to write')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of scanning processes')
+    parser.add_argument('--filter_resolution', type=int, default=None, help='Resolution filter value')
+    parser.add_argument('--filter_method', type=str, default='larger', choices=['larger', 'smaller'])
+    parser.add_argument('--image_key', type=str, default='jpg', help='Extension of the image the filter applies to')
+    parser.add_argument(
+        '--record_sizes', action='store_true', help='Record the image sizes, used by aspect ratio bucketing'
+    )
+    parser.add_argument('--no_cache', action='store_true', help='Rescan all shards even if the index exists')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    urls = list(itertools.chain.from_iterable(map(wds.shardlists.expand_urls, args.shards)))
+    filter_cfg = None
+    if args.filter_resolution is not None:
+        filter_cfg = {'resolution': {'value': args.filter_resolution, 'method': args.filter_method}}
+
+    cached_index = None
+    if os.path.exists(args.output) and not args.no_cache:
+        cached_index = ShardIndex.load(args.output)
+
+    index = build_shard_index(
+        urls,
+        root=args.root,
+        num_workers=args.workers,
+        filter_cfg=filter_cfg,
+        image_key=args.image_key,
+        cached_index=cached_index,
+        record_sizes=args.record_sizes,
+    )
+    index.save(args.output)
+    logging.info(
+        f'Wrote index of {len(index)} shards to {args.output}: '
+        f'{index.num_raw_samples} samples, {index.num_samples} after filtering'
+    )
+
+
+if __name__ == '__main__':
+    main()
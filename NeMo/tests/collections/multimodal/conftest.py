@@ -0,0 +1,66 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import threading
+from typing import Type
+
+import pytest
+
+
+class FakeS3Client:
+    """
+    Local stand-in of a boto3 S3 client serving the files of a directory as the objects of `bucket`, with support
+    for ranged GETs, failing the first `num_failures` calls. Every GET is recorded as (key, range, size).
+    """
+
+    def __init__(self, root, num_failures=0, bucket='bucket'):
+        self.root = root
+        self.num_failures = num_failures
+        self.bucket = bucket
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def _maybe_fail(self):
+        with self.lock:
+            if self.num_failures > 0:
+                self.num_failures -= 1
+                raise ConnectionError('connection reset by fake peer')
+
+    def head_object(self, Bucket, Key):
+        assert Bucket == self.bucket
+        self._maybe_fail()
+        return {'ContentLength': os.path.getsize(os.path.join(self.root, Key))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        assert Bucket == self.bucket
+        self._maybe_fail()
+        with open(os.path.join(self.root, Key), 'rb') as f:
+            data = f.read()
+        if Range is not None:
+            start, end = Range[len('bytes=') :].split('-')
+            data = data[int(start) : int(end) + 1]
+        with self.lock:
+            self.requests.append((Key, Range, len(data)))
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    @property
+    def bytes_served(self):
+        return sum(size for _, _, size in self.requests)
+
+
+@pytest.fixture(scope="session")
+def fake_s3_client() -> Type[FakeS3Client]:
+    return FakeS3Client
@@ -0,0 +1,164 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import random
+import tarfile
+from functools import partial
+
+import pytest
+from PIL import Image
+
+from nemo.collections.multimodal.data.common.aspect_buckets import (
+    AspectRatioBuckets,
+    bucket_batches,
+    generate_buckets,
+)
+from nemo.collections.multimodal.data.common.data_samplers import WDSBucketedShardSampler
+from nemo.collections.multimodal.data.common.shard_index import (
+    build_shard_index,
+    indexed_tarfile_samples,
+    shard_sample_order,
+)
+
+NUM_SHARDS = 4
+SAMPLES_PER_SHARD = 12
+MICRO_BATCH_SIZE = 2
+IMAGE_SIZES = [(32, 32), (16, 32), (32, 16), (24, 32)]
+
+
+def write_shard(path, shard_id):
+    rng = random.Random(shard_id)
+    with tarfile.open(path, 'w') as tar:
+        for i in range(SAMPLES_PER_SHARD):
+            key = f'{shard_id:03d}{i:05d}'
+            height, width = rng.choice(IMAGE_SIZES)
+            image = io.BytesIO()
+            Image.new('RGB', (width, height), color=(i, shard_id, 0)).save(image, format='PNG')
+            for ext, data in {'jpg': image.getvalue(), 'txt': f'caption {key}'.encode()}.items():
+                info = tarfile.TarInfo(f'{key}.{ext}')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture()
+def shards(tmp_path):
+    urls = [f'{i:05d}.tar' for i in range(NUM_SHARDS)]
+    for i, url in enumerate(urls):
+        write_shard(os.path.join(tmp_path, url), i)
+    index = build_shard_index(urls, root=str(tmp_path), num_workers=2, record_sizes=True)
+    return str(tmp_path), index
+
+
+def decode(samples):
+    for sample in samples:
+        sample['jpg'] = Image.open(io.BytesIO(sample['jpg'])).convert('RGB')
+        yield sample
+
+
+class TestAspectRatioBuckets:
+    @pytest.mark.unit
+    def test_generate_buckets(self):
+        buckets = generate_buckets(base_resolution=512, step=64, max_aspect_ratio=2.0)
+        assert (512, 512) in buckets
+        assert (384, 640) in buckets and (640, 384) in buckets
+        for height, width in buckets:
+            assert height % 64 == 0 and width % 64 == 0
+            assert height * width <= 512 * 512
+            assert max(height / width, width / height) <= 2.0
+        ratios = [height / width for height, width in buckets]
+        assert ratios == sorted(ratios)
+
+    @pytest.mark.unit
+    def test_assign_and_resize(self):
+        aspect_buckets = AspectRatioBuckets([(512, 512), (384, 640), (640, 384)])
+        assert aspect_buckets.buckets[aspect_buckets.assign(1000, 1010)] == (512, 512)
+        assert aspect_buckets.buckets[aspect_buckets.assign(300, 600)] == (384, 640)
+        assert aspect_buckets.buckets[aspect_buckets.assign(4000, 100)] == (640, 384)
+        image = Image.new('RGB', (700, 300))
+        resized = aspect_buckets.resize_and_crop(image, aspect_buckets.assign(300, 700))
+        assert resized.size == (640, 384)
+
+    @pytest.mark.unit
+    def test_index_records_sizes(self, shards):
+        _, index = shards
+        assert index.has_sizes
+        sizes = {tuple(size) for shard in index.shards for size in shard['sizes']}
+        assert sizes <= set(IMAGE_SIZES)
+
+    @pytest.mark.unit
+    def test_map_failures_keep_runs_in_one_bucket(self):
+        aspect_buckets = AspectRatioBuckets([(32, 32), (16, 32), (32, 16)])
+        rng = random.Random(0)
+        samples = [{'__key__': i, 'jpg': Image.new('RGB', rng.choice(IMAGE_SIZES))} for i in range(40)]
+
+        def map_fn(sample):
+            if sample['__key__'] % 7 == 3:
+                raise ValueError('corrupted sample')
+            return sample['__key__'], sample['__bucket__']
+
+        errors = []
+
+        def skip(exn):
+            errors.append(exn)
+            return True
+
+        mapped = list(bucket_batches(iter(samples), aspect_buckets, MICRO_BATCH_SIZE, map_fn=map_fn, handler=skip))
+        assert len(errors) == 6 and len(mapped) % MICRO_BATCH_SIZE == 0
+        for batch_start in range(0, len(mapped), MICRO_BATCH_SIZE):
+            batch = mapped[batch_start : batch_start + MICRO_BATCH_SIZE]
+            assert len({bucket_id for _, bucket_id in batch}) == 1
+            assert all(key % 7 != 3 for key, _ in batch)
+
+        with pytest.raises(ValueError):
+            list(bucket_batches(iter(samples), aspect_buckets, MICRO_BATCH_SIZE, map_fn=map_fn))
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('num_workers', [1, 2])
+    def test_bucketed_batches_resume_is_exact(self, shards, num_workers):
+        root, index = shards
+        aspect_buckets = AspectRatioBuckets([(32, 32), (16, 32), (32, 16)])
+
+        def stream(consumed, worker_id):
+            sampler = WDSBucketedShardSampler(
+                urls=index.urls,
+                shard_sizes=index.shard_sizes,
+                sample_buckets=index.sample_buckets(aspect_buckets.assign),
+                sample_order_fn=partial(shard_sample_order, index, seed=1),
+                consumed_samples=consumed,
+                micro_batch_size=MICRO_BATCH_SIZE,
+                data_parallel_rank=0,
+                data_parallel_size=1,
+                num_workers=num_workers,
+            )
+            sampler._get_worker_info = lambda: worker_id
+            samples = indexed_tarfile_samples(iter(sampler), index, seed=1, local_root_path=root)
+            samples = list(bucket_batches(decode(samples), aspect_buckets, MICRO_BATCH_SIZE))
+            return [(s['__key__'], s['__bucket__']) for s in samples], len(sampler)
+
+        full = {}
+        for worker_id in range(num_workers):
+            full[worker_id], epoch_len = stream(0, worker_id)
+            assert len(full[worker_id]) * num_workers == epoch_len
+            for batch_start in range(0, len(full[worker_id]), MICRO_BATCH_SIZE):
+                batch = full[worker_id][batch_start : batch_start + MICRO_BATCH_SIZE]
+                assert len({bucket_id for _, bucket_id in batch}) == 1
+
+        # workers produce micro batches in turn, resuming after 3 batches skips the first ones of every worker
+        consumed_batches = 3
+        for worker_id in range(num_workers):
+            worker_batches = consumed_batches // num_workers + int(worker_id < consumed_batches % num_workers)
+            resumed, _ = stream(consumed_batches * MICRO_BATCH_SIZE, worker_id)
+            assert resumed == full[worker_id][worker_batches * MICRO_BATCH_SIZE :]
@@ -0,0 +1,97 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nemo.collections.multimodal.parts.clip.zero_shot import ZeroShotClassifier
+
+NUM_CLASSES = 7
+NUM_TEMPLATES = 3
+SEQ_LEN = 5
+
+
+class TinyTextEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embedding = nn.EmbeddingBag(32, 8)
+        self.calls = 0
+
+    def forward(self, tokens):
+        self.calls += 1
+        return self.embedding(tokens)
+
+
+def make_texts():
+    return torch.randint(32, (NUM_CLASSES * NUM_TEMPLATES, SEQ_LEN), generator=torch.Generator().manual_seed(0))
+
+
+def reference_classifier(text_encoder, texts):
+    weights = []
+    for class_texts in texts.split(NUM_TEMPLATES):
+        class_embedding = F.normalize(text_encoder(class_texts), dim=-1).mean(dim=0)
+        weights.append(class_embedding / class_embedding.norm())
+    return torch.stack(weights, dim=1)
+
+
+def run_rank(rank, world_size, init_file, result_file):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    text_encoder = TinyTextEncoder()
+    classifier = ZeroShotClassifier(make_texts(), NUM_TEMPLATES, batch_size=4)
+    weights = classifier(text_encoder)
+    if rank == 0:
+        torch.save(weights, result_file)
+    dist.destroy_process_group()
+
+
+class TestZeroShotClassifier:
+    @pytest.mark.unit
+    def test_matches_reference_and_caches(self):
+        text_encoder = TinyTextEncoder()
+        texts = make_texts()
+        classifier = ZeroShotClassifier(list(texts), NUM_TEMPLATES, batch_size=4)
+        with torch.no_grad():
+            expected = reference_classifier(text_encoder, texts)
+        weights = classifier(text_encoder)
+        assert weights.shape == (8, NUM_CLASSES)
+        torch.testing.assert_close(weights, expected)
+
+        calls = text_encoder.calls
+        assert classifier(text_encoder) is weights
+        assert text_encoder.calls == calls
+
+        # an optimizer step changes the weights in place and invalidates the cache
+        with torch.no_grad():
+            text_encoder.embedding.weight.add_(0.1)
+        updated = classifier(text_encoder)
+        assert text_encoder.calls > calls
+        with torch.no_grad():
+            torch.testing.assert_close(updated, reference_classifier(text_encoder, texts))
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('world_size', [2, 3])
+    def test_sharded_across_ranks(self, tmp_path, world_size):
+        init_file = os.path.join(tmp_path, 'init')
+        result_file = os.path.join(tmp_path, 'weights.pt')
+        mp.spawn(run_rank, args=(world_size, init_file, result_file), nprocs=world_size)
+        with torch.no_grad():
+            expected = reference_classifier(TinyTextEncoder(), make_texts())
+        torch.testing.assert_close(torch.load(result_file), expected)
@@ -0,0 +1,117 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+import torch.nn as nn
+
+from nemo.collections.multimodal.data.nerf.random_poses import RandomPosesDataset
+from nemo.collections.multimodal.modules.nerf.background.static_background import StaticBackground
+from nemo.collections.multimodal.modules.nerf.materials.basic_shading import BasicShading
+from nemo.collections.multimodal.modules.nerf.renderers.batched_volume_renderer import BatchedVolumeRenderer
+
+BOUND = 1.0
+
+
+class SphereNeRF(nn.Module):
+    """Dense red sphere of radius 0.5 in empty space."""
+
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(torch.tensor(20.0))
+
+    def forward_density(self, positions):
+        return self.scale * (positions.norm(dim=-1) < 0.5).float()
+
+    def forward(self, positions, return_normal=True):
+        albedo = torch.tensor([1.0, 0.0, 0.0]).expand(positions.shape[0], -1)
+        normals = nn.functional.normalize(positions) if return_normal else None
+        return self.forward_density(positions), albedo, normals
+
+
+def make_renderer(**kwargs):
+    renderer = BatchedVolumeRenderer(bound=BOUND, update_interval=4, grid_resolution=16, num_samples=64, **kwargs)
+    renderer.nerf = SphereNeRF()
+    renderer.material = BasicShading()
+    renderer.background = StaticBackground((0.0, 0.0, 1.0))
+    return renderer
+
+
+def make_views(num_views, size=16):
+    torch.manual_seed(0)
+    dataset = RandomPosesDataset(
+        internal_batch_size=num_views,
+        height=size,
+        width=size,
+        radius_range=[2.5, 2.5],
+        fovx_range=[40, 40],
+        fovy_range=[40, 40],
+    )
+    rays_o, rays_d, _, _, _ = dataset.generate_samples()
+    return rays_o, rays_d
+
+
+class TestBatchedVolumeRenderer:
+    @pytest.mark.unit
+    def test_renders_views_in_one_call(self):
+        renderer = make_renderer(max_ray_batch=100)
+        rays_o, rays_d = make_views(3)
+        outputs = renderer(rays_o=rays_o, rays_d=rays_d)
+        assert outputs['image'].shape == (3, 16, 16, 3)
+        assert outputs['opacity'].shape == (3, 16, 16, 1)
+        # the sphere is red, in the middle of every view, on a blue background
+        center, corner = outputs['image'][:, 8, 8], outputs['image'][:, 0, 0]
+        assert torch.all(center[:, 0] > 0.9) and torch.all(center[:, 2] < 0.1)
+        assert torch.allclose(corner, torch.tensor([0.0, 0.0, 1.0]).expand(3, -1), atol=1e-3)
+        assert outputs['weights'].shape[0] == outputs['dirs'].shape[0]
+
+        stats = renderer.render_stats
+        assert stats['rays'] == 3 * 16 * 16 and stats['samples'] == stats['rays'] * 64
+        assert stats['rays_per_sec'] > 0
+
+        outputs['image'].sum().backward()
+        assert renderer.nerf.scale.grad is not None
+
+    @pytest.mark.unit
+    def test_occupancy_grid_skips_empty_space(self):
+        rays_o, rays_d = make_views(2)
+        renderer = make_renderer()
+        with torch.no_grad():
+            dense = renderer(rays_o=rays_o, rays_d=rays_d)
+        dense_samples = renderer.render_stats['evaluated_samples']
+
+        # updates only happen every update_interval steps
+        renderer.update_step(epoch=0, global_step=1)
+        assert renderer.occupancy_grid.num_updates == 0
+        renderer.update_step(epoch=0, global_step=4)
+        assert renderer.occupancy_grid.num_updates == 1
+        assert renderer.occupancy_grid.occupied.float().mean() < 0.2
+
+        with torch.no_grad():
+            sparse = renderer(rays_o=rays_o, rays_d=rays_d)
+        assert renderer.render_stats['evaluated_samples'] < dense_samples / 4
+        assert (sparse['image'] - dense['image']).abs().mean() < 0.02
+
+    @pytest.mark.unit
+    def test_incremental_update(self):
+        renderer = make_renderer(update_fraction=0.1)
+        grid = renderer.occupancy_grid
+        renderer.update_step(epoch=0, global_step=0)
+        # the first update evaluates all the cells
+        assert bool((grid.density >= 0).all())
+        before = grid.density.clone()
+        renderer.nerf.scale.data.fill_(40.0)
+        renderer.update_step(epoch=0, global_step=4)
+        changed = (grid.density != before).float().mean()
+        assert 0 < changed <= 0.1
@@ -0,0 +1,100 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pickle
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.multimodal.data.neva.neva_feature_store import (
+    VisionFeatureShardWriter,
+    VisionFeatureStore,
+    VisionFeatureStoreWriter,
+    merge_vision_feature_shards,
+    vision_config_hash,
+)
+
+IMAGE_NAMES = ['b.jpg', 'a.jpg', 'dir/c.jpg', 'a.jpg']
+
+
+def make_model_cfg(**vision_overrides):
+    vision_cfg = dict(from_pretrained='openai/clip-vit-large-patch14', from_hf=True, vision_select_layer=-2)
+    vision_cfg.update(vision_overrides)
+    return OmegaConf.create(dict(mm_cfg=dict(vision_encoder=vision_cfg), data=dict(image_aspect_ratio='square')))
+
+
+class TestVisionFeatureStore:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('dtype', ['bfloat16', 'float16', 'float32'])
+    def test_roundtrip(self, tmp_path, dtype):
+        store_dir = os.path.join(tmp_path, 'features')
+        features = {name: torch.randn(4, 3) for name in set(IMAGE_NAMES)}
+        # several writers each write a part of the features to their own shard, the first shard has no images
+        shards = [[], ['b.jpg'], ['dir/c.jpg', 'a.jpg']]
+        for i, names in enumerate(shards):
+            writer = VisionFeatureShardWriter(store_dir, str(i), names, dtype=dtype)
+            for name in names:
+                writer.add([name], features[name][None])
+            writer.close()
+        merge_vision_feature_shards(store_dir, IMAGE_NAMES, dtype=dtype)
+        assert sorted(os.listdir(store_dir)) == ['features.npy', 'index.json', 'names.npy', 'written.npy']
+
+        store = pickle.loads(pickle.dumps(VisionFeatureStore(store_dir)))
+        assert len(store) == 3
+        for name, expected in features.items():
+            loaded = store.get(name)
+            assert loaded.dtype == getattr(torch, dtype)
+            assert torch.equal(loaded, expected.to(loaded.dtype))
+        with pytest.raises(KeyError):
+            store.get('missing.jpg')
+
+        padded = store.pad(torch.stack([store.get('a.jpg')]), 3)
+        assert padded.shape == (3, 4, 3) and not padded[1:].any()
+        assert store.pad(torch.tensor([]), 2).shape == (2, 4, 3)
+
+    @pytest.mark.unit
+    def test_incomplete_store(self, tmp_path):
+        store_dir = os.path.join(tmp_path, 'features')
+        writer = VisionFeatureStoreWriter(store_dir, IMAGE_NAMES, num_patches=4, hidden_size=3)
+        writer.add(['a.jpg'], torch.randn(1, 4, 3))
+        with pytest.raises(ValueError):
+            writer.finalize()
+        with pytest.raises(ValueError):
+            VisionFeatureStore(store_dir)
+        with pytest.raises(FileNotFoundError):
+            VisionFeatureStore(os.path.join(tmp_path, 'missing'))
+
+    @pytest.mark.unit
+    def test_incomplete_shards(self, tmp_path):
+        store_dir = os.path.join(tmp_path, 'features')
+        writer = VisionFeatureShardWriter(store_dir, '0', [])
+        writer.close()
+        with pytest.raises(ValueError):
+            merge_vision_feature_shards(store_dir, IMAGE_NAMES)
+
+        # the features of dir/c.jpg are never added
+        writer = VisionFeatureShardWriter(store_dir, '1', IMAGE_NAMES)
+        writer.add(['a.jpg', 'b.jpg'], torch.randn(2, 4, 3))
+        writer.close()
+        with pytest.raises(ValueError):
+            merge_vision_feature_shards(store_dir, IMAGE_NAMES)
+        with pytest.raises(ValueError):
+            VisionFeatureStore(store_dir)
+
+    @pytest.mark.unit
+    def test_config_hash(self):
+        assert vision_config_hash(make_model_cfg()) == vision_config_hash(make_model_cfg())
+        assert vision_config_hash(make_model_cfg()) != vision_config_hash(make_model_cfg(vision_select_layer=-1))
@@ -0,0 +1,140 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from nemo.collections.multimodal.data.neva.neva_dataset import (
+    IGNORE_INDEX,
+    DataCollatorForSupervisedDataset,
+    get_packed_masks_and_position_ids,
+)
+from nemo.collections.multimodal.data.neva.neva_memmap_dataset import (
+    NevaMemmapWriter,
+    NevaPackedDataset,
+    pack_conversations,
+)
+from nemo.collections.multimodal.models.neva import neva_model
+from nemo.collections.multimodal.models.neva.neva_model import MegatronNevaModel
+
+MULTIMODAL_CFG = dict(
+    is_multimodal=False,
+    conv_template='nvgpt',
+    use_im_start_end=False,
+    add_extra_token=1,
+    image_processor=None,
+    image_aspect_ratio='square',
+)
+
+
+@pytest.fixture()
+def conversations(tmp_path):
+    rng = np.random.RandomState(0)
+    prefix = os.path.join(tmp_path, 'conversations')
+    multimodal_cfg = dict(MULTIMODAL_CFG, image_folder=str(tmp_path))
+    writer = NevaMemmapWriter(prefix)
+    data = []
+    for i in range(20):
+        length = rng.randint(3, 30)
+        tokens = rng.randint(1, 1000, size=length)
+        labels = np.where(rng.rand(length) < 0.5, IGNORE_INDEX, tokens)
+        images = [f'image_{i}_{j}.jpg' for j in range(i % 3)]
+        writer.add(tokens, labels, images)
+        data.append((tokens, labels, images))
+    writer.finalize({key: multimodal_cfg[key] for key in ['conv_template', 'use_im_start_end', 'add_extra_token']})
+    return prefix, multimodal_cfg, data
+
+
+class TestNevaMemmapDataset:
+    @pytest.mark.unit
+    def test_pack_conversations(self):
+        rng = np.random.RandomState(0)
+        lengths = rng.randint(1, 64, size=500)
+        num_images = rng.randint(0, 3, size=500)
+        offsets, members = pack_conversations(lengths, num_images, pack_length=128, max_num_images=4)
+        assert sorted(members.tolist()) == list(range(500))
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            pack = members[start:end]
+            assert lengths[pack].sum() <= 128 and num_images[pack].sum() <= 4
+            assert pack.tolist() == sorted(pack.tolist())
+        # without images, packing is dense
+        offsets, _ = pack_conversations(lengths, np.zeros_like(num_images), pack_length=128)
+        assert len(offsets) - 1 <= np.ceil(lengths.sum() / 128) * 1.05
+
+    @pytest.mark.unit
+    def test_roundtrip(self, conversations):
+        prefix, multimodal_cfg, data = conversations
+        dataset = NevaPackedDataset(prefix, multimodal_cfg)
+        assert len(dataset) == len(data)
+        for i, (tokens, labels, images) in enumerate(data):
+            sample = dataset[i]
+            assert sample['tokens'].tolist() == tokens.tolist()
+            assert sample['labels'].tolist() == labels.tolist()
+            assert sample['seq_lengths'].tolist() == [len(tokens)]
+            assert dataset.image_names(i) == images
+
+    @pytest.mark.unit
+    def test_packed_samples(self, conversations):
+        prefix, multimodal_cfg, data = conversations
+        dataset = NevaPackedDataset(prefix, multimodal_cfg, pack_length=64, max_num_images=4)
+        assert len(dataset) < len(data)
+        seen = 0
+        for i in range(len(dataset)):
+            sample = dataset[i]
+            assert len(sample['tokens']) == sample['seq_lengths'].sum() <= 64
+            seen += len(sample['seq_lengths'])
+        assert seen == len(data)
+
+        with pytest.raises(ValueError):
+            NevaPackedDataset(prefix, dict(multimodal_cfg, conv_template='llama_2'))
+
+    @pytest.mark.unit
+    def test_packed_masks(self):
+        attention_mask, position_ids = get_packed_masks_and_position_ids([torch.tensor([2, 3])], 6)
+        assert position_ids.tolist() == [[0, 1, 0, 1, 2, 0]]
+        allowed = ~attention_mask[0, 0]
+        expected = torch.zeros(6, 6, dtype=torch.bool)
+        expected[:2, :2] = torch.tril(torch.ones(2, 2, dtype=torch.bool))
+        expected[2:5, 2:5] = torch.tril(torch.ones(3, 3, dtype=torch.bool))
+        expected[5, 5] = True
+        assert torch.equal(allowed, expected)
+
+    @pytest.mark.unit
+    def test_packed_batch_in_forward_step(self, conversations, monkeypatch):
+        prefix, multimodal_cfg, _ = conversations
+        dataset = NevaPackedDataset(prefix, multimodal_cfg, pack_length=64, max_num_images=4)
+        instances = [dict(dataset[i], image=torch.zeros(1, 3, 2, 2)) for i in range(2)]
+        seq_lengths = [instance['seq_lengths'].tolist() for instance in instances]
+        assert len(seq_lengths[0]) > 1
+        model_cfg = OmegaConf.create({'data': {'data_prefix': prefix, 'packing': True}})
+        batch = DataCollatorForSupervisedDataset(model_cfg, SimpleNamespace(eos_id=0))(instances)
+        packed_mask = batch['attention_mask'].clone()
+
+        # with the default config, the fused causal softmax would drop the mask of the packed conversations
+        model = SimpleNamespace(cfg=model_cfg, get_attention_mask_from_fusion=True)
+        MegatronNevaModel._check_packing_attention_mask(model)
+        assert not model.get_attention_mask_from_fusion
+
+        monkeypatch.setattr(neva_model.parallel_state, 'get_pipeline_model_parallel_world_size', lambda: 1)
+        batch = MegatronNevaModel._get_step_batch(model, batch, device='cpu')
+        assert torch.equal(batch['attention_mask'], packed_mask)
+        # the second conversation of a sample does not attend to the first one, and restarts its positions
+        first = seq_lengths[0][0]
+        assert batch['attention_mask'][0, 0, first, :first].all() and not batch['attention_mask'][0, 0, first, first]
+        assert batch['position_ids'][0, first] == 0
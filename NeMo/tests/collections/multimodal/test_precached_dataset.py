@@ -0,0 +1,115 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from nemo.collections.multimodal.data.stable_diffusion.precached_dataset import (
+    PrecachedMemmapDataset,
+    PrecachedShardWriter,
+    merge_precached_indices,
+)
+
+FIELD_TO_KEY = {'latents': 'images_moments', 'id': 'id'}
+
+
+def latents(ids):
+    return np.stack([np.full((2, 3), i, dtype=np.float16) for i in ids])
+
+
+@pytest.fixture()
+def precached(tmp_path):
+    """17 samples written by two writers, with shards of 4 samples, the sample ids are their global order."""
+    root = str(tmp_path)
+    first = PrecachedShardWriter(root, 'r0', samples_per_shard=4)
+    for ids in [range(0, 3), range(3, 10)]:
+        first.write({'latents': torch.from_numpy(latents(ids)), 'id': np.array(ids)})
+    first.close()
+    second = PrecachedShardWriter(root, 'r1', samples_per_shard=4)
+    second.write({'latents': latents(range(10, 17)), 'id': np.arange(10, 17)})
+    second.close()
+    merge_precached_indices(root)
+    return root
+
+
+def make_dataset(root, **kwargs):
+    kwargs = dict(dict(micro_batch_size=2, data_parallel_rank=0, data_parallel_size=1), **kwargs)
+    return PrecachedMemmapDataset(root, FIELD_TO_KEY, **kwargs)
+
+
+def sample_ids(samples):
+    return [int(sample['id']) for sample in samples]
+
+
+class TestPrecachedDataset:
+    @pytest.mark.unit
+    def test_roundtrip(self, precached):
+        index = merge_precached_indices(precached)
+        assert index['total_samples'] == 17
+        assert [shard['num_samples'] for shard in index['shards']] == [4, 4, 2, 4, 3]
+        assert index['fields']['latents'] == {'shape': [2, 3], 'dtype': 'float16'}
+        # the last shard of a writer is truncated to the samples written
+        assert np.load(os.path.join(precached, 'r0-000002.latents.npy')).shape == (2, 2, 3)
+
+        dataset = make_dataset(precached, shuffle=False, drop_last=False)
+        assert len(dataset) == 17
+        for i in range(17):
+            sample = dataset[i]
+            assert int(sample['id']) == i
+            assert torch.equal(sample['images_moments'], torch.from_numpy(latents([i])[0]))
+        assert sample_ids(dataset) == list(range(17))
+
+    @pytest.mark.unit
+    def test_writer_checks_fields(self, tmp_path):
+        writer = PrecachedShardWriter(str(tmp_path), 'r0', samples_per_shard=4)
+        writer.write({'latents': latents([0, 1]), 'id': np.arange(2)})
+        with pytest.raises(ValueError):
+            writer.write({'latents': latents([2])})
+        with pytest.raises(ValueError):
+            writer.write({'latents': np.zeros((1, 3, 2), dtype=np.float16), 'id': np.arange(1)})
+
+    @pytest.mark.unit
+    def test_resume_from_consumed_samples(self, precached):
+        for rank in range(2):
+            dataset = make_dataset(precached, data_parallel_rank=rank, data_parallel_size=2)
+            # 17 samples, 8 per rank in micro batches of 2
+            assert len(dataset) == 8
+            epochs = [sample_ids(dataset), sample_ids(dataset)]
+            assert len(set(epochs[0])) == 8 and epochs[0] != epochs[1]
+
+            # one step consumes a micro batch on each rank, the resumed dataset continues where it stopped
+            resumed = make_dataset(precached, data_parallel_rank=rank, data_parallel_size=2, consumed_samples=4)
+            assert sample_ids(resumed) == epochs[0][2:]
+            resumed = make_dataset(precached, data_parallel_rank=rank, data_parallel_size=2, consumed_samples=20)
+            assert sample_ids(resumed) == epochs[1][2:]
+
+        ranks = [sample_ids(make_dataset(precached, data_parallel_rank=rank, data_parallel_size=2)) for rank in [0, 1]]
+        assert not set(ranks[0]) & set(ranks[1])
+
+    @pytest.mark.unit
+    def test_order_does_not_depend_on_workers(self, precached):
+        expected = sample_ids(make_dataset(precached, consumed_samples=6))
+        for num_workers in [1, 2, 3]:
+            loader = torch.utils.data.DataLoader(
+                make_dataset(precached, consumed_samples=6), batch_size=2, num_workers=num_workers
+            )
+            assert [int(i) for batch in loader for i in batch['id']] == expected
+
+    @pytest.mark.unit
+    def test_too_few_samples(self, precached):
+        with pytest.raises(ValueError):
+            make_dataset(precached, micro_batch_size=4, data_parallel_size=8)
@@ -0,0 +1,119 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tarfile
+
+import pytest
+
+from nemo.collections.multimodal.data.common.s3_shard_reader import S3ShardReader
+from nemo.collections.multimodal.data.common.webdataset_s3 import tarfile_samples
+
+BUCKET = 'bucket'
+SHARD_SIZE = 10 * 1024
+
+
+@pytest.fixture()
+def bucket_dir(tmp_path):
+    root = os.path.join(tmp_path, 'bucket')
+    os.makedirs(root)
+    for i in range(3):
+        with tarfile.open(os.path.join(root, f'{i:05d}.tar'), 'w') as tar:
+            for j in range(4):
+                data = os.urandom(SHARD_SIZE // 8)
+                info = tarfile.TarInfo(f'{i:03d}{j:05d}.jpg')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return root
+
+
+def make_reader(client, tmp_path, **kwargs):
+    kwargs = {'part_size_mb': 1 / 1024, 'backoff_base': 0.0, 'log_interval': 0, **kwargs}
+    return S3ShardReader(lambda: client, BUCKET, cache_dir=os.path.join(tmp_path, 'cache'), **kwargs)
+
+
+def read_file(root, key):
+    with open(os.path.join(root, key), 'rb') as f:
+        return f.read()
+
+
+class TestS3ShardReader:
+    @pytest.mark.unit
+    def test_open_fetches_with_ranged_requests(self, bucket_dir, tmp_path, fake_s3_client):
+        client = fake_s3_client(bucket_dir)
+        reader = make_reader(client, tmp_path)
+        with reader.open('00000.tar') as f:
+            assert f.read() == read_file(bucket_dir, '00000.tar')
+        size = os.path.getsize(os.path.join(bucket_dir, '00000.tar'))
+        assert len(client.requests) == -(-size // 1024)
+        assert all(request_range is not None for _, request_range, _ in client.requests)
+        metrics = reader.metrics()
+        assert metrics['shards'] == 1 and metrics['bytes'] == size
+        assert metrics['throughput_MBps'] > 0
+        reader.close()
+
+    @pytest.mark.unit
+    def test_prefetched_shard_is_a_cache_hit(self, bucket_dir, tmp_path, fake_s3_client):
+        reader = make_reader(fake_s3_client(bucket_dir), tmp_path)
+        reader.prefetch(['00001.tar', '00002.tar'])
+        with reader.open('00001.tar') as f:
+            assert f.read() == read_file(bucket_dir, '00001.tar')
+        with reader.open('00001.tar') as f:
+            f.read()
+        with reader.open('00002.tar') as f:
+            assert f.read() == read_file(bucket_dir, '00002.tar')
+        metrics = reader.metrics()
+        assert metrics['shards'] == 2
+        assert metrics['cache_hits'] >= 1
+        reader.close()
+
+    @pytest.mark.unit
+    def test_retries_with_backoff(self, bucket_dir, tmp_path, fake_s3_client):
+        reader = make_reader(fake_s3_client(bucket_dir, num_failures=3), tmp_path, max_attempts=5)
+        with reader.open('00000.tar') as f:
+            assert f.read() == read_file(bucket_dir, '00000.tar')
+        reader.close()
+
+        reader = make_reader(fake_s3_client(bucket_dir, num_failures=100), tmp_path, max_attempts=2)
+        with pytest.raises(ConnectionError):
+            reader.open('00000.tar')
+        reader.close()
+
+    @pytest.mark.unit
+    def test_lru_eviction_keeps_open_shards(self, bucket_dir, tmp_path, fake_s3_client):
+        size = os.path.getsize(os.path.join(bucket_dir, '00000.tar'))
+        reader = make_reader(fake_s3_client(bucket_dir), tmp_path, cache_size_mb=2.5 * size / 1024 ** 2)
+        opened = reader.open('00000.tar')
+        for key in ['00001.tar', '00002.tar']:
+            with reader.open(key) as f:
+                f.read()
+        # 00000 is open, so the least recently used closed shard is evicted instead
+        assert set(reader._entries) == {'00000.tar', '00002.tar'}
+        assert opened.read() == read_file(bucket_dir, '00000.tar')
+        opened.close()
+        reader.close()
+
+    @pytest.mark.unit
+    def test_tarfile_samples_match_direct_reads(self, bucket_dir, tmp_path, fake_s3_client):
+        urls = [dict(url=f'{i:05d}.tar') for i in range(3)]
+        kwargs = dict(load_from_object_store=True, s3_bucket_name=BUCKET)
+        direct = list(tarfile_samples(iter(urls), s3_client=fake_s3_client(bucket_dir), **kwargs))
+        client = fake_s3_client(bucket_dir)
+        reader = make_reader(client, tmp_path, prefetch_shards=2)
+        pooled = list(tarfile_samples(iter(urls), s3_client=client, s3_reader=reader, **kwargs))
+        assert [s['__key__'] for s in pooled] == [s['__key__'] for s in direct]
+        assert all(a['jpg'] == b['jpg'] for a, b in zip(pooled, direct))
+        assert reader.metrics()['shards'] == 3
+        reader.close()
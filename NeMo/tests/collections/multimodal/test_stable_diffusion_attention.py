@@ -0,0 +1,89 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from nemo.collections.multimodal.modules.stable_diffusion.attention import (
+    HAVE_SDPA,
+    CrossAttention,
+    chunked_attention,
+)
+
+QUERY_DIM = 32
+CONTEXT_DIM = 24
+
+
+def make_attention(backend, context_dim=None, **kwargs):
+    torch.manual_seed(0)
+    return CrossAttention(QUERY_DIM, context_dim=context_dim, heads=4, dim_head=8, attention_backend=backend, **kwargs)
+
+
+def get_inputs(batch_size=2, seq_len=37, context_len=11):
+    torch.manual_seed(1)
+    x = torch.randn(batch_size, seq_len, QUERY_DIM)
+    context = torch.randn(batch_size, context_len, CONTEXT_DIM)
+    mask = torch.rand(batch_size, context_len) > 0.3
+    mask[:, 0] = True
+    return x, context, mask
+
+
+class TestCrossAttentionBackends:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('backend', ['chunked', 'sdpa'])
+    @pytest.mark.parametrize('cross', [False, True])
+    @pytest.mark.parametrize('masked', [False, True])
+    def test_backend_matches_math(self, backend, cross, masked):
+        if backend == 'sdpa' and not HAVE_SDPA:
+            pytest.skip('scaled_dot_product_attention is not available')
+        x, context, mask = get_inputs()
+        context_dim = CONTEXT_DIM if cross else None
+        context = context if cross else None
+        if masked and not cross:
+            mask = torch.rand(x.shape[:2]) > 0.3
+            mask[:, 0] = True
+        mask = mask if masked else None
+        # small chunks so that the online softmax runs over several query and key chunks
+        attention = make_attention(backend, context_dim, query_chunk_size=8, key_chunk_size=4).eval()
+        reference = make_attention('math', context_dim).eval()
+        assert attention.select_backend(x, x, mask) == backend
+        with torch.no_grad():
+            expected = reference(x, context=context, mask=mask)
+            actual = attention(x, context=context, mask=mask)
+        torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_chunked_attention_gradients_match(self):
+        torch.manual_seed(0)
+        q, k, v = (torch.randn(3, 20, 8, dtype=torch.float64, requires_grad=True) for _ in range(3))
+        scale = 8 ** -0.5
+        expected = torch.softmax(q @ k.transpose(1, 2) * scale, dim=-1) @ v
+        actual = chunked_attention(q, k, v, scale, query_chunk_size=7, key_chunk_size=6)
+        torch.testing.assert_close(actual, expected)
+        grads = torch.autograd.grad(actual.sum(), (q, k, v))
+        expected_grads = torch.autograd.grad(expected.sum(), (q, k, v))
+        for grad, expected_grad in zip(grads, expected_grads):
+            torch.testing.assert_close(grad, expected_grad)
+
+    @pytest.mark.unit
+    def test_auto_selection(self):
+        x, _, mask = get_inputs(seq_len=16)
+        attention = make_attention('auto', query_chunk_size=8, key_chunk_size=8)
+        # flash needs fp16/bf16 on CUDA without a mask, so it is never selected on CPU
+        expected = 'sdpa' if HAVE_SDPA else 'chunked'
+        assert attention.select_backend(x, x) == expected
+        assert attention.select_backend(x[:, :4], x[:, :4]) == ('sdpa' if HAVE_SDPA else 'math')
+        # an invalid explicit backend falls back to auto
+        attention.attention_backend = 'flash'
+        assert attention.select_backend(x, x, mask) == expected
@@ -0,0 +1,177 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from nemo.collections.multimodal.parts.stable_diffusion.pipeline import AsyncOutputStage, decode_images
+
+
+class SlowDecoder:
+    """Stand-in of the LatentDiffusion model, decoding the latents as they are after `delay` seconds."""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+
+    def decode_first_stage(self, samples):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('decoding failed')
+        return samples
+
+
+def latents(prompt_ids, num_images_per_prompt=2):
+    # the images of prompt i decode to i / 100
+    return torch.cat([torch.full((num_images_per_prompt, 3, 4, 4), 2 * i / 100 - 1) for i in prompt_ids])
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+class DelayedOutputStage(AsyncOutputStage):
+    """Converts the prompt `p<i>` once `delays[i]` seconds have passed or `events[i]` is set."""
+
+    def __init__(self, *args, delays=None, events=None, **kwargs):
+        self.delays = delays or {}
+        self.events = events or {}
+        super().__init__(*args, **kwargs)
+
+    def _convert_and_save(self, prompt, images):
+        i = int(prompt[1:])
+        time.sleep(self.delays.get(i, 0.0))
+        if i in self.events:
+            self.events[i].wait()
+        return super()._convert_and_save(prompt, images)
+
+
+class TestAsyncOutputStage:
+    @pytest.mark.unit
+    def test_outputs_in_prompt_order(self):
+        # the first prompts are converted last
+        stage = DelayedOutputStage(
+            SlowDecoder(), 2, output_type='torch', num_workers=3, delays={i: 0.02 * (8 - i) for i in range(8)}
+        )
+        for batch in range(4):
+            stage.put([f'p{2 * batch}', f'p{2 * batch + 1}'], latents([2 * batch, 2 * batch + 1]))
+        output, decode_times = stage.close()
+        assert len(output) == 8 and len(decode_times) == 4
+        for i, images in enumerate(output):
+            torch.testing.assert_close(images, torch.full((2, 3, 4, 4), i / 100))
+
+    @pytest.mark.unit
+    def test_saves_images(self, tmp_path):
+        stage = AsyncOutputStage(SlowDecoder(), 2, output_type='pil', out_path=str(tmp_path), keep_outputs=False)
+        stage.put(['p0', 'p1'], latents([0, 1]))
+        output, _ = stage.close()
+        assert output == [None, None]
+        assert sorted(os.listdir(tmp_path)) == ['p0_0.png', 'p0_1.png', 'p1_0.png', 'p1_1.png']
+
+        stage = AsyncOutputStage(SlowDecoder(), 2, output_type='numpy')
+        stage.put(['p0'], latents([3]))
+        output, _ = stage.close()
+        assert output[0].shape == (2, 4, 4, 3)
+
+    @pytest.mark.unit
+    def test_bounded_queues(self):
+        release = threading.Event()
+        stage = DelayedOutputStage(
+            SlowDecoder(), 1, output_type='torch', num_workers=1, max_queue_size=2, events={0: release}
+        )
+        producer = threading.Thread(target=lambda: [stage.put([f'p{i}'], latents([i], 1)) for i in range(8)])
+        producer.start()
+        # one prompt is converted and two wait for the worker, the decode thread holds the next micro batch and two
+        # more wait in the queue, so the producer blocks
+        wait_for(lambda: len(stage.futures) == 3 and stage.queue.full())
+        time.sleep(0.1)
+        assert len(stage.futures) == 3 and producer.is_alive()
+
+        release.set()
+        producer.join()
+        output, decode_times = stage.close()
+        assert len(output) == 8 and len(decode_times) == 8
+
+    @pytest.mark.unit
+    def test_slots_are_released_per_prompt(self):
+        release = threading.Event()
+        stage = DelayedOutputStage(
+            SlowDecoder(), 1, output_type='torch', num_workers=2, max_queue_size=1, events={0: release}
+        )
+        stage.put(['p0', 'p1', 'p2'], latents([0, 1, 2], 1))
+        stage.put(['p3'], latents([3], 1))
+        # the prompts converted after p0 free their slots while p0 is still converted
+        wait_for(lambda: len(stage.futures) == 4 and stage.futures[3].done())
+        assert not stage.futures[0].done()
+        release.set()
+        output, _ = stage.close()
+        assert len(output) == 4
+
+    @pytest.mark.unit
+    def test_abort(self):
+        stage = AsyncOutputStage(SlowDecoder(delay=0.05), 1, output_type='torch', max_queue_size=4)
+        for i in range(4):
+            stage.put([f'p{i}'], latents([i], 1))
+        stage.abort()
+        # the micro batches that are not decoded yet are skipped, and the threads are stopped
+        assert len(stage.decode_times) < 4
+        assert not stage.thread.is_alive()
+        with pytest.raises(RuntimeError):
+            stage.executor.submit(time.sleep, 0)
+
+        stage = AsyncOutputStage(SlowDecoder(), 1, output_type='torch')
+        stage.put(['p0'], latents([0], 1))
+        output, _ = stage.close()
+        stage.abort()
+        assert len(output) == 1
+
+    @pytest.mark.unit
+    def test_decode_error(self):
+        stage = AsyncOutputStage(SlowDecoder(fail=True), 1, output_type='torch')
+        stage.put(['p0'], latents([0], 1))
+        wait_for(lambda: stage.error is not None)
+        with pytest.raises(RuntimeError):
+            stage.put(['p1'], latents([1], 1))
+        with pytest.raises(RuntimeError):
+            stage.close()
+        assert not stage.thread.is_alive()
+
+    @pytest.mark.unit
+    def test_overlaps_sampling(self):
+        num_batches, sampling_time, model = 6, 0.05, SlowDecoder(delay=0.05)
+
+        tic = time.perf_counter()
+        for i in range(num_batches):
+            time.sleep(sampling_time)
+            decode_images(model, latents([i]))
+        sequential_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        stage = AsyncOutputStage(model, 2, output_type='torch')
+        for i in range(num_batches):
+            time.sleep(sampling_time)
+            stage.put([f'p{i}'], latents([i]))
+        output, _ = stage.close()
+        async_time = time.perf_counter() - tic
+
+        # decoding overlaps with the sampling of the next micro batch
+        assert len(output) == num_batches
+        assert async_time < 0.8 * sequential_time
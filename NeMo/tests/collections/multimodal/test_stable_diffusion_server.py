@@ -0,0 +1,120 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.client
+import json
+
+import pytest
+import torch
+import torch.nn as nn
+
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.openaimodel import UNetModel
+from nemo.collections.multimodal.parts.stable_diffusion.server import (
+    GenerationRequest,
+    StableDiffusionServer,
+    run_http_server,
+)
+from nemo.collections.multimodal.parts.stable_diffusion.tiny_diffusion import TinyLatentDiffusion
+
+CONTEXT_DIM = 16
+
+
+class TinyTextEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(64, CONTEXT_DIM)
+
+    def encode(self, texts):
+        ids = torch.tensor([[ord(char) % 64 for char in text[:8].ljust(8)] for text in texts])
+        return self.embedding(ids)
+
+
+def tiny_latent_diffusion():
+    torch.manual_seed(0)
+    unet = UNetModel(
+        image_size=8,
+        in_channels=4,
+        model_channels=32,
+        out_channels=4,
+        num_res_blocks=1,
+        attention_resolutions=[2],
+        channel_mult=(1, 2),
+        num_heads=2,
+        use_spatial_transformer=True,
+        context_dim=CONTEXT_DIM,
+    )
+    return TinyLatentDiffusion(unet, cond_stage_model=TinyTextEncoder())
+
+
+@pytest.fixture()
+def server():
+    server = StableDiffusionServer(tiny_latent_diffusion().eval(), max_batch_size=4, batch_window_ms=200)
+    server.start(warmup_requests=[GenerationRequest('warmup', inference_steps=2, height=64, width=64)])
+    yield server
+    server.stop()
+
+
+def make_request(prompt, seed=0, **kwargs):
+    kwargs = {'inference_steps': 2, 'height': 64, 'width': 64, **kwargs}
+    return GenerationRequest(prompt, seed=seed, **kwargs)
+
+
+class TestStableDiffusionServer:
+    @pytest.mark.unit
+    def test_compatible_requests_are_batched(self, server):
+        futures = [server.submit(make_request(f'prompt {i}', seed=i)) for i in range(3)]
+        futures.append(server.submit(make_request('large', height=128, width=64)))
+        results = [future.result(timeout=60) for future in futures]
+
+        for result in results[:3]:
+            assert result.images.shape == (1, 3, 64, 64)
+            assert result.metrics['batch-requests'] == 3
+            assert result.metrics['latency'] >= result.metrics['sampling-time']
+        assert results[3].images.shape == (1, 3, 128, 64)
+        assert results[3].metrics['batch-requests'] == 1
+        assert server.status()['served-batches'] == 2
+
+    @pytest.mark.unit
+    def test_results_do_not_depend_on_batching(self, server):
+        alone = server.generate(make_request('a corgi', seed=7), timeout=60)
+        futures = [server.submit(make_request('a cat', seed=1)), server.submit(make_request('a corgi', seed=7))]
+        batched = futures[1].result(timeout=60)
+        assert batched.metrics['batch-requests'] == 2
+        torch.testing.assert_close(batched.images, alone.images, rtol=1e-4, atol=1e-4)
+
+    @pytest.mark.unit
+    def test_max_batch_size(self, server):
+        futures = [server.submit(make_request(f'prompt {i}', num_images=2)) for i in range(3)]
+        results = [future.result(timeout=60) for future in futures]
+        assert [result.metrics['batch-size'] for result in results] == [4, 4, 2]
+
+    @pytest.mark.unit
+    def test_http_streaming(self, server):
+        httpd = run_http_server(server, host='127.0.0.1', port=0, block=False)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=60)
+            body = {'requests': [{'prompt': 'a corgi', 'inference_steps': 2, 'height': 64, 'width': 64}] * 2}
+            connection.request('POST', '/generate', body=json.dumps(body))
+            response = connection.getresponse()
+            assert response.status == 200
+            lines = [json.loads(line) for line in response.read().decode().splitlines()]
+            assert sorted(line['index'] for line in lines) == [0, 1]
+            assert all(len(line['images']) == 1 and 'latency' in line['metrics'] for line in lines)
+
+            connection.request('POST', '/generate', body=json.dumps({'prompt': 'x', 'guidance': 3}))
+            response = connection.getresponse()
+            assert response.status == 400
+            response.read()
+        finally:
+            httpd.shutdown()
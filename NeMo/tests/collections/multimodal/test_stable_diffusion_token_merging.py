@@ -0,0 +1,139 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from nemo.collections.multimodal.modules.stable_diffusion.attention import BasicTransformerBlock
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.openaimodel import UNetModel
+from nemo.collections.multimodal.modules.stable_diffusion.token_merging import (
+    bipartite_soft_matching_random2d,
+    get_token_merging_ratios,
+)
+
+CONTEXT_DIM = 16
+IMAGE_SIZE = 8
+
+
+def make_unet(**kwargs):
+    torch.manual_seed(0)
+    model = UNetModel(
+        image_size=IMAGE_SIZE,
+        in_channels=4,
+        model_channels=32,
+        out_channels=4,
+        num_res_blocks=1,
+        attention_resolutions=[1, 2],
+        channel_mult=(1, 2),
+        num_heads=2,
+        use_spatial_transformer=True,
+        context_dim=CONTEXT_DIM,
+        **kwargs,
+    )
+    with torch.no_grad():
+        for param in model.parameters():
+            if torch.all(param == 0):
+                param.normal_(std=0.05)
+    return model.eval()
+
+
+class TestTokenMerging:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('r', [0, 5, 48])
+    def test_merge_unmerge_windows_of_duplicates(self, r):
+        h, w, c = 8, 8, 16
+        # every 2x2 window holds copies of one token, so merging loses nothing
+        windows = torch.randn(2, h // 2, w // 2, c)
+        x = windows.repeat_interleave(2, dim=1).repeat_interleave(2, dim=2).reshape(2, h * w, c)
+        generator = torch.Generator().manual_seed(0)
+        merge, unmerge = bipartite_soft_matching_random2d(x, h, w, r, generator=generator)
+        merged = merge(x)
+        assert merged.shape == (2, h * w - r, c)
+        torch.testing.assert_close(unmerge(merged), x)
+
+    @pytest.mark.unit
+    def test_merge_averages_tokens(self):
+        x = torch.randn(1, 16, 4)
+        merge, unmerge = bipartite_soft_matching_random2d(x, 4, 4, 12, generator=torch.Generator().manual_seed(0))
+        # all source tokens are merged into the 4 destination tokens, which hold the mean of their group
+        merged = merge(x)
+        assert merged.shape == (1, 4, 4)
+        unmerged = unmerge(merged)
+        assert unmerged.shape == x.shape
+        assert torch.allclose(unmerged.sum(dim=1), x.sum(dim=1), atol=1e-5)
+
+    @pytest.mark.unit
+    def test_ratios_per_level(self):
+        assert get_token_merging_ratios(0.5, 3) == [0.5, 0.0, 0.0]
+        assert get_token_merging_ratios([0.5, 0.25], 3) == [0.5, 0.25, 0.0]
+        with pytest.raises(ValueError):
+            get_token_merging_ratios(1.0, 3)
+
+    @pytest.mark.unit
+    def test_unet_token_merging(self):
+        unet = make_unet()
+        x = torch.randn(2, 4, IMAGE_SIZE, IMAGE_SIZE)
+        t = torch.full((2,), 500, dtype=torch.long)
+        context = torch.randn(2, 8, CONTEXT_DIM)
+        with torch.no_grad():
+            baseline = unet(x, t, context=context)
+            unet.enable_token_merging([0.0, 0.0])
+            torch.testing.assert_close(unet(x, t, context=context), baseline)
+
+            unet.enable_token_merging([0.5, 0.25])
+            levels = {}
+            for level, transformer in unet._spatial_transformers_by_level():
+                levels.setdefault(level, set()).update(
+                    block.token_merging_ratio for block in transformer.transformer_blocks
+                )
+            assert levels == {0: {0.5}, 1: {0.25}}
+            merged = unet(x, t, context=context)
+            assert merged.shape == baseline.shape
+            assert not torch.allclose(merged, baseline)
+
+            unet.disable_token_merging()
+            torch.testing.assert_close(unet(x, t, context=context), baseline)
+
+    @pytest.mark.unit
+    def test_unet_config(self):
+        unet = make_unet(token_merging_ratio=0.5)
+        ratios = {
+            level: transformer.transformer_blocks[0].token_merging_ratio
+            for level, transformer in unet._spatial_transformers_by_level()
+        }
+        assert ratios == {0: 0.5, 1: 0.0}
+
+    @pytest.mark.unit
+    def test_gradients_with_checkpointing(self):
+        blocks = []
+        for use_checkpoint in [False, True]:
+            torch.manual_seed(0)
+            block = BasicTransformerBlock(16, 2, 8, context_dim=CONTEXT_DIM, use_checkpoint=use_checkpoint)
+            block.token_merging_ratio = 0.5
+            block.token_merging_hw = (4, 4)
+            blocks.append(block)
+        x = torch.randn(2, 16, 16)
+        context = torch.randn(2, 8, CONTEXT_DIM)
+        grads = []
+        for block in blocks:
+            # the destination tokens change at every call, the recomputation in backward must use the same ones
+            for _ in range(3):
+                block.zero_grad()
+                inputs = x.clone().requires_grad_(True)
+                block(inputs, context).square().sum().backward()
+            grads.append([inputs.grad] + [param.grad for param in block.parameters()])
+        for expected, grad in zip(*grads):
+            assert (grad is None) == (expected is None)
+            if expected is not None:
+                torch.testing.assert_close(grad, expected)
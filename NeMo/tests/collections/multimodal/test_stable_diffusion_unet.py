@@ -0,0 +1,128 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.openaimodel import UNetModel
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+CONTEXT_DIM = 16
+IMAGE_SIZE = 8
+
+
+@pytest.fixture()
+def unet():
+    torch.manual_seed(0)
+    model = UNetModel(
+        image_size=IMAGE_SIZE,
+        in_channels=4,
+        model_channels=32,
+        out_channels=4,
+        num_res_blocks=1,
+        attention_resolutions=[1, 2],
+        channel_mult=(1, 2),
+        num_heads=2,
+        use_spatial_transformer=True,
+        context_dim=CONTEXT_DIM,
+    )
+    # zero-initialized output projections would make every output identical
+    with torch.no_grad():
+        for param in model.parameters():
+            if torch.all(param == 0):
+                param.normal_(std=0.05)
+    return model.to(DEVICE).eval()
+
+
+def get_inputs(batch_size=2, timestep=500):
+    x = torch.randn(batch_size, 4, IMAGE_SIZE, IMAGE_SIZE, device=DEVICE)
+    t = torch.full((batch_size,), timestep, device=DEVICE, dtype=torch.long)
+    context = torch.randn(batch_size, 8, CONTEXT_DIM, device=DEVICE)
+    return x, t, context
+
+
+def denoise(unet, x, context, num_steps=8):
+    for step, timestep in enumerate(torch.linspace(900, 100, num_steps).long()):
+        unet.set_feature_cache_step(step)
+        t = torch.full((x.shape[0],), timestep.item(), device=DEVICE, dtype=torch.long)
+        x = x - 0.1 * unet(x, t, context=context)
+    return x
+
+
+class TestUNetFeatureCache:
+    @pytest.mark.unit
+    def test_refresh_step_matches_uncached(self, unet):
+        x, t, context = get_inputs()
+        with torch.no_grad():
+            reference = unet(x, t, context=context)
+            unet.enable_feature_cache(interval=3, block_id=1)
+            unet.set_feature_cache_step(0)
+            output = unet(x, t, context=context)
+        assert torch.equal(output, reference)
+
+    @pytest.mark.unit
+    def test_cached_step_skips_deep_blocks(self, unet):
+        x, t, context = get_inputs()
+        calls = []
+        unet.middle_block.register_forward_hook(lambda *args: calls.append(1))
+        with torch.no_grad():
+            reference = unet(x, t, context=context)
+            unet.enable_feature_cache(interval=3, block_id=1)
+            unet.set_feature_cache_step(0)
+            unet(x, t, context=context)
+            unet.set_feature_cache_step(1)
+            output = unet(x, t, context=context)
+        # the middle block runs for the reference and the refresh step only
+        assert len(calls) == 2
+        # deep features are unchanged for identical inputs, so the cached step is exact
+        assert torch.allclose(output, reference, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_cache_is_refreshed_every_interval(self, unet):
+        x, t, context = get_inputs()
+        calls = []
+        unet.middle_block.register_forward_hook(lambda *args: calls.append(1))
+        unet.enable_feature_cache(interval=3, warmup_steps=2)
+        with torch.no_grad():
+            denoise(unet, x, context, num_steps=8)
+        # steps 0, 1 are warmup, then steps 2 and 5 refresh the cache
+        assert len(calls) == 4
+
+    @pytest.mark.unit
+    def test_cache_disabled_matches_uncached(self, unet):
+        x, _, context = get_inputs()
+        with torch.no_grad():
+            reference = denoise(unet, x, context)
+            unet.enable_feature_cache(interval=1)
+            output = denoise(unet, x, context)
+        assert torch.equal(output, reference)
+
+    @pytest.mark.unit
+    def test_cached_trajectory_close_to_uncached(self, unet):
+        x, _, context = get_inputs()
+        with torch.no_grad():
+            reference = denoise(unet, x, context)
+            unet.enable_feature_cache(interval=2, block_id=0)
+            output = denoise(unet, x, context)
+            unet.disable_feature_cache()
+            uncached = denoise(unet, x, context)
+        assert torch.equal(uncached, reference)
+        assert not torch.equal(output, reference)
+        relative_error = (output - reference).norm() / reference.norm()
+        assert relative_error < 0.5
+
+    @pytest.mark.unit
+    def test_invalid_block_id(self, unet):
+        with pytest.raises(ValueError):
+            unet.enable_feature_cache(interval=2, block_id=len(unet.input_blocks))
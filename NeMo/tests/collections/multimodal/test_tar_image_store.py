@@ -0,0 +1,103 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import pickle
+import tarfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from nemo.collections.multimodal.data.common.tar_image_store import (
+    TarImageStore,
+    ThumbnailCache,
+    build_tar_image_index,
+)
+
+
+def write_tar(path, images):
+    with tarfile.open(path, 'w') as tar:
+        for name, image in images.items():
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            info = tarfile.TarInfo(name)
+            info.size = buffer.tell()
+            buffer.seek(0)
+            tar.addfile(info, buffer)
+
+
+@pytest.fixture()
+def tar_images(tmp_path):
+    rng = np.random.RandomState(0)
+    images = {}
+    tar_paths = []
+    for shard in range(3):
+        shard_images = {}
+        for i in range(5):
+            pixels = rng.randint(0, 256, size=(rng.randint(4, 12), rng.randint(4, 12), 3), dtype=np.uint8)
+            shard_images[f'dir_{shard}/image_{i}.png'] = Image.fromarray(pixels)
+        tar_paths.append(os.path.join(tmp_path, f'images_{shard}.tar'))
+        write_tar(tar_paths[-1], shard_images)
+        images.update(shard_images)
+    index_dir = os.path.join(tmp_path, 'index')
+    build_tar_image_index(tar_paths, index_dir, num_workers=2)
+    return index_dir, images
+
+
+class TestTarImageStore:
+    @pytest.mark.unit
+    def test_random_access(self, tar_images):
+        index_dir, images = tar_images
+        store = TarImageStore(index_dir)
+        assert len(store) == len(images)
+        # the memory maps are reopened after pickling to a worker
+        store = pickle.loads(pickle.dumps(store))
+        for name in reversed(sorted(images)):
+            image_id = store.find(name)
+            assert image_id >= 0
+            assert np.array_equal(np.asarray(store.open_image(image_id)), np.asarray(images[name]))
+        assert store.find('missing.png') == -1
+        assert store.find('dir_0/image_0.pn') == -1
+
+    @pytest.mark.unit
+    def test_thumbnail_cache(self, tar_images, tmp_path):
+        index_dir, images = tar_images
+        store = TarImageStore(index_dir)
+        cache_dir = os.path.join(tmp_path, 'thumbnails')
+        cache = ThumbnailCache(cache_dir, len(store), 4, 6)
+        image_id = store.find('dir_1/image_2.png')
+        assert cache.get(image_id) is None
+        thumbnail = store.open_image(image_id).resize((6, 4))
+        cache.put(image_id, thumbnail)
+
+        # another process opening the same cache sees the thumbnail
+        other = pickle.loads(pickle.dumps(ThumbnailCache(cache_dir, len(store), 4, 6)))
+        assert np.array_equal(np.asarray(other.get(image_id)), np.asarray(thumbnail))
+        assert other.get(image_id + 1) is None
+        with pytest.raises(AssertionError):
+            other.put(image_id, thumbnail.resize((4, 4)))
+        # the thumbnails of other images or transforms are not shared
+        assert ThumbnailCache(cache_dir, len(store), 4, 6, key='other').get(image_id) is None
+
+    @pytest.mark.unit
+    def test_fingerprint_changes_with_shards(self, tar_images):
+        index_dir, _ = tar_images
+        store = TarImageStore(index_dir)
+        fingerprint = store.fingerprint()
+        assert TarImageStore(index_dir).fingerprint() == fingerprint
+        stat = os.stat(store.shards[0])
+        os.utime(store.shards[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert store.fingerprint() != fingerprint
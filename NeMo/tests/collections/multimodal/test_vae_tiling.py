@@ -0,0 +1,74 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from nemo.collections.multimodal.modules.stable_diffusion.diffusionmodules.tiling import (
+    get_tile_starts,
+    tiled_forward,
+)
+
+
+def upsample(x):
+    # pointwise followed by upsampling, so that tiles do not depend on their neighbours
+    return F.interpolate(torch.tanh(x), scale_factor=8, mode='nearest')
+
+
+def downsample(x):
+    return F.avg_pool2d(x, 8) * 2
+
+
+class TestVAETiling:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('size,tile_size,overlap', [(10, 16, 4), (64, 16, 4), (70, 16, 8), (33, 32, 31)])
+    def test_tile_starts_cover_with_overlap(self, size, tile_size, overlap):
+        tile_size = min(tile_size, size)
+        starts = get_tile_starts(size, tile_size, overlap)
+        assert starts[0] == 0 and starts[-1] + tile_size == size
+        for start, next_start in zip(starts[:-1], starts[1:]):
+            assert start + tile_size - next_start >= overlap
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('max_tile_batch', [None, 1, 3])
+    def test_tiled_decode_matches_full(self, max_tile_batch):
+        z = torch.randn(2, 4, 20, 28)
+        tiled = tiled_forward(upsample, z, tile_size=8, overlap=2, out_factor=8, max_tile_batch=max_tile_batch)
+        assert tiled.shape == (2, 4, 160, 224)
+        torch.testing.assert_close(tiled, upsample(z))
+
+    @pytest.mark.unit
+    def test_tiled_encode_matches_full(self):
+        x = torch.randn(3, 3, 96, 136)
+        tiled = tiled_forward(downsample, x, tile_size=6, overlap=2, in_factor=8, max_tile_batch=4)
+        torch.testing.assert_close(tiled, downsample(x))
+
+    @pytest.mark.unit
+    def test_seams_are_blended(self):
+        calls = []
+
+        def fn(tiles):
+            calls.append(tiles.shape[0])
+            # a constant offset per tile makes the blending visible
+            return upsample(tiles) + torch.arange(tiles.shape[0], dtype=tiles.dtype)[:, None, None, None]
+
+        z = torch.zeros(1, 1, 12, 12)
+        out = tiled_forward(fn, z, tile_size=8, overlap=4, out_factor=8, max_tile_batch=2)
+        assert calls == [2, 2]
+        # outputs go from one tile value to the next without jumps larger than the ramp step
+        row = out[0, 0, 0]
+        assert row[0] == 0 and row[-1] == 1
+        assert torch.all(row[1:] - row[:-1] >= 0)
+        assert torch.max(row[1:] - row[:-1]) <= 1 / 32 + 1e-6
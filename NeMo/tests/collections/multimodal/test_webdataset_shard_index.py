@@ -0,0 +1,148 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import random
+import tarfile
+
+import pytest
+
+from nemo.collections.multimodal.data.common.data_samplers import WDSIndexedShardSampler
+from nemo.collections.multimodal.data.common.shard_index import (
+    ShardIndex,
+    build_shard_index,
+    indexed_tarfile_samples,
+    samples_in_order,
+    scan_shard,
+)
+
+NUM_SHARDS = 3
+SAMPLES_PER_SHARD = 10
+BUCKET = 'bucket'
+
+
+def write_shard(path, shard_id):
+    rng = random.Random(shard_id)
+    with tarfile.open(path, 'w') as tar:
+        for i in range(SAMPLES_PER_SHARD):
+            key = f'{shard_id:03d}{i:05d}'
+            # variable member sizes so that samples do not align to fixed offsets
+            members = {'jpg': os.urandom(rng.randint(100, 3000)), 'txt': f'caption {key}'.encode()}
+            for ext, data in members.items():
+                info = tarfile.TarInfo(f'{key}.{ext}')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture()
+def shards(tmp_path):
+    urls = [f'{i:05d}.tar' for i in range(NUM_SHARDS)]
+    for i, url in enumerate(urls):
+        write_shard(os.path.join(tmp_path, url), i)
+    index = build_shard_index(urls, root=str(tmp_path), num_workers=2)
+    return str(tmp_path), index
+
+
+def read(index, descriptors, root, use_byte_ranges, s3_client=None):
+    kwargs = dict(load_from_object_store=True, s3_client=s3_client, s3_bucket_name=BUCKET)
+    if s3_client is None:
+        kwargs = dict(local_root_path=root)
+    return list(indexed_tarfile_samples(iter(descriptors), index, seed=1, use_byte_ranges=use_byte_ranges, **kwargs))
+
+
+class TestShardIndex:
+    @pytest.mark.unit
+    def test_scan_shard(self, shards):
+        root, index = shards
+        shard = scan_shard('00001.tar', root=root)
+        assert shard['num_samples'] == SAMPLES_PER_SHARD
+        assert shard['keys'][0] == '00100000'
+        assert index.num_samples == NUM_SHARDS * SAMPLES_PER_SHARD
+        # every sample range holds whole tar members, and the ranges cover the members back to back
+        for (_, end), (next_start, _) in zip(shard['offsets'][:-1], shard['offsets'][1:]):
+            assert end == next_start
+        with open(os.path.join(root, '00001.tar'), 'rb') as f:
+            f.seek(shard['offsets'][3][0])
+            data = f.read(shard['offsets'][3][1] - shard['offsets'][3][0])
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+            assert tar.getnames() == ['00100003.jpg', '00100003.txt']
+
+    @pytest.mark.unit
+    def test_index_save_load(self, shards, tmp_path):
+        _, index = shards
+        path = os.path.join(tmp_path, 'index.json')
+        index.save(path)
+        loaded = ShardIndex.load(path)
+        assert loaded.shards == index.shards
+        assert loaded.shard_sizes == [SAMPLES_PER_SHARD] * NUM_SHARDS
+
+    @pytest.mark.unit
+    def test_samples_in_order_buffers_early_samples_only(self):
+        yielded = []
+
+        def stream(keys):
+            for key in keys:
+                yielded.append(key)
+                yield {'__key__': key}
+
+        ordered = samples_in_order(stream(['a', 'b', 'x', 'c']), ['a', 'b', 'c'])
+        # a sample in order is yielded before the next one is read
+        assert next(ordered)['__key__'] == 'a' and yielded == ['a']
+        assert [sample['__key__'] for sample in ordered] == ['b', 'c']
+
+        shuffled = samples_in_order(stream(['a', 'b', 'c', 'd']), ['c', 'a', 'e', 'd', 'b'])
+        assert [sample['__key__'] for sample in shuffled] == ['c', 'a', 'd', 'b']
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('start', [0, 1, 4, 9])
+    def test_byte_range_resume_matches_streaming(self, shards, start, fake_s3_client):
+        root, index = shards
+        descriptors = [dict(url='00002.tar', shard_id=2, epoch=3, start=start, stop=SAMPLES_PER_SHARD)]
+        full = read(index, [dict(descriptors[0], start=0)], root, use_byte_ranges=False)
+        streamed = read(index, descriptors, root, use_byte_ranges=False)
+        local = read(index, descriptors, root, use_byte_ranges=True)
+        s3_client = fake_s3_client(root)
+        s3 = read(index, descriptors, root, use_byte_ranges=True, s3_client=s3_client)
+
+        assert [s['__key__'] for s in streamed] == [s['__key__'] for s in full[start:]]
+        for samples in [local, s3]:
+            assert [s['__key__'] for s in samples] == [s['__key__'] for s in streamed]
+            assert all(a['jpg'] == b['jpg'] and a['txt'] == b['txt'] for a, b in zip(samples, streamed))
+        if start > 0:
+            # only ranged requests are issued, and never more than the shard
+            assert all(request_range is not None for _, request_range, _ in s3_client.requests)
+            assert s3_client.bytes_served < os.path.getsize(os.path.join(root, '00002.tar'))
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('consumed_samples', [2, 6, 14, 28])
+    def test_sampler_resume_is_exact(self, shards, consumed_samples):
+        root, index = shards
+
+        def stream(consumed):
+            sampler = WDSIndexedShardSampler(
+                urls=index.urls,
+                shard_sizes=index.shard_sizes,
+                consumed_samples=consumed,
+                micro_batch_size=2,
+                data_parallel_rank=0,
+                data_parallel_size=1,
+                num_workers=1,
+            )
+            return [s['__key__'] for s in read(index, list(sampler), root, use_byte_ranges=True)]
+
+        full = stream(0)
+        assert len(full) == NUM_SHARDS * SAMPLES_PER_SHARD
+        assert len(set(full)) == len(full)
+        assert stream(consumed_samples) == full[consumed_samples:]
@@ -0,0 +1,149 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from nemo.collections.multimodal.data.neva.neva_dataset import DEFAULT_IM_END_TOKEN
+from nemo.collections.nlp.modules.common.text_generation_prefix_cache import PrefixKVCache
+from nemo.collections.nlp.modules.common.text_generation_strategy import NevaModelTextGenerationStrategy
+
+BLOCK_SIZE = 4
+NUM_HEADS = 2
+HEAD_SIZE = 3
+# keys and values of the two layers of a block, in float32
+BLOCK_BYTES = 2 * 2 * BLOCK_SIZE * NUM_HEADS * HEAD_SIZE * 4
+
+
+class FakeAttention:
+    """The inference key-value memory of a ParallelAttention layer."""
+
+    def __init__(self):
+        self.inference_key_memory = None
+        self.inference_value_memory = None
+        self.inference_current_sequence_len = 0
+
+    def _allocate_memory(self, inference_max_sequence_len, batch_size, dtype, device):
+        return torch.empty(inference_max_sequence_len, batch_size, NUM_HEADS, HEAD_SIZE, dtype=dtype, device=device)
+
+    def prefill(self, tokens):
+        """Keys and values of every position, a function of the tokens up to that position."""
+        tokens = torch.tensor(tokens, dtype=torch.float32).t()
+        memory = tokens.cumsum(dim=0)[:, :, None, None].expand(-1, -1, NUM_HEADS, HEAD_SIZE)
+        self.inference_key_memory = memory.clone()
+        self.inference_value_memory = -memory.clone()
+        self.inference_current_sequence_len = tokens.shape[0]
+
+
+def make_cache(max_blocks):
+    return PrefixKVCache(max_memory_mb=max_blocks * BLOCK_BYTES / 2 ** 20, block_size=BLOCK_SIZE)
+
+
+def prefill_and_store(cache, layers, prompts):
+    hashes = [cache.block_hashes(prompt) for prompt in prompts]
+    for layer in layers:
+        layer.prefill(prompts)
+    cache.store(layers, hashes, len(prompts[0]))
+    return hashes
+
+
+class TestPrefixKVCache:
+    @pytest.mark.unit
+    def test_block_hashes(self):
+        cache = make_cache(max_blocks=8)
+        tokens = list(range(1, 11))
+        hashes = cache.block_hashes(tokens)
+        # only the full blocks are hashed, each with the whole prefix before it
+        assert len(hashes) == 2 and len(set(hashes)) == 2
+        assert cache.block_hashes(tokens[:8] + [0, 0, 0]) == hashes
+        assert cache.block_hashes([0] + tokens[1:])[1] != hashes[1]
+
+        # the salt changes the hashes from the block of its first position on
+        salted = cache.block_hashes(tokens, salt=b'image', salt_from=5)
+        assert salted[0] == hashes[0] and salted[1] != hashes[1]
+        assert cache.block_hashes(tokens, salt=b'other image', salt_from=5)[1] != salted[1]
+
+    @pytest.mark.unit
+    def test_store_and_restore(self):
+        cache = make_cache(max_blocks=8)
+        layers = [FakeAttention(), FakeAttention()]
+        prompts = [[1, 2, 3, 4, 5, 6, 7, 8, 9], [4, 3, 2, 1, 8, 7, 6, 5, 9]]
+        hashes = prefill_and_store(cache, layers, prompts)
+        assert len(cache) == 4
+        expected = [(layer.inference_key_memory[:8], layer.inference_value_memory[:8]) for layer in layers]
+
+        # a new batch with the prompts in another order, sharing their first 8 tokens
+        new_hashes = [cache.block_hashes(prompts[1][:8] + [10]), cache.block_hashes(prompts[0][:8] + [11, 12])]
+        assert [cache.lookup(row_hashes) for row_hashes in new_hashes] == [2, 2]
+        assert cache.lookup(cache.block_hashes([1, 2, 3, 4, 9, 9, 9, 9])) == 1
+        layers = [FakeAttention(), FakeAttention()]
+        cache.restore(layers, new_hashes, maxlen=16)
+        for layer, (key, value) in zip(layers, expected):
+            assert layer.inference_key_memory.shape == (16, 2, NUM_HEADS, HEAD_SIZE)
+            assert layer.inference_current_sequence_len == 8
+            assert torch.equal(layer.inference_key_memory[:8], key.flip(1))
+            assert torch.equal(layer.inference_value_memory[:8], value.flip(1))
+        assert hashes[0][:2] == new_hashes[1]
+
+    @pytest.mark.unit
+    def test_evicts_least_recently_used_blocks(self):
+        cache = make_cache(max_blocks=4)
+        layers = [FakeAttention(), FakeAttention()]
+        first = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+        second = [1, 2, 3, 4, 8, 8, 8, 8, 9, 9, 9, 9]
+        prefill_and_store(cache, layers, [first])
+        prefill_and_store(cache, layers, [second])
+        assert len(cache) == 4 and cache.memory_bytes <= cache.max_memory_bytes
+        # the last block of the first prompt is evicted, the block shared by both prompts is kept
+        assert cache.lookup(cache.block_hashes(first)) == 2
+        assert cache.lookup(cache.block_hashes(second)) == 3
+        assert cache.stats()['evicted_blocks'] == 1
+
+        cache.clear()
+        assert len(cache) == 0 and cache.memory_bytes == 0
+
+    @pytest.mark.unit
+    def test_stats(self):
+        cache = make_cache(max_blocks=4)
+        cache.record([10, 12], prefix_length=0)
+        cache.record([9, 9], prefix_length=8)
+        stats = cache.stats()
+        assert stats['requests'] == 4 and stats['hits'] == 2 and stats['hit_rate'] == 0.5
+        assert stats['prompt_tokens'] == 40 and stats['reused_tokens'] == 16
+        assert stats['token_hit_rate'] == pytest.approx(0.4)
+
+
+class MediaTokenizer:
+    """Token 8 is the image start token and 9 the image end token."""
+
+    def token_to_id(self, token):
+        assert token == DEFAULT_IM_END_TOKEN
+        return 9
+
+
+class TestNevaPrefixLength:
+    @pytest.mark.unit
+    def test_prefix_ends_before_first_image(self):
+        # the strategy is not built from a model, only its tokenizer and number of image tokens are used
+        strategy = NevaModelTextGenerationStrategy.__new__(NevaModelTextGenerationStrategy)
+        strategy.tokenizer = MediaTokenizer()
+        strategy.num_media_latents = 2
+        # text, an image at positions 4 to 7, text, an image at positions 12 to 15, text
+        tokens = [1, 2, 3, 4, 8, 0, 0, 9, 5, 6, 7, 1, 8, 0, 0, 9, 2, 3]
+        assert strategy.clip_prefix_length(tokens, 4) == 4
+        assert strategy.clip_prefix_length(tokens, 3) == 3
+        # a prefix covering the first image would shift the media of the suffix to its second image
+        for prefix_length in [6, 8, 12, 16]:
+            assert strategy.clip_prefix_length(tokens, prefix_length) == 4
+        assert strategy.clip_prefix_length([1, 2, 3, 4, 5, 6], 4) == 4
@@ -0,0 +1,87 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from nemo.collections.nlp.modules.common.text_generation_sampling import BatchedSampler
+from nemo.collections.nlp.modules.common.text_generation_utils import top_k_logits
+
+VOCAB_SIZE = 8
+EOD_ID = 0
+
+
+@pytest.fixture()
+def logits():
+    torch.manual_seed(0)
+    # the padded vocabulary of the model is larger than the one of the tokenizer
+    return torch.randn(4, VOCAB_SIZE + 2)
+
+
+class TestBatchedSampler:
+    @pytest.mark.unit
+    def test_mixed_parameters(self, logits):
+        sampler = BatchedSampler(4, VOCAB_SIZE, EOD_ID)
+        sampler.reset([0, 1], greedy=True)
+        sampler.reset(2, top_k=2, temperature=0.5)
+        sampler.reset(3, top_p=0.5)
+        top_2 = logits[2, :VOCAB_SIZE].topk(2).indices.tolist()
+        allowed_top_p = top_k_logits(logits[3:, :VOCAB_SIZE].clone(), top_p=0.5)[0].isfinite()
+        for _ in range(50):
+            tokens = sampler.sample(logits)
+            assert tokens[:2].tolist() == logits[:2, :VOCAB_SIZE].argmax(dim=-1).tolist()
+            assert tokens[2].item() in top_2
+            assert allowed_top_p[tokens[3]]
+
+    @pytest.mark.unit
+    def test_penalties_use_token_counts(self):
+        logits = torch.tensor([[-100.0, 3.0, 2.0, 1.0, 0.0, -1.0, -2.0, -3.0, 9.0, 9.0]]).repeat(4, 1)
+        sampler = BatchedSampler(4, VOCAB_SIZE, EOD_ID)
+        # top_k=1 makes the sampling deterministic
+        sampler.reset(torch.arange(4), top_k=1, repetition_penalty=torch.tensor([1.0, 1e4, 1.0, 1.0]))
+        sampler.reset(2, top_k=1, presence_penalty=100.0)
+        first = sampler.sample(logits)
+        assert first.tolist() == [1, 1, 1, 1]
+        sampler.append(first)
+        assert sampler.token_counts[:, 1].tolist() == [1, 1, 1, 1] and sampler.token_counts.sum().item() == 4
+
+        # without penalty the same token is sampled again, the penalties make the other rows avoid it
+        assert sampler.sample(logits).tolist() == [1, 2, 2, 1]
+
+        # the counts of a row start over with a new sequence
+        sampler.reset(1, top_k=1)
+        assert sampler.token_counts[1].sum().item() == 0
+        assert sampler.sample(logits)[1] == 1
+
+    @pytest.mark.unit
+    def test_min_tokens_to_generate(self, logits):
+        sampler = BatchedSampler(4, VOCAB_SIZE, EOD_ID)
+        sampler.reset(torch.arange(4), greedy=True, min_tokens_to_generate=torch.tensor([0, 2, 2, 0]))
+        logits[:, EOD_ID] = 100.0
+        for step in range(3):
+            tokens = sampler.sample(logits)
+            ends = sampler.append(tokens)
+            expected = [True, step >= 2, step >= 2, True]
+            assert (tokens == EOD_ID).tolist() == expected and ends.tolist() == expected
+
+    @pytest.mark.unit
+    def test_end_token_ids(self):
+        sampler = BatchedSampler(3, VOCAB_SIZE, EOD_ID)
+        sampler.reset(0, end_token_ids=[[5]])
+        sampler.reset(1, end_token_ids=[[3, 4], [6]])
+        # the rows keep their end sequences when another row has longer or more of them
+        sampler.reset(2, end_token_ids=[[1, 2, 3]])
+        steps = [[5, 3, 1], [4, 4, 2], [5, 6, 3], [2, 3, EOD_ID]]
+        ends = [sampler.append(torch.tensor(tokens)).tolist() for tokens in steps]
+        assert ends == [[True, False, False], [False, True, False], [True, True, True], [False, False, True]]
@@ -0,0 +1,345 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+from pytorch_lightning.trainer.trainer import Trainer
+
+from nemo.collections.nlp.models.language_modeling.megatron.gpt_model import GPTModel
+from nemo.collections.nlp.modules.common.megatron.megatron_init import initialize_model_parallel_for_nemo
+from nemo.collections.nlp.modules.common.text_generation_scheduler import (
+    ContinuousBatchingScheduler,
+    GenerationRequest,
+    MegatronGPTSlotDecoder,
+    SlotKVCache,
+    slot_attention_mask,
+)
+from nemo.collections.nlp.parts.nlp_overrides import NLPDDPStrategy
+
+try:
+    import apex
+
+    HAVE_APEX = True
+except (ImportError, ModuleNotFoundError):
+    HAVE_APEX = False
+
+try:
+    from megatron.core import ModelParallelConfig
+
+    HAVE_MEGATRON_CORE = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_MEGATRON_CORE = False
+
+VOCAB_SIZE = 32
+EOS_ID = 0
+
+
+class CharTokenizer:
+    """Token i is the character chr(ord('a') + i - 1), token 0 is the end of document."""
+
+    eos_id = EOS_ID
+    bos_id = 1
+    vocab_size = VOCAB_SIZE
+
+    def text_to_ids(self, text):
+        return [ord(c) - ord('a') + 1 for c in text]
+
+    def ids_to_text(self, ids):
+        return ''.join(chr(ord('a') + i - 1) for i in ids if i != EOS_ID)
+
+    def ids_to_tokens(self, ids):
+        return [self.ids_to_text([i]) for i in ids]
+
+
+class TinyGPT(nn.Module):
+    """Two layer GPT in the [s, b, h] layout, decoding with a SlotKVCache on CPU."""
+
+    def __init__(self, hidden_size=16, num_layers=2, num_heads=2, max_seq_len=64):
+        super().__init__()
+        torch.manual_seed(0)
+        self.num_heads = num_heads
+        self.embedding = nn.Embedding(VOCAB_SIZE, hidden_size)
+        self.position_embedding = nn.Embedding(max_seq_len, hidden_size)
+        self.qkv = nn.ModuleList([nn.Linear(hidden_size, 3 * hidden_size) for _ in range(num_layers)])
+        self.mlp = nn.ModuleList([nn.Linear(hidden_size, hidden_size) for _ in range(num_layers)])
+        self.output_layer = nn.Linear(hidden_size, VOCAB_SIZE)
+
+    def forward(self, input_ids, position_ids, attention_mask, layer_past=None):
+        """[n, s, vocab] logits and the keys and values of all the layers, after the ones of layer_past."""
+        hidden = (self.embedding(input_ids) + self.position_embedding(position_ids)).transpose(0, 1)
+        presents = []
+        for layer, (qkv, mlp) in enumerate(zip(self.qkv, self.mlp)):
+            q, k, v = qkv(hidden).view(*hidden.shape[:2], self.num_heads, -1).chunk(3, dim=-1)
+            if layer_past is not None:
+                k = torch.cat([layer_past[layer][0], k])
+                v = torch.cat([layer_past[layer][1], v])
+            presents.append((k, v))
+            scores = torch.einsum('qbnd,kbnd->bnqk', q, k) / q.shape[-1] ** 0.5
+            scores = scores.masked_fill(attention_mask, -float('inf'))
+            context = torch.einsum('bnqk,kbnd->qbnd', scores.softmax(dim=-1), v).reshape(hidden.shape)
+            hidden = hidden + context
+            hidden = hidden + torch.tanh(mlp(hidden))
+        return self.output_layer(hidden).transpose(0, 1), presents
+
+    def decode(self, input_ids, position_ids, slots, kv_cache):
+        past_length = int(position_ids[:, 0].max())
+        layer_past = None
+        if past_length > 0:
+            slot_index = kv_cache.slot_index(slots)
+            layer_past = [kv_cache.read(layer, slot_index, past_length) for layer in range(len(self.qkv))]
+        logits, presents = self(input_ids, position_ids, slot_attention_mask(position_ids, past_length), layer_past)
+        for layer, (key, value) in enumerate(presents):
+            kv_cache.write(layer, slots, position_ids[:, 0], key[past_length:], value[past_length:])
+        return logits
+
+    @torch.no_grad()
+    def greedy_reference(self, tokens, tokens_to_generate):
+        """Greedy generation recomputing the whole sequence at every step."""
+        tokens = list(tokens)
+        for _ in range(tokens_to_generate):
+            input_ids = torch.tensor([tokens])
+            mask = torch.ones(len(tokens), len(tokens), dtype=torch.bool).triu(diagonal=1)[None, None]
+            logits, _ = self(input_ids, torch.arange(len(tokens))[None], mask)
+            tokens.append(int(logits[0, -1].argmax()))
+        return tokens
+
+
+@pytest.fixture()
+def model():
+    return TinyGPT().eval()
+
+
+def make_scheduler(model, **kwargs):
+    return ContinuousBatchingScheduler(model.decode, CharTokenizer(), max_seq_len=64, device='cpu', **kwargs)
+
+
+class TestSlotKVCache:
+    @pytest.mark.unit
+    def test_read_contiguous_slots_without_copy(self):
+        kv_cache = SlotKVCache(num_slots=4, max_seq_len=8)
+        key = torch.randn(5, 4, 2, 3)
+        kv_cache.write(0, torch.arange(4), torch.zeros(4, dtype=torch.long), key, -key)
+        slot_index = kv_cache.slot_index(torch.tensor([1, 2]))
+        assert slot_index == slice(1, 3)
+        keys, values = kv_cache.read(0, slot_index, 5)
+        assert keys.data_ptr() == kv_cache.keys[0][:, 1].data_ptr()
+        torch.testing.assert_close(keys, key[:, 1:3])
+        torch.testing.assert_close(values, -key[:, 1:3])
+
+    @pytest.mark.unit
+    def test_read_scattered_slots(self):
+        kv_cache = SlotKVCache(num_slots=4, max_seq_len=8)
+        key = torch.randn(5, 4, 2, 3)
+        kv_cache.write(0, torch.arange(4), torch.zeros(4, dtype=torch.long), key, -key)
+        slots = torch.tensor([3, 0])
+        assert kv_cache.slot_index(slots) is slots
+        keys, values = kv_cache.read(0, kv_cache.slot_index(slots), 5)
+        torch.testing.assert_close(keys, key[:, [3, 0]])
+        torch.testing.assert_close(values, -key[:, [3, 0]])
+
+
+class TestContinuousBatchingScheduler:
+    @pytest.mark.unit
+    def test_matches_generation_without_cache(self, model):
+        # more sequences than slots, with different prompt lengths and numbers of generated tokens
+        scheduler = make_scheduler(model, max_batch_size=2)
+        prompts = ['abc', 'hello', 'x', 'continuous', 'batching']
+        requests = [
+            scheduler.submit(
+                GenerationRequest(CharTokenizer().text_to_ids(prompt), tokens_to_generate=3 + 2 * i, greedy=True)
+            )
+            for i, prompt in enumerate(prompts)
+        ]
+        while scheduler.step():
+            assert len(scheduler.running) <= 2
+        for i, request in enumerate(requests):
+            expected = model.greedy_reference(request.context_tokens, 3 + 2 * i)
+            # the reference does not stop at the end of document token
+            if EOS_ID in request.generated_tokens:
+                expected = expected[: len(request.tokens)]
+            assert request.done and request.tokens == expected
+        assert scheduler.kv_cache.num_free == 2
+
+    @pytest.mark.unit
+    def test_admits_requests_into_running_batch(self, model):
+        scheduler = make_scheduler(model, max_batch_size=4)
+        long_request = scheduler.submit(
+            GenerationRequest([2, 3, 4], tokens_to_generate=20, min_tokens_to_generate=20, greedy=True)
+        )
+        for _ in range(3):
+            scheduler.step()
+        assert scheduler.metrics()['queue_depth'] == 0
+        short_request = scheduler.submit(
+            GenerationRequest([5, 6], tokens_to_generate=2, min_tokens_to_generate=2, greedy=True)
+        )
+        assert scheduler.metrics()['queue_depth'] == 1
+        scheduler.step()
+        assert len(short_request.generated_tokens) == 1 and not long_request.done
+        scheduler.step()
+        # the short request finishes while the long one is still running
+        assert short_request.done and not long_request.done
+        assert short_request.time_to_first_token > 0
+
+        metrics = scheduler.metrics()
+        assert metrics['finished_sequences'] == 1 and metrics['running_sequences'] == 1
+        assert metrics['time_to_first_token']['max'] >= metrics['time_to_first_token']['p50']
+
+    @pytest.mark.unit
+    def test_stop_conditions(self, model):
+        tokenizer = CharTokenizer()
+        scheduler = make_scheduler(model, max_batch_size=4)
+        scheduler.start()
+        args = dict(min_tokens_to_generate=6, greedy=True)
+        unconstrained = scheduler.submit(GenerationRequest([2, 3], tokens_to_generate=6, **args)).wait(timeout=10)
+        assert len(unconstrained) == 6
+
+        # generation stops on an end string, at its own max number of tokens, or at max_seq_len
+        end_string = tokenizer.ids_to_text(unconstrained[1:3])
+        stopped = scheduler.submit(GenerationRequest([2, 3], tokens_to_generate=6, end_strings=[end_string], **args))
+        short = scheduler.submit(GenerationRequest([2, 3], tokens_to_generate=1, **args))
+        long_prompt = scheduler.submit(GenerationRequest([2] * 62, tokens_to_generate=6, **args))
+        tokens = stopped.wait(timeout=10)
+        assert len(tokens) <= 3 and tokens == unconstrained[: len(tokens)]
+        assert tokenizer.ids_to_text(tokens).endswith(end_string)
+        assert short.wait(timeout=10) == unconstrained[:1]
+        assert len(long_prompt.wait(timeout=10)) <= 2
+        scheduler.stop()
+
+        with pytest.raises(ValueError):
+            scheduler.submit(GenerationRequest([2] * 64))
+
+    @pytest.mark.unit
+    def test_invalid_sentences(self, model):
+        scheduler = make_scheduler(model, max_batch_size=2)
+        sentences = ['abc', 'a' * 64]
+        # none of the sentences is queued, and stream raises before any event is read
+        with pytest.raises(ValueError):
+            scheduler.generate(sentences, tokens_to_generate=2)
+        with pytest.raises(ValueError):
+            scheduler.stream(sentences, tokens_to_generate=2)
+        assert scheduler.metrics()['queue_depth'] == 0
+
+    @pytest.mark.unit
+    def test_stream(self, model):
+        tokenizer = CharTokenizer()
+        scheduler = make_scheduler(model, max_batch_size=2)
+        scheduler.start()
+        sentences = ['abc', 'hello', 'x']
+        args = dict(tokens_to_generate=5, min_tokens_to_generate=5, greedy=True)
+        expected = scheduler.generate(sentences, **args)['token_ids']
+
+        token_ids, texts, finished = [[], [], []], ['', '', ''], []
+        for event in scheduler.stream(sentences, wait_timeout=10, **args):
+            texts[event['index']] += event['text']
+            if event.get('finished'):
+                finished.append(event['index'])
+            else:
+                assert event['index'] not in finished
+                token_ids[event['index']].append(event['token_id'])
+        scheduler.stop()
+        assert sorted(finished) == [0, 1, 2]
+        for sentence, ids, text, expected_ids in zip(sentences, token_ids, texts, expected):
+            assert tokenizer.text_to_ids(sentence) + ids == expected_ids
+            assert text == tokenizer.ids_to_text(ids)
+
+
+@pytest.fixture()
+def model_parallel_config():
+    return ModelParallelConfig()
+
+
+@pytest.mark.run_only_on('GPU')
+@pytest.mark.skipif(not HAVE_APEX or not HAVE_MEGATRON_CORE, reason="apex or megatron-core is not installed")
+class TestMegatronGPTSlotDecoder:
+    @classmethod
+    def setup_class(cls):
+        if not torch.cuda.is_available():
+            return
+        trainer = Trainer(strategy=NLPDDPStrategy(), devices=1, accelerator='gpu', num_nodes=1, logger=None)
+        initialize_model_parallel_for_nemo(
+            world_size=trainer.world_size,
+            global_rank=trainer.global_rank,
+            local_rank=trainer.local_rank,
+            tensor_model_parallel_size=1,
+            pipeline_model_parallel_size=1,
+            micro_batch_size=1,
+            global_batch_size=1,
+            seed=1234,
+            apex_transformer_log_level=30,
+        )
+
+        def dummy():
+            return
+
+        if trainer.strategy.launcher is not None:
+            trainer.strategy.launcher.launch(dummy, trainer=trainer)
+        trainer.strategy.setup_environment()
+        torch.distributed.barrier()
+
+    @pytest.mark.unit
+    @torch.no_grad()
+    def test_matches_full_recomputation(self, model_parallel_config):
+        gpt = GPTModel(
+            config=model_parallel_config,
+            vocab_size=VOCAB_SIZE,
+            hidden_size=32,
+            max_position_embeddings=64,
+            num_layers=2,
+            num_attention_heads=4,
+            ffn_hidden_size=64,
+            hidden_dropout=0.0,
+            attention_dropout=0.0,
+            precision=32,
+            bias_activation_fusion=False,
+            bias_dropout_add_fusion=False,
+            masked_softmax_fusion=False,
+        )
+        gpt = gpt.cuda().eval()
+        decoder = MegatronGPTSlotDecoder(SimpleNamespace(cfg=OmegaConf.create({}), model=gpt))
+
+        def full_logits(tokens):
+            """Logits of the whole sequence, without the cache."""
+            input_ids = torch.tensor([tokens], device='cuda')
+            position_ids = torch.arange(len(tokens), device='cuda')[None]
+            mask = torch.ones(len(tokens), len(tokens), dtype=torch.bool, device='cuda').triu(diagonal=1)[None, None]
+            return gpt(input_ids, position_ids, mask)[0]
+
+        # prompts of different lengths in out of order slots, computed together and padded as by the scheduler
+        prompts = [[2, 3, 4, 5, 6], [7, 8], [9, 10, 11]]
+        kv_cache = SlotKVCache(num_slots=4, max_seq_len=64)
+        slots = torch.tensor([2, 0, 3], device='cuda')
+        input_ids = torch.full((3, 5), EOS_ID, dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, : len(prompt)] = torch.tensor(prompt)
+        position_ids = torch.arange(5).expand(3, 5)
+        logits = decoder(input_ids.cuda(), position_ids.cuda(), slots, kv_cache)
+        assert logits.shape == (3, 5, VOCAB_SIZE)
+        for i, prompt in enumerate(prompts):
+            torch.testing.assert_close(logits[i, : len(prompt)], full_logits(prompt), atol=1e-4, rtol=1e-4)
+
+        # then one token at a time, attending to the keys and values of the slots
+        tokens = [prompt + [int(logits[i, len(prompt) - 1].argmax())] for i, prompt in enumerate(prompts)]
+        for _ in range(4):
+            input_ids = torch.tensor([[sequence[-1]] for sequence in tokens], device='cuda')
+            position_ids = torch.tensor([[len(sequence) - 1] for sequence in tokens], device='cuda')
+            logits = decoder(input_ids, position_ids, slots, kv_cache)
+            for i, sequence in enumerate(tokens):
+                torch.testing.assert_close(logits[i, 0], full_logits(sequence)[-1], atol=1e-4, rtol=1e-4)
+                sequence.append(int(logits[i, 0].argmax()))
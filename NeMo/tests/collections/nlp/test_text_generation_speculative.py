@@ -0,0 +1,161 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+import torch.nn as nn
+
+from nemo.collections.nlp.modules.common.text_generation_speculative import SpeculativeDecoder, speculative_accept
+
+VOCAB_SIZE = 16
+EOD_ID = 0
+
+
+class TinyLM(nn.Module):
+    """One layer causal LM on CPU, with a key-value memory that is truncated like the Megatron inference memory."""
+
+    def __init__(self, seed, hidden_size=16, max_seq_len=64):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.embedding = nn.Embedding(VOCAB_SIZE, hidden_size)
+        self.position_embedding = nn.Embedding(max_seq_len, hidden_size)
+        self.qkv = nn.Linear(hidden_size, 3 * hidden_size)
+        self.output_layer = nn.Linear(hidden_size, VOCAB_SIZE)
+        self.keys = self.values = None
+
+    def forward(self, tokens, start, end, maxlen):
+        hidden = self.embedding(tokens[:, start:end]) + self.position_embedding(torch.arange(start, end))
+        query, key, value = self.qkv(hidden).chunk(3, dim=-1)
+        if start > 0:
+            assert self.keys.size(1) == start
+            key, value = torch.cat([self.keys, key], dim=1), torch.cat([self.values, value], dim=1)
+        self.keys, self.values = key, value
+        scores = query @ key.transpose(1, 2) / query.size(-1) ** 0.5
+        mask = torch.arange(end)[None, :] > torch.arange(start, end)[:, None]
+        hidden = hidden + scores.masked_fill(mask, -float('inf')).softmax(dim=-1) @ value
+        return self.output_layer(hidden)
+
+    def truncate(self, length):
+        self.keys, self.values = self.keys[:, :length], self.values[:, :length]
+
+    @torch.no_grad()
+    def greedy_reference(self, tokens, tokens_to_generate):
+        """Greedy generation recomputing the whole sequence at every step."""
+        tokens = torch.tensor([tokens])
+        for _ in range(tokens_to_generate):
+            logits = self(tokens, 0, tokens.size(1), 64)
+            tokens = torch.cat([tokens, logits[:, -1].argmax(dim=-1, keepdim=True)], dim=1)
+        return tokens[0].tolist()
+
+
+def pad(prompts, length):
+    return torch.tensor([prompt + [EOD_ID] * (length - len(prompt)) for prompt in prompts])
+
+
+def until_end_of_document(tokens, context_length):
+    """The tokens up to the first end of document token after the context, included."""
+    generated = tokens[context_length:]
+    return tokens[: context_length + generated.index(EOD_ID) + 1] if EOD_ID in generated else tokens
+
+
+class TestSpeculativeDecoding:
+    @pytest.mark.unit
+    def test_rejection_sampling_preserves_target_distribution(self):
+        torch.manual_seed(0)
+        num_samples = 20000
+        draft = torch.tensor([0.4, 0.3, 0.2, 0.1])
+        target = torch.tensor([0.1, 0.2, 0.3, 0.4])
+        draft_tokens = torch.multinomial(draft, num_samples, replacement=True).view(-1, 1)
+        num_accepted, next_tokens = speculative_accept(
+            draft_tokens, draft.expand(num_samples, 1, -1), target.expand(num_samples, 2, -1)
+        )
+        first_tokens = torch.where(num_accepted > 0, draft_tokens[:, 0], next_tokens)
+        frequencies = torch.bincount(first_tokens, minlength=4).float() / num_samples
+        assert torch.allclose(frequencies, target, atol=0.02)
+        # the expected acceptance rate is the sum of min(p, q)
+        assert num_accepted.float().mean().item() == pytest.approx(0.6, abs=0.02)
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize("num_speculative_tokens", [1, 3, 5])
+    def test_greedy_matches_target_model(self, num_speculative_tokens):
+        target, draft = TinyLM(seed=0).eval(), TinyLM(seed=1).eval()
+        prompts = [[3, 5, 7], [2, 4, 6, 8, 10], [9, 1]]
+        tokens_to_generate = 12
+        maxlen = max(len(prompt) for prompt in prompts) + tokens_to_generate
+        context_lengths = torch.tensor([len(prompt) for prompt in prompts])
+
+        decoder = SpeculativeDecoder(target, draft, num_speculative_tokens)
+        tokens = decoder.generate(
+            pad(prompts, maxlen), context_lengths, maxlen, EOD_ID, VOCAB_SIZE, greedy=True
+        ).tolist()
+        for prompt, row in zip(prompts, tokens):
+            expected = until_end_of_document(target.greedy_reference(prompt, maxlen - len(prompt)), len(prompt))
+            assert row[: len(expected)] == expected
+            # the sequence is padded with end of document tokens after its end
+            assert all(token == EOD_ID for token in row[len(expected) :])
+
+        metrics = decoder.metrics()
+        assert 0 <= metrics['acceptance_rate'] <= 1
+        assert metrics['generated_tokens'] > 0 and metrics['tokens_per_sec'] > 0
+
+    @pytest.mark.unit
+    def test_identical_draft_accepts_all_tokens(self):
+        target, draft = TinyLM(seed=0).eval(), TinyLM(seed=0).eval()
+        prompt = [3, 5, 7]
+        decoder = SpeculativeDecoder(target, draft, num_speculative_tokens=4)
+        tokens = decoder.generate(
+            pad([prompt], 13), torch.tensor([3]), 13, EOD_ID, VOCAB_SIZE, greedy=True, min_tokens_to_generate=10
+        )
+        reference = target.greedy_reference(prompt, 10)
+        assert len(tokens[0]) == 13
+        metrics = decoder.metrics()
+        assert metrics['acceptance_rate'] == 1.0
+        # 5 tokens per target step, the last step drafts only the remaining tokens
+        assert metrics['target_steps'] == 2 and metrics['generated_tokens'] == 10
+        # with the end of document token forbidden, the reference may differ once it would have been generated
+        if EOD_ID not in reference[3:]:
+            assert tokens[0].tolist() == reference
+
+    @pytest.mark.unit
+    def test_sampling(self):
+        target, draft = TinyLM(seed=0).eval(), TinyLM(seed=1).eval()
+        torch.manual_seed(0)
+        decoder = SpeculativeDecoder(target, draft, num_speculative_tokens=3)
+        tokens = decoder.generate(
+            pad([[3, 5, 7]] * 4, 20), torch.tensor([3] * 4), 20, EOD_ID, VOCAB_SIZE, temperature=0.8, top_k=5
+        )
+        assert tokens.shape[0] == 4 and tokens.shape[1] <= 20
+        assert (tokens[:, :3] == torch.tensor([3, 5, 7])).all()
+        assert tokens.max() < VOCAB_SIZE
+
+    @pytest.mark.unit
+    def test_probs_do_not_modify_logits(self):
+        decoder = SpeculativeDecoder(TinyLM(seed=0).eval(), TinyLM(seed=1).eval(), num_speculative_tokens=3)
+        sampling = dict(
+            vocab_size=VOCAB_SIZE,
+            eod_id=EOD_ID,
+            min_tokens_to_generate=4,
+            greedy=False,
+            temperature=1.0,
+            top_k=0,
+            top_p=0.0,
+        )
+        logits = torch.randn(2, 6, VOCAB_SIZE + 2)
+        expected = logits.clone()
+        tokens = torch.randint(1, VOCAB_SIZE, (2, 8))
+        # the last positions of the logits are not contiguous
+        probs = decoder._probs(logits[:, -3:], tokens, torch.arange(3, 6), torch.tensor([2, 4]), sampling)
+        assert probs.shape == (2, 3, VOCAB_SIZE)
+        torch.testing.assert_close(probs.sum(dim=-1), torch.ones(2, 3))
+        assert torch.equal(logits, expected)
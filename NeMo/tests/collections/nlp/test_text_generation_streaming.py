@@ -0,0 +1,97 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from nemo.collections.nlp.modules.common.text_generation_strategy import TextGenerationStrategy
+from nemo.collections.nlp.modules.common.text_generation_streaming import EndStringMatcher, IncrementalDetokenizer
+
+PIECES = ['<eos>', '▁hello', '▁world', 'ly', '▁', '<0xE2>', '<0x82>', '<0xAC>', '!']
+EOS_ID = 0
+
+
+class PieceTokenizer:
+    """SentencePiece-like tokenizer: the leading space of a text is dropped and characters may span byte tokens."""
+
+    eos_id = EOS_ID
+
+    def __init__(self):
+        self.max_decoded_tokens = 0
+
+    def text_to_ids(self, text):
+        # only used to tell that the end strings are not special tokens
+        return [len(PIECES)] * len(text)
+
+    def ids_to_text(self, ids):
+        self.max_decoded_tokens = max(self.max_decoded_tokens, len(ids))
+        data = b''
+        for i in ids:
+            piece = PIECES[i]
+            if piece.startswith('<0x'):
+                data += bytes([int(piece[3:5], 16)])
+            elif i != EOS_ID:
+                data += piece.replace('▁', ' ').encode()
+        text = data.decode('utf-8', errors='replace')
+        return text[1:] if text.startswith(' ') else text
+
+
+class TestIncrementalDetokenizer:
+    @pytest.mark.unit
+    def test_text_of_new_tokens(self):
+        tokenizer = PieceTokenizer()
+        prompt, generated = [1], [2, 3, 4, 5, 6, 7, 8, EOS_ID, 2]
+        detokenizer = IncrementalDetokenizer(tokenizer, prompt)
+        texts = [detokenizer.push([token]) for token in generated]
+        # the space of a token depends on the previous ones, a character is held back until its last byte
+        assert texts == [' world', 'ly', ' ', '', '', '€', '!', '', ' world']
+        assert tokenizer.ids_to_text(prompt) + ''.join(texts) == tokenizer.ids_to_text(prompt + generated)
+
+    @pytest.mark.unit
+    def test_flush_and_decoded_length(self):
+        tokenizer = PieceTokenizer()
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        texts = [detokenizer.push([token]) for token in [1, 3] * 50 + [5, 6]]
+        # only the last tokens are decoded at every step
+        assert tokenizer.max_decoded_tokens <= 4
+        assert ''.join(texts) == tokenizer.ids_to_text([1, 3] * 50)
+        assert detokenizer.flush() == tokenizer.ids_to_text([1, 5, 6])[len('hello') :]
+
+
+class TestEndStringMatcher:
+    @pytest.mark.unit
+    def test_end_strings_across_pieces(self):
+        matcher = EndStringMatcher(['world!', 'ly'])
+        ends = [matcher.push(text) for text in ['hello', ' wor', 'l', 'd!', ' l', 'y', '', ' ']]
+        assert ends == [False, False, False, True, False, True, True, False]
+        assert not EndStringMatcher([]).push('text')
+
+
+class TestEndOfGenerationCondition:
+    @pytest.mark.unit
+    def test_matches_decoding_whole_sequences(self):
+        tokenizer = PieceTokenizer()
+        strategy = TextGenerationStrategy(SimpleNamespace(training=False, tokenizer=tokenizer))
+        end_strings = ['€!']
+        for _ in range(2):
+            # the same strategy is used for another batch after a reset
+            strategy.reset_end_of_generation_condition()
+            tokens = torch.tensor([[1, 2, 3, 4, 5, 6, 7, 8, 2], [1, 3, 5, 6, 7, 8, 3, 5, 2]])
+            for length in range(2, tokens.size(1) + 1):
+                prev = tokens[:, length - 1]
+                is_end = strategy.end_of_generation_condition(tokens[:, :length], prev, EOS_ID, end_strings)
+                expected = [tokenizer.ids_to_text(row).endswith('€!') for row in tokens[:, :length].tolist()]
+                assert is_end.tolist() == expected